@@ -0,0 +1,51 @@
+import threading
+import boto3
+
+##########################################
+# Shared boto3 session and client cache
+##########################################
+# boto3's default session is not thread safe, clients are. Every step
+# asks for its clients here so they are created once under a lock and
+# then shared across worker threads. Offline runs swap the session (or
+# register pre-built stubbed clients) before provisioning starts.
+_lock = threading.Lock()
+_session = None
+_clients = {}
+_account_id = None
+
+
+def session():
+    global _session
+    with _lock:
+        if _session is None:
+            _session = boto3.session.Session()
+        return _session
+
+
+def set_session(new_session):
+    global _session, _account_id
+    with _lock:
+        _session = new_session
+        _account_id = None
+        _clients.clear()
+
+
+def register_client(service, client, region_name=None):
+    with _lock:
+        _clients[(service, region_name)] = client
+
+
+def client(service, region_name=None):
+    key = (service, region_name)
+    sess = session()
+    with _lock:
+        if key not in _clients:
+            _clients[key] = sess.client(service, region_name=region_name)
+        return _clients[key]
+
+
+def account_id():
+    global _account_id
+    if _account_id is None:
+        _account_id = client('sts').get_caller_identity()['Account']
+    return _account_id
@@ -0,0 +1,118 @@
+##########################################
+# Latency profiles for the AWS stand-in
+##########################################
+# A profile says how long each service takes to answer a call and how
+# long the eventually consistent parts of AWS take to settle: an IAM role
+# becoming assumable, a certificate being issued once its validation
+# record exists, a DNS change reaching every name server, a distribution
+# deploying, an invalidation completing, a build running. Times are
+# seconds. scale() shrinks or stretches a whole profile, which keeps the
+# relative costs while making a run short enough for a quick check.
+
+
+class Profile:
+    def __init__(self, name, latency=None, default_latency=0.0, jitter=0.0,
+                 iam_propagation=0.0, acm_record=0.0, acm_validation=0.0,
+                 dns_propagation=0.0, cdn_deploy=0.0, cdn_invalidation=0.0, build_seconds=0.0, scale=1.0):
+        self.name = name
+        self.latency = dict(latency or {})
+        self.default_latency = default_latency
+        # each call takes its latency +/- this fraction of it
+        self.jitter = jitter
+        self.iam_propagation = iam_propagation
+        self.acm_record = acm_record
+        self.acm_validation = acm_validation
+        self.dns_propagation = dns_propagation
+        self.cdn_deploy = cdn_deploy
+        self.cdn_invalidation = cdn_invalidation
+        self.build_seconds = build_seconds
+        self.factor = scale
+
+    def call_latency(self, service, rng):
+        base = self.latency.get(service, self.default_latency) * self.factor
+        if not base or not self.jitter:
+            return base
+        return base * rng.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def delay(self, name):
+        # one of the propagation delays, scaled
+        return getattr(self, name) * self.factor
+
+    def scale(self, factor):
+        scaled = Profile(self.name, self.latency, self.default_latency, self.jitter,
+                         self.iam_propagation, self.acm_record, self.acm_validation,
+                         self.dns_propagation, self.cdn_deploy, self.cdn_invalidation, self.build_seconds,
+                         self.factor * factor)
+        return scaled
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'scale': self.factor,
+            'latency': self.latency,
+            'default_latency': self.default_latency,
+            'jitter': self.jitter,
+            'iam_propagation': self.iam_propagation,
+            'acm_record': self.acm_record,
+            'acm_validation': self.acm_validation,
+            'dns_propagation': self.dns_propagation,
+            'cdn_deploy': self.cdn_deploy,
+            'cdn_invalidation': self.cdn_invalidation,
+            'build_seconds': self.build_seconds
+        }
+
+
+# Service latencies are keyed by botocore's service name, as in
+# session.client(...). The typical figures are what calls from a machine
+# in the same continent as the region usually take; control planes that
+# are global (iam, cloudfront, route53) are the slow ones.
+TYPICAL_LATENCY = {
+    'sts': 0.05,
+    'iam': 0.15,
+    's3': 0.02,
+    'sqs': 0.02,
+    'codecommit': 0.08,
+    'codebuild': 0.08,
+    'lambda': 0.06,
+    'events': 0.05,
+    'logs': 0.04,
+    'route53': 0.12,
+    'acm': 0.08,
+    'cloudfront': 0.25
+}
+
+PROFILES = {
+    # no latency and nothing to wait for: counts calls, times local work
+    'instant': Profile('instant'),
+    'typical': Profile(
+        'typical',
+        latency= TYPICAL_LATENCY,
+        default_latency= 0.05,
+        jitter= 0.2,
+        iam_propagation= 8,
+        acm_record= 3,
+        acm_validation= 20,
+        dns_propagation= 30,
+        cdn_deploy= 600,
+        cdn_invalidation= 30,
+        build_seconds= 2
+    ),
+    # a far away region on a slow link, with AWS having a slow day
+    'slow': Profile(
+        'slow',
+        latency= dict((service, latency * 3) for service, latency in TYPICAL_LATENCY.items()),
+        default_latency= 0.15,
+        jitter= 0.5,
+        iam_propagation= 15,
+        acm_record= 10,
+        acm_validation= 60,
+        dns_propagation= 60,
+        cdn_deploy= 1200,
+        cdn_invalidation= 90,
+        build_seconds= 4
+    )
+}
+
+
+def get(name, scale=1.0):
+    return PROFILES[name].scale(scale)
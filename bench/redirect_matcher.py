@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'deploy_tools'))
+import redirects
+
+##########################################
+# Throughput of the compiled redirect matcher
+##########################################
+# Redirect files of growing size are compiled as a build would, and the
+# same mix of requests (exact paths, paths under a moved section and
+# paths no rule covers) is matched against each: by the index in
+# Python, by the generated CloudFront Function under node when node is
+# installed, its key value store stood in for by an in-memory map, and
+# by a scan of the rules in file order, which is how routing rules are
+# evaluated. The index's cost should not grow with the number of rules,
+# the scan's grows with it. Whatever node answers is checked against
+# the Python index first.
+
+SIZES = (100, 1000, 10000, 50000)
+# share of the lookups that hit an exact rule, a splat rule, nothing
+MIX = (0.6, 0.2, 0.2)
+AGREEMENT_SAMPLE = 5000
+
+# in place of the runtime's cloudfront module
+NODE_STORE = '''
+var fs = require('fs');
+var input = JSON.parse(fs.readFileSync(process.argv[2], 'utf8'));
+var cf = {kvs: function () {
+    return {get: function (key) {
+        return Object.prototype.hasOwnProperty.call(input.entries, key) ?
+            Promise.resolve(input.entries[key]) : Promise.reject(new Error('key not found'));
+    }};
+}};
+'''
+RUNTIME_IMPORT = b"import cf from 'cloudfront';"
+
+NODE_HARNESS = '''
+var events = input.paths.map(function (uri) { return {request: {uri: uri, querystring: {}}}; });
+function answer(result) {
+    return result.statusCode ? [result.statusCode, result.headers.location.value] : null;
+}
+(async function () {
+    var sample = [];
+    for (var i = 0; i < input.sample && i < events.length; i++) { sample.push(answer(await handler(events[i]))); }
+    for (var k = 0; k < events.length; k++) { await handler(events[k]); }
+    var started = process.hrtime.bigint();
+    for (var n = 0; n < input.rounds; n++) {
+        for (var j = 0; j < events.length; j++) { await handler(events[j]); }
+    }
+    var elapsed = Number(process.hrtime.bigint() - started);
+    console.log(JSON.stringify({ns: elapsed / (input.rounds * events.length), sample: sample}));
+})();
+'''
+
+
+def generate(count, seed=0):
+    # moved pages at varied depths, a twentieth of them whole sections
+    rng = random.Random(seed)
+    rules, exact, sections = [], [], []
+    for n in range(count):
+        depth = rng.randint(1, 4)
+        parts = ['s%d' % rng.randrange(50)] + ['p%d' % rng.randrange(1000) for _ in range(depth)] + ['n%d' % n]
+        if n % 20 == 0:
+            # a section of its own, so no two rules cover the same path
+            source = '/'+'/'.join(['section%d' % n] + parts[1:depth])+'/*'
+            rules.append(redirects.Rule(source, '/moved/%d/:splat' % n, 302))
+            sections.append(source[:-1])
+        else:
+            source = '/'+'/'.join(parts)
+            rules.append(redirects.Rule(source, '/pages/%d' % n))
+            exact.append(source)
+    return rules, exact, sections
+
+
+def lookups(exact, sections, total, seed=1):
+    rng = random.Random(seed)
+    paths = []
+    for _ in range(total):
+        pick = rng.random()
+        if pick < MIX[0]:
+            paths.append(rng.choice(exact) + rng.choice(('', '/')))
+        elif pick < MIX[0] + MIX[1] and sections:
+            paths.append(rng.choice(sections) + 'x%d/y%d' % (rng.randrange(100), rng.randrange(100)))
+        else:
+            paths.append('/unmatched/p%d/q%d' % (rng.randrange(10000), rng.randrange(10000)))
+    return paths
+
+
+def scan(rules, path):
+    # the first rule in file order that covers path
+    path = redirects.normalize(path)
+    for rule in rules:
+        if rule.splat:
+            prefix = rule.source[:-2]
+            if path == prefix or path.startswith(prefix+'/'):
+                return rule.status, rule.target.replace(':splat', path[len(prefix)+1:])
+        elif redirects.normalize(rule.source) == path:
+            return rule.status, rule.target
+    return None
+
+
+def timed(match, paths):
+    # nanoseconds per lookup, and the answers
+    for path in paths[:100]:
+        match(path)
+    started = time.perf_counter()
+    answers = [match(path) for path in paths]
+    return (time.perf_counter() - started) * 1e9 / len(paths), answers
+
+
+def node_run(node, entries, code, paths, rounds):
+    with tempfile.TemporaryDirectory() as work_dir:
+        script = os.path.join(work_dir, 'matcher.js')
+        with open(script, 'wb') as script_file:
+            script_file.write(NODE_STORE.encode('utf-8') + code.replace(RUNTIME_IMPORT, b'')
+                              + NODE_HARNESS.encode('utf-8'))
+        data = os.path.join(work_dir, 'input.json')
+        with open(data, 'w') as data_file:
+            json.dump({'entries': entries, 'paths': paths, 'rounds': rounds, 'sample': AGREEMENT_SAMPLE},
+                      data_file)
+        child = subprocess.run([node, script, data], check=True, stdout=subprocess.PIPE, universal_newlines=True)
+    return json.loads(child.stdout)
+
+
+def measure(count, total, scanned, node):
+    rules, exact, sections = generate(count)
+    paths = lookups(exact, sections, total)
+    started = time.perf_counter()
+    index = redirects.Index(rules)
+    entries = redirects.store_entries(index)
+    code = redirects.function_code(entries, 'bench')
+    compile_ms = (time.perf_counter() - started) * 1000
+    index_ns, expected = timed(index.match, paths)
+    scan_ns, scanned_answers = timed(lambda path: scan(rules, path), paths[:scanned])
+    # rules here never overlap, so the first match is the best match
+    if scanned_answers != expected[:scanned]:
+        raise AssertionError('scan and index disagree for %d rules' % count)
+    result = {
+        'rules': count,
+        'compile_ms': compile_ms,
+        'store_bytes': redirects.store_size(entries),
+        'index_ns': index_ns,
+        'scan_ns': scan_ns
+    }
+    if node:
+        answered = node_run(node, entries, code, paths, rounds=5)
+        if [tuple(item) if item else None for item in answered['sample']] != expected[:AGREEMENT_SAMPLE]:
+            raise AssertionError('the generated function and the index disagree for %d rules' % count)
+        result['function_ns'] = answered['ns']
+    return result
+
+
+def report(results):
+    lines = ['%8s %10s %11s %12s %12s %12s' % (
+        'rules', 'store', 'compile', 'index', 'function', 'scan')]
+    for result in results:
+        function = '%9.0fns' % result['function_ns'] if 'function_ns' in result else 'no node'
+        lines.append('%8d %9.1fK %9.1fms %10.0fns %12s %10.0fns' % (
+            result['rules'], result['store_bytes'] / 1024.0,
+            result['compile_ms'], result['index_ns'], function, result['scan_ns']))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure lookups per rule count of the compiled redirect matcher.')
+    parser.add_argument('sizes', nargs='*', type=int, metavar='RULES',
+                        help='rule counts to measure (default: %s)' % ', '.join(map(str, SIZES)))
+    parser.add_argument('--lookups', type=int, default=200000, help='requests matched per rule count')
+    parser.add_argument('--scanned', type=int, default=1000, help='of those, matched by scanning the rules')
+    parser.add_argument('--node', default=shutil.which('node'), help='node binary for the generated function')
+    parser.add_argument('--json', metavar='FILE', help='save the results to FILE')
+    args = parser.parse_args(argv)
+    results = [measure(count, args.lookups, args.scanned, args.node) for count in args.sizes or SIZES]
+    print(report(results))
+    if args.json:
+        with open(args.json, 'w') as results_file:
+            json.dump(results, results_file, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import platform
+import contextlib
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+for path in (HERE, os.path.join(ROOT, 'deploy_tools'), ROOT):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+# nothing may reach a real account, whatever the environment says
+os.environ.update({
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'AWS_ACCESS_KEY_ID': 'bench',
+    'AWS_SECRET_ACCESS_KEY': 'bench',
+    'AWS_CONFIG_FILE': os.devnull,
+    'AWS_SHARED_CREDENTIALS_FILE': os.devnull
+})
+os.environ.pop('AWS_PROFILE', None)
+os.environ.pop('AWS_SESSION_TOKEN', None)
+os.chdir(ROOT)
+
+import profiles
+from standin import StandIn
+from scenarios import SCENARIOS, Environment
+
+##########################################
+# Offline benchmarks of the whole pipeline
+##########################################
+# Runs setup.py's provisioning, the generated site's sync and the three
+# lambda functions against the in-process AWS stand-in, under a latency
+# profile, and reports for each scenario its wall time, the AWS calls
+# made (by operation, and whether setup or the functions made them) and
+# the function invocations. --json saves the results; --compare checks a
+# run against saved results and fails when calls, invocations or wall
+# time grew past the tolerances. Polls and retries follow the profile's
+# delays, so only runs of the same profile, scale and options compare.
+
+
+def run_scenario(name, standin, profile, options):
+    standin.reset(profiles.get('instant'), options.seed)
+    env = Environment(standin, profile, options)
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = SCENARIOS[name](env)
+    waits = env.waits or []
+    return dict(env.counters, **{
+        'wall_time': env.wall_time,
+        'waits': {
+            'count': len(waits),
+            'elapsed': sum(wait['elapsed'] for wait in waits),
+            'timed_out': len([wait for wait in waits if not wait['ready']])
+        },
+        'results': results
+    })
+
+
+def failed_checks(result):
+    return [check for check, ok in result['results'].get('checks', {}).items() if not ok]
+
+
+def grew(current, baseline, tolerance):
+    # more than the tolerance above the baseline, with one to spare for
+    # counts that depend on timing (readiness polls)
+    return current > baseline * (1 + tolerance) + 1
+
+
+def run_conditions(results):
+    return results['profile']['name'], results['profile']['scale'], results['options']
+
+
+def incomparable(results, baseline):
+    # why the baseline can't be compared with a run, None if it can
+    profile, scale, options = run_conditions(results)
+    saved_profile, saved_scale, saved_options = run_conditions(baseline)
+    if (profile, scale) != (saved_profile, saved_scale):
+        return 'recorded with --profile %s --scale %g, not --profile %s --scale %g' % (
+            saved_profile, saved_scale, profile, scale)
+    changed = sorted(name for name in set(options) | set(saved_options)
+                     if options.get(name) != saved_options.get(name))
+    if changed:
+        return 'recorded with other %s: %s' % ('option' if len(changed) == 1 else 'options', ', '.join(
+            '--%s %s' % (name.replace('_', '-'), saved_options.get(name)) for name in changed))
+    return None
+
+
+def compare(results, baseline, tolerance, call_tolerance):
+    regressions = []
+    for name, result in results['scenarios'].items():
+        before = baseline['scenarios'].get(name)
+        if before is None:
+            continue
+        if grew(result['calls'], before['calls'], call_tolerance):
+            operations = ['%s %d -> %d' % (operation, before['calls_by_operation'].get(operation, 0), count)
+                          for operation, count in sorted(result['calls_by_operation'].items())
+                          if grew(count, before['calls_by_operation'].get(operation, 0), call_tolerance)]
+            regressions.append('%s: %d aws calls, was %d (%s)' % (
+                name, result['calls'], before['calls'], ', '.join(operations)))
+        for function, count in sorted(result['invocations'].items()):
+            if grew(count, before['invocations'].get(function, 0), call_tolerance):
+                regressions.append('%s: %d invocations of %s, was %d' % (
+                    name, count, function, before['invocations'].get(function, 0)))
+        if result['wall_time'] > before['wall_time'] * (1 + tolerance):
+            regressions.append('%s: %.2fs, was %.2fs' % (name, result['wall_time'], before['wall_time']))
+    return regressions
+
+
+def report(results):
+    lines = ['%-28s %9s %8s %8s %12s %8s  %s' % (
+        'scenario', 'wall time', 'calls', 'setup', 'invocations', 'waits', 'checks')]
+    for name, result in results['scenarios'].items():
+        failed = failed_checks(result)
+        lines.append('%-28s %8.2fs %8d %8d %12d %7.1fs  %s' % (
+            name, result['wall_time'], result['calls'], result['calls_by_origin'].get('setup', 0),
+            sum(result['invocations'].values()), result['waits']['elapsed'],
+            'failed: '+', '.join(failed) if failed else 'ok'))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline against a local AWS stand-in.')
+    parser.add_argument('scenarios', nargs='*', metavar='SCENARIO',
+                        help='scenarios to run (default: all of %s)' % ', '.join(SCENARIOS))
+    parser.add_argument('--profile', default='typical', choices=sorted(profiles.PROFILES),
+                        help='latency profile of the stand-in')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiply every latency and delay of the profile, eg: 0.1 for a quick run')
+    parser.add_argument('--sites', type=int, default=8, help='sites set up at once in shared_zone_setup')
+    parser.add_argument('--files', type=int, default=10000, help='files in the generated site')
+    parser.add_argument('--render-seconds', type=float, default=5.0,
+                        help='time the stand-in generator takes to render the site')
+    parser.add_argument('--pushes', type=int, default=50, help='pushes in the rapid push scenarios')
+    parser.add_argument('--streams', type=int, default=400, help='log streams per log group')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the latency jitter')
+    parser.add_argument('--json', metavar='FILE', help='save the results to FILE')
+    parser.add_argument('--compare', metavar='FILE', help='fail on regressions against results saved in FILE')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='wall time allowed above the saved results, as a fraction')
+    parser.add_argument('--call-tolerance', type=float, default=0.1,
+                        help='calls and invocations allowed above the saved results, as a fraction')
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error('unknown scenario: '+', '.join(unknown))
+    profile = profiles.get(args.profile, args.scale)
+    standin = StandIn(profile)
+    results = {
+        'profile': profile.as_dict(),
+        'options': {'sites': args.sites, 'files': args.files, 'render_seconds': args.render_seconds,
+                    'pushes': args.pushes, 'streams': args.streams, 'seed': args.seed},
+        'python': platform.python_version(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'scenarios': {}
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        # refused before running anything, the comparison would be noise
+        reason = incomparable(results, baseline)
+        if reason:
+            parser.error(args.compare+' was '+reason)
+    for name in args.scenarios or list(SCENARIOS):
+        print('Running '+name+'...', file=sys.stderr)
+        results['scenarios'][name] = run_scenario(name, standin, profile, args)
+    print(report(results))
+    if args.json:
+        with open(args.json, 'w') as results_file:
+            json.dump(results, results_file, indent=2, sort_keys=True)
+    status = 0
+    if any(failed_checks(result) for result in results['scenarios'].values()):
+        status = 1
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance, args.call_tolerance)
+        print()
+        if regressions:
+            print('Regressions against '+args.compare+':')
+            for regression in regressions:
+                print('  '+regression)
+            status = 1
+        else:
+            print('No regressions against '+args.compare+'.')
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,662 @@
+import os
+import sys
+import time
+import types
+import random
+import shutil
+import tempfile
+import subprocess
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from botocore.config import Config
+import aws
+import destroy
+import dns
+import inventory
+import readiness
+import settings
+import setup
+import sync
+import releases
+import redirects
+from multisite import defaults_from
+import profiles
+
+##########################################
+# Benchmark scenarios
+##########################################
+# Each scenario gets the stand-in reset to an empty account, prepares
+# whatever it needs (a provisioned site, a generated site tree, seeded
+# log groups) with the instant profile, and then runs the part being
+# measured inside env.measure(), under the profile chosen for the run.
+# It returns its own results, with a 'checks' dict of things that must
+# hold for the run to count (the newest commit got deployed...).
+
+SITE = {
+    'region': 'us-east-1',
+    'proj_name': 'bench',
+    'proj_desc': 'benchmark site',
+    'dns_domain': 'example.com',
+    'website_fqdn': 'www.example.com'
+}
+
+
+class Environment:
+    def __init__(self, standin, profile, options):
+        self.standin = standin
+        self.profile = profile
+        self.options = options
+        self.wall_time = None
+        self.counters = None
+        self.waits = None
+
+    @contextlib.contextmanager
+    def measure(self):
+        self.standin.reset_counters(self.profile)
+        readiness.metrics = readiness.Metrics()
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.wall_time = time.monotonic() - started
+            self.counters = self.standin.summary()
+            self.waits = readiness.metrics.as_dict()
+            self.standin.profile = profiles.get('instant')
+
+
+def site_settings(**overrides):
+    return types.SimpleNamespace(**dict(defaults_from(settings), **dict(SITE, **overrides)))
+
+
+def connect(standin):
+    # a fresh session and inventory, as a new run of setup.py would have
+    session = boto3.session.Session(region_name=SITE['region'], aws_access_key_id='bench',
+                                    aws_secret_access_key='bench')
+    standin.install(session)
+    aws.set_session(session)
+    inventory.account = inventory.Account()
+    with inventory._inventories_lock:
+        inventory._inventories.clear()
+    dns.batcher = dns.Batcher()
+    return session
+
+
+def seed_account(standin):
+    standin.add_hosted_zone(SITE['dns_domain'])
+    # another customer's zone that sorts next to ours
+    standin.add_hosted_zone('example.net')
+
+
+def provision(var, workers=8):
+    plan = setup.graph.plan(var, {}, workers=workers, log=lambda msg: None)
+    out, timings = setup.graph.apply(var, plan, workers=workers, log=lambda msg: None)
+    return plan, out, timings
+
+
+def provisioned(env, **overrides):
+    # an account with the site already set up, not measured
+    seed_account(env.standin)
+    var = site_settings(**overrides)
+    connect(env.standin)
+    _, out, _ = provision(var)
+    connect(env.standin)
+    # the metrics function polls on the stand-in's clock rather than the
+    # real invalidation window
+    metrics = env.standin.host.module('pipeline_metrics')
+    metrics.INVALIDATION_WINDOW = metrics.GRACE_SECONDS = 0
+    metrics.POLL_SECONDS = max(env.profile.delay('cdn_invalidation') / 10, 0.01)
+    return var, out
+
+
+##########################################
+# Provisioning
+##########################################
+def fresh_setup(env):
+    seed_account(env.standin)
+    var = site_settings()
+    connect(env.standin)
+    # zips are built once per checkout, not per run
+    for name in setup.packages.names:
+        setup.packages.get(name)
+    with env.measure():
+        plan, out, timings = provision(var)
+    return {
+        'steps_applied': len(plan.changes()),
+        'apply_wall_time': timings.wall_time(),
+        'critical_path': timings.critical_path(),
+        'checks': {
+            'every step applied': len(timings.stopped) == len(setup.graph.steps),
+            'certificate issued': out.get('cert_arn') in env.standin.certificates
+        }
+    }
+
+
+def existing_certificate_setup(env):
+    # the account already has a wildcard certificate for the domain
+    seed_account(env.standin)
+    wildcard = env.standin.add_certificate(['*.'+SITE['dns_domain'], SITE['dns_domain']])
+    var = site_settings()
+    connect(env.standin)
+    for name in setup.packages.names:
+        setup.packages.get(name)
+    with env.measure():
+        plan, out, timings = provision(var)
+    return {
+        'steps_applied': len(plan.changes()),
+        'apply_wall_time': timings.wall_time(),
+        'checks': {
+            'certificate reused': out.get('cert_arn') == wildcard and len(env.standin.certificates) == 1
+        }
+    }
+
+
+def rerun_setup(env):
+    var, _ = provisioned(env)
+    with env.measure():
+        plan = setup.graph.plan(var, {}, workers=8, log=lambda msg: None)
+    changes = plan.changes()
+    return {
+        'changes': changes,
+        'checks': {
+            # the cdn may still be deploying, nothing else may differ
+            'nothing to change': not [name for name in changes if name != 'cdn_deployed']
+        }
+    }
+
+
+def shared_zone_setup(env):
+    # several sites of one domain set up at once, as multisite.py would:
+    # their dns changes share route53 calls and change polls
+    seed_account(env.standin)
+    sites = [site_settings(proj_name='bench-%d' % n, website_fqdn='site-%d.example.com' % n)
+             for n in range(env.options.sites)]
+    connect(env.standin)
+    for name in setup.packages.names:
+        setup.packages.get(name)
+    with env.measure():
+        with ThreadPoolExecutor(max_workers=len(sites)) as executor:
+            outs = [out for _, out, _ in executor.map(lambda var: provision(var, workers=4), sites)]
+    batched = dns.batcher.as_dict()
+    return dict(batched, **{
+        'sites': len(sites),
+        'checks': {
+            'every certificate issued': all(out.get('cert_arn') in env.standin.certificates for out in outs),
+            'every site aliased': all(env.standin._record_in_sync(var.website_fqdn, 'A') for var in sites)
+        }
+    })
+
+
+##########################################
+# Deploying the generated site
+##########################################
+def generate_site(site_dir, files, seed=0):
+    # html pages in nested sections plus stylesheets, scripts and images,
+    # a few KB each
+    rng = random.Random(seed)
+    words = ['static', 'site', 'bucket', 'cdn', 'build', 'deploy', 'cache', 'edge', 'origin', 'page']
+    kinds = (['html'] * 7) + ['css', 'js', 'png']
+    for n in range(files):
+        kind = kinds[n % len(kinds)]
+        section = 'section-%02d/part-%02d' % (n % 40, (n // 40) % 25)
+        if kind == 'html':
+            path = os.path.join(site_dir, section, 'page-%05d' % n, 'index.html')
+            body = ('<html><body>'+' '.join(rng.choice(words) for _ in range(rng.randint(300, 900)))
+                    + '</body></html>').encode('utf-8')
+        elif kind == 'png':
+            path = os.path.join(site_dir, 'images', section, 'image-%05d.png' % n)
+            body = bytes(rng.getrandbits(8) for _ in range(rng.randint(2000, 6000)))
+        else:
+            path = os.path.join(site_dir, 'assets', section, 'asset-%05d.%s' % (n, kind))
+            body = ('/* %d */ ' % n + ' '.join(rng.choice(words) for _ in range(rng.randint(200, 600)))).encode('utf-8')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as out_file:
+            out_file.write(body)
+
+
+def edit_site(site_dir, changed, added, removed, seed=1):
+    rng = random.Random(seed)
+    paths = sorted(os.path.join(root, name) for root, _, names in os.walk(site_dir) for name in names)
+    rng.shuffle(paths)
+    for path in paths[:changed]:
+        with open(path, 'ab') as out_file:
+            out_file.write(b'<!-- edited -->')
+    for path in paths[changed:changed + removed]:
+        os.remove(path)
+    for n in range(added):
+        path = os.path.join(site_dir, 'posts', 'new-%03d' % n, 'index.html')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as out_file:
+            out_file.write(b'<html><body>new post %d</body></html>' % n)
+
+
+def publish(env, var, site_dir, manifest_path):
+    # what the build does: sync the output, then the invalidation
+    # function drains what S3 reported to its queue
+    s3 = aws.session().client('s3', config=Config(max_pool_connections=20))
+    changed, removed = sync.sync(site_dir, var.website_fqdn, concurrency=10, manifest_path=manifest_path,
+                                 s3=s3, log=lambda msg: None)
+    env.standin.drain_queues()
+    env.standin.deliver()
+    return changed, removed
+
+
+def invalidation_results(env):
+    batches = [invalidation['InvalidationBatch'] for invalidation in env.standin.invalidations]
+    return {
+        'invalidations': len(batches),
+        'invalidated_paths': sum(batch['Paths']['Quantity'] for batch in batches)
+    }
+
+
+def deploy_site(env):
+    var, _ = provisioned(env, deploy_mode= 'inplace')
+    work_dir = tempfile.mkdtemp(prefix='bench-site-')
+    try:
+        site_dir = os.path.join(work_dir, 'public')
+        generate_site(site_dir, env.options.files)
+        with env.measure():
+            changed, removed = publish(env, var, site_dir, os.path.join(work_dir, 'manifest.json'))
+    finally:
+        shutil.rmtree(work_dir)
+    stored = env.standin.buckets[var.website_fqdn]['objects']
+    return dict(invalidation_results(env), **{
+        'files': env.options.files,
+        'uploaded': len(changed),
+        'checks': {
+            'every file stored': len(stored) == env.options.files,
+            'cdn invalidated': bool(env.standin.invalidations)
+        }
+    })
+
+
+def redeploy_site(env):
+    # a typical content change on top of the full site
+    var, _ = provisioned(env, deploy_mode= 'inplace')
+    work_dir = tempfile.mkdtemp(prefix='bench-site-')
+    try:
+        site_dir = os.path.join(work_dir, 'public')
+        manifest_path = os.path.join(work_dir, 'manifest.json')
+        generate_site(site_dir, env.options.files)
+        publish(env, var, site_dir, manifest_path)
+        del env.standin.invalidations[:]
+        edit = max(1, env.options.files // 100)
+        edit_site(site_dir, changed=edit, added=10, removed=10)
+        with env.measure():
+            changed, removed = publish(env, var, site_dir, manifest_path)
+    finally:
+        shutil.rmtree(work_dir)
+    return dict(invalidation_results(env), **{
+        'uploaded': len(changed),
+        'deleted': len(removed),
+        'checks': {
+            'only the edit uploaded': len(changed) == edit + 10 and len(removed) == 10,
+            'cdn invalidated': bool(env.standin.invalidations)
+        }
+    })
+
+
+# A stand-in generator: copies a generated tree into the output
+# directory a chunk at a time, spread over the render time, the way a
+# generator writes pages as it renders them.
+RENDER = '''
+import os, sys, time, shutil
+source, output, seconds = sys.argv[1], sys.argv[2], float(sys.argv[3])
+paths = sorted(os.path.relpath(os.path.join(root, name), source)
+               for root, _, names in os.walk(source) for name in names)
+chunks = [paths[i:i + 100] for i in range(0, len(paths), 100)]
+for chunk in chunks:
+    for rel in chunk:
+        os.makedirs(os.path.dirname(os.path.join(output, rel)), exist_ok=True)
+        shutil.copyfile(os.path.join(source, rel), os.path.join(output, rel))
+    time.sleep(seconds / len(chunks))
+'''
+
+
+def render_command(source_dir, site_dir, seconds):
+    return [sys.executable, '-c', RENDER, source_dir, site_dir, str(seconds)]
+
+
+def render_and_sync(streamed):
+    # the build's render and deploy of the full site as a release, one
+    # after the other or with the sync streaming while the generator renders
+    def scenario(env):
+        var, out = provisioned(env, deploy_mode= 'release')
+        work_dir = tempfile.mkdtemp(prefix='bench-site-')
+        try:
+            source_dir = os.path.join(work_dir, 'source')
+            site_dir = os.path.join(work_dir, 'public')
+            manifest_path = os.path.join(work_dir, 'manifest.json')
+            generate_site(source_dir, env.options.files)
+            command = render_command(source_dir, site_dir, env.options.render_seconds)
+            with env.measure():
+                if not streamed:
+                    subprocess.run(command, check=True)
+                changed, _ = deploy_release(env, var, site_dir, manifest_path, 'release-0',
+                                            command=command if streamed else None)
+        finally:
+            shutil.rmtree(work_dir)
+        stored = env.standin.buckets[var.website_fqdn]['objects']
+        dist = env.standin.distributions[out['cdn_dist_id']]['config']
+        return dict(invalidation_results(env), **{
+            'files': env.options.files,
+            'uploaded': len(changed),
+            'checks': {
+                'every file in the release': len([key for key in stored
+                                                  if key.startswith(sync.release_prefix('release-0'))])
+                    == env.options.files,
+                'cdn switched to the release': sync.origin_release(dist) == 'release-0',
+                'cdn invalidated': bool(env.standin.invalidations)
+            }
+        })
+    return scenario
+
+
+def deploy_release(env, var, site_dir, manifest_path, release_id, keep=5, redirect_entries=None, command=None):
+    # what a release build does: upload the release (streamed while command
+    # renders, if given), switch the cdn to it without waiting for the
+    # deploy, send the changed paths to the queue
+    session = aws.session()
+    s3 = session.client('s3', config=Config(max_pool_connections=20))
+    cloudfront = session.client('cloudfront')
+    _, changed, removed, _ = sync.deploy_release(site_dir, var.website_fqdn, release_id, command=command,
+                                                 switch=True, keep=keep, wait=False, manifest_path=manifest_path,
+                                                 s3=s3, cloudfront=cloudfront, log=lambda msg: None,
+                                                 redirect_entries=redirect_entries,
+                                                 kvs=session.client('cloudfront-keyvaluestore'))
+    sqs = session.client('sqs')
+    queue_url = sqs.get_queue_url(QueueName= var.proj_name+'-cdn-invalidation')['QueueUrl']
+    if changed or removed:
+        sync.notify(queue_url, changed + removed, sqs=sqs)
+    env.standin.drain_queues()
+    env.standin.deliver()
+    return changed, removed
+
+
+def release_deploy(env):
+    # an edit deployed as a third release, pruning down to the newest one
+    # and the one it replaces
+    var, out = provisioned(env, deploy_mode= 'release')
+    work_dir = tempfile.mkdtemp(prefix='bench-site-')
+    files = max(10, env.options.files // 10)
+    try:
+        site_dir = os.path.join(work_dir, 'public')
+        manifest_path = os.path.join(work_dir, 'manifest.json')
+        generate_site(site_dir, files)
+        deploy_release(env, var, site_dir, manifest_path, 'release-0')
+        edit_site(site_dir, changed=2, added=0, removed=0, seed=2)
+        deploy_release(env, var, site_dir, manifest_path, 'release-1')
+        del env.standin.invalidations[:]
+        edit = max(1, files // 100)
+        edit_site(site_dir, changed=edit, added=10, removed=10)
+        with env.measure():
+            changed, removed = deploy_release(env, var, site_dir, manifest_path, 'release-2', keep=1)
+    finally:
+        shutil.rmtree(work_dir)
+    stored = env.standin.buckets[var.website_fqdn]['objects']
+    kept = sorted(set(key.split('/')[1] for key in stored if key.startswith(sync.RELEASES)))
+    dist = env.standin.distributions[out['cdn_dist_id']]['config']
+    return dict(invalidation_results(env), **{
+        'uploaded': len(changed),
+        'releases_kept': len(kept),
+        'checks': {
+            'only the edit uploaded': len(changed) == edit + 10 and len(removed) == 10,
+            'cdn serves the new release': sync.origin_release(dist) == 'release-2',
+            'replaced release kept, older pruned': kept == ['release-1', 'release-2'],
+            'cdn invalidated': bool(env.standin.invalidations)
+        }
+    })
+
+
+def release_rollback(env):
+    # back to the previous release: a switch of the origin path and one
+    # invalidation, nothing uploaded
+    var, out = provisioned(env, deploy_mode= 'release')
+    work_dir = tempfile.mkdtemp(prefix='bench-site-')
+    try:
+        site_dir = os.path.join(work_dir, 'public')
+        manifest_path = os.path.join(work_dir, 'manifest.json')
+        generate_site(site_dir, max(10, env.options.files // 10))
+        deploy_release(env, var, site_dir, manifest_path, 'release-0')
+        edit_site(site_dir, changed=10, added=10, removed=10)
+        deploy_release(env, var, site_dir, manifest_path, 'release-1')
+        del env.standin.invalidations[:]
+        session = aws.session()
+        s3, cloudfront = session.client('s3'), session.client('cloudfront')
+        with env.measure():
+            live = sync.live_release(cloudfront, out['cdn_dist_id'])
+            target = releases.previous_release(sync.list_releases(s3, var.website_fqdn), live)
+            releases.switch(cloudfront, out['cdn_dist_id'], target, wait=False)
+    finally:
+        shutil.rmtree(work_dir)
+    dist = env.standin.distributions[out['cdn_dist_id']]['config']
+    return dict(invalidation_results(env), **{
+        'checks': {
+            'cdn serves the previous release': sync.origin_release(dist) == 'release-0',
+            'nothing uploaded': not set(env.counters['calls_by_operation']) & {'s3.PutObject', 's3.CopyObject'},
+            'cdn invalidated': bool(env.standin.invalidations)
+        }
+    })
+
+
+def redirect_rules(count, seed=0):
+    # a redirects file of moved pages, with a few whole sections moved
+    rng = random.Random(seed)
+    lines = ['/section-%02d/* /archive/section-%02d/:splat 302' % (n, n) for n in range(count // 20)]
+    for n in range(count - len(lines)):
+        lines.append('/old/%d/page-%05d /section-%02d/page-%05d' % (seed, n, rng.randrange(40), rng.randrange(100000)))
+    return redirects.parse('\n'.join(lines))
+
+
+def live_redirects(env, var):
+    # the rules in the store and the code the function runs
+    store = env.standin.kv_stores[setup.redirects_store_name(var)]
+    function = env.standin.cdn_functions[setup.redirects_function_name(var)]
+    return dict(store['items']), function['live']
+
+
+def compiled_redirects(env, var, entries):
+    store = env.standin.kv_stores[setup.redirects_store_name(var)]
+    return entries, redirects.function_code(entries, store['Id'])
+
+
+def release_redirects(env):
+    # each release deployed with its own redirects, then a rollback that
+    # brings back the redirects of the release it goes back to, and a
+    # switch to a release without any
+    var, out = provisioned(env, deploy_mode= 'release', redirects_file= '_redirects')
+    first = redirects.store_entries(redirects.Index(redirect_rules(120, seed=0)))
+    second = redirects.store_entries(redirects.Index(redirect_rules(120, seed=1)))
+    work_dir = tempfile.mkdtemp(prefix='bench-site-')
+    try:
+        site_dir = os.path.join(work_dir, 'public')
+        manifest_path = os.path.join(work_dir, 'manifest.json')
+        generate_site(site_dir, max(10, env.options.files // 10))
+        deploy_release(env, var, site_dir, manifest_path, 'release-0', redirect_entries=first)
+        edit_site(site_dir, changed=10, added=0, removed=0)
+        session = aws.session()
+        s3, cloudfront = session.client('s3'), session.client('cloudfront')
+        kvs = session.client('cloudfront-keyvaluestore')
+        with env.measure():
+            deploy_release(env, var, site_dir, manifest_path, 'release-1', redirect_entries=second)
+            published = live_redirects(env, var)
+            releases.switch(cloudfront, out['cdn_dist_id'], 'release-0', wait=False, s3=s3, bucket=var.website_fqdn,
+                            kvs=kvs)
+        restored = live_redirects(env, var)
+        # and one deployed before the site had redirects
+        deploy_release(env, var, site_dir, manifest_path, 'release-2')
+        releases.switch(cloudfront, out['cdn_dist_id'], 'release-2', wait=False, s3=s3, bucket=var.website_fqdn,
+                        kvs=kvs)
+    finally:
+        shutil.rmtree(work_dir)
+    dist = env.standin.distributions[out['cdn_dist_id']]['config']
+    errors = dict((item['ErrorCode'], item) for item in dist['CustomErrorResponses']['Items'])
+    return {
+        'store_bytes': redirects.store_size(second),
+        'checks': {
+            'cdn runs the redirects function': redirects.associated_function(dist) == setup.redirects_function_name(var),
+            'new release published its redirects': published == compiled_redirects(env, var, second),
+            'rollback restored the previous redirects': restored == compiled_redirects(env, var, first),
+            'a release without redirects has none live': live_redirects(env, var) == compiled_redirects(env, var, {}),
+            'missing pages get the error page': errors[404].get('ResponsePagePath') == '/404.html'
+                and errors[403].get('ResponseCode') == '404'
+        }
+    }
+
+
+##########################################
+# Pushes and builds
+##########################################
+def rapid_pushes(mode):
+    def scenario(env):
+        var, _ = provisioned(env, build_concurrency= mode)
+        standin = env.standin
+        # the module keeps the mode it was first loaded with
+        standin.host.module('build_trigger').MODE = mode
+        commits = ['%040x' % random.Random(n).getrandbits(160) for n in range(env.options.pushes)]
+        with env.measure():
+            interval = env.profile.delay('build_seconds') / 10
+            for commit in commits:
+                standin.push(var.proj_name, 'master', commit)
+                standin.deliver()
+                standin.advance()
+                standin.deliver()
+                time.sleep(interval)
+            while standin.builds_running() or standin.pending:
+                standin.advance()
+                standin.deliver()
+                time.sleep(0.01)
+        builds = list(standin.builds.values())
+        succeeded = [build for build in builds if build['buildStatus'] == 'SUCCEEDED']
+        last = max(succeeded, key=lambda build: build['endTime']) if succeeded else None
+        return {
+            'pushes': len(commits),
+            'builds_started': len(builds),
+            'builds_stopped': len([build for build in builds if build['buildStatus'] == 'STOPPED']),
+            'builds_succeeded': len(succeeded),
+            'checks': {
+                'newest commit deployed': last is not None and last['sourceVersion'] == commits[-1]
+            }
+        }
+    return scenario
+
+
+def push_to_live(env):
+    # one push followed through the build, the sync and the invalidation
+    # to the metrics function's record of it
+    var, _ = provisioned(env, deploy_mode= 'inplace')
+    standin = env.standin
+    work_dir = tempfile.mkdtemp(prefix='bench-site-')
+    try:
+        site_dir = os.path.join(work_dir, 'public')
+        generate_site(site_dir, max(1, env.options.files // 100))
+        with env.measure():
+            standin.push(var.proj_name, 'master', '%040x' % random.Random(0).getrandbits(160))
+            standin.deliver()
+            # the build renders, then syncs while in its BUILD phase
+            early = ('SUBMITTED', 'QUEUED', 'PROVISIONING', 'DOWNLOAD_SOURCE', 'INSTALL')
+            while any(phase in early for phase in standin.builds_running().values()):
+                time.sleep(0.01)
+            publish(env, var, site_dir, os.path.join(work_dir, 'manifest.json'))
+            while standin.builds_running():
+                standin.advance()
+                time.sleep(0.01)
+            records = [result for result in standin.deliver() if '_aws' in (result or {})]
+    finally:
+        shutil.rmtree(work_dir)
+    record = records[0] if records else {}
+    stages = ('Trigger', 'Queue', 'Source', 'Build', 'Invalidation', 'Propagation', 'PushToLive')
+    return {
+        'stages': dict((name, record.get(name)) for name in stages),
+        'slowest_stage': record.get('slowest_stage'),
+        'checks': {
+            'one record per build': len(records) == 1,
+            'every stage measured': all(record.get(name) is not None for name in stages),
+            'pushed build has no BuildToLive': 'BuildToLive' not in record,
+            'metrics declared': [metric['Name'] for metric in record.get('_aws', {}).get(
+                'CloudWatchMetrics', [{}])[0].get('Metrics', [])] == [
+                name for name in stages + ('BuildToLive',) if name in record]
+        }
+    }
+
+
+##########################################
+# Log cleanup
+##########################################
+def log_cleanup(env):
+    var, out = provisioned(env)
+    groups = [
+        '/aws/codebuild/'+var.proj_name,
+        '/aws/lambda/'+out['trigger_function_name'],
+        '/aws/lambda/'+out['invalidate_cdn_function_name'],
+        '/aws/lambda/'+var.proj_name+'-log-cleanup'
+    ]
+    streams = env.options.streams
+    expired = streams * 3 // 4
+    for name in groups:
+        env.standin.add_log_group(name, streams=streams, expired=expired)
+    with env.measure():
+        report = env.standin.host.invoke(var.proj_name+'-log-cleanup', {})
+    return {
+        'streams_deleted': report['streams_deleted'],
+        'bytes_reclaimed': report['bytes_reclaimed'],
+        'checks': {
+            'expired streams deleted': report['streams_deleted'] == expired * len(groups) and report['complete']
+        }
+    }
+
+
+##########################################
+# Teardown
+##########################################
+def teardown(env):
+    # a provisioned site with its build cache bucket and a deployed
+    # release, then destroy.py
+    var, _ = provisioned(env, build_cache= 's3', deploy_mode= 'release', redirects_file= '_redirects')
+    work_dir = tempfile.mkdtemp(prefix='bench-site-')
+    try:
+        site_dir = os.path.join(work_dir, 'public')
+        generate_site(site_dir, env.options.files)
+        deploy_release(env, var, site_dir, os.path.join(work_dir, 'manifest.json'), 'release-0')
+    finally:
+        shutil.rmtree(work_dir)
+    objects = len(env.standin.buckets[var.website_fqdn]['objects'])
+    connect(env.standin)
+    with env.measure():
+        found = destroy.find(var)
+        _, timings = destroy.teardown(var, found, log=lambda msg: None)
+    standin = env.standin
+    return {
+        'objects_deleted': objects,
+        'critical_path': timings.critical_path(),
+        'checks': {
+            'everything found': all(found.values()),
+            'account empty': not (standin.buckets or standin.queues or standin.repositories or standin.projects
+                                  or standin.functions or standin.mappings or standin.rules or standin.roles
+                                  or standin.policies or standin.distributions or standin.certificates
+                                  or standin.cdn_functions or standin.kv_stores),
+            'dns aliases removed': all(key[0] != var.website_fqdn+'.' for zone in standin.zones.values()
+                                       for key in zone['records'] if key[1] in ('A', 'AAAA'))
+        }
+    }
+
+
+SCENARIOS = {
+    'fresh_setup': fresh_setup,
+    'existing_certificate_setup': existing_certificate_setup,
+    'rerun_setup': rerun_setup,
+    'shared_zone_setup': shared_zone_setup,
+    'deploy_site': deploy_site,
+    'redeploy_site': redeploy_site,
+    'render_then_sync': render_and_sync(streamed=False),
+    'render_stream_sync': render_and_sync(streamed=True),
+    'release_deploy': release_deploy,
+    'release_rollback': release_rollback,
+    'release_redirects': release_redirects,
+    'rapid_pushes': rapid_pushes('cancel'),
+    'rapid_pushes_queue': rapid_pushes('queue'),
+    'rapid_pushes_coalesce': rapid_pushes('coalesce'),
+    'push_to_live': push_to_live,
+    'log_cleanup': log_cleanup,
+    'teardown': teardown
+}
@@ -0,0 +1,1641 @@
+import os
+import sys
+import json
+import time
+import uuid
+import base64
+import random
+import hashlib
+import io
+import datetime
+import importlib
+import threading
+import types
+from collections import Counter, deque
+from urllib.parse import quote, quote_plus, unquote
+from botocore import xform_name
+from botocore.awsrequest import AWSResponse
+from botocore.response import StreamingBody
+
+##########################################
+# An in-process stand-in for the AWS account
+##########################################
+# Installed on a boto3 session, it answers every call made by that
+# session's clients from a small in-memory model of the account: buckets
+# and objects, queues, roles and policies, functions, rules, zones and
+# records, certificates, distributions, builds and log groups. Real
+# clients are used, so requests are built and validated by botocore as
+# usual; only the network is replaced. The answer comes from a handler
+# on before-call (the parameters are caught on before-parameter-build),
+# after sleeping for the call's latency in the current profile.
+#
+# Eventually consistent behaviour follows the profile too: a new role
+# cannot be assumed for a while, a certificate is issued some time after
+# its validation record is in its zone, a distribution deploys, a build
+# runs. The deployed lambda functions run in this process against the
+# same stand-in, fed by S3 notifications through their queue, pushes to
+# the repository and build state changes, so a scenario exercises the
+# pipeline end to end.
+
+ACCOUNT_ID = '123456789012'
+HERE = os.path.dirname(os.path.abspath(__file__))
+LAMBDAS = os.path.join(os.path.dirname(HERE), 'lambdas')
+
+
+class AwsError(Exception):
+    def __init__(self, code, message='', status=400):
+        self.code = code
+        self.message = message
+        self.status = status
+        super().__init__(code+': '+message)
+
+
+def now_utc():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def new_id(prefix='', length=13):
+    return prefix+uuid.uuid4().hex[:length].upper()
+
+
+def page(items, token, limit, key=None, reverse=False):
+    # (items on this page, token of the next page or None). With a sort
+    # key the token is where the last page ended rather than an offset,
+    # so deleting items while paging does not skip any.
+    start = int(token or 0) if key is None else 0
+    if key is not None and token:
+        last = json.loads(token)
+        after = (lambda item: list(key(item)) < last) if reverse else (lambda item: list(key(item)) > last)
+        start = next((n for n, item in enumerate(items) if after(item)), len(items))
+    end = start + int(limit)
+    if end >= len(items):
+        return items[start:end], None
+    return items[start:end], (str(end) if key is None else json.dumps(list(key(items[end - 1]))))
+
+
+def body_bytes(body):
+    if body is None:
+        return b''
+    if isinstance(body, (bytes, bytearray)):
+        return bytes(body)
+    if isinstance(body, str):
+        return body.encode('utf-8')
+    return body.read()
+
+
+def zone_order(name):
+    # route53 lists hosted zones by their labels read right to left
+    return list(reversed(name.rstrip('.').lower().split('.')))
+
+
+def pattern_matches(pattern, event):
+    for key, wanted in pattern.items():
+        value = event.get(key)
+        if isinstance(wanted, dict):
+            if not isinstance(value, dict) or not pattern_matches(wanted, value):
+                return False
+        elif value not in wanted:
+            return False
+    return True
+
+
+class StandIn:
+    def __init__(self, profile, region='us-east-1', seed=0):
+        self.region = region
+        self._lock = threading.RLock()
+        self.host = LambdaHost(self)
+        self.reset(profile, seed)
+
+    def reset(self, profile, seed=0):
+        # forget the whole account, keep the sessions it is installed on
+        with self._lock:
+            self.random = random.Random(seed)
+            self.reset_counters(profile)
+            self.buckets = {}
+            self.queues = {}
+            self.repositories = {}
+            self.policies = {}
+            self.roles = {}
+            self.projects = {}
+            self.builds = {}
+            self.functions = {}
+            self.mappings = {}
+            self.rules = {}
+            self.zones = {}
+            self.changes = {}
+            self.certificates = {}
+            self.distributions = {}
+            self.cdn_functions = {}
+            self.kv_stores = {}
+            self.invalidations = []
+            self.log_groups = {}
+            # events waiting to be delivered to lambda functions
+            self.pending = deque()
+
+    def reset_counters(self, profile=None):
+        # start counting afresh, optionally under another profile
+        with self._lock:
+            if profile is not None:
+                self.profile = profile
+            self.calls = Counter()
+            self.calls_by_origin = Counter()
+            self.latency = Counter()
+            self.invocations = Counter()
+            self.invocation_time = Counter()
+
+    ##########################################
+    # botocore hooks
+    ##########################################
+    def install(self, session, origin='setup'):
+        # before any client of the session is created
+        session.events.register('before-parameter-build', self._capture)
+        session.events.register('before-call', lambda **kwargs: self._answer(origin=origin, **kwargs))
+
+    def _capture(self, params, context, **kwargs):
+        context['standin_params'] = params
+
+    def _answer(self, model, context, origin, **kwargs):
+        service = model.service_model.service_name
+        handler = getattr(self, service.replace('-', '_')+'_'+xform_name(model.name), None)
+        if handler is None:
+            raise NotImplementedError('the stand-in does not answer '+service+'.'+model.name)
+        with self._lock:
+            delay = self.profile.call_latency(service, self.random)
+            self.calls[service+'.'+model.name] += 1
+            self.calls_by_origin[origin] += 1
+            self.latency[service] += delay
+        if delay:
+            time.sleep(delay)
+        try:
+            with self._lock:
+                parsed = handler(context.get('standin_params', {})) or {}
+            status = 200
+        except AwsError as err:
+            parsed = {'Error': {'Code': err.code, 'Message': err.message}}
+            status = err.status
+        parsed['ResponseMetadata'] = {'HTTPStatusCode': status, 'HTTPHeaders': {}, 'RetryAttempts': 0}
+        return AWSResponse(None, status, {}, None), parsed
+
+    def elapsed(self, since, delay):
+        return time.monotonic() - since >= self.profile.delay(delay)
+
+    def arn(self, service, resource, region=None):
+        return 'arn:aws:%s:%s:%s:%s' % (service, self.region if region is None else region,
+                                        ACCOUNT_ID, resource)
+
+    ##########################################
+    # sts
+    ##########################################
+    def sts_get_caller_identity(self, params):
+        return {
+            'Account': ACCOUNT_ID,
+            'UserId': 'AIDABENCHMARK',
+            'Arn': 'arn:aws:iam::'+ACCOUNT_ID+':user/benchmark'
+        }
+
+    ##########################################
+    # s3
+    ##########################################
+    def _bucket(self, name):
+        if name not in self.buckets:
+            raise AwsError('NoSuchBucket', 'The specified bucket does not exist', 404)
+        return self.buckets[name]
+
+    def s3_create_bucket(self, params):
+        if params['Bucket'] in self.buckets:
+            raise AwsError('BucketAlreadyOwnedByYou', 'Your previous request to create the named bucket succeeded', 409)
+        self.buckets[params['Bucket']] = {
+            'objects': {}, 'policy': None, 'tags': [], 'website': None,
+            'notifications': {}, 'public_access_block': None
+        }
+        return {'Location': '/'+params['Bucket']}
+
+    def s3_head_bucket(self, params):
+        if params['Bucket'] not in self.buckets:
+            raise AwsError('404', 'Not Found', 404)
+        return {}
+
+    def s3_put_bucket_tagging(self, params):
+        self._bucket(params['Bucket'])['tags'] = params['Tagging']['TagSet']
+
+    def s3_get_bucket_tagging(self, params):
+        tags = self._bucket(params['Bucket'])['tags']
+        if not tags:
+            raise AwsError('NoSuchTagSet', 'The TagSet does not exist', 404)
+        return {'TagSet': [dict(tag) for tag in tags]}
+
+    def s3_delete_bucket(self, params):
+        if self._bucket(params['Bucket'])['objects']:
+            raise AwsError('BucketNotEmpty', 'The bucket you tried to delete is not empty', 409)
+        del self.buckets[params['Bucket']]
+
+    def s3_put_bucket_website(self, params):
+        self._bucket(params['Bucket'])['website'] = params['WebsiteConfiguration']
+
+    def s3_put_public_access_block(self, params):
+        self._bucket(params['Bucket'])['public_access_block'] = params['PublicAccessBlockConfiguration']
+
+    def s3_put_bucket_policy(self, params):
+        self._bucket(params['Bucket'])['policy'] = params['Policy']
+
+    def s3_get_bucket_policy(self, params):
+        policy = self._bucket(params['Bucket'])['policy']
+        if policy is None:
+            raise AwsError('NoSuchBucketPolicy', 'The bucket policy does not exist', 404)
+        return {'Policy': policy}
+
+    def s3_put_bucket_notification_configuration(self, params):
+        self._bucket(params['Bucket'])['notifications'] = params['NotificationConfiguration']
+
+    def s3_get_bucket_notification_configuration(self, params):
+        return dict(self._bucket(params['Bucket'])['notifications'])
+
+    def s3_put_object(self, params):
+        bucket = self._bucket(params['Bucket'])
+        data = body_bytes(params.get('Body'))
+        etag = '"'+hashlib.md5(data).hexdigest()+'"'
+        bucket['objects'][params['Key']] = {
+            'Key': params['Key'],
+            'ETag': etag,
+            'Size': len(data),
+            'LastModified': now_utc(),
+            'CacheControl': params.get('CacheControl'),
+            'ContentEncoding': params.get('ContentEncoding'),
+            'Body': data
+        }
+        self._notify(params['Bucket'], 'ObjectCreated:Put', params['Key'])
+        return {'ETag': etag}
+
+    def s3_get_object(self, params):
+        obj = self._bucket(params['Bucket'])['objects'].get(params['Key'])
+        if obj is None:
+            raise AwsError('NoSuchKey', 'The specified key does not exist.', 404)
+        data = obj.get('Body', b'')
+        return {'Body': StreamingBody(io.BytesIO(data), len(data)), 'ETag': obj['ETag'],
+                'ContentLength': len(data), 'LastModified': obj['LastModified']}
+
+    def s3_copy_object(self, params):
+        source = params['CopySource']
+        if isinstance(source, str):
+            source_bucket, source_key = unquote(source.lstrip('/')).split('/', 1)
+        else:
+            source_bucket, source_key = source['Bucket'], source['Key']
+        obj = self._bucket(source_bucket)['objects'].get(source_key)
+        if obj is None:
+            raise AwsError('NoSuchKey', 'The specified key does not exist.', 404)
+        copied = dict(obj, Key=params['Key'], LastModified=now_utc())
+        self._bucket(params['Bucket'])['objects'][params['Key']] = copied
+        self._notify(params['Bucket'], 'ObjectCreated:Copy', params['Key'])
+        return {'CopyObjectResult': {'ETag': copied['ETag'], 'LastModified': copied['LastModified']}}
+
+    def s3_delete_objects(self, params):
+        bucket = self._bucket(params['Bucket'])
+        deleted = []
+        for obj in params['Delete']['Objects']:
+            if bucket['objects'].pop(obj['Key'], None) is not None:
+                self._notify(params['Bucket'], 'ObjectRemoved:Delete', obj['Key'])
+            deleted.append({'Key': obj['Key']})
+        return {} if params['Delete'].get('Quiet') else {'Deleted': deleted}
+
+    def s3_list_objects_v2(self, params):
+        objects = self._bucket(params['Bucket'])['objects']
+        prefix, delimiter = params.get('Prefix', ''), params.get('Delimiter')
+        keys = sorted(key for key in objects if key.startswith(prefix))
+        if delimiter:
+            # keys with the delimiter past the prefix roll up into one
+            # common prefix each, listed in order with the keys
+            rolled = []
+            for key in keys:
+                cut = key.find(delimiter, len(prefix))
+                entry = key[:cut + len(delimiter)] if cut >= 0 else key
+                if not rolled or rolled[-1] != entry:
+                    rolled.append(entry)
+            keys = rolled
+        keys, token = page(keys, params.get('ContinuationToken'), params.get('MaxKeys', 1000))
+        result = {
+            'Contents': [dict((field, objects[key][field]) for field in ('Key', 'ETag', 'Size', 'LastModified'))
+                         for key in keys if key in objects],
+            'KeyCount': len(keys),
+            'IsTruncated': token is not None
+        }
+        common = [{'Prefix': key} for key in keys if key not in objects]
+        if common:
+            result['CommonPrefixes'] = common
+        if token:
+            result['NextContinuationToken'] = token
+        return result
+
+    def s3_list_object_versions(self, params):
+        # buckets are unversioned: one 'null' version per object, no
+        # delete markers
+        objects = self._bucket(params['Bucket'])['objects']
+        prefix, marker = params.get('Prefix', ''), params.get('KeyMarker', '')
+        keys = sorted(key for key in objects if key.startswith(prefix) and key > marker)
+        limit = int(params.get('MaxKeys', 1000))
+        result = {
+            'Versions': [{'Key': key, 'VersionId': 'null', 'IsLatest': True, 'ETag': objects[key]['ETag'],
+                          'Size': objects[key]['Size'], 'LastModified': objects[key]['LastModified']}
+                         for key in keys[:limit]],
+            'IsTruncated': len(keys) > limit
+        }
+        if len(keys) > limit:
+            result['NextKeyMarker'], result['NextVersionIdMarker'] = keys[limit - 1], 'null'
+        return result
+
+    def _notify(self, bucket_name, event_name, key):
+        # one message per object change, as S3 sends them
+        configurations = self.buckets[bucket_name]['notifications'].get('QueueConfigurations', [])
+        for configuration in configurations:
+            category = event_name.split(':')[0]
+            if not any(event.startswith('s3:'+category) for event in configuration['Events']):
+                continue
+            for queue in self.queues.values():
+                if queue['arn'] == configuration['QueueArn']:
+                    queue['messages'].append(json.dumps({'Records': [{
+                        'eventSource': 'aws:s3',
+                        'eventName': event_name,
+                        's3': {'bucket': {'name': bucket_name}, 'object': {'key': quote_plus(key)}}
+                    }]}))
+
+    ##########################################
+    # sqs
+    ##########################################
+    def _queue_by_url(self, url):
+        for queue in self.queues.values():
+            if queue['url'] == url:
+                return queue
+        raise AwsError('AWS.SimpleQueueService.NonExistentQueue', 'The specified queue does not exist.')
+
+    def sqs_create_queue(self, params):
+        name = params['QueueName']
+        attributes = params.get('Attributes', {})
+        if name in self.queues:
+            if any(self.queues[name]['attributes'].get(key) != value for key, value in attributes.items()):
+                raise AwsError('QueueAlreadyExists', 'A queue already exists with the same name and a different value for attribute')
+            return {'QueueUrl': self.queues[name]['url']}
+        self.queues[name] = {
+            'url': 'https://sqs.%s.amazonaws.com/%s/%s' % (self.region, ACCOUNT_ID, name),
+            'arn': self.arn('sqs', name),
+            'attributes': dict({'VisibilityTimeout': '30'}, **attributes),
+            'tags': params.get('tags', {}),
+            'messages': deque()
+        }
+        return {'QueueUrl': self.queues[name]['url']}
+
+    def sqs_get_queue_url(self, params):
+        if params['QueueName'] not in self.queues:
+            raise AwsError('AWS.SimpleQueueService.NonExistentQueue', 'The specified queue does not exist.')
+        return {'QueueUrl': self.queues[params['QueueName']]['url']}
+
+    def sqs_set_queue_attributes(self, params):
+        self._queue_by_url(params['QueueUrl'])['attributes'].update(params['Attributes'])
+
+    def sqs_get_queue_attributes(self, params):
+        queue = self._queue_by_url(params['QueueUrl'])
+        attributes = dict(queue['attributes'], QueueArn= queue['arn'],
+                          ApproximateNumberOfMessages= str(len(queue['messages'])))
+        names = params.get('AttributeNames', ['All'])
+        if 'All' not in names:
+            attributes = dict((name, value) for name, value in attributes.items() if name in names)
+        return {'Attributes': attributes}
+
+    def sqs_send_message(self, params):
+        queue = self._queue_by_url(params['QueueUrl'])
+        queue['messages'].append(params['MessageBody'])
+        return {'MessageId': str(uuid.uuid4()), 'MD5OfMessageBody': hashlib.md5(params['MessageBody'].encode('utf-8')).hexdigest()}
+
+    def sqs_list_queue_tags(self, params):
+        return {'Tags': dict(self._queue_by_url(params['QueueUrl'])['tags'])}
+
+    def sqs_delete_queue(self, params):
+        queue = self._queue_by_url(params['QueueUrl'])
+        del self.queues[queue['url'].rsplit('/', 1)[-1]]
+
+    ##########################################
+    # codecommit
+    ##########################################
+    def _repository(self, name):
+        if name not in self.repositories:
+            raise AwsError('RepositoryDoesNotExistException', name+' does not exist')
+        return self.repositories[name]
+
+    def codecommit_create_repository(self, params):
+        name = params['repositoryName']
+        if name in self.repositories:
+            raise AwsError('RepositoryNameExistsException', 'Repository named '+name+' already exists')
+        self.repositories[name] = {
+            'metadata': {
+                'repositoryName': name,
+                'repositoryId': str(uuid.uuid4()),
+                'repositoryDescription': params.get('repositoryDescription', ''),
+                'Arn': self.arn('codecommit', name),
+                'cloneUrlHttp': 'https://git-codecommit.%s.amazonaws.com/v1/repos/%s' % (self.region, name),
+                'cloneUrlSsh': 'ssh://git-codecommit.%s.amazonaws.com/v1/repos/%s' % (self.region, name),
+                'accountId': ACCOUNT_ID
+            },
+            'triggers': [],
+            'branches': {}
+        }
+        return {'repositoryMetadata': dict(self.repositories[name]['metadata'])}
+
+    def codecommit_get_repository(self, params):
+        return {'repositoryMetadata': dict(self._repository(params['repositoryName'])['metadata'])}
+
+    def codecommit_delete_repository(self, params):
+        # succeeds with no id when there is nothing to delete
+        repo = self.repositories.pop(params['repositoryName'], None)
+        return {'repositoryId': repo['metadata']['repositoryId']} if repo else {}
+
+    def codecommit_put_repository_triggers(self, params):
+        self._repository(params['repositoryName'])['triggers'] = [dict(trigger) for trigger in params['triggers']]
+        return {'configurationId': str(uuid.uuid4())}
+
+    def codecommit_get_repository_triggers(self, params):
+        triggers = self._repository(params['repositoryName'])['triggers']
+        return {'configurationId': str(uuid.uuid4()), 'triggers': [dict(trigger) for trigger in triggers]}
+
+    def codecommit_get_branch(self, params):
+        branches = self._repository(params['repositoryName'])['branches']
+        if params['branchName'] not in branches:
+            raise AwsError('BranchDoesNotExistException', params['branchName']+' does not exist')
+        return {'branch': {'branchName': params['branchName'], 'commitId': branches[params['branchName']]}}
+
+    def push(self, repository, branch, commit):
+        # move the branch and queue the repository triggers it fires
+        with self._lock:
+            repo = self._repository(repository)
+            event = 'updateReference' if branch in repo['branches'] else 'createReference'
+            repo['branches'][branch] = commit
+            for trigger in repo['triggers']:
+                if trigger.get('branches') and branch not in trigger['branches']:
+                    continue
+                if event not in trigger['events'] and 'all' not in trigger['events']:
+                    continue
+                self.pending.append((trigger['destinationArn'], {'Records': [{
+                    'eventSource': 'aws:codecommit',
+                    'eventTime': now_utc().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]+'+0000',
+                    'eventSourceARN': repo['metadata']['Arn'],
+                    'codecommit': {'references': [{'ref': 'refs/heads/'+branch, 'commit': commit}]}
+                }]}))
+
+    ##########################################
+    # iam
+    ##########################################
+    # Policy documents are kept url encoded, as IAM returns them and
+    # botocore's handlers expect to decode them.
+    def _policy_summary(self, policy):
+        return dict((key, value) for key, value in policy.items() if key not in ('versions', 'tags'))
+
+    def iam_create_policy(self, params):
+        path = params.get('Path', '/')
+        arn = 'arn:aws:iam::'+ACCOUNT_ID+':policy'+path+params['PolicyName']
+        if arn in self.policies:
+            raise AwsError('EntityAlreadyExists', 'A policy called '+params['PolicyName']+' already exists.', 409)
+        created = now_utc()
+        self.policies[arn] = {
+            'PolicyName': params['PolicyName'],
+            'PolicyId': new_id('ANPA', 17),
+            'Arn': arn,
+            'Path': path,
+            'DefaultVersionId': 'v1',
+            'AttachmentCount': 0,
+            'IsAttachable': True,
+            'CreateDate': created,
+            'UpdateDate': created,
+            'versions': {'v1': {'Document': quote(params['PolicyDocument']), 'VersionId': 'v1',
+                                'IsDefaultVersion': True, 'CreateDate': created}},
+            'next_version': 2,
+            'tags': dict((tag['Key'], tag['Value']) for tag in params.get('Tags', []))
+        }
+        return {'Policy': self._policy_summary(self.policies[arn])}
+
+    def _policy(self, arn):
+        if arn not in self.policies:
+            raise AwsError('NoSuchEntity', 'Policy '+arn+' does not exist.', 404)
+        return self.policies[arn]
+
+    def iam_list_policy_versions(self, params):
+        versions = self._policy(params['PolicyArn'])['versions'].values()
+        return {'Versions': [dict((key, value) for key, value in version.items() if key != 'Document')
+                             for version in sorted(versions, key=lambda v: v['CreateDate'], reverse=True)],
+                'IsTruncated': False}
+
+    def iam_delete_policy_version(self, params):
+        policy = self._policy(params['PolicyArn'])
+        if policy['DefaultVersionId'] == params['VersionId']:
+            raise AwsError('DeleteConflict', 'Cannot delete the default version of a policy.', 409)
+        policy['versions'].pop(params['VersionId'], None)
+
+    def iam_create_policy_version(self, params):
+        policy = self._policy(params['PolicyArn'])
+        if len(policy['versions']) >= 5:
+            raise AwsError('LimitExceeded', 'A managed policy can have up to 5 versions.', 409)
+        version_id = 'v%d' % policy['next_version']
+        policy['next_version'] += 1
+        policy['versions'][version_id] = {
+            'Document': quote(params['PolicyDocument']), 'VersionId': version_id,
+            'IsDefaultVersion': False, 'CreateDate': now_utc()
+        }
+        if params.get('SetAsDefault'):
+            for version in policy['versions'].values():
+                version['IsDefaultVersion'] = version['VersionId'] == version_id
+            policy['DefaultVersionId'] = version_id
+            policy['UpdateDate'] = now_utc()
+        return {'PolicyVersion': dict((key, value) for key, value in policy['versions'][version_id].items()
+                                      if key != 'Document')}
+
+    def iam_get_policy_version(self, params):
+        policy = self._policy(params['PolicyArn'])
+        if params['VersionId'] not in policy['versions']:
+            raise AwsError('NoSuchEntity', 'Policy version does not exist.', 404)
+        return {'PolicyVersion': dict(policy['versions'][params['VersionId']])}
+
+    def iam_list_policies(self, params):
+        prefix = params.get('PathPrefix', '/')
+        policies = [self._policy_summary(policy) for policy in self.policies.values()
+                    if policy['Path'].startswith(prefix)]
+        return {'Policies': policies, 'IsTruncated': False}
+
+    def iam_list_policy_tags(self, params):
+        tags = self._policy(params['PolicyArn'])['tags']
+        return {'Tags': [{'Key': key, 'Value': value} for key, value in sorted(tags.items())], 'IsTruncated': False}
+
+    def iam_tag_policy(self, params):
+        self._policy(params['PolicyArn'])['tags'].update((tag['Key'], tag['Value']) for tag in params['Tags'])
+
+    def iam_delete_policy(self, params):
+        policy = self._policy(params['PolicyArn'])
+        if policy['AttachmentCount'] or len(policy['versions']) > 1:
+            raise AwsError('DeleteConflict', 'Cannot delete a policy attached to entities or with non-default versions.', 409)
+        del self.policies[params['PolicyArn']]
+
+    def iam_create_role(self, params):
+        name = params['RoleName']
+        if name in self.roles:
+            raise AwsError('EntityAlreadyExists', 'Role with name '+name+' already exists.', 409)
+        path = params.get('Path', '/')
+        self.roles[name] = {
+            'role': {
+                'RoleName': name,
+                'RoleId': new_id('AROA', 17),
+                'Arn': 'arn:aws:iam::'+ACCOUNT_ID+':role'+path+name,
+                'Path': path,
+                'CreateDate': now_utc(),
+                'Description': params.get('Description', ''),
+                'AssumeRolePolicyDocument': quote(params['AssumeRolePolicyDocument'])
+            },
+            'created': time.monotonic(),
+            'attached': [],
+            'inline': {},
+            'tags': dict((tag['Key'], tag['Value']) for tag in params.get('Tags', []))
+        }
+        return {'Role': dict(self.roles[name]['role'])}
+
+    def _role(self, name):
+        if name not in self.roles:
+            raise AwsError('NoSuchEntity', 'The role with name '+name+' cannot be found.', 404)
+        return self.roles[name]
+
+    def iam_get_role(self, params):
+        return {'Role': dict(self._role(params['RoleName'])['role'])}
+
+    def iam_attach_role_policy(self, params):
+        role = self._role(params['RoleName'])
+        policy = self._policy(params['PolicyArn'])
+        if params['PolicyArn'] not in role['attached']:
+            role['attached'].append(params['PolicyArn'])
+            policy['AttachmentCount'] += 1
+
+    def iam_list_roles(self, params):
+        prefix = params.get('PathPrefix', '/')
+        return {'Roles': [dict(role['role']) for role in self.roles.values()
+                          if role['role']['Path'].startswith(prefix)], 'IsTruncated': False}
+
+    def iam_list_attached_role_policies(self, params):
+        role = self._role(params['RoleName'])
+        return {'AttachedPolicies': [{'PolicyArn': arn, 'PolicyName': self.policies[arn]['PolicyName']}
+                                     for arn in role['attached']], 'IsTruncated': False}
+
+    def iam_detach_role_policy(self, params):
+        role = self._role(params['RoleName'])
+        if params['PolicyArn'] not in role['attached']:
+            raise AwsError('NoSuchEntity', 'Policy '+params['PolicyArn']+' was not found.', 404)
+        role['attached'].remove(params['PolicyArn'])
+        self.policies[params['PolicyArn']]['AttachmentCount'] -= 1
+
+    def iam_put_role_policy(self, params):
+        self._role(params['RoleName'])['inline'][params['PolicyName']] = params['PolicyDocument']
+
+    def iam_get_role_policy(self, params):
+        inline = self._role(params['RoleName'])['inline']
+        if params['PolicyName'] not in inline:
+            raise AwsError('NoSuchEntity', 'The role policy with name '+params['PolicyName']+' cannot be found.', 404)
+        return {'RoleName': params['RoleName'], 'PolicyName': params['PolicyName'],
+                'PolicyDocument': quote(inline[params['PolicyName']])}
+
+    def iam_delete_role_policy(self, params):
+        inline = self._role(params['RoleName'])['inline']
+        if params['PolicyName'] not in inline:
+            raise AwsError('NoSuchEntity', 'The role policy with name '+params['PolicyName']+' cannot be found.', 404)
+        del inline[params['PolicyName']]
+
+    def iam_list_role_policies(self, params):
+        return {'PolicyNames': sorted(self._role(params['RoleName'])['inline']), 'IsTruncated': False}
+
+    def iam_delete_role(self, params):
+        role = self._role(params['RoleName'])
+        if role['attached'] or role['inline']:
+            raise AwsError('DeleteConflict', 'Cannot delete entity, must detach all policies first.', 409)
+        del self.roles[params['RoleName']]
+
+    def role_assumable(self, arn):
+        # a new role takes a while to be usable by other services
+        for role in self.roles.values():
+            if role['role']['Arn'] == arn:
+                return self.elapsed(role['created'], 'iam_propagation')
+        return False
+
+    ##########################################
+    # codebuild
+    ##########################################
+    def _project_from(self, params):
+        project = dict(params)
+        project['arn'] = self.arn('codebuild', 'project/'+params['name'])
+        project.setdefault('cache', {'type': 'NO_CACHE'})
+        return project
+
+    def codebuild_create_project(self, params):
+        if params['name'] in self.projects:
+            raise AwsError('ResourceAlreadyExistsException', 'Project already exists: '+params['name'])
+        if not self.role_assumable(params['serviceRole']):
+            raise AwsError('InvalidInputException', 'CodeBuild is not authorized to perform: sts:AssumeRole on '+params['serviceRole'])
+        self.projects[params['name']] = self._project_from(params)
+        return {'project': dict(self.projects[params['name']])}
+
+    def codebuild_update_project(self, params):
+        if params['name'] not in self.projects:
+            raise AwsError('ResourceNotFoundException', 'Project not found: '+params['name'])
+        if not self.role_assumable(params['serviceRole']):
+            raise AwsError('InvalidInputException', 'CodeBuild is not authorized to perform: sts:AssumeRole on '+params['serviceRole'])
+        self.projects[params['name']] = self._project_from(params)
+        return {'project': dict(self.projects[params['name']])}
+
+    def codebuild_batch_get_projects(self, params):
+        names = params['names']
+        return {
+            'projects': [dict(self.projects[name]) for name in names if name in self.projects],
+            'projectsNotFound': [name for name in names if name not in self.projects]
+        }
+
+    def codebuild_delete_project(self, params):
+        self.projects.pop(params['name'], None)
+
+    # fraction of the build's time at which each phase starts
+    BUILD_PHASES = (
+        (0.0, 'SUBMITTED'), (0.02, 'QUEUED'), (0.05, 'PROVISIONING'), (0.2, 'DOWNLOAD_SOURCE'),
+        (0.3, 'INSTALL'), (0.4, 'BUILD'), (0.9, 'POST_BUILD')
+    )
+
+    def _phases(self, build, fraction):
+        # the phases started by `fraction` of the build's time, timed
+        # from its start
+        phases = []
+        bounds = [start for start, _ in self.BUILD_PHASES[1:]] + [1.0]
+        for (start, phase), end in zip(self.BUILD_PHASES, bounds):
+            if fraction < start:
+                break
+            entry = {'phaseType': phase, 'startTime': build['startTime'] + datetime.timedelta(
+                seconds= start * build['_duration'])}
+            if fraction >= end:
+                entry['endTime'] = build['startTime'] + datetime.timedelta(seconds= end * build['_duration'])
+                entry['durationInSeconds'] = int((end - start) * build['_duration'])
+                entry['phaseStatus'] = 'SUCCEEDED'
+            phases.append(entry)
+        return phases
+
+    def _build_view(self, build):
+        view = dict((key, value) for key, value in build.items() if not key.startswith('_'))
+        fraction = (time.monotonic() - build['_started']) / max(build['_duration'], 1e-6)
+        view['phases'] = self._phases(build, min(fraction, build.get('_ended', fraction)))
+        if build['buildStatus'] != 'IN_PROGRESS':
+            return view
+        view['currentPhase'] = [phase for start, phase in self.BUILD_PHASES if fraction >= start][-1]
+        if fraction < 0.3:
+            # the commit is resolved once the source has been fetched
+            view.pop('resolvedSourceVersion', None)
+        return view
+
+    def codebuild_start_build(self, params):
+        project = self.projects.get(params['projectName'])
+        if project is None:
+            raise AwsError('ResourceNotFoundException', 'Project cannot be found: '+params['projectName'])
+        build_id = params['projectName']+':'+str(uuid.uuid4())
+        self.builds[build_id] = {
+            'id': build_id,
+            'arn': self.arn('codebuild', 'build/'+build_id),
+            'projectName': params['projectName'],
+            'buildStatus': 'IN_PROGRESS',
+            'currentPhase': 'SUBMITTED',
+            'sourceVersion': params.get('sourceVersion'),
+            'resolvedSourceVersion': params.get('sourceVersion'),
+            'startTime': now_utc(),
+            'environment': {'environmentVariables': list(params.get('environmentVariablesOverride', []))},
+            '_started': time.monotonic(),
+            '_duration': self.profile.delay('build_seconds')
+        }
+        return {'build': self._build_view(self.builds[build_id])}
+
+    def codebuild_stop_build(self, params):
+        build = self.builds.get(params['id'])
+        if build is None:
+            raise AwsError('ResourceNotFoundException', 'Build not found: '+params['id'])
+        if build['buildStatus'] == 'IN_PROGRESS':
+            self._finish_build(build, 'STOPPED')
+        return {'build': self._build_view(build)}
+
+    def codebuild_list_builds_for_project(self, params):
+        builds = [build for build in self.builds.values() if build['projectName'] == params['projectName']]
+        builds.sort(key=lambda build: build['_started'], reverse=params.get('sortOrder', 'DESCENDING') == 'DESCENDING')
+        ids, token = page([build['id'] for build in builds], params.get('nextToken'), 100)
+        return dict({'ids': ids}, **({'nextToken': token} if token else {}))
+
+    def codebuild_batch_get_builds(self, params):
+        return {
+            'builds': [self._build_view(self.builds[build_id]) for build_id in params['ids'] if build_id in self.builds],
+            'buildsNotFound': [build_id for build_id in params['ids'] if build_id not in self.builds]
+        }
+
+    def _finish_build(self, build, status):
+        build['_ended'] = (time.monotonic() - build['_started']) / max(build['_duration'], 1e-6)
+        build['buildStatus'] = status
+        build['currentPhase'] = 'COMPLETED'
+        build['endTime'] = now_utc()
+        self._put_event({
+            'source': 'aws.codebuild',
+            'detail-type': 'CodeBuild Build State Change',
+            'detail': {'project-name': build['projectName'], 'build-status': status, 'build-id': build['id']}
+        })
+
+    def advance(self):
+        # finish the builds whose time is up
+        with self._lock:
+            now = time.monotonic()
+            for build in sorted(self.builds.values(), key=lambda build: build['_started'] + build['_duration']):
+                if build['buildStatus'] == 'IN_PROGRESS' and now - build['_started'] >= build['_duration']:
+                    self._finish_build(build, 'SUCCEEDED')
+
+    def builds_running(self):
+        # {build id: current phase}
+        with self._lock:
+            return dict((build['id'], self._build_view(build)['currentPhase'])
+                        for build in self.builds.values() if build['buildStatus'] == 'IN_PROGRESS')
+
+    ##########################################
+    # lambda
+    ##########################################
+    def _function(self, name):
+        name = name.split(':')[-1] if name.startswith('arn:') else name
+        if name not in self.functions:
+            raise AwsError('ResourceNotFoundException', 'Function not found: '+self.arn('lambda', 'function:'+name), 404)
+        return self.functions[name]
+
+    def _role_assumable_by_lambda(self, role):
+        if not self.role_assumable(role):
+            raise AwsError('InvalidParameterValueException', 'The role defined for the function cannot be assumed by Lambda.')
+
+    def lambda_create_function(self, params):
+        name = params['FunctionName']
+        if name in self.functions:
+            raise AwsError('ResourceConflictException', 'Function already exist: '+name, 409)
+        self._role_assumable_by_lambda(params['Role'])
+        code = params['Code']['ZipFile']
+        config = {
+            'FunctionName': name,
+            'FunctionArn': self.arn('lambda', 'function:'+name),
+            'Runtime': params.get('Runtime'),
+            'Role': params['Role'],
+            'Handler': params.get('Handler'),
+            'Description': params.get('Description', ''),
+            'Timeout': params.get('Timeout', 3),
+            'MemorySize': params.get('MemorySize', 128),
+            'Environment': {'Variables': dict(params.get('Environment', {}).get('Variables', {}))},
+            'Version': '$LATEST',
+            'State': 'Active',
+            'LastUpdateStatus': 'Successful'
+        }
+        self.functions[name] = {'config': config, 'policy': [], 'concurrency': None, 'tags': params.get('Tags', {})}
+        self._set_code(name, code)
+        return dict(config)
+
+    def _set_code(self, name, code):
+        config = self.functions[name]['config']
+        config['CodeSha256'] = base64.b64encode(hashlib.sha256(code).digest()).decode('ascii')
+        config['CodeSize'] = len(code)
+        config['LastModified'] = now_utc().strftime('%Y-%m-%dT%H:%M:%S.000+0000')
+
+    def lambda_get_function_configuration(self, params):
+        return dict(self._function(params['FunctionName'])['config'])
+
+    def lambda_update_function_code(self, params):
+        function = self._function(params['FunctionName'])
+        self._set_code(function['config']['FunctionName'], params['ZipFile'])
+        return dict(function['config'])
+
+    def lambda_update_function_configuration(self, params):
+        function = self._function(params['FunctionName'])
+        if 'Role' in params:
+            self._role_assumable_by_lambda(params['Role'])
+        for key, value in params.items():
+            if key != 'FunctionName':
+                function['config'][key] = value
+        function['config']['LastModified'] = now_utc().strftime('%Y-%m-%dT%H:%M:%S.000+0000')
+        return dict(function['config'])
+
+    def lambda_add_permission(self, params):
+        function = self._function(params['FunctionName'])
+        if any(statement['Sid'] == params['StatementId'] for statement in function['policy']):
+            raise AwsError('ResourceConflictException', 'The statement id ('+params['StatementId']+') provided already exists.', 409)
+        statement = {
+            'Sid': params['StatementId'],
+            'Effect': 'Allow',
+            'Principal': {'Service': params['Principal']},
+            'Action': params['Action'],
+            'Resource': function['config']['FunctionArn']
+        }
+        if params.get('SourceArn'):
+            statement['Condition'] = {'ArnLike': {'AWS:SourceArn': params['SourceArn']}}
+        function['policy'].append(statement)
+        return {'Statement': json.dumps(statement)}
+
+    def lambda_get_policy(self, params):
+        function = self._function(params['FunctionName'])
+        if not function['policy']:
+            raise AwsError('ResourceNotFoundException', 'The resource you requested does not exist.', 404)
+        return {'Policy': json.dumps({'Version': '2012-10-17', 'Id': 'default', 'Statement': function['policy']})}
+
+    def lambda_put_function_concurrency(self, params):
+        self._function(params['FunctionName'])['concurrency'] = params['ReservedConcurrentExecutions']
+        return {'ReservedConcurrentExecutions': params['ReservedConcurrentExecutions']}
+
+    def lambda_delete_function_concurrency(self, params):
+        self._function(params['FunctionName'])['concurrency'] = None
+        return {}
+
+    def lambda_list_tags(self, params):
+        return {'Tags': dict(self._function(params['Resource'])['tags'])}
+
+    def lambda_delete_function(self, params):
+        del self.functions[self._function(params['FunctionName'])['config']['FunctionName']]
+
+    def lambda_list_functions(self, params):
+        names = sorted(self.functions)
+        names, marker = page(names, params.get('Marker'), params.get('MaxItems', 50))
+        result = {'Functions': [dict(self.functions[name]['config']) for name in names]}
+        if marker:
+            result['NextMarker'] = marker
+        return result
+
+    def lambda_create_event_source_mapping(self, params):
+        function = self._function(params['FunctionName'])
+        if not self.role_assumable(function['config']['Role']):
+            raise AwsError('InvalidParameterValueException',
+                           'The provided execution role does not have permissions to call ReceiveMessage on SQS')
+        mapping = {
+            'UUID': str(uuid.uuid4()),
+            'EventSourceArn': params['EventSourceArn'],
+            'FunctionArn': function['config']['FunctionArn'],
+            'BatchSize': params.get('BatchSize', 10),
+            'MaximumBatchingWindowInSeconds': params.get('MaximumBatchingWindowInSeconds', 0),
+            'ScalingConfig': dict(params.get('ScalingConfig', {})),
+            'State': 'Enabled' if params.get('Enabled', True) else 'Disabled'
+        }
+        self.mappings[mapping['UUID']] = mapping
+        return dict(mapping)
+
+    def lambda_update_event_source_mapping(self, params):
+        if params['UUID'] not in self.mappings:
+            raise AwsError('ResourceNotFoundException', 'The resource you requested does not exist.', 404)
+        mapping = self.mappings[params['UUID']]
+        for key in ('BatchSize', 'MaximumBatchingWindowInSeconds', 'ScalingConfig'):
+            if key in params:
+                mapping[key] = params[key]
+        if 'Enabled' in params:
+            mapping['State'] = 'Enabled' if params['Enabled'] else 'Disabled'
+        return dict(mapping)
+
+    def lambda_list_event_source_mappings(self, params):
+        arn = self._function(params['FunctionName'])['config']['FunctionArn'] if params.get('FunctionName') else None
+        mappings = [dict(mapping) for mapping in self.mappings.values()
+                    if arn is None or mapping['FunctionArn'] == arn]
+        return {'EventSourceMappings': mappings}
+
+    def lambda_delete_event_source_mapping(self, params):
+        if params['UUID'] not in self.mappings:
+            raise AwsError('ResourceNotFoundException', 'The resource you requested does not exist.', 404)
+        return dict(self.mappings.pop(params['UUID']), State='Deleting')
+
+    ##########################################
+    # eventbridge
+    ##########################################
+    def _rule(self, name):
+        if name not in self.rules:
+            raise AwsError('ResourceNotFoundException', 'Rule '+name+' does not exist.')
+        return self.rules[name]
+
+    def events_put_rule(self, params):
+        rule = self.rules.setdefault(params['Name'], {'targets': []})
+        rule.update(dict((key, value) for key, value in params.items()))
+        rule['Arn'] = self.arn('events', 'rule/'+params['Name'])
+        return {'RuleArn': rule['Arn']}
+
+    def events_describe_rule(self, params):
+        return dict((key, value) for key, value in self._rule(params['Name']).items() if key != 'targets')
+
+    def events_put_targets(self, params):
+        rule = self._rule(params['Rule'])
+        targets = dict((target['Id'], target) for target in rule['targets'])
+        for target in params['Targets']:
+            targets[target['Id']] = dict(target)
+        rule['targets'] = list(targets.values())
+        return {'FailedEntryCount': 0, 'FailedEntries': []}
+
+    def events_list_targets_by_rule(self, params):
+        return {'Targets': [dict(target) for target in self._rule(params['Rule'])['targets']]}
+
+    def events_remove_targets(self, params):
+        rule = self._rule(params['Rule'])
+        rule['targets'] = [target for target in rule['targets'] if target['Id'] not in params['Ids']]
+        return {'FailedEntryCount': 0, 'FailedEntries': []}
+
+    def events_delete_rule(self, params):
+        if self.rules.get(params['Name'], {}).get('targets'):
+            raise AwsError('ValidationException', "Rule can't be deleted since it has targets.")
+        self.rules.pop(params['Name'], None)
+
+    def _put_event(self, event):
+        for rule in self.rules.values():
+            if rule.get('State', 'ENABLED') != 'ENABLED' or not rule.get('EventPattern'):
+                continue
+            if pattern_matches(json.loads(rule['EventPattern']), event):
+                for target in rule['targets']:
+                    self.pending.append((target['Arn'], dict(event)))
+
+    ##########################################
+    # route53
+    ##########################################
+    def add_hosted_zone(self, name):
+        zone_id = new_id('Z', 13)
+        self.zones[zone_id] = {
+            'zone': {
+                'Id': '/hostedzone/'+zone_id,
+                'Name': name.rstrip('.')+'.',
+                'CallerReference': str(uuid.uuid4()),
+                'Config': {'PrivateZone': False},
+                'ResourceRecordSetCount': 2
+            },
+            'records': {}
+        }
+        return zone_id
+
+    def _zone(self, zone_id):
+        zone_id = zone_id.split('/')[-1]
+        if zone_id not in self.zones:
+            raise AwsError('NoSuchHostedZone', 'No hosted zone found with ID: '+zone_id, 404)
+        return self.zones[zone_id]
+
+    def route53_list_hosted_zones_by_name(self, params):
+        zones = sorted((zone['zone'] for zone in self.zones.values()), key=lambda zone: zone_order(zone['Name']))
+        if params.get('DNSName'):
+            start = zone_order(params['DNSName'])
+            zones = [zone for zone in zones if zone_order(zone['Name']) >= start]
+        limit = int(params.get('MaxItems', 100))
+        result = {'HostedZones': [dict(zone) for zone in zones[:limit]], 'IsTruncated': len(zones) > limit,
+                  'MaxItems': str(limit)}
+        if params.get('DNSName'):
+            result['DNSName'] = params['DNSName']
+        return result
+
+    def route53_change_resource_record_sets(self, params):
+        zone = self._zone(params['HostedZoneId'])
+        changes = params['ChangeBatch']['Changes']
+        seen = set()
+        for change in changes:
+            record = change['ResourceRecordSet']
+            key = (record['Name'].rstrip('.').lower()+'.', record['Type'])
+            if key in seen:
+                raise AwsError('InvalidChangeBatch', 'Duplicate Resource Record: '+key[0]+' type '+key[1])
+            seen.add(key)
+            if change['Action'] == 'CREATE' and key in zone['records']:
+                raise AwsError('InvalidChangeBatch', 'Tried to create resource record set '+key[0]+' type '+key[1]+' but it already exists')
+            if change['Action'] == 'DELETE' and key not in zone['records']:
+                raise AwsError('InvalidChangeBatch', 'Tried to delete resource record set '+key[0]+' type '+key[1]+' but it was not found')
+        change_id = new_id('C', 13)
+        submitted = time.monotonic()
+        for change in changes:
+            record = dict(change['ResourceRecordSet'])
+            record['Name'] = record['Name'].rstrip('.').lower()+'.'
+            key = (record['Name'], record['Type'])
+            if change['Action'] == 'DELETE':
+                del zone['records'][key]
+            else:
+                zone['records'][key] = {'record': record, 'change': change_id}
+        self.changes[change_id] = submitted
+        return {'ChangeInfo': {'Id': '/change/'+change_id, 'Status': 'PENDING', 'SubmittedAt': now_utc(),
+                               'Comment': params['ChangeBatch'].get('Comment', '')}}
+
+    def _change_status(self, change_id):
+        return 'INSYNC' if self.elapsed(self.changes[change_id], 'dns_propagation') else 'PENDING'
+
+    def route53_get_change(self, params):
+        change_id = params['Id'].split('/')[-1]
+        if change_id not in self.changes:
+            raise AwsError('NoSuchChange', 'Could not find resource with ID: '+change_id, 404)
+        return {'ChangeInfo': {'Id': '/change/'+change_id, 'Status': self._change_status(change_id),
+                               'SubmittedAt': now_utc()}}
+
+    def route53_list_resource_record_sets(self, params):
+        zone = self._zone(params['HostedZoneId'])
+        keys = sorted(zone['records'], key=lambda key: (zone_order(key[0]), key[1]))
+        if params.get('StartRecordName'):
+            start = (zone_order(params['StartRecordName']), params.get('StartRecordType', ''))
+            keys = [key for key in keys if (zone_order(key[0]), key[1]) >= start]
+        limit = int(params.get('MaxItems', 300))
+        result = {'ResourceRecordSets': [dict(zone['records'][key]['record']) for key in keys[:limit]],
+                  'IsTruncated': len(keys) > limit, 'MaxItems': str(limit)}
+        if len(keys) > limit:
+            result['NextRecordName'], result['NextRecordType'] = keys[limit]
+        return result
+
+    def _record_in_sync(self, name, record_type):
+        # whether a record is published by a zone and its change is in sync
+        name = name.rstrip('.').lower()+'.'
+        for zone in self.zones.values():
+            entry = zone['records'].get((name, record_type))
+            if entry and self._change_status(entry['change']) == 'INSYNC':
+                return self.changes[entry['change']]
+        return None
+
+    ##########################################
+    # acm
+    ##########################################
+    def _certificate(self, arn):
+        if arn not in self.certificates:
+            raise AwsError('ResourceNotFoundException', 'Could not find certificate '+arn+'.')
+        return self.certificates[arn]
+
+    def acm_request_certificate(self, params):
+        arn = self.arn('acm', 'certificate/'+str(uuid.uuid4()), region='us-east-1')
+        names = [params['DomainName']] + [name for name in params.get('SubjectAlternativeNames', [])
+                                          if name != params['DomainName']]
+        options = []
+        for name in names:
+            token = hashlib.sha256((arn+name).encode('utf-8')).hexdigest()
+            options.append({
+                'DomainName': name,
+                'ValidationDomain': name,
+                'ValidationStatus': 'PENDING_VALIDATION',
+                'ValidationMethod': params.get('ValidationMethod', 'DNS'),
+                'ResourceRecord': {
+                    # wildcards validate with the record of their base name
+                    'Name': '_'+token[:32]+'.'+name.lstrip('*.')+'.',
+                    'Type': 'CNAME',
+                    'Value': '_'+token[32:]+'.acm-validations.aws.'
+                }
+            })
+        self.certificates[arn] = {
+            'certificate': {
+                'CertificateArn': arn,
+                'DomainName': params['DomainName'],
+                'SubjectAlternativeNames': names,
+                'Status': 'PENDING_VALIDATION',
+                'Type': 'AMAZON_ISSUED',
+                'KeyAlgorithm': 'RSA_2048',
+                'CreatedAt': now_utc(),
+                'InUseBy': []
+            },
+            'options': options,
+            'requested': time.monotonic(),
+            'tags': []
+        }
+        return {'CertificateArn': arn}
+
+    def _issue(self, entry):
+        entry['certificate'].update({
+            'Status': 'ISSUED',
+            'IssuedAt': now_utc(),
+            'NotBefore': now_utc(),
+            'NotAfter': now_utc() + datetime.timedelta(days=395)
+        })
+
+    def add_certificate(self, names):
+        # an issued certificate the account already had
+        arn = self.acm_request_certificate({'DomainName': names[0], 'SubjectAlternativeNames': names})['CertificateArn']
+        entry = self.certificates[arn]
+        self._issue(entry)
+        for option in entry['options']:
+            option['ValidationStatus'] = 'SUCCESS'
+        return arn
+
+    def acm_add_tags_to_certificate(self, params):
+        self._certificate(params['CertificateArn'])['tags'].extend(params['Tags'])
+
+    def acm_list_tags_for_certificate(self, params):
+        return {'Tags': [dict(tag) for tag in self._certificate(params['CertificateArn'])['tags']]}
+
+    def acm_delete_certificate(self, params):
+        arn = params['CertificateArn']
+        self._certificate(arn)
+        for entry in self.distributions.values():
+            if entry['config'].get('ViewerCertificate', {}).get('ACMCertificateArn') == arn:
+                raise AwsError('ResourceInUseException', 'Certificate '+arn+' in use.')
+        del self.certificates[arn]
+
+    def _certificate_view(self, entry):
+        certificate = dict(entry['certificate'])
+        if certificate['Status'] == 'PENDING_VALIDATION':
+            issued = True
+            for option in entry['options']:
+                synced = self._record_in_sync(option['ResourceRecord']['Name'], 'CNAME')
+                if synced is None or not self.elapsed(synced, 'acm_validation'):
+                    issued = False
+                else:
+                    option['ValidationStatus'] = 'SUCCESS'
+            if issued:
+                self._issue(entry)
+                certificate = dict(entry['certificate'])
+        options = [dict(option) for option in entry['options']]
+        if not self.elapsed(entry['requested'], 'acm_record'):
+            # the validation records take a moment to show up
+            for option in options:
+                option.pop('ResourceRecord')
+        certificate['DomainValidationOptions'] = options
+        return certificate
+
+    def acm_describe_certificate(self, params):
+        return {'Certificate': self._certificate_view(self._certificate(params['CertificateArn']))}
+
+    def acm_list_certificates(self, params):
+        statuses = params.get('CertificateStatuses')
+        summaries = []
+        for entry in self.certificates.values():
+            certificate = self._certificate_view(entry)
+            if statuses and certificate['Status'] not in statuses:
+                continue
+            summaries.append({
+                'CertificateArn': certificate['CertificateArn'],
+                'DomainName': certificate['DomainName'],
+                'SubjectAlternativeNameSummaries': certificate['SubjectAlternativeNames'],
+                'HasAdditionalSubjectAlternativeNames': False,
+                'Status': certificate['Status'],
+                'Type': certificate['Type'],
+                'InUse': bool(certificate['InUseBy'])
+            })
+        return {'CertificateSummaryList': summaries}
+
+    ##########################################
+    # cloudfront
+    ##########################################
+    def _distribution(self, dist_id):
+        if dist_id not in self.distributions:
+            raise AwsError('NoSuchDistribution', 'The specified distribution does not exist.', 404)
+        return self.distributions[dist_id]
+
+    def _distribution_view(self, entry):
+        deployed = self.elapsed(entry['modified'], 'cdn_deploy')
+        return {
+            'Id': entry['Id'],
+            'ARN': entry['ARN'],
+            'Status': 'Deployed' if deployed else 'InProgress',
+            'LastModifiedTime': entry['LastModifiedTime'],
+            'InProgressInvalidationBatches': 0,
+            'DomainName': entry['DomainName'],
+            'DistributionConfig': json.loads(json.dumps(entry['config']))
+        }
+
+    def _check_associations(self, config):
+        # only published functions can be associated
+        associations = config.get('DefaultCacheBehavior', {}).get('FunctionAssociations', {})
+        for item in associations.get('Items', []):
+            function = self.cdn_functions.get(item['FunctionARN'].rsplit('/', 1)[-1])
+            if function is None or function['live'] is None:
+                raise AwsError('NoSuchFunctionExists', 'The specified function does not exist.', 404)
+
+    def cloudfront_create_distribution_with_tags(self, params):
+        config = params['DistributionConfigWithTags']['DistributionConfig']
+        self._check_associations(config)
+        for alias in config.get('Aliases', {}).get('Items', []):
+            for other in self.distributions.values():
+                if alias in other['config'].get('Aliases', {}).get('Items', []):
+                    raise AwsError('CNAMEAlreadyExists', 'One or more of the CNAMEs you provided are already associated with a different resource.', 409)
+        dist_id = new_id('E', 13)
+        self.distributions[dist_id] = {
+            'Id': dist_id,
+            'ARN': 'arn:aws:cloudfront::'+ACCOUNT_ID+':distribution/'+dist_id,
+            'DomainName': 'd'+dist_id.lower()[1:]+'.cloudfront.net',
+            'LastModifiedTime': now_utc(),
+            'modified': time.monotonic(),
+            'config': json.loads(json.dumps(config)),
+            'ETag': new_id('E', 13),
+            'tags': params['DistributionConfigWithTags'].get('Tags', {})
+        }
+        entry = self.distributions[dist_id]
+        return {'Distribution': self._distribution_view(entry), 'ETag': entry['ETag'],
+                'Location': 'https://cloudfront.amazonaws.com/2020-05-31/distribution/'+dist_id}
+
+    def cloudfront_get_distribution(self, params):
+        entry = self._distribution(params['Id'])
+        return {'Distribution': self._distribution_view(entry), 'ETag': entry['ETag']}
+
+    def cloudfront_get_distribution_config(self, params):
+        entry = self._distribution(params['Id'])
+        return {'DistributionConfig': json.loads(json.dumps(entry['config'])), 'ETag': entry['ETag']}
+
+    def cloudfront_update_distribution(self, params):
+        entry = self._distribution(params['Id'])
+        if params.get('IfMatch') != entry['ETag']:
+            raise AwsError('PreconditionFailed', 'The If-Match version is missing or not valid for the resource.', 412)
+        self._check_associations(params['DistributionConfig'])
+        entry['config'] = json.loads(json.dumps(params['DistributionConfig']))
+        entry['ETag'] = new_id('E', 13)
+        entry['LastModifiedTime'] = now_utc()
+        entry['modified'] = time.monotonic()
+        return {'Distribution': self._distribution_view(entry), 'ETag': entry['ETag']}
+
+    def cloudfront_delete_distribution(self, params):
+        # only once it is disabled and that has deployed
+        entry = self._distribution(params['Id'])
+        if params.get('IfMatch') != entry['ETag']:
+            raise AwsError('PreconditionFailed', 'The If-Match version is missing or not valid for the resource.', 412)
+        if entry['config'].get('Enabled') or not self.elapsed(entry['modified'], 'cdn_deploy'):
+            raise AwsError('DistributionNotDisabled', 'The distribution you are trying to delete has not been disabled.', 409)
+        del self.distributions[params['Id']]
+
+    def cloudfront_list_tags_for_resource(self, params):
+        for entry in self.distributions.values():
+            if entry['ARN'] == params['Resource']:
+                return {'Tags': json.loads(json.dumps(entry['tags']))}
+        raise AwsError('NoSuchResource', 'The specified resource does not exist.', 404)
+
+    def cloudfront_list_distributions(self, params):
+        ids = sorted(self.distributions)
+        ids, marker = page(ids, params.get('Marker'), params.get('MaxItems', 100))
+        items = []
+        for dist_id in ids:
+            view = self._distribution_view(self.distributions[dist_id])
+            config = view.pop('DistributionConfig')
+            items.append(dict(config, **view))
+        listing = {'Items': items, 'Quantity': len(items), 'IsTruncated': marker is not None,
+                   'MaxItems': int(params.get('MaxItems', 100)), 'Marker': params.get('Marker', '')}
+        if marker:
+            listing['NextMarker'] = marker
+        return {'DistributionList': listing}
+
+    def _cdn_function(self, name):
+        if name not in self.cdn_functions:
+            raise AwsError('NoSuchFunctionExists', 'The specified function does not exist.', 404)
+        return self.cdn_functions[name]
+
+    def _cdn_function_associated(self, function):
+        return any(item['FunctionARN'] == function['ARN']
+                   for entry in self.distributions.values()
+                   for item in entry['config'].get('DefaultCacheBehavior', {})
+                                              .get('FunctionAssociations', {}).get('Items', []))
+
+    def _cdn_function_summary(self, function, stage='DEVELOPMENT'):
+        return {
+            'Name': function['Name'],
+            'Status': 'DEPLOYED' if self._cdn_function_associated(function) else 'UNASSOCIATED' if function['live'] is not None else 'UNPUBLISHED',
+            'FunctionConfig': dict(function['config']),
+            'FunctionMetadata': {
+                'FunctionARN': function['ARN'],
+                'Stage': stage,
+                'CreatedTime': function['CreatedTime'],
+                'LastModifiedTime': function['LastModifiedTime']
+            }
+        }
+
+    def _cdn_function_stage(self, params):
+        # the function and the code of the stage asked for
+        function = self._cdn_function(params['Name'])
+        stage = params.get('Stage', 'DEVELOPMENT')
+        code = function['code'] if stage == 'DEVELOPMENT' else function['live']
+        if code is None:
+            raise AwsError('NoSuchFunctionExists', 'The function has not been published.', 404)
+        return function, stage, code
+
+    def cloudfront_create_function(self, params):
+        if params['Name'] in self.cdn_functions:
+            raise AwsError('FunctionAlreadyExists', 'A function with the same name already exists.', 409)
+        function = {
+            'Name': params['Name'],
+            'ARN': 'arn:aws:cloudfront::'+ACCOUNT_ID+':function/'+params['Name'],
+            'config': dict(params['FunctionConfig']),
+            'code': body_bytes(params['FunctionCode']),
+            'live': None,
+            'ETag': new_id('E', 13),
+            'CreatedTime': now_utc(),
+            'LastModifiedTime': now_utc()
+        }
+        self.cdn_functions[params['Name']] = function
+        return {'FunctionSummary': self._cdn_function_summary(function), 'ETag': function['ETag'],
+                'Location': 'https://cloudfront.amazonaws.com/2020-05-31/function/'+function['ARN']}
+
+    def cloudfront_describe_function(self, params):
+        function, stage, _ = self._cdn_function_stage(params)
+        return {'FunctionSummary': self._cdn_function_summary(function, stage), 'ETag': function['ETag']}
+
+    def cloudfront_get_function(self, params):
+        function, _, code = self._cdn_function_stage(params)
+        return {'FunctionCode': StreamingBody(io.BytesIO(code), len(code)), 'ETag': function['ETag'],
+                'ContentType': 'application/octet-stream'}
+
+    def cloudfront_update_function(self, params):
+        function = self._cdn_function(params['Name'])
+        if params.get('IfMatch') != function['ETag']:
+            raise AwsError('PreconditionFailed', 'The If-Match version is missing or not valid for the resource.', 412)
+        function.update(config=dict(params['FunctionConfig']), code=body_bytes(params['FunctionCode']),
+                        ETag=new_id('E', 13), LastModifiedTime=now_utc())
+        return {'FunctionSummary': self._cdn_function_summary(function), 'ETag': function['ETag']}
+
+    def cloudfront_publish_function(self, params):
+        function = self._cdn_function(params['Name'])
+        if params.get('IfMatch') != function['ETag']:
+            raise AwsError('PreconditionFailed', 'The If-Match version is missing or not valid for the resource.', 412)
+        function['live'] = function['code']
+        return {'FunctionSummary': self._cdn_function_summary(function, 'LIVE')}
+
+    def cloudfront_delete_function(self, params):
+        function = self._cdn_function(params['Name'])
+        if params.get('IfMatch') != function['ETag']:
+            raise AwsError('PreconditionFailed', 'The If-Match version is missing or not valid for the resource.', 412)
+        if self._cdn_function_associated(function):
+            raise AwsError('FunctionInUse', 'Cannot delete function, it\'s in use by one or more distributions.', 409)
+        del self.cdn_functions[params['Name']]
+
+    def _kv_store(self, name):
+        if name not in self.kv_stores:
+            raise AwsError('EntityNotFound', 'The key value store entity was not found.', 404)
+        return self.kv_stores[name]
+
+    def _kv_store_by_arn(self, arn):
+        for store in self.kv_stores.values():
+            if store['ARN'] == arn:
+                return store
+        raise AwsError('ResourceNotFoundException', 'The key value store was not found.', 404)
+
+    def _kv_store_summary(self, store):
+        return dict((key, store[key]) for key in ('Name', 'Id', 'Comment', 'ARN', 'Status', 'LastModifiedTime'))
+
+    def cloudfront_create_key_value_store(self, params):
+        if params['Name'] in self.kv_stores:
+            raise AwsError('EntityAlreadyExists', 'The key value store entity already exists.', 409)
+        store_id = str(uuid.uuid4())
+        store = {
+            'Name': params['Name'],
+            'Id': store_id,
+            'Comment': params.get('Comment', ''),
+            'ARN': 'arn:aws:cloudfront::'+ACCOUNT_ID+':key-value-store/'+store_id,
+            'Status': 'READY',
+            'LastModifiedTime': now_utc(),
+            'ETag': new_id('E', 13),
+            'items': {}
+        }
+        self.kv_stores[params['Name']] = store
+        return {'KeyValueStore': self._kv_store_summary(store), 'ETag': store['ETag']}
+
+    def cloudfront_describe_key_value_store(self, params):
+        store = self._kv_store(params['Name'])
+        return {'KeyValueStore': self._kv_store_summary(store), 'ETag': store['ETag']}
+
+    def cloudfront_delete_key_value_store(self, params):
+        store = self._kv_store(params['Name'])
+        if params.get('IfMatch') != store['ETag']:
+            raise AwsError('PreconditionFailed', 'The If-Match version is missing or not valid for the resource.', 412)
+        if any(item['KeyValueStoreARN'] == store['ARN'] for function in self.cdn_functions.values()
+               for item in function['config'].get('KeyValueStoreAssociations', {}).get('Items', [])):
+            raise AwsError('CannotDeleteEntityWhileInUse', 'The key value store is associated with a function.', 409)
+        del self.kv_stores[params['Name']]
+
+    def _kv_store_stats(self, store):
+        return {'ItemCount': len(store['items']),
+                'TotalSizeInBytes': sum(len(key.encode('utf-8')) + len(value.encode('utf-8'))
+                                        for key, value in store['items'].items())}
+
+    def cloudfront_keyvaluestore_describe_key_value_store(self, params):
+        store = self._kv_store_by_arn(params['KvsARN'])
+        return dict(self._kv_store_stats(store), KvsARN=store['ARN'], Created=store['LastModifiedTime'],
+                    ETag=store['ETag'], LastModified=store['LastModifiedTime'], Status='READY')
+
+    def cloudfront_keyvaluestore_list_keys(self, params):
+        store = self._kv_store_by_arn(params['KvsARN'])
+        items = [{'Key': key, 'Value': store['items'][key]} for key in sorted(store['items'])]
+        listed, token = page(items, params.get('NextToken'), min(params.get('MaxResults', 10), 50))
+        return dict({'Items': listed}, **({'NextToken': token} if token else {}))
+
+    def cloudfront_keyvaluestore_update_keys(self, params):
+        store = self._kv_store_by_arn(params['KvsARN'])
+        if params.get('IfMatch') != store['ETag']:
+            raise AwsError('ConflictException', 'The ETag does not match the store\'s.', 409)
+        puts, deletes = params.get('Puts', []), params.get('Deletes', [])
+        if len(puts) + len(deletes) > 50:
+            raise AwsError('ValidationException', 'At most 50 keys can be updated at once.', 400)
+        for item in puts:
+            store['items'][item['Key']] = item['Value']
+        for item in deletes:
+            store['items'].pop(item['Key'], None)
+        store['ETag'] = new_id('E', 13)
+        return dict(self._kv_store_stats(store), ETag=store['ETag'])
+
+    def cloudfront_create_invalidation(self, params):
+        self._distribution(params['DistributionId'])
+        batch = params['InvalidationBatch']
+        invalidation = {
+            'Id': new_id('I', 13),
+            'Status': 'InProgress',
+            'CreateTime': now_utc(),
+            'InvalidationBatch': batch
+        }
+        self.invalidations.append(dict(invalidation, DistributionId= params['DistributionId'],
+                                       created= time.monotonic()))
+        return {'Invalidation': invalidation,
+                'Location': 'https://cloudfront.amazonaws.com/2020-05-31/distribution/'+params['DistributionId']+'/invalidation/'+invalidation['Id']}
+
+    def _invalidation_view(self, invalidation):
+        done = self.elapsed(invalidation['created'], 'cdn_invalidation')
+        return {'Id': invalidation['Id'], 'CreateTime': invalidation['CreateTime'],
+                'Status': 'Completed' if done else 'InProgress'}
+
+    def cloudfront_list_invalidations(self, params):
+        self._distribution(params['DistributionId'])
+        found = [invalidation for invalidation in reversed(self.invalidations)
+                 if invalidation['DistributionId'] == params['DistributionId']]
+        items, marker = page(found, params.get('Marker'), params.get('MaxItems', 100))
+        listing = {'Items': [self._invalidation_view(invalidation) for invalidation in items],
+                   'Quantity': len(items), 'IsTruncated': marker is not None,
+                   'MaxItems': int(params.get('MaxItems', 100)), 'Marker': params.get('Marker', '')}
+        if marker:
+            listing['NextMarker'] = marker
+        return {'InvalidationList': listing}
+
+    def cloudfront_get_invalidation(self, params):
+        for invalidation in self.invalidations:
+            if invalidation['Id'] == params['Id'] and invalidation['DistributionId'] == params['DistributionId']:
+                return {'Invalidation': dict(self._invalidation_view(invalidation),
+                                             InvalidationBatch= invalidation['InvalidationBatch'])}
+        raise AwsError('NoSuchInvalidation', 'The specified invalidation does not exist.', 404)
+
+    ##########################################
+    # cloudwatch logs
+    ##########################################
+    def add_log_group(self, name, streams=0, expired=0, now_ms=None, stream_bytes=4096):
+        # a group with `streams` streams, `expired` of them last written
+        # to over a year ago and the rest within the last day
+        now_ms = int(time.time() * 1000) if now_ms is None else now_ms
+        group = {
+            'group': {'logGroupName': name, 'arn': self.arn('logs', 'log-group:'+name+':*'),
+                      'creationTime': now_ms - 400 * 86400000, 'storedBytes': 0},
+            'streams': {}
+        }
+        for n in range(streams):
+            last = now_ms - (400 * 86400000 if n < expired else 3600000) + n
+            group['streams']['stream-%06d' % n] = {
+                'logStreamName': 'stream-%06d' % n,
+                'creationTime': last - 60000,
+                'firstEventTimestamp': last - 60000,
+                'lastEventTimestamp': last,
+                'storedBytes': stream_bytes
+            }
+            group['group']['storedBytes'] += stream_bytes
+        self.log_groups[name] = group
+
+    def _log_group(self, name):
+        if name not in self.log_groups:
+            raise AwsError('ResourceNotFoundException', 'The specified log group does not exist.')
+        return self.log_groups[name]
+
+    def logs_describe_log_groups(self, params):
+        names = sorted(name for name in self.log_groups if name.startswith(params.get('logGroupNamePrefix', '')))
+        names, token = page(names, params.get('nextToken'), params.get('limit', 50))
+        result = {'logGroups': [dict(self.log_groups[name]['group']) for name in names]}
+        if token:
+            result['nextToken'] = token
+        return result
+
+    def logs_put_retention_policy(self, params):
+        self._log_group(params['logGroupName'])['group']['retentionInDays'] = params['retentionInDays']
+
+    def logs_describe_log_streams(self, params):
+        streams = list(self._log_group(params['logGroupName'])['streams'].values())
+        if params.get('orderBy') == 'LastEventTime':
+            order = lambda stream: (stream.get('lastEventTimestamp', 0), stream['logStreamName'])
+        else:
+            order = lambda stream: (stream['logStreamName'],)
+        descending = params.get('descending', False)
+        streams.sort(key=order, reverse=descending)
+        streams, token = page(streams, params.get('nextToken'), params.get('limit', 50), order, descending)
+        result = {'logStreams': [dict(stream) for stream in streams]}
+        if token:
+            result['nextToken'] = token
+        return result
+
+    def logs_delete_log_stream(self, params):
+        group = self._log_group(params['logGroupName'])
+        stream = group['streams'].pop(params['logStreamName'], None)
+        if stream is None:
+            raise AwsError('ResourceNotFoundException', 'The specified log stream does not exist.')
+        group['group']['storedBytes'] -= stream['storedBytes']
+
+    ##########################################
+    # Delivering events to the functions
+    ##########################################
+    def drain_queues(self):
+        # What the event source mappings would deliver: every message
+        # waiting on a queue, in batches of the mapping's batch size.
+        with self._lock:
+            deliveries = []
+            for mapping in self.mappings.values():
+                if mapping['State'] != 'Enabled':
+                    continue
+                queue = [queue for queue in self.queues.values() if queue['arn'] == mapping['EventSourceArn']]
+                if not queue:
+                    continue
+                messages = queue[0]['messages']
+                while messages:
+                    batch = [messages.popleft() for _ in range(min(len(messages), mapping['BatchSize']))]
+                    deliveries.append((mapping['FunctionArn'], {'Records': [
+                        {'messageId': str(uuid.uuid4()), 'body': body, 'eventSource': 'aws:sqs',
+                         'eventSourceARN': mapping['EventSourceArn']} for body in batch
+                    ]}))
+            self.pending.extend(deliveries)
+
+    def deliver(self):
+        # invoke the functions for every pending event, in order, until
+        # nothing is left (an invocation may cause more events)
+        results = []
+        while True:
+            with self._lock:
+                if not self.pending:
+                    return results
+                target, event = self.pending.popleft()
+            results.append(self.host.invoke(target, event))
+
+    def summary(self):
+        with self._lock:
+            return {
+                'calls': sum(self.calls.values()),
+                'calls_by_origin': dict(self.calls_by_origin),
+                'calls_by_operation': dict(sorted(self.calls.items())),
+                'simulated_latency': dict((service, round(seconds, 3)) for service, seconds in sorted(self.latency.items())),
+                'invocations': dict(self.invocations),
+                'invocation_time': dict((name, round(seconds, 3)) for name, seconds in self.invocation_time.items())
+            }
+
+
+##########################################
+# Running the deployed functions in process
+##########################################
+class LambdaHost:
+    # Loads a function's handler module from lambdas/ the way the lambda
+    # runtime would, with the shared runtime on the path and the
+    # function's environment variables set, and the shared runtime's
+    # session wired to the stand-in before any handler builds a client.
+    def __init__(self, standin):
+        self.standin = standin
+        self.modules = {}
+        self.runtime = None
+
+    def module(self, name):
+        if name in self.modules:
+            return self.modules[name]
+        for path in (os.path.join(LAMBDAS, 'shared'), os.path.join(LAMBDAS, name)):
+            if path not in sys.path:
+                sys.path.insert(0, path)
+        if self.runtime is None:
+            self.runtime = importlib.import_module('runtime')
+            self.standin.install(self.runtime.session, origin='functions')
+        self.modules[name] = importlib.import_module(name)
+        return self.modules[name]
+
+    def invoke(self, function, event):
+        with self.standin._lock:
+            config = self.standin._function(function)['config']
+            name = config['FunctionName']
+            module_name, handler_name = config['Handler'].rsplit('.', 1)
+            environment = dict(config['Environment']['Variables'])
+            timeout = config['Timeout']
+        environment['AWS_LAMBDA_FUNCTION_NAME'] = name
+        environment['AWS_LAMBDA_LOG_GROUP_NAME'] = '/aws/lambda/'+name
+        os.environ.update(environment)
+        handler = getattr(self.module(module_name), handler_name)
+        started = time.monotonic()
+        context = types.SimpleNamespace(
+            function_name= name,
+            aws_request_id= str(uuid.uuid4()),
+            get_remaining_time_in_millis= lambda: int((timeout - (time.monotonic() - started)) * 1000)
+        )
+        try:
+            return handler(event, context)
+        finally:
+            with self.standin._lock:
+                self.standin.invocations[name] += 1
+                self.standin.invocation_time[name] += time.monotonic() - started
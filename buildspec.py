@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+import sys
+import json
+import shlex
+import settings
+
+##########################################
+# Generated buildspec per site generator
+##########################################
+# Each generator profile says which CodeBuild image and compute type it
+# builds on, how to install it, how to render the site and which
+# directories are worth keeping between builds: the package caches
+# (pip, bundler), the generator binary itself and the generator's own
+# incremental output. With those cached a build on an unchanged
+# dependency set only renders the content and syncs what changed.
+#
+# The spec is plain JSON, which CodeBuild accepts as YAML.
+#
+# With sync_mode 'stream' the sync runs the generator's render command
+# itself and uploads a new release while it renders (see
+# deploy_tools/sync.py), so it needs deploy_mode 'release'; with 'after'
+# it syncs the finished output. With deploy_mode 'release' every
+# build is deployed as a new release that the cdn is switched to, the
+# changed paths then go to the invalidation queue.
+#
+# With redirects_file set the sync also publishes the site's redirects
+# to the cdn's function, with the release when there are releases.
+
+IMAGE = 'aws/codebuild/standard:7.0'
+PIP_CACHE = '/root/.cache/pip/**/*'
+SYNC_CACHE = '.sync-cache/**/*'
+
+GENERATORS = {
+    'hugo': {
+        'image': IMAGE,
+        'compute_type': 'BUILD_GENERAL1_SMALL',
+        'runtimes': {'python': '3.11'},
+        'variables': {'HUGO_VERSION': '0.121.1'},
+        'install': [
+            # the extended binary is kept in the cache, only fetched when the version changes
+            'if [ ! -x /root/.cache/hugo-bin/hugo-$HUGO_VERSION ]; then'
+            ' mkdir -p /root/.cache/hugo-bin'
+            ' && curl -sSL https://github.com/gohugoio/hugo/releases/download/v$HUGO_VERSION/hugo_extended_${HUGO_VERSION}_linux-amd64.tar.gz'
+            ' | tar -xz -C /root/.cache/hugo-bin hugo'
+            ' && mv /root/.cache/hugo-bin/hugo /root/.cache/hugo-bin/hugo-$HUGO_VERSION; fi',
+            'ln -sf /root/.cache/hugo-bin/hugo-$HUGO_VERSION /usr/local/bin/hugo'
+        ],
+        'build': [
+            'hugo --minify --cacheDir /root/.cache/hugo_cache'
+        ],
+        'output': 'public',
+        'cache': [
+            '/root/.cache/hugo-bin/**/*',
+            '/root/.cache/hugo_cache/**/*',
+            'resources/_gen/**/*'
+        ]
+    },
+    'jekyll': {
+        'image': IMAGE,
+        'compute_type': 'BUILD_GENERAL1_MEDIUM',
+        'runtimes': {'python': '3.11', 'ruby': '3.2'},
+        'variables': {'JEKYLL_ENV': 'production'},
+        'install': [
+            'bundle config set --local path vendor/bundle',
+            'bundle install --jobs 4'
+        ],
+        'build': [
+            'bundle exec jekyll build --incremental'
+        ],
+        'output': '_site',
+        'cache': [
+            'vendor/bundle/**/*',
+            '.jekyll-cache/**/*',
+            '.jekyll-metadata',
+            '_site/**/*'
+        ]
+    },
+    'pelican': {
+        'image': IMAGE,
+        'compute_type': 'BUILD_GENERAL1_SMALL',
+        'runtimes': {'python': '3.11'},
+        'variables': {},
+        'install': [
+            'pip3 install -r requirements.txt'
+        ],
+        'build': [
+            'pelican content -o output -s publishconf.py -e CACHE_CONTENT=true LOAD_CONTENT_CACHE=true'
+        ],
+        'output': 'output',
+        'cache': [
+            'cache/**/*'
+        ]
+    }
+}
+
+
+def generator(var):
+    if var.generator not in GENERATORS:
+        raise ValueError('unknown generator %r, expected one of %s'
+                         % (var.generator, ', '.join(sorted(GENERATORS))))
+    return GENERATORS[var.generator]
+
+
+def image(var):
+    return var.build_image or generator(var)['image']
+
+
+def compute_type(var):
+    return var.build_compute_type or generator(var)['compute_type']
+
+
+def sync_mode(var):
+    mode = getattr(var, 'sync_mode', 'after')
+    if mode not in ('after', 'stream'):
+        raise ValueError('unknown sync_mode %r, expected \'after\' or \'stream\'' % mode)
+    if mode == 'stream' and deploy_mode(var) != 'release':
+        # streaming over the live files would serve pages mid-deploy
+        raise ValueError('sync_mode \'stream\' deploys each build as a release, it needs deploy_mode \'release\'')
+    return mode
+
+
+def deploy_mode(var):
+    mode = getattr(var, 'deploy_mode', 'inplace')
+    if mode not in ('inplace', 'release'):
+        raise ValueError('unknown deploy_mode %r, expected \'inplace\' or \'release\'' % mode)
+    return mode
+
+
+def releases_kept(var):
+    kept = getattr(var, 'releases_kept', 5)
+    if not isinstance(kept, int) or kept < 1:
+        raise ValueError('releases_kept must be a whole number of at least 1, not %r' % (kept,))
+    return kept
+
+
+def build_commands(var):
+    profile = generator(var)
+    sync = 'python3 deploy_tools/sync.py %s $SITE_BUCKET --manifest .sync-cache/manifest.json' \
+        % profile['output']
+    if var.redirects_file:
+        sync += ' --redirects '+shlex.quote(var.redirects_file)
+    if deploy_mode(var) == 'release':
+        sync += ' --release auto --switch --keep %d --queue-url $INVALIDATION_QUEUE_URL' % releases_kept(var)
+    if sync_mode(var) == 'stream':
+        # the render command runs under the sync, the ones before it as usual
+        return profile['build'][:-1] + [sync+' --stream -- sh -c '+shlex.quote(profile['build'][-1])]
+    # the sync only runs when the render succeeded
+    return profile['build'] + [sync]
+
+
+def spec(var):
+    profile = generator(var)
+    return {
+        'version': 0.2,
+        'env': {
+            'variables': profile['variables']
+        },
+        'phases': {
+            'install': {
+                'runtime-versions': profile['runtimes'],
+                'commands': ['pip3 install -r deploy_tools/requirements.txt'] + profile['install']
+            },
+            'build': {
+                'commands': build_commands(var)
+            }
+        },
+        'cache': {
+            'paths': [PIP_CACHE, SYNC_CACHE] + profile['cache']
+        }
+    }
+
+
+def render(var):
+    return json.dumps(spec(var), indent=2)
+
+
+def main(argv=None):
+    # print the spec, eg. to commit it to the site repo as buildspec.yml
+    print(render(settings))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
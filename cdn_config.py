@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+import sys
+import json
+import botocore.session
+from botocore.validate import ParamValidator
+import settings
+
+##########################################
+# CloudFront distribution config per site
+##########################################
+# Caching is set by a cache policy instead of the legacy ForwardedValues
+# and TTLs: by default the managed CachingOptimized policy, which keys
+# on nothing but the path and the accepted encodings, so objects are
+# shared by every viewer and CloudFront can serve them compressed (gzip
+# or brotli, with Compress on). Viewers get HTTP/3 where they support it.
+# Origin Shield adds a regional cache in front of the bucket that every
+# edge location goes through, which cuts the fetches from S3 when the
+# site is served from many locations; it is billed per request so it is
+# off unless a region is set.
+#
+# With deploy_mode 'release' the builds set the origin path, pointing it
+# at the release being served (see deploy_tools/sync.py). Updating the
+# distribution keeps whatever path it has.
+#
+# Errors are answered by CloudFront too. A missing key is a 403 from the
+# bucket (anyone may get its objects, not list them) that viewers see as
+# a 404 with the site's error page, taken from the release being served
+# and cached for error_caching_ttl: the invalidation of a deploy clears
+# the paths it adds. Server errors are only held for a few seconds, so an
+# origin hiccup is retried soon. With redirects_file set, a CloudFront
+# Function on viewer requests answers the site's redirects (see
+# deploy_tools/redirects.py).
+#
+# The settings are checked against botocore's service model, offline:
+# python3 cdn_config.py prints and validates the config of settings.py.
+
+# Managed policies, by the name used in the console
+CACHE_POLICIES = {
+    'CachingOptimized': '658327ea-f89d-4fab-a63d-7e88639e58f6',
+    'CachingOptimizedForUncompressedObjects': 'b2884449-e4de-46a7-ac36-70bc7f1ddd6d',
+    'CachingDisabled': '4135ea2d-6df8-44a3-9df3-4b5a84be39ad'
+}
+ORIGIN_REQUEST_POLICIES = {
+    'CORS-S3Origin': '88a5eaf4-2fd4-4709-b370-b4c650ea3fcf',
+    'CORS-CustomOrigin': '59781a5b-3903-41f3-afcb-af62929ccde1',
+    'UserAgentRefererHeaders': 'acba4595-bd28-49b8-b9fe-13317c0390fa',
+    'AllViewerExceptHostHeader': 'b689b0a8-53d0-40ab-baf2-68738e2966ac'
+}
+# Regions Origin Shield runs in
+ORIGIN_SHIELD_REGIONS = (
+    'us-east-1', 'us-east-2', 'us-west-2', 'ap-south-1', 'ap-northeast-1', 'ap-northeast-2',
+    'ap-southeast-1', 'ap-southeast-2', 'eu-central-1', 'eu-west-1', 'eu-west-2', 'sa-east-1'
+)
+# errors cached briefly and passed on as they are
+SERVER_ERRORS = (500, 502, 503, 504)
+SERVER_ERROR_TTL = 5
+
+
+_service_model = None
+
+
+def service_model():
+    # shipped with botocore, nothing is fetched; loaded once, every
+    # setting check and probe asks for it
+    global _service_model
+    if _service_model is None:
+        _service_model = botocore.session.get_session().get_service_model('cloudfront')
+    return _service_model
+
+
+def enum(shape_name):
+    return service_model().shape_for(shape_name).enum
+
+
+def policy_id(kind, value, managed):
+    # a managed policy by name, or the id of one of the account's own
+    if not value:
+        return None
+    if value in managed:
+        return managed[value]
+    if len(value) == 36 and value.count('-') == 4:
+        return value
+    raise ValueError('unknown %s %r, expected a policy id or one of %s'
+                     % (kind, value, ', '.join(sorted(managed))))
+
+
+def cache_policy_id(var):
+    return policy_id('cache_policy', var.cache_policy, CACHE_POLICIES)
+
+
+def origin_request_policy_id(var):
+    return policy_id('origin_request_policy', var.origin_request_policy, ORIGIN_REQUEST_POLICIES)
+
+
+def origin_shield_region(var):
+    # 'auto' shields in the bucket's region
+    region = var.region if var.origin_shield == 'auto' else var.origin_shield
+    if region and region not in ORIGIN_SHIELD_REGIONS:
+        raise ValueError('Origin Shield is not available in %r, expected one of %s'
+                         % (region, ', '.join(ORIGIN_SHIELD_REGIONS)))
+    return region
+
+
+def http_version(var):
+    if var.http_version not in enum('HttpVersion'):
+        raise ValueError('unknown http_version %r, expected one of %s'
+                         % (var.http_version, ', '.join(enum('HttpVersion'))))
+    return var.http_version
+
+
+def min_tls_version(var):
+    # SSLv3 is only accepted with dedicated ip addresses, not sni
+    versions = [version for version in enum('MinimumProtocolVersion') if version != 'SSLv3']
+    if var.min_tls_version not in versions:
+        raise ValueError('unknown min_tls_version %r, expected one of %s'
+                         % (var.min_tls_version, ', '.join(versions)))
+    return var.min_tls_version
+
+
+def error_caching_ttl(var):
+    ttl = var.error_caching_ttl
+    if not isinstance(ttl, int) or ttl < 0:
+        raise ValueError('error_caching_ttl must be a whole number of seconds, not %r' % (ttl,))
+    return ttl
+
+
+def custom_error_responses(var):
+    items = []
+    for code in (403, 404):
+        item = {'ErrorCode': code, 'ErrorCachingMinTTL': error_caching_ttl(var)}
+        if var.error_page:
+            item.update(ResponsePagePath='/'+var.error_page.lstrip('/'), ResponseCode='404')
+        items.append(item)
+    items.extend({'ErrorCode': code, 'ErrorCachingMinTTL': SERVER_ERROR_TTL} for code in SERVER_ERRORS)
+    return {'Quantity': len(items), 'Items': items}
+
+
+def function_associations(function_arn):
+    items = [{'FunctionARN': function_arn, 'EventType': 'viewer-request'}] if function_arn else []
+    return {'Quantity': len(items), 'Items': items}
+
+
+def origin(var, path=''):
+    item = {
+        'Id': var.website_fqdn,
+        'DomainName': var.website_fqdn+'.s3.amazonaws.com',
+        'OriginPath': path,
+        'CustomOriginConfig': {
+            'HTTPPort': 80,
+            'HTTPSPort': 443,
+            'OriginProtocolPolicy': 'http-only'
+        }
+    }
+    region = origin_shield_region(var)
+    item['OriginShield'] = {'Enabled': True, 'OriginShieldRegion': region} if region else {'Enabled': False}
+    return item
+
+
+def cache_behavior(var, function_arn=None):
+    behavior = {
+        'TargetOriginId': var.website_fqdn,
+        'ViewerProtocolPolicy': 'redirect-to-https',
+        'Compress': bool(var.compress),
+        'CachePolicyId': cache_policy_id(var) or CACHE_POLICIES['CachingOptimized'],
+        'FunctionAssociations': function_associations(function_arn)
+    }
+    request_policy = origin_request_policy_id(var)
+    if request_policy:
+        behavior['OriginRequestPolicyId'] = request_policy
+    return behavior
+
+
+def origin_path(distribution_config):
+    # the path a deploy set, '' when serving the bucket root
+    items = distribution_config['Origins'].get('Items', [])
+    return items[0].get('OriginPath', '') if items else ''
+
+
+def config(var, cert_arn, call_ref, path='', function_arn=None):
+    return {
+        'CallerReference': call_ref,
+        'Aliases': {
+            'Quantity': 1,
+            'Items': [
+                var.website_fqdn,
+            ]
+        },
+        'DefaultRootObject': 'index.html',
+        'Origins': {
+            'Quantity': 1,
+            'Items': [
+                origin(var, path)
+            ]
+        },
+        'DefaultCacheBehavior': cache_behavior(var, function_arn),
+        'CustomErrorResponses': custom_error_responses(var),
+        'Comment': 'Static website cdn',
+        'Enabled': True,
+        'ViewerCertificate': {
+            'CloudFrontDefaultCertificate': False,
+            'ACMCertificateArn': cert_arn,
+            'SSLSupportMethod': 'sni-only',
+            'MinimumProtocolVersion': min_tls_version(var)
+        },
+        'HttpVersion': http_version(var)
+    }
+
+
+def validate(distribution_config):
+    # the checks botocore makes before sending a request: required
+    # members, types, lengths and ranges
+    shape = service_model().shape_for('DistributionConfig')
+    report = ParamValidator().validate(distribution_config, shape)
+    if report.has_errors():
+        raise ValueError(report.generate_report())
+    return distribution_config
+
+
+def error_responses(items):
+    # comparable whether listed or built here
+    return sorted((int(item['ErrorCode']), item.get('ResponsePagePath') or '', str(item.get('ResponseCode') or ''),
+                   int(item.get('ErrorCachingMinTTL', 10))) for item in items)
+
+
+def differences(var, summary, function_arn=None):
+    # what a listed distribution has that the settings no longer ask for
+    behavior = cache_behavior(var, function_arn)
+    current = summary['DefaultCacheBehavior']
+    reasons = []
+    if current.get('CachePolicyId') != behavior['CachePolicyId'] or \
+            current.get('OriginRequestPolicyId') != behavior.get('OriginRequestPolicyId'):
+        reasons.append('cache policy changed')
+    if current.get('Compress', False) != behavior['Compress']:
+        reasons.append('compression changed')
+    if current.get('FunctionAssociations', {}).get('Items', []) != behavior['FunctionAssociations']['Items']:
+        reasons.append('redirects function changed')
+    if error_responses(summary.get('CustomErrorResponses', {}).get('Items', [])) != \
+            error_responses(custom_error_responses(var)['Items']):
+        reasons.append('error responses changed')
+    if summary.get('HttpVersion') != http_version(var):
+        reasons.append('http version changed')
+    if summary['ViewerCertificate'].get('MinimumProtocolVersion') != min_tls_version(var):
+        reasons.append('tls version changed')
+    shield = [item.get('OriginShield', {'Enabled': False}) for item in summary['Origins'].get('Items', [])]
+    if shield != [origin(var)['OriginShield']]:
+        reasons.append('origin shield changed')
+    return reasons
+
+
+def main(argv=None):
+    # print the config settings.py would create, after validating it
+    function_arn = 'arn:aws:cloudfront::123456789012:function/example' if settings.redirects_file else None
+    distribution_config = validate(config(settings, 'arn:aws:acm:us-east-1:123456789012:certificate/example',
+                                          'example', function_arn=function_arn))
+    print(json.dumps(distribution_config, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
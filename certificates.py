@@ -0,0 +1,157 @@
+import datetime
+import aws
+import dns
+import inventory
+import readiness
+from readiness import error_matches
+
+##########################################
+# ACM certificates for the cdn
+##########################################
+# CloudFront only takes certificates from us-east-1. Before requesting
+# one, the account's ISSUED certificates are searched for one that
+# already covers website_fqdn, by name or by wildcard, so reruns and
+# sites that share a domain never wait for a new certificate. A new
+# certificate names the apex and the www host together when the site is
+# either of them, and all of its validation records go to Route 53 in a
+# single change.
+
+REGION = 'us-east-1'
+# certificates that expire sooner are not worth reusing
+MIN_VALIDITY = datetime.timedelta(days=30)
+
+
+def client():
+    return aws.client('acm', region_name= REGION)
+
+
+def covers(name, fqdn):
+    # '*.example.com' covers 'www.example.com' but neither 'example.com'
+    # nor 'a.www.example.com'
+    name, fqdn = name.rstrip('.').lower(), fqdn.rstrip('.').lower()
+    if name == fqdn:
+        return True
+    return name.startswith('*.') and '.' in fqdn and fqdn.split('.', 1)[1] == name[2:]
+
+
+def wanted_names(var):
+    # the site's name first, as the certificate's DomainName
+    apex = var.dns_domain.rstrip('.').lower()
+    fqdn = var.website_fqdn.rstrip('.').lower()
+    if fqdn in (apex, 'www.'+apex):
+        return [fqdn] + [name for name in (apex, 'www.'+apex) if name != fqdn]
+    return [fqdn]
+
+
+def summary_names(summary):
+    return [summary['DomainName']] + summary.get('SubjectAlternativeNameSummaries', [])
+
+
+def may_cover(summary, fqdn):
+    # the listing truncates long name lists, those need a describe
+    return summary.get('HasAdditionalSubjectAlternativeNames') or \
+        any(covers(name, fqdn) for name in summary_names(summary))
+
+
+def usable(certificate, fqdn):
+    if certificate['Status'] != 'ISSUED':
+        return False
+    names = certificate.get('SubjectAlternativeNames') or [certificate['DomainName']]
+    if not any(covers(name, fqdn) for name in names):
+        return False
+    not_after = certificate.get('NotAfter')
+    return not_after is None or not_after - datetime.datetime.now(not_after.tzinfo) > MIN_VALIDITY
+
+
+def preference(certificate, var):
+    # most of the wanted names first, then exact names over wildcards
+    names = certificate.get('SubjectAlternativeNames') or [certificate['DomainName']]
+    wanted = wanted_names(var)
+    return (-len([fqdn for fqdn in wanted if any(covers(name, fqdn) for name in names)]),
+            -len([fqdn for fqdn in wanted if fqdn in names]))
+
+
+def find_issued(var, recorded_arn=None):
+    # An ISSUED certificate covering website_fqdn, the recorded one if it
+    # still does. Only the listing's candidates are described, and the
+    # descriptions are shared between sites.
+    account = inventory.for_site(var).account
+    candidates = [summary['CertificateArn'] for summary in account.certificates()
+                  if summary.get('Status', 'ISSUED') == 'ISSUED' and may_cover(summary, var.website_fqdn)]
+    if recorded_arn in candidates:
+        candidates.remove(recorded_arn)
+        candidates.insert(0, recorded_arn)
+    found = [account.certificate(arn) for arn in candidates]
+    found = [certificate for certificate in found if usable(certificate, var.website_fqdn)]
+    if not found:
+        return None
+    if found[0]['CertificateArn'] == recorded_arn:
+        return found[0]
+    return min(found, key=lambda certificate: preference(certificate, var))
+
+
+def find_pending(var):
+    # a certificate requested by an earlier run that stopped before it
+    # was issued
+    for summary in inventory.for_site(var).certificates():
+        if summary.get('Status') == 'PENDING_VALIDATION' and \
+                set(wanted_names(var)) <= set(summary_names(summary)):
+            return summary['CertificateArn']
+    return None
+
+
+def request(var):
+    names = wanted_names(var)
+    print('Request ssl certificate for '+', '.join(names)+'...')
+    params = {'DomainName': names[0], 'ValidationMethod': 'DNS'}
+    if len(names) > 1:
+        params['SubjectAlternativeNames'] = names
+    arn = client().request_certificate(**params)['CertificateArn']
+    readiness.retry('acm certificate tags', lambda: client().add_tags_to_certificate(
+        CertificateArn= arn,
+        Tags=[
+            {
+                'Key': 'Name',
+                'Value': var.proj_name
+            },
+        ]
+    ), retry_if= error_matches('ResourceNotFoundException'))
+    return arn
+
+
+def validation_records(arn):
+    # ACM adds a record to each name's validation option shortly after the
+    # request. Names sharing a record (a wildcard and its base name) list
+    # it once.
+    def records():
+        options = client().describe_certificate(
+            CertificateArn= arn
+        )['Certificate'].get('DomainValidationOptions', [])
+        pending = [option for option in options if option.get('ValidationStatus') != 'SUCCESS']
+        if not options or not all(option.get('ResourceRecord') for option in pending):
+            return None
+        unique = {}
+        for option in pending:
+            record = option['ResourceRecord']
+            unique.setdefault((record['Name'], record['Type']), record)
+        # a tuple, so that nothing left to validate still counts as ready
+        return (list(unique.values()),)
+    return readiness.wait_until('acm validation records', records)[0]
+
+
+def validate(var, zone, arn):
+    records = validation_records(arn)
+    if records:
+        # acm checks the name servers itself, polling the change as well
+        # would only add its interval to the wait below
+        dns.change(zone, [dns.cname(record['Name'], record['Value']) for record in records],
+                   'Validate ownership of '+var.website_fqdn, wait= False)
+    print('Wait for certificate to be issued before proceeding...')
+    def issued():
+        status = client().describe_certificate(
+            CertificateArn= arn
+        )['Certificate']['Status']
+        if status not in ('PENDING_VALIDATION', 'ISSUED'):
+            raise RuntimeError('certificate '+arn+' is '+status)
+        return status == 'ISSUED'
+    readiness.wait_until('acm certificate issued', issued, timeout= 3600, base= 5, cap= 30)
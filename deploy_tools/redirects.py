@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+import sys
+import json
+import argparse
+
+##########################################
+# Redirects answered at the edge
+##########################################
+# The site repo's redirects file, one rule a line:
+#
+#   /old-page         /new-page
+#   /blog/*           /posts/:splat     301
+#   /docs             https://docs.example.com/   302
+#
+# is answered by a CloudFront Function that runs on every viewer
+# request, so a redirect never reaches the bucket. The rules live in the
+# CloudFront KeyValueStore associated with the function, keyed by their
+# path (/old-page, /blog/*): a request costs one lookup of its path, then
+# one per depth at which there are splat rules, longest first, however
+# many rules there are. The function's code only holds those depths, so
+# it stays the same size. An exact path wins over a splat rule, a longer
+# splat over a shorter one, and of two rules for the same path the first.
+#
+# Paths match with or without a trailing slash. :splat in a target is
+# replaced by what * matched, and the request's query string is kept
+# unless the target has its own.
+#
+# A store holds at most 5MB of keys and values, over 100,000 rules of
+# the usual length. A file over that, or with a path or target too long
+# for a key or value, is refused before anything is deployed.
+#
+# python3 redirects.py FILE checks a file and prints the size of its
+# rules, --test PATH shows where a path goes.
+
+STATUSES = {
+    301: 'Moved Permanently',
+    302: 'Found',
+    303: 'See Other',
+    307: 'Temporary Redirect',
+    308: 'Permanent Redirect'
+}
+DEFAULT_STATUS = 301
+# browsers keep permanent redirects for as long as they are told
+PERMANENT_CACHE_CONTROL = 'public, max-age=3600'
+RUNTIME = 'cloudfront-js-2.0'
+MAX_KEY_SIZE = 512
+MAX_VALUE_SIZE = 1024
+MAX_STORE_SIZE = 5 * 1024 * 1024
+# keys written or deleted by one UpdateKeys call
+UPDATE_BATCH = 50
+# the key of a rule in a trie node, never a path segment
+RULE = '/'
+SPLAT = '/*'
+
+HANDLER = '''import cf from 'cloudfront';
+
+var STORE = %(store)s;
+var DEPTHS = %(depths)s;
+var PERMANENT = %(permanent)s;
+var STATUSES = %(statuses)s;
+
+function query(querystring) {
+    var parts = [];
+    for (var name in querystring) {
+        var values = querystring[name].multiValue || [querystring[name]];
+        for (var i = 0; i < values.length; i++) {
+            parts.push(values[i].value === '' ? name : name + '=' + values[i].value);
+        }
+    }
+    return parts.join('&');
+}
+
+async function find(key) {
+    try {
+        return JSON.parse(await STORE.get(key));
+    } catch (err) {
+        // no rule for the key
+        return null;
+    }
+}
+
+async function handler(event) {
+    var request = event.request;
+    if (STORE === null) {
+        return request;
+    }
+    var uri = request.uri;
+    var path = uri.length > 1 && uri.charAt(uri.length - 1) === '/' ? uri.slice(0, -1) : uri;
+    var rule = await find(path);
+    var splat = '';
+    var segments = path.split('/');
+    for (var i = 0; rule === null && i < DEPTHS.length; i++) {
+        if (DEPTHS[i] < segments.length) {
+            rule = await find(segments.slice(0, DEPTHS[i] + 1).join('/') + '/*');
+            splat = segments.slice(DEPTHS[i] + 1).join('/');
+        }
+    }
+    if (rule === null) {
+        return request;
+    }
+    var status = typeof rule === 'string' ? %(default)d : rule[0];
+    var location = (typeof rule === 'string' ? rule : rule[1]).split(':splat').join(splat);
+    var search = location.indexOf('?') < 0 ? query(request.querystring) : '';
+    var response = {
+        statusCode: status,
+        statusDescription: STATUSES[status],
+        headers: {location: {value: search ? location + '?' + search : location}}
+    };
+    if (status === 301 || status === 308) {
+        response.headers['cache-control'] = {value: PERMANENT};
+    }
+    return response;
+}
+'''
+
+
+class Rule:
+    def __init__(self, source, target, status=DEFAULT_STATUS, line=None):
+        self.source = source
+        self.target = target
+        self.status = status
+        self.line = line
+
+    @property
+    def splat(self):
+        return self.source == '/*' or self.source.endswith('/*')
+
+
+def normalize(path):
+    # '/a/' and '/a' are the same path
+    return path[:-1] if len(path) > 1 and path.endswith('/') else path
+
+
+def parse_rule(text, line=None):
+    # one line of the file, None for a blank line or a comment
+    fields = text.split('#', 1)[0].split()
+    if not fields:
+        return None
+    where = 'line %d: ' % line if line else ''
+    if len(fields) not in (2, 3):
+        raise ValueError(where+'expected a path, a target and an optional status, got %r' % text.strip())
+    source, target = fields[0], fields[1]
+    status = fields[2].rstrip('!') if len(fields) == 3 else str(DEFAULT_STATUS)
+    if not status.isdigit() or int(status) not in STATUSES:
+        raise ValueError(where+'status %s is not a redirect, expected one of %s'
+                         % (fields[2], ', '.join(map(str, sorted(STATUSES)))))
+    if not source.startswith('/'):
+        raise ValueError(where+'%r does not start with /' % source)
+    if '*' in source and (source.count('*') > 1 or not source.endswith('/*')):
+        raise ValueError(where+'%r: * only stands for a whole path suffix, as in /blog/*' % source)
+    if ':' in source:
+        raise ValueError(where+'%r: placeholders other than :splat are not supported' % source)
+    if not target.startswith(('/', 'http://', 'https://')):
+        raise ValueError(where+'target %r is neither a path nor an http(s) url' % target)
+    if ':splat' in target and not source.endswith('*'):
+        raise ValueError(where+'%r has no * for :splat in %r' % (source, target))
+    return Rule(source, target, int(status), line)
+
+
+def parse(text):
+    rules = []
+    for number, line in enumerate(text.splitlines(), 1):
+        rule = parse_rule(line, number)
+        if rule is not None:
+            rules.append(rule)
+    return rules
+
+
+def load(path):
+    with open(path) as redirects_file:
+        return parse(redirects_file.read())
+
+
+def entry(rule):
+    # the target alone for the default status, it is by far the commonest
+    return rule.target if rule.status == DEFAULT_STATUS else [rule.status, rule.target]
+
+
+class Index:
+    # exact paths in a dict, splat rules in a trie of dicts keyed by path
+    # segment; the store gets both flattened into keys, see store_entries
+    def __init__(self, rules):
+        self.exact = {}
+        self.splats = {}
+        self.size = len(rules)
+        for rule in rules:
+            if rule.splat:
+                node = self.splats
+                for segment in rule.source[1:-2].split('/') if rule.source != '/*' else []:
+                    node = node.setdefault(segment, {})
+                node.setdefault(RULE, entry(rule))
+            else:
+                self.exact.setdefault(normalize(rule.source), entry(rule))
+
+    def lookup(self, path):
+        # the entry and what * matched, (None, '') when no rule applies
+        path = normalize(path)
+        found, splat = self.exact.get(path), ''
+        if found is None:
+            segments = path.split('/')
+            node = self.splats
+            i = 1
+            while node is not None:
+                if RULE in node:
+                    found, splat = node[RULE], '/'.join(segments[i:])
+                node = node.get(segments[i]) if i < len(segments) else None
+                i += 1
+        return found, splat
+
+    def match(self, path, query=''):
+        # (status, location), None when the path is served as it is
+        found, splat = self.lookup(path)
+        if found is None:
+            return None
+        status, target = (DEFAULT_STATUS, found) if isinstance(found, str) else found
+        location = target.replace(':splat', splat)
+        if query and '?' not in location:
+            location += '?'+query
+        return status, location
+
+
+def literal(value):
+    return json.dumps(value, separators=(',', ':'), sort_keys=True)
+
+
+def store_entries(index):
+    # the store's keys and values for the rules of `index`: exact paths
+    # and splat sources (/blog/*), each with its entry as json
+    entries = dict((path, literal(found)) for path, found in index.exact.items())
+    pending = [('', index.splats)]
+    while pending:
+        prefix, node = pending.pop()
+        for segment, child in node.items():
+            if segment == RULE:
+                entries[prefix+SPLAT] = literal(child)
+            else:
+                pending.append((prefix+'/'+segment, child))
+    for key, value in entries.items():
+        if len(key.encode('utf-8')) > MAX_KEY_SIZE:
+            raise ValueError('path %s... is over the %d bytes of a key' % (key[:60], MAX_KEY_SIZE))
+        if len(value.encode('utf-8')) > MAX_VALUE_SIZE:
+            raise ValueError('the target of %s is over the %d bytes of a value' % (key, MAX_VALUE_SIZE))
+    size = store_size(entries)
+    if size > MAX_STORE_SIZE:
+        raise ValueError('%d redirect rules take %d bytes, a CloudFront KeyValueStore holds at most %d: '
+                         'fold runs of paths under a common prefix into /prefix/* rules'
+                         % (index.size, size, MAX_STORE_SIZE))
+    return entries
+
+
+def store_size(entries):
+    return sum(len(key.encode('utf-8')) + len(value.encode('utf-8')) for key, value in entries.items())
+
+
+def function_code(entries, store_id):
+    # the function's source, as bytes, answering the rules `entries` from
+    # the store store_id
+    depths = sorted(set(key[:-len(SPLAT)].count('/') for key in entries if key.endswith(SPLAT)), reverse=True)
+    return (HANDLER % {'store': 'cf.kvs(%s)' % literal(store_id) if entries else 'null',
+                       'depths': literal(depths),
+                       'permanent': literal(PERMANENT_CACHE_CONTROL),
+                       'statuses': literal(dict((str(code), text) for code, text in STATUSES.items())),
+                       'default': DEFAULT_STATUS}).encode('utf-8')
+
+
+##########################################
+# Publishing
+##########################################
+# setup.py creates the store and the function, with no rules, and
+# associates the function with the distribution's viewer requests. A
+# build brings the store in line with its rules, new and changed keys
+# first, and publishes the function's code if the depths of its splat
+# rules changed; keys of rules that are gone are deleted last. The store
+# takes a few seconds to reach every edge, the code within minutes; an
+# unchanged file changes nothing.
+
+def associated_function(distribution_config):
+    # the name of the distribution's viewer request function, or None
+    associations = distribution_config['DefaultCacheBehavior'].get('FunctionAssociations', {})
+    for item in associations.get('Items', []):
+        if item['EventType'] == 'viewer-request':
+            return item['FunctionARN'].rsplit('/', 1)[-1]
+    return None
+
+
+def associated_store(function_config):
+    # the ARN of the function's key value store, or None
+    items = function_config.get('KeyValueStoreAssociations', {}).get('Items', [])
+    return items[0]['KeyValueStoreARN'] if items else None
+
+
+def stored(kvs, store_arn):
+    entries = {}
+    for page in kvs.get_paginator('list_keys').paginate(KvsARN=store_arn, PaginationConfig={'PageSize': 50}):
+        entries.update((item['Key'], item['Value']) for item in page.get('Items', []))
+    return entries
+
+
+def update_store(kvs, store_arn, puts=(), deletes=()):
+    etag = kvs.describe_key_value_store(KvsARN=store_arn)['ETag']
+    changes = [('put', key, value) for key, value in puts] + [('delete', key, None) for key in deletes]
+    for start in range(0, len(changes), UPDATE_BATCH):
+        batch = changes[start:start + UPDATE_BATCH]
+        etag = kvs.update_keys(
+            KvsARN=store_arn,
+            IfMatch=etag,
+            Puts=[{'Key': key, 'Value': value} for change, key, value in batch if change == 'put'],
+            Deletes=[{'Key': key} for change, key, _ in batch if change == 'delete']
+        )['ETag']
+
+
+def publish(cloudfront, kvs, name, entries):
+    # make `entries` the rules the function answers, False when they
+    # already were
+    described = cloudfront.describe_function(Name=name, Stage='DEVELOPMENT')
+    config = described['FunctionSummary']['FunctionConfig']
+    store_arn = associated_store(config)
+    if store_arn is None:
+        raise LookupError('function '+name+' has no key value store for its rules, rerun setup.py')
+    current = stored(kvs, store_arn)
+    puts = sorted((key, value) for key, value in entries.items() if current.get(key) != value)
+    deletes = sorted(key for key in current if key not in entries)
+    update_store(kvs, store_arn, puts=puts)
+    code = function_code(entries, store_arn.rsplit('/', 1)[-1])
+    republished = cloudfront.get_function(Name=name, Stage='LIVE')['FunctionCode'].read() != code
+    if republished:
+        updated = cloudfront.update_function(
+            Name=name,
+            IfMatch=described['ETag'],
+            FunctionConfig={
+                'Comment': config['Comment'],
+                'Runtime': RUNTIME,
+                'KeyValueStoreAssociations': config['KeyValueStoreAssociations']
+            },
+            FunctionCode=code
+        )
+        cloudfront.publish_function(Name=name, IfMatch=updated['ETag'])
+    update_store(kvs, store_arn, deletes=deletes)
+    return bool(puts or deletes or republished)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check a redirects file and index it for the CloudFront Function.')
+    parser.add_argument('file', help='redirects file, eg. _redirects')
+    parser.add_argument('--test', metavar='PATH', action='append', default=[],
+                        help='print where PATH is redirected (repeatable)')
+    parser.add_argument('--output', metavar='FILE', help='write the keys and values of the rules to FILE, as json')
+    args = parser.parse_args(argv)
+    try:
+        rules = load(args.file)
+        index = Index(rules)
+        entries = store_entries(index)
+    except (OSError, ValueError) as err:
+        print('%s: %s' % (args.file, err), file=sys.stderr)
+        return 1
+    print('%d rules (%d splats), %d of %d bytes'
+          % (len(rules), len([rule for rule in rules if rule.splat]), store_size(entries), MAX_STORE_SIZE))
+    for path in args.test:
+        path, _, query = path.partition('?')
+        found = index.match(path, query)
+        print('%s -> %s' % (path, '%d %s' % found if found else 'not redirected'))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(entries, output, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
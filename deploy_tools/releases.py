@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+import sys
+import time
+import argparse
+import boto3
+from sync import (find_distribution, live_release, switch_release, switch_redirects, wait_deployed,
+                  list_releases, prune_releases)
+
+##########################################
+# Releases deployed by sync.py --release
+##########################################
+# List them, switch the cdn to any of them, roll back to the one before
+# the release being served, or prune old ones. A switch only changes the
+# distribution's origin path: nothing is rebuilt or uploaded. As the
+# cached copies of every path may belong to the other release, the whole
+# distribution is invalidated once the switch has deployed. The redirects
+# the release was deployed with are published along with the switch.
+
+
+def invalidate_all(cloudfront, dist_id):
+    cloudfront.create_invalidation(
+        DistributionId=dist_id,
+        InvalidationBatch={
+            'Paths': {'Quantity': 1, 'Items': ['/*']},
+            'CallerReference': 'release-switch-%d' % (time.time() * 1000)
+        }
+    )
+
+
+def switch(cloudfront, dist_id, release_id, wait=True, s3=None, bucket=None, kvs=None):
+    previous = switch_release(cloudfront, dist_id, release_id)
+    print('cdn %s switched from release %s to %s' % (dist_id, previous or '(bucket root)', release_id))
+    if s3 is not None and switch_redirects(s3, cloudfront, bucket, dist_id, release_id, kvs):
+        print('redirects of release %s published' % release_id)
+    if wait:
+        print('Waiting for the switch to deploy...')
+        wait_deployed(cloudfront, dist_id)
+    invalidate_all(cloudfront, dist_id)
+
+
+def previous_release(releases, live):
+    if not live:
+        # not deployed as a release yet, eg. the first build after
+        # switching deploy_mode to 'release' has not run
+        raise LookupError('the cdn serves the bucket root, which is not a release: '
+                          'there is no previous release, switch to one by its id instead')
+    older = [release_id for release_id in releases if release_id < live]
+    if not older:
+        raise LookupError('no release older than '+live)
+    return older[-1]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Manage the releases of a site deployed with sync.py --release.')
+    parser.add_argument('bucket', help='website bucket')
+    parser.add_argument('--distribution', metavar='ID',
+                        help='the cdn serving the bucket (default: the one aliased to the bucket name)')
+    parser.add_argument('--no-wait', action='store_true',
+                        help='invalidate without waiting for a switch to deploy')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('list', help='list the releases, marking the one served')
+    switch_parser = commands.add_parser('switch', help='serve a release')
+    switch_parser.add_argument('release', help='release id')
+    rollback_parser = commands.add_parser('rollback', help='serve the release before the one served')
+    rollback_parser.add_argument('--to', metavar='ID', help='serve this release instead')
+    prune_parser = commands.add_parser('prune', help='delete old releases')
+    prune_parser.add_argument('--keep', type=int, default=5, help='newest releases kept')
+    args = parser.parse_args(argv)
+    s3 = boto3.client('s3')
+    cloudfront = boto3.client('cloudfront')
+    dist_id = args.distribution or find_distribution(cloudfront, args.bucket)
+    live = live_release(cloudfront, dist_id)
+    releases = list_releases(s3, args.bucket)
+    if args.command == 'list':
+        for release_id in releases:
+            print(('* ' if release_id == live else '  ')+release_id)
+        if not live:
+            print('* (bucket root)')
+    elif args.command == 'switch':
+        if args.release not in releases:
+            parser.error('no release '+args.release)
+        switch(cloudfront, dist_id, args.release, wait=not args.no_wait, s3=s3, bucket=args.bucket)
+    elif args.command == 'rollback':
+        try:
+            target = args.to or previous_release(releases, live)
+        except LookupError as err:
+            parser.error(str(err))
+        if target not in releases:
+            parser.error('no release '+target)
+        switch(cloudfront, dist_id, target, wait=not args.no_wait, s3=s3, bucket=args.bucket)
+    elif args.command == 'prune':
+        if args.keep < 1:
+            parser.error('--keep must be at least 1')
+        pruned = prune_releases(s3, args.bucket, args.keep, protect=(live,))
+        print('pruned %d releases' % len(pruned) + (': '+', '.join(pruned) if pruned else ''))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,759 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import math
+import time
+import hashlib
+import argparse
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from botocore.config import Config
+from s3transfer.manager import TransferManager, TransferConfig
+from upload_rules import Rules, compress_all, MIN_COMPRESS_SIZE, ENCODINGS
+import redirects
+
+##########################################
+# Incremental sync of a generated site to S3
+##########################################
+# Only files whose content changed are uploaded. Local files are hashed
+# (MD5, or the multipart ETag S3 would compute for large files) and
+# compared against a manifest of the bucket cached from the previous
+# run, falling back to listing the bucket when there is no manifest.
+# The keys that changed are written out for the cdn invalidation.
+#
+# What gets compared is the object as it will be stored: after the
+# upload rules have picked its metadata and, for text assets, after
+# compression. Compression is deterministic so unchanged files compare
+# equal run after run.
+#
+# With --release the site is deployed as a new release instead, see
+# Releases below. With --redirects the rules of the site's redirects
+# file are published to the function the cdn runs on viewer requests,
+# once the site is uploaded (see redirects.py).
+
+MB = 1024 * 1024
+DELETE_BATCH = 1000
+# part sizes tried when matching a multipart ETag uploaded by another tool
+PART_SIZES = (8 * MB, 16 * MB, 5 * MB, 15 * MB, 64 * MB)
+# larger objects need a multipart copy
+MAX_COPY_SIZE = 5 * 1024 * MB
+
+
+def file_md5(path, chunk_size=MB):
+    digest = hashlib.md5()
+    with open(path, 'rb') as blob:
+        for chunk in iter(lambda: blob.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def multipart_etag(path, part_size):
+    digests = []
+    with open(path, 'rb') as blob:
+        for chunk in iter(lambda: blob.read(part_size), b''):
+            digests.append(hashlib.md5(chunk).digest())
+    return hashlib.md5(b''.join(digests)).hexdigest()+'-'+str(len(digests))
+
+
+def etag_for(path, size, part_size, threshold):
+    # the ETag S3 will report after we upload this file ourselves
+    if size < threshold:
+        return None
+    return multipart_etag(path, part_size)
+
+
+def etag_matches(obj, remote_etag, part_size):
+    remote_etag = remote_etag.strip('"')
+    if '-' not in remote_etag:
+        return obj['md5'] == remote_etag
+    if obj.get('etag') == remote_etag:
+        return True
+    if not obj.get('path'):
+        # known from the manifest only, treat as changed and re-upload
+        return False
+    parts = int(remote_etag.split('-')[1])
+    for size in (part_size,) + PART_SIZES:
+        if math.ceil(obj['size'] / float(size)) == parts:
+            if multipart_etag(obj['path'], size) == remote_etag:
+                return True
+    return False
+
+
+##########################################
+# Local tree and manifest
+##########################################
+def scan(site_dir, prefix=''):
+    files = {}
+    for root, dirs, names in os.walk(site_dir):
+        for name in names:
+            path = os.path.join(root, name)
+            rel = os.path.relpath(path, site_dir).replace(os.sep, '/')
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                # removed since it was listed, eg. a generator's temp file
+                continue
+            files[prefix+rel] = {
+                'path': path,
+                'size': stat.st_size,
+                'mtime': stat.st_mtime_ns
+            }
+    return files
+
+
+def load_manifest(path, bucket, prefix):
+    if not path or not os.path.exists(path):
+        return None
+    with open(path) as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest.get('bucket') != bucket or manifest.get('prefix') != prefix:
+        return None
+    return manifest
+
+
+def save_manifest(path, manifest):
+    tmp_path = path+'.tmp'
+    with open(tmp_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, separators=(',', ':'), sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def write_manifest(path, bucket, prefix, local):
+    objects = {}
+    for key, entry in local.items():
+        objects[key] = {
+            'size': entry['size'],
+            'mtime': entry['mtime'],
+            'md5': entry['md5'],
+            'rules': entry['rules'],
+            'object': dict((field, value) for field, value in entry['object'].items() if field != 'path')
+        }
+    save_manifest(path, {'bucket': bucket, 'prefix': prefix, 'objects': objects})
+
+
+def prepare(local, cached, rules, work_dir, workers, part_size, threshold, keys=None):
+    # Work out how each file will be stored: its metadata, whether it is
+    # stored compressed and the size/MD5/ETag of the stored bytes. When
+    # size, mtime and rules match the manifest the previous result is
+    # reused, everything else is hashed on a thread pool and compressed
+    # on a process pool.
+    todo = []
+    for key in (keys if keys is not None else list(local)):
+        entry = local[key]
+        entry['extra_args'], entry['compress'] = rules.metadata(key)
+        entry['rules'] = rules.fingerprint(key)
+        previous = cached.get(key)
+        if keys is None and previous and all(previous.get(field) == entry[field]
+                                             for field in ('size', 'mtime', 'rules')):
+            entry['md5'] = previous['md5']
+            entry['object'] = dict(previous['object'], path=None)
+        else:
+            todo.append(key)
+    def digest(key):
+        local[key]['md5'] = file_md5(local[key]['path'])
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(digest, todo))
+    jobs = [(key, local[key]['path'], os.path.join(work_dir, '%d.z' % i))
+            for i, key in enumerate(todo) if local[key]['compress']
+            and local[key]['size'] >= MIN_COMPRESS_SIZE]
+    compressed = compress_all(jobs, workers)
+    out_paths = dict((key, out_path) for key, path, out_path in jobs)
+    def finish(key):
+        entry = local[key]
+        if key in compressed:
+            size, md5 = compressed[key]
+            obj = {'path': out_paths[key], 'size': size, 'md5': md5, 'encoding': rules.encoding}
+        else:
+            obj = {'path': entry['path'], 'size': entry['size'], 'md5': entry['md5'], 'encoding': None}
+        obj['etag'] = etag_for(obj['path'], obj['size'], part_size, threshold)
+        entry['object'] = obj
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(finish, todo))
+    for key in (keys if keys is not None else list(local)):
+        if local[key]['object']['encoding']:
+            local[key]['extra_args']['ContentEncoding'] = local[key]['object']['encoding']
+
+
+def list_bucket(s3, bucket, prefix):
+    remote = {}
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        for item in page.get('Contents', []):
+            if item['Key'].startswith(prefix+RELEASES):
+                continue
+            remote[item['Key']] = {
+                'etag': item['ETag'].strip('"'),
+                'size': item['Size']
+            }
+    return remote
+
+
+def rebase(objects, old_prefix, new_prefix):
+    # the same objects, keyed as if stored under new_prefix
+    return dict((new_prefix+key[len(old_prefix):], entry) for key, entry in objects.items())
+
+
+def remote_objects(s3, bucket, prefix, manifest, verify, base=None):
+    # What the bucket holds: from the manifest unless asked to verify.
+    # For a new release, what its base release holds.
+    if manifest and not verify:
+        remote = dict((key, {
+            'etag': entry['object']['etag'] or entry['object']['md5'],
+            'size': entry['object']['size'],
+            'rules': entry['rules']
+        }) for key, entry in manifest['objects'].items())
+    else:
+        remote = list_bucket(s3, bucket, prefix if base is None else base)
+    return remote if base is None else rebase(remote, base, prefix)
+
+
+##########################################
+# Diff, upload and delete
+##########################################
+def diff(local, remote, part_size):
+    changed = []
+    for key, entry in local.items():
+        obj = entry['object']
+        current = remote.get(key)
+        if current is None or current['size'] != obj['size']:
+            changed.append(key)
+        elif current.get('rules') not in (None, entry['rules']):
+            changed.append(key)
+        elif not etag_matches(obj, current['etag'], part_size):
+            changed.append(key)
+    removed = [key for key in remote if key not in local]
+    return sorted(changed), sorted(removed)
+
+
+def upload(s3, bucket, local, keys, concurrency, part_size, threshold):
+    config = TransferConfig(
+        multipart_threshold=threshold,
+        multipart_chunksize=part_size,
+        max_request_concurrency=concurrency
+    )
+    manager = TransferManager(s3, config)
+    try:
+        futures = [manager.upload(local[key]['object']['path'], bucket, key,
+                                  extra_args=local[key]['extra_args'])
+                   for key in keys]
+        for future in futures:
+            future.result()
+    finally:
+        manager.shutdown()
+
+
+def copy_objects(s3, bucket, local, sources, concurrency):
+    # server side copies of {key: source key} within the bucket
+    def copy(key):
+        source = {'Bucket': bucket, 'Key': sources[key]}
+        if local[key]['object']['size'] < MAX_COPY_SIZE:
+            s3.copy_object(Bucket=bucket, Key=key, CopySource=source, MetadataDirective='COPY')
+        else:
+            s3.copy(source, bucket, key, ExtraArgs=local[key]['extra_args'])
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(copy, sources))
+
+
+def delete(s3, bucket, keys, concurrency):
+    batches = [keys[i:i + DELETE_BATCH] for i in range(0, len(keys), DELETE_BATCH)]
+    def delete_batch(batch):
+        response = s3.delete_objects(
+            Bucket=bucket,
+            Delete={
+                'Objects': [{'Key': key} for key in batch],
+                'Quiet': True
+            }
+        )
+        if response.get('Errors'):
+            raise RuntimeError('could not delete: '+', '.join(e['Key'] for e in response['Errors']))
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(delete_batch, batches))
+
+
+def notify(queue_url, keys, region_name=None, sqs=None):
+    # send the changed keys to the invalidation queue in messages well
+    # under the 256KB SQS limit
+    sqs = sqs or boto3.client('sqs', region_name=region_name)
+    for i in range(0, len(keys), 1000):
+        sqs.send_message(QueueUrl=queue_url, MessageBody=json.dumps({'keys': keys[i:i + 1000]}))
+
+
+def sync(site_dir, bucket, prefix='', concurrency=10, manifest_path=None, verify=False,
+         delete_removed=True, dry_run=False, part_size=8 * MB, threshold=8 * MB, s3=None,
+         rules=None, log=print, base=None):
+    # base is the prefix of the release a new release under prefix is
+    # made from, None to sync prefix in place
+    if s3 is None:
+        s3 = boto3.client('s3', config=Config(max_pool_connections=max(10, concurrency * 2)))
+    rules = rules or Rules()
+    local = scan(site_dir, prefix)
+    manifest = load_manifest(manifest_path, bucket, prefix if base is None else base)
+    cached = {}
+    if manifest:
+        cached = manifest['objects'] if base is None else rebase(manifest['objects'], base, prefix)
+    with tempfile.TemporaryDirectory() as work_dir:
+        prepare(local, cached, rules, work_dir, concurrency, part_size, threshold)
+        remote = remote_objects(s3, bucket, prefix, manifest, verify, base)
+        changed, removed = diff(local, remote, part_size)
+        if not delete_removed:
+            removed = []
+        unchanged = [] if base is None else sorted(set(local) - set(changed))
+        log('%d files, %d changed, %d removed' % (len(local), len(changed), len(removed))
+            + (', %d copied from the base release' % len(unchanged) if base is not None else ''))
+        if dry_run:
+            return changed, removed
+        # changed files whose stored form came from the manifest still
+        # need their upload bytes produced
+        stale = [key for key in changed if not local[key]['object'].get('path')]
+        if stale:
+            prepare(local, cached, rules, work_dir, concurrency, part_size, threshold, keys=stale)
+        if changed:
+            upload(s3, bucket, local, changed, concurrency, part_size, threshold)
+    if unchanged:
+        copy_objects(s3, bucket, local, dict((key, base+key[len(prefix):]) for key in unchanged), concurrency)
+    # a new release starts out empty, there is nothing to delete
+    if removed and base is None:
+        delete(s3, bucket, removed, concurrency)
+    if manifest_path:
+        write_manifest(manifest_path, bucket, prefix, local)
+    return changed, removed
+
+
+##########################################
+# Streaming: upload while the generator runs
+##########################################
+# With --stream sync.py runs the site generator itself and uploads while
+# it renders, instead of waiting for the whole tree. The output directory
+# is rescanned every SCAN_INTERVAL seconds; a file is taken once its size
+# and mtime held still across two scans and it was last written
+# SETTLE_SECONDS ago. Taken files are prepared and diffed like any other,
+# and a file rewritten after it was taken is simply taken again.
+#
+# A stream always deploys a new release (see Releases below): nothing
+# uploaded while the generator runs is served until the cdn is switched
+# to the release, in one change, once everything is in place. Overwriting
+# the live files as they render can't be made atomic, an old page would
+# be served with a new asset it links to, so it isn't offered.
+#
+# The uploads share one transfer manager, whose queues are bounded so a
+# fast generator cannot run ahead of them without limit. Everything that
+# changed uploads to its key in the release right away, what did not is
+# copied from the base release once the render is done. Most of a site's
+# bytes are rendered early, so most of the upload overlaps the render. A
+# failed render deletes what it had uploaded again.
+
+SCAN_INTERVAL = 0.5
+SETTLE_SECONDS = 1.0
+
+
+class Watcher:
+    def __init__(self, site_dir, prefix='', settle=SETTLE_SECONDS):
+        self.site_dir = site_dir
+        self.prefix = prefix
+        self.settle_ns = int(settle * 1e9)
+        self.seen = {}
+        self.taken = {}
+        self.files = {}
+
+    def finished(self, final=False):
+        # Files done being written and not taken in their current state.
+        # The final call, after the generator exited, takes all of them.
+        files = scan(self.site_dir, self.prefix) if os.path.isdir(self.site_dir) else {}
+        now = time.time_ns()
+        ready = {}
+        for key, entry in files.items():
+            state = (entry['size'], entry['mtime'])
+            if self.taken.get(key) == state:
+                continue
+            if final or (self.seen.get(key) == state and now - entry['mtime'] >= self.settle_ns):
+                ready[key] = entry
+                self.taken[key] = state
+        self.seen = dict((key, (entry['size'], entry['mtime'])) for key, entry in files.items())
+        self.files = files
+        return ready
+
+    def retake(self, keys):
+        for key in keys:
+            self.taken.pop(key, None)
+
+
+class Uploads:
+    # uploads on one transfer manager, at most one in flight per key
+    def __init__(self, s3, bucket, concurrency, part_size, threshold):
+        self.bucket = bucket
+        self.manager = TransferManager(s3, TransferConfig(
+            multipart_threshold=threshold,
+            multipart_chunksize=part_size,
+            max_request_concurrency=concurrency
+        ))
+        self.futures = {}
+
+    def upload(self, key, entry):
+        previous = self.futures.get(key)
+        if previous:
+            previous.result()
+        self.futures[key] = self.manager.upload(entry['object']['path'], self.bucket, key,
+                                                extra_args=entry['extra_args'])
+
+    def wait(self):
+        for future in self.futures.values():
+            future.result()
+
+    def shutdown(self, cancel=False):
+        self.manager.shutdown(cancel=cancel)
+
+
+def stream_sync(command, site_dir, bucket, prefix, base, concurrency=10, manifest_path=None,
+                verify=False, delete_removed=True, part_size=8 * MB, threshold=8 * MB, s3=None,
+                rules=None, log=print, scan_interval=SCAN_INTERVAL, settle=SETTLE_SECONDS):
+    # Run command, which renders the site into site_dir, and sync it while
+    # it does into the release under prefix, made from the one under base.
+    # Raises CalledProcessError, with the release removed, if it fails.
+    if s3 is None:
+        s3 = boto3.client('s3', config=Config(max_pool_connections=max(10, concurrency * 2)))
+    rules = rules or Rules()
+    manifest = load_manifest(manifest_path, bucket, base)
+    cached = rebase(manifest['objects'], base, prefix) if manifest else {}
+    remote = remote_objects(s3, bucket, prefix, manifest, verify, base)
+    watcher = Watcher(site_dir, prefix, settle)
+    local = {}
+    changed = set()
+    batches = 0
+    with tempfile.TemporaryDirectory() as work_dir:
+        uploads = Uploads(s3, bucket, concurrency, part_size, threshold)
+        generator = None
+        try:
+            generator = subprocess.Popen(command)
+            final = False
+            while not final:
+                final = generator.poll() is not None
+                if final and generator.returncode != 0:
+                    raise subprocess.CalledProcessError(generator.returncode, command)
+                batch = watcher.finished(final)
+                if batch:
+                    # a directory per batch, compressed files are numbered
+                    batch_dir = os.path.join(work_dir, str(batches))
+                    os.mkdir(batch_dir)
+                    batches += 1
+                    try:
+                        prepare(batch, cached, rules, batch_dir, concurrency, part_size, threshold)
+                    except FileNotFoundError:
+                        # replaced while being read, look again next scan
+                        watcher.retake(batch)
+                        final = False
+                        continue
+                    batch_changed, _ = diff(batch, remote, part_size)
+                    stale = [key for key in batch_changed if not batch[key]['object'].get('path')]
+                    if stale:
+                        prepare(batch, cached, rules, batch_dir, concurrency, part_size, threshold, keys=stale)
+                    for key in batch_changed:
+                        uploads.upload(key, batch[key])
+                    changed.difference_update(batch)
+                    changed.update(batch_changed)
+                    local.update(batch)
+                if not final:
+                    time.sleep(scan_interval)
+            uploads.wait()
+        except BaseException:
+            if generator and generator.poll() is None:
+                generator.kill()
+            uploads.shutdown(cancel=True)
+            if uploads.futures:
+                delete(s3, bucket, list(uploads.futures), concurrency)
+            raise
+        uploads.shutdown()
+        # files the generator deleted after they were taken
+        local = dict((key, entry) for key, entry in local.items() if key in watcher.files)
+        orphans = [key for key in uploads.futures if key not in local]
+        changed = sorted(key for key in changed if key in local)
+        removed = sorted(key for key in remote if key not in local) if delete_removed else []
+        log('%d files, %d changed, %d removed, streamed in %d batches'
+            % (len(local), len(changed), len(removed), batches))
+        copy_objects(s3, bucket, local, dict((key, base+key[len(prefix):])
+                                             for key in set(local) - set(changed)), concurrency)
+    if orphans:
+        delete(s3, bucket, orphans, concurrency)
+    if manifest_path:
+        write_manifest(manifest_path, bucket, prefix, local)
+    return changed, removed
+
+
+##########################################
+# Releases: deploy under a prefix, switch the cdn to it
+##########################################
+# With --release the site is deployed as a new release under
+# releases/<id>/, which nothing serves yet, and --switch then points the
+# distribution's origin path at it. Every edge serves either the old
+# release or the new one, never a mix of the two, and going back to an
+# earlier release (deploy_tools/releases.py rollback) is a change of the
+# origin path, not a rebuild.
+#
+# A release is built from the one being served, its base: what changed
+# is uploaded, the rest copied within the bucket (no bytes leave S3).
+# Release ids start with the time, so they sort oldest first. Once
+# switched, releases older than the newest --keep are deleted, batched,
+# while the distribution deploys the switch. The changed and removed
+# paths are only invalidated once it has deployed, so no edge fetches
+# them from the old release again.
+#
+# A release's indexed redirects are kept next to it, outside what the
+# cdn serves, and published with every switch to it: a rollback brings
+# back the redirects the release was built with.
+
+RELEASES = 'releases/'
+
+
+def release_prefix(release_id):
+    return RELEASES+release_id+'/'
+
+
+def redirects_key(release_id):
+    return RELEASES+release_id+'.redirects.json'
+
+
+def new_release_id():
+    # the time, and the commit when built by codebuild
+    release_id = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+    commit = os.environ.get('CODEBUILD_RESOLVED_SOURCE_VERSION', '')
+    return release_id+'-'+commit[:8] if commit else release_id
+
+
+def find_distribution(cloudfront, alias):
+    for page in cloudfront.get_paginator('list_distributions').paginate():
+        for item in page['DistributionList'].get('Items', []):
+            if alias in item['Aliases'].get('Items', []):
+                return item['Id']
+    raise LookupError('no cdn serves '+alias)
+
+
+def origin_release(distribution_config):
+    # the release the origin path points at, '' for the bucket root
+    path = distribution_config['Origins']['Items'][0].get('OriginPath', '')
+    return path[len('/'+RELEASES):] if path.startswith('/'+RELEASES) else ''
+
+
+def live_release(cloudfront, dist_id):
+    return origin_release(cloudfront.get_distribution_config(Id=dist_id)['DistributionConfig'])
+
+
+def switch_release(cloudfront, dist_id, release_id):
+    # point the origin at a release ('' for the bucket root), returns
+    # the release it pointed at before
+    current = cloudfront.get_distribution_config(Id=dist_id)
+    config = current['DistributionConfig']
+    previous = origin_release(config)
+    for origin in config['Origins']['Items']:
+        origin['OriginPath'] = '/'+release_prefix(release_id).rstrip('/') if release_id else ''
+    cloudfront.update_distribution(Id=dist_id, IfMatch=current['ETag'], DistributionConfig=config)
+    return previous
+
+
+def publish_redirects(cloudfront, dist_id, entries, kvs=None):
+    # publish to the distribution's function, False when it already
+    # answers entries
+    name = redirects.associated_function(cloudfront.get_distribution_config(Id=dist_id)['DistributionConfig'])
+    if name is None:
+        raise LookupError('cdn '+dist_id+' runs no redirects function, set redirects_file and rerun setup.py')
+    return redirects.publish(cloudfront, kvs or boto3.client('cloudfront-keyvaluestore'), name, entries)
+
+
+def switch_redirects(s3, cloudfront, bucket, dist_id, release_id, kvs=None):
+    # Publish the redirects a release was deployed with. A release with
+    # none gets none, the redirects of the release it replaces must not
+    # stay live. None when the cdn runs no redirects function.
+    try:
+        entries = json.loads(s3.get_object(Bucket=bucket, Key=redirects_key(release_id))['Body'].read())
+    except s3.exceptions.NoSuchKey:
+        if redirects.associated_function(cloudfront.get_distribution_config(Id=dist_id)['DistributionConfig']) is None:
+            return None
+        entries = {}
+    return publish_redirects(cloudfront, dist_id, entries, kvs)
+
+
+def wait_deployed(cloudfront, dist_id, timeout=1800, interval=15):
+    deadline = time.monotonic() + timeout
+    while cloudfront.get_distribution(Id=dist_id)['Distribution']['Status'] != 'Deployed':
+        if time.monotonic() > deadline:
+            raise TimeoutError('cdn '+dist_id+' still deploying after %ds' % timeout)
+        time.sleep(interval)
+
+
+def list_releases(s3, bucket):
+    releases = []
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=RELEASES, Delimiter='/'):
+        releases.extend(item['Prefix'][len(RELEASES):-1] for item in page.get('CommonPrefixes', []))
+    return sorted(releases)
+
+
+def prune_releases(s3, bucket, keep, protect=(), concurrency=10):
+    # delete all but the newest `keep` releases, and those in protect
+    releases = list_releases(s3, bucket)
+    pruned = [release_id for release_id in releases[:max(0, len(releases) - keep)]
+              if release_id not in protect]
+    keys = []
+    for release_id in pruned:
+        keys.append(redirects_key(release_id))
+        for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=release_prefix(release_id)):
+            keys.extend(item['Key'] for item in page.get('Contents', []))
+    if keys:
+        delete(s3, bucket, keys, concurrency)
+    return pruned
+
+
+def deploy_release(site_dir, bucket, release_id='auto', command=None, dist_id=None, switch=False,
+                   keep=5, wait=True, concurrency=10, s3=None, cloudfront=None, log=print,
+                   wait_interval=15, redirect_entries=None, kvs=None, **options):
+    # Upload a new release built from the one being served (streamed
+    # while command renders, if given) and switch the cdn to it, with
+    # redirect_entries (the indexed redirects) if given. Returns the
+    # release id, the changed and removed paths as the cdn serves them
+    # and whether the cdn was switched.
+    if s3 is None:
+        s3 = boto3.client('s3', config=Config(max_pool_connections=max(10, concurrency * 2)))
+    cloudfront = cloudfront or boto3.client('cloudfront')
+    dist_id = dist_id or find_distribution(cloudfront, bucket)
+    live = live_release(cloudfront, dist_id)
+    release_id = new_release_id() if release_id == 'auto' else release_id
+    prefix, base = release_prefix(release_id), release_prefix(live) if live else ''
+    log('release %s, based on %s' % (release_id, live or 'the bucket root'))
+    if command:
+        changed, removed = stream_sync(command, site_dir, bucket, prefix, base, concurrency=concurrency,
+                                       s3=s3, log=log, **options)
+    else:
+        changed, removed = sync(site_dir, bucket, prefix=prefix, concurrency=concurrency,
+                                s3=s3, log=log, base=base, **options)
+    changed = [key[len(prefix):] for key in changed]
+    removed = [key[len(prefix):] for key in removed]
+    if options.get('dry_run'):
+        return release_id, changed, removed, False
+    if redirect_entries is not None:
+        s3.put_object(Bucket=bucket, Key=redirects_key(release_id), Body=json.dumps(redirect_entries),
+                      ContentType='application/json')
+    if not switch:
+        return release_id, changed, removed, False
+    switch_release(cloudfront, dist_id, release_id)
+    log('cdn %s switched to release %s' % (dist_id, release_id))
+    if redirect_entries is not None and publish_redirects(cloudfront, dist_id, redirect_entries, kvs):
+        log('redirects of release %s published' % release_id)
+    with ThreadPoolExecutor(max_workers=1) as background:
+        pruning = background.submit(prune_releases, s3, bucket, keep, (release_id, live), concurrency) \
+            if keep else None
+        if wait:
+            wait_deployed(cloudfront, dist_id, interval=wait_interval)
+        if pruning and pruning.result():
+            log('pruned releases '+', '.join(pruning.result()))
+    return release_id, changed, removed, True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Upload only the changed files of a generated site to S3.')
+    parser.add_argument('site_dir', help='directory the site generator wrote to')
+    parser.add_argument('bucket', help='website bucket')
+    parser.add_argument('--prefix', default='', help='key prefix to sync under')
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help='parallel uploads, deletes and hashing threads')
+    parser.add_argument('--manifest', default='.sync-manifest.json',
+                        help='cached manifest of the bucket from the previous sync')
+    parser.add_argument('--verify', action='store_true',
+                        help='list the bucket instead of trusting the cached manifest')
+    parser.add_argument('--no-delete', action='store_true',
+                        help='keep objects that no longer exist locally')
+    parser.add_argument('--changes', metavar='FILE',
+                        help='write the changed and removed keys to FILE as json')
+    parser.add_argument('--queue-url', help='send changed keys to this cdn invalidation queue')
+    parser.add_argument('--dry-run', action='store_true', help='report what would change')
+    parser.add_argument('--rules', metavar='FILE',
+                        help='json file of cache-control and compression rules (default: built in rules)')
+    parser.add_argument('--encoding', choices=ENCODINGS,
+                        help='encoding text assets are stored with (default gzip)')
+    parser.add_argument('--stream', action='store_true',
+                        help='run the generator command given after -- and upload the release while it renders')
+    parser.add_argument('--release', metavar='ID',
+                        help="deploy as a new release under releases/ID/ ('auto' for a dated id)")
+    parser.add_argument('--switch', action='store_true',
+                        help='point the cdn at the new release once it is uploaded')
+    parser.add_argument('--distribution', metavar='ID',
+                        help='the cdn serving the bucket (default: the one aliased to the bucket name)')
+    parser.add_argument('--keep', type=int, default=5,
+                        help='releases kept after a switch, older ones are deleted (0 keeps all)')
+    parser.add_argument('--no-wait', action='store_true',
+                        help='invalidate without waiting for the switch to deploy')
+    parser.add_argument('--redirects', metavar='FILE',
+                        help='publish the rules of this redirects file to the cdn (no file: no rules)')
+    argv = list(sys.argv[1:] if argv is None else argv)
+    command = []
+    if '--' in argv:
+        argv, command = argv[:argv.index('--')], argv[argv.index('--') + 1:]
+    args = parser.parse_args(argv)
+    if args.stream and not command:
+        parser.error('--stream needs the generator command, after --')
+    if args.stream and not args.release:
+        parser.error('--stream deploys a new release, it needs --release')
+    if args.stream and args.dry_run:
+        parser.error('--stream cannot be combined with --dry-run')
+    if command and not args.stream:
+        parser.error('a command after -- is only run with --stream')
+    if args.release and args.prefix:
+        parser.error('a release is deployed under releases/, not --prefix')
+    if args.switch and not args.release:
+        parser.error('--switch needs --release')
+    if args.distribution and not (args.release or args.redirects):
+        parser.error('--distribution needs --release or --redirects')
+    try:
+        rules = Rules.load(args.rules, args.encoding) if args.rules else Rules(encoding=args.encoding or 'gzip')
+    except ValueError as err:
+        parser.error(str(err))
+    options = dict(
+        concurrency=args.concurrency,
+        manifest_path=args.manifest,
+        verify=args.verify,
+        delete_removed=not args.no_delete,
+        rules=rules
+    )
+    if not args.stream:
+        options['dry_run'] = args.dry_run
+    redirect_entries = None
+    if args.redirects:
+        # refused before anything is uploaded
+        try:
+            rules = redirects.load(args.redirects) if os.path.exists(args.redirects) else []
+            redirect_entries = redirects.store_entries(redirects.Index(rules))
+        except ValueError as err:
+            print('%s: %s' % (args.redirects, err), file=sys.stderr)
+            return 1
+    switched = False
+    try:
+        if args.release:
+            release_id, changed, removed, switched = deploy_release(
+                args.site_dir, args.bucket, args.release, command=command or None,
+                dist_id=args.distribution, switch=args.switch, keep=args.keep,
+                wait=not args.no_wait, redirect_entries=redirect_entries, **options
+            )
+        else:
+            changed, removed = sync(args.site_dir, args.bucket, prefix=args.prefix, **options)
+    except subprocess.CalledProcessError as err:
+        print('generator failed with exit status %d, nothing was changed' % err.returncode,
+              file=sys.stderr)
+        return err.returncode
+    if redirect_entries is not None and not args.release and not args.dry_run:
+        cloudfront = boto3.client('cloudfront')
+        if publish_redirects(cloudfront, args.distribution or find_distribution(cloudfront, args.bucket),
+                             redirect_entries):
+            print('redirects published')
+    if args.changes:
+        with open(args.changes, 'w') as changes_file:
+            report = {'changed': changed, 'removed': removed}
+            if args.release:
+                report['release'] = release_id
+            json.dump(report, changes_file, indent=2)
+    # a release changes nothing served until it is switched to
+    live_changed = switched or not args.release
+    if args.queue_url and not args.dry_run and live_changed and (changed or removed):
+        notify(args.queue_url, changed + removed)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
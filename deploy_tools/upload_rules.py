@@ -0,0 +1,136 @@
+import os
+import re
+import io
+import gzip
+import json
+import hashlib
+import fnmatch
+import mimetypes
+from concurrent.futures import ProcessPoolExecutor
+
+##########################################
+# Object metadata and compression rules
+##########################################
+# Each rule maps keys (glob patterns or a regex) to the metadata their
+# objects are uploaded with. The first matching rule wins. Text assets
+# are compressed before upload and the compressed copy is stored, with
+# its Content-Encoding, only when it is actually smaller. Only gzip is
+# stored: CloudFront serves the one stored copy to every viewer without
+# decoding it, and gzip is the encoding all of them accept. Brotli is
+# left to the cdn's own compression of the objects stored uncompressed.
+
+HASHED_ASSET = r'[.-][0-9a-f]{8,}\.(js|css|mjs|map|png|jpe?g|gif|webp|avif|svg|ico|woff2?|ttf|otf|eot)$'
+
+DEFAULT_RULES = [
+    {
+        # fingerprinted file names never change content
+        'regex': HASHED_ASSET,
+        'cache_control': 'public, max-age=31536000, immutable'
+    },
+    {
+        'match': ['*.html', '*.htm', '*.xml', '*.json', '*.txt', '*.webmanifest'],
+        'cache_control': 'public, max-age=60, must-revalidate'
+    },
+    {
+        'match': ['*'],
+        'cache_control': 'public, max-age=86400'
+    }
+]
+
+COMPRESSIBLE_TYPES = (
+    'text/',
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'application/manifest+json',
+    'application/wasm',
+    'application/vnd.ms-fontobject',
+    'image/svg+xml',
+    'image/x-icon',
+    'font/ttf',
+    'font/otf'
+)
+MIN_COMPRESS_SIZE = 1024
+ENCODINGS = ('gzip', 'none')
+
+mimetypes.add_type('application/manifest+json', '.webmanifest')
+mimetypes.add_type('font/woff2', '.woff2')
+mimetypes.add_type('font/woff', '.woff')
+mimetypes.add_type('image/svg+xml', '.svg')
+mimetypes.add_type('application/javascript', '.mjs')
+
+
+class Rules:
+    def __init__(self, rules=None, encoding='gzip'):
+        self.rules = rules if rules is not None else DEFAULT_RULES
+        if encoding not in ENCODINGS:
+            raise ValueError('text assets are stored as '+' or '.join(ENCODINGS)+', not '+repr(encoding))
+        self.encoding = encoding
+        self._regexes = [re.compile(rule['regex']) if 'regex' in rule else None for rule in self.rules]
+
+    @classmethod
+    def load(cls, path, encoding=None):
+        with open(path) as rules_file:
+            config = json.load(rules_file)
+        return cls(config.get('rules'), encoding or config.get('encoding', 'gzip'))
+
+    def rule_for(self, key):
+        for rule, regex in zip(self.rules, self._regexes):
+            if regex is not None:
+                if regex.search(key):
+                    return rule
+            elif any(fnmatch.fnmatch(key, pattern) for pattern in rule.get('match', [])):
+                return rule
+        return {}
+
+    def metadata(self, key):
+        rule = self.rule_for(key)
+        content_type = rule.get('content_type') or mimetypes.guess_type(key)[0] or 'application/octet-stream'
+        extra_args = {'ContentType': content_type}
+        if rule.get('cache_control'):
+            extra_args['CacheControl'] = rule['cache_control']
+        compress = rule.get('compress', content_type.startswith(COMPRESSIBLE_TYPES))
+        return extra_args, compress and self.encoding != 'none'
+
+    def fingerprint(self, key):
+        # changes whenever the metadata or encoding a key would get changes
+        extra_args, compress = self.metadata(key)
+        described = json.dumps([extra_args, compress and self.encoding], sort_keys=True)
+        return hashlib.md5(described.encode('utf-8')).hexdigest()
+
+
+##########################################
+# Pre-compression in a process pool
+##########################################
+def compress_file(path, out_path):
+    with open(path, 'rb') as source:
+        data = source.read()
+    buffer = io.BytesIO()
+    # fixed mtime and no file name so identical input gives identical output
+    with gzip.GzipFile(filename='', mode='wb', fileobj=buffer, compresslevel=9, mtime=0) as stream:
+        stream.write(data)
+    compressed = buffer.getvalue()
+    if len(compressed) >= len(data):
+        return None
+    with open(out_path, 'wb') as target:
+        target.write(compressed)
+    return len(compressed), hashlib.md5(compressed).hexdigest()
+
+
+def compress_all(jobs, workers=None):
+    # jobs is a list of (key, path, out_path). Returns {key: (size, md5)}
+    # for the files worth storing gzipped.
+    if not jobs:
+        return {}
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = dict((key, pool.submit(compress_file, path, out_path))
+                       for key, path, out_path in jobs)
+        for key, future in futures.items():
+            result = future.result()
+            if result is not None:
+                results[key] = result
+    for key, path, out_path in jobs:
+        if key not in results and os.path.exists(out_path):
+            os.remove(out_path)
+    return results
@@ -0,0 +1,517 @@
+#!/usr/bin/env python3
+import os
+import sys
+import argparse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import aws
+import certificates
+import dns
+import inventory
+import readiness
+import settings
+import setup
+from provision import Graph, StepFailed
+from readiness import error_code, error_matches
+from state import State, state_path
+
+##########################################
+# Tear down everything setup.py created
+##########################################
+# Resources are found the way setup.py names them: by the Name tag it
+# puts on buckets, functions, the queue, the distribution and the
+# certificate, under the '/'+proj_name+'/' path of its IAM roles and
+# policies, and by name for the rules, repository, build project,
+# redirects function and its key value store, which carry no tags.
+# Everything is looked up first, all at once, so the run can be listed
+# before anything is deleted.
+#
+# Teardown steps form a graph of their own, where a step needs the steps
+# that remove whatever still uses its resources: the functions go once
+# their rules are gone, the roles once the functions and the build
+# project are, the policies after the roles. Independent branches run
+# side by side. The long one is the distribution, which has to be
+# disabled and deployed before it can be deleted: the buckets are
+# emptied and IAM is cleaned up while it deploys. The website bucket
+# itself is only deleted after the distribution, so the cdn never
+# points at a bucket name anyone could claim.
+#
+# Everything already gone is skipped, so a run that stopped half way is
+# simply run again.
+
+graph = Graph()
+
+# delete_objects takes at most 1,000 keys
+MAX_DELETE = 1000
+# calls of one step made at the same time (functions, roles, batches)
+STEP_WORKERS = 8
+
+RULES = ('-build-finished', '-log-cleanup')
+
+
+def each(call, items, workers=STEP_WORKERS):
+    items = list(items)
+    if not items:
+        return []
+    with ThreadPoolExecutor(max_workers=min(workers, len(items))) as pool:
+        return list(pool.map(call, items))
+
+
+def unless_gone(codes, call, *args, **kwargs):
+    # the call's result, or None when the resource is already gone
+    try:
+        return call(*args, **kwargs)
+    except Exception as err:
+        if not error_matches(codes)(err):
+            raise
+        return None
+
+
+def paginate(client, operation, result_key, **kwargs):
+    items = []
+    for page in client.get_paginator(operation).paginate(**kwargs):
+        items.extend(page.get(result_key, []))
+    return items
+
+
+def name_tag(tags):
+    # tags come as a dict or as a list of {'Key': ..., 'Value': ...}
+    if isinstance(tags, dict):
+        return tags.get('Name')
+    return next((tag['Value'] for tag in tags if tag['Key'] == 'Name'), None)
+
+##########################################
+# Events rules
+##########################################
+@graph.step('rules')
+def delete_rules(var, out):
+    events = aws.client('events')
+    def delete(name):
+        targets = events.list_targets_by_rule(Rule= name)['Targets']
+        if targets:
+            events.remove_targets(Rule= name, Ids= [target['Id'] for target in targets])
+        events.delete_rule(Name= name)
+    each(lambda name: unless_gone('ResourceNotFoundException', delete, name), out['found'])
+    print('Deleted rules '+', '.join(out['found']))
+
+@graph.probe('rules')
+def find_rules(var, out, recorded):
+    events = aws.client('events')
+    names = [var.proj_name+suffix for suffix in RULES]
+    found = [name for name in names
+             if unless_gone('ResourceNotFoundException', events.describe_rule, Name= name)]
+    return {'found': found} if found else None
+
+##########################################
+# Lambda functions and their event sources
+##########################################
+@graph.step('functions', needs=['rules'])
+def delete_functions(var, out):
+    serverless = aws.client('lambda')
+    def delete(name):
+        for mapping in paginate(serverless, 'list_event_source_mappings', 'EventSourceMappings',
+                                FunctionName= name):
+            unless_gone('ResourceNotFoundException', serverless.delete_event_source_mapping,
+                        UUID= mapping['UUID'])
+        unless_gone('ResourceNotFoundException', serverless.delete_function, FunctionName= name)
+    each(delete, out['found'])
+    print('Deleted functions '+', '.join(out['found']))
+
+@graph.probe('functions')
+def find_functions(var, out, recorded):
+    # a function of another project may share the name prefix, its tag
+    # tells them apart
+    serverless = aws.client('lambda')
+    functions = inventory.for_site(var).functions()
+    def ours(name):
+        tags = serverless.list_tags(Resource= functions[name]['FunctionArn'])['Tags']
+        return name_tag(tags) == var.proj_name
+    names = sorted(functions)
+    found = [name for name, mine in zip(names, each(ours, names)) if mine]
+    return {'found': found} if found else None
+
+##########################################
+# Build project and repository
+##########################################
+@graph.step('build_project', needs=['functions'])
+def delete_build_project(var, out):
+    # after the functions, so that no build is started meanwhile
+    aws.client('codebuild').delete_project(name= var.proj_name)
+    print('Deleted build project '+var.proj_name)
+
+@graph.probe('build_project')
+def find_build_project(var, out, recorded):
+    return {'found': [var.proj_name]} if inventory.for_site(var).build_project() else None
+
+@graph.step('repo', needs=['functions', 'build_project'])
+def delete_repo(var, out):
+    # the repository triggers go with it
+    aws.client('codecommit').delete_repository(repositoryName= var.proj_name)
+    print('Deleted repository '+var.proj_name)
+
+@graph.probe('repo')
+def find_repo(var, out, recorded):
+    return {'found': [var.proj_name]} if inventory.for_site(var).repository() else None
+
+##########################################
+# Invalidation queue
+##########################################
+QUEUE_GONE = ['AWS.SimpleQueueService.NonExistentQueue', 'QueueDoesNotExist']
+
+@graph.step('invalidation_queue', needs=['functions', 'empty_bucket'])
+def delete_invalidation_queue(var, out):
+    unless_gone(QUEUE_GONE, aws.client('sqs').delete_queue, QueueUrl= out['queue_url'])
+    print('Deleted queue '+out['found'][0])
+
+@graph.probe('invalidation_queue')
+def find_invalidation_queue(var, out, recorded):
+    sqs = aws.client('sqs')
+    name = var.proj_name+'-cdn-invalidation'
+    queue = unless_gone(QUEUE_GONE, sqs.get_queue_url, QueueName= name)
+    if queue is None:
+        return None
+    if name_tag(sqs.list_queue_tags(QueueUrl= queue['QueueUrl']).get('Tags', {})) != var.proj_name:
+        return None
+    return {'found': [name], 'queue_url': queue['QueueUrl']}
+
+##########################################
+# IAM roles, then their policies
+##########################################
+@graph.step('roles', needs=['functions', 'build_project'])
+def delete_roles(var, out):
+    iam = aws.client('iam')
+    def delete(name):
+        for policy in paginate(iam, 'list_attached_role_policies', 'AttachedPolicies', RoleName= name):
+            iam.detach_role_policy(RoleName= name, PolicyArn= policy['PolicyArn'])
+        for policy_name in paginate(iam, 'list_role_policies', 'PolicyNames', RoleName= name):
+            iam.delete_role_policy(RoleName= name, PolicyName= policy_name)
+        iam.delete_role(RoleName= name)
+    each(lambda name: unless_gone('NoSuchEntity', delete, name), out['found'])
+    print('Deleted roles '+', '.join(out['found']))
+
+@graph.probe('roles')
+def find_roles(var, out, recorded):
+    found = sorted(inventory.for_site(var).roles())
+    return {'found': found} if found else None
+
+@graph.step('policies', needs=['roles'])
+def delete_policies(var, out):
+    # the versions setup.py kept go first, a policy is deleted with its
+    # default version
+    iam = aws.client('iam')
+    def delete(arn):
+        for version in iam.list_policy_versions(PolicyArn= arn)['Versions']:
+            if not version['IsDefaultVersion']:
+                iam.delete_policy_version(PolicyArn= arn, VersionId= version['VersionId'])
+        iam.delete_policy(PolicyArn= arn)
+    each(lambda arn: unless_gone('NoSuchEntity', delete, arn), out['policy_arns'])
+    print('Deleted policies '+', '.join(out['found']))
+
+@graph.probe('policies')
+def find_policies(var, out, recorded):
+    policies = inventory.for_site(var).policies()
+    if not policies:
+        return None
+    return {'found': sorted(policies), 'policy_arns': [policies[name]['Arn'] for name in sorted(policies)]}
+
+##########################################
+# Dns records
+##########################################
+@graph.step('dns_records')
+def delete_dns_records(var, out):
+    # the aliases go before the distribution, nothing is left pointing at
+    # a cdn name someone else could take over
+    dns.delete(out['zone_id'], out['records'], 'Remove '+var.website_fqdn, wait= False)
+    print('Deleted dns records '+', '.join(out['found']))
+
+@graph.probe('dns_records')
+def find_dns_records(var, out, recorded):
+    try:
+        zone_id = dns.zone_id(dns.find_zone(var))
+    except LookupError:
+        return None
+    records = aws.client('route53').list_resource_record_sets(
+        HostedZoneId= zone_id,
+        StartRecordName= var.website_fqdn,
+        StartRecordType= 'A',
+        MaxItems= '2'
+    )['ResourceRecordSets']
+    records = [record for record in records
+               if dns.normalize(record['Name']) == dns.normalize(var.website_fqdn)
+               and record['Type'] in ('A', 'AAAA')
+               and record.get('AliasTarget', {}).get('HostedZoneId') == dns.CLOUDFRONT_ZONE_ID]
+    if not records:
+        return None
+    return {
+        'found': [var.website_fqdn+' '+record['Type'] for record in records],
+        'zone_id': zone_id,
+        'records': records
+    }
+
+##########################################
+# Cdn: disable, wait for the deploy, delete
+##########################################
+@graph.step('cdn', needs=['dns_records'])
+def delete_cdn(var, out):
+    cloudfront = aws.client('cloudfront')
+    dist_id = out['cdn_dist_id']
+    current = unless_gone('NoSuchDistribution', cloudfront.get_distribution_config, Id= dist_id)
+    if current is None:
+        return {'cdn_dist_arn': out['cdn_dist_arn']}
+    if current['DistributionConfig']['Enabled']:
+        print('Disabling cdn '+dist_id+'...')
+        cloudfront.update_distribution(
+            Id= dist_id,
+            IfMatch= current['ETag'],
+            DistributionConfig= dict(current['DistributionConfig'], Enabled= False)
+        )
+    # deletable once the disabled configuration has deployed everywhere
+    print('Waiting for cdn '+dist_id+' to be disabled...')
+    def disabled():
+        distribution = cloudfront.get_distribution(Id= dist_id)
+        return distribution['ETag'] if distribution['Distribution']['Status'] == 'Deployed' else None
+    etag = readiness.wait_until('cloudfront disable '+dist_id, disabled, timeout= 3600, base= 5, cap= 60)
+    cloudfront.delete_distribution(Id= dist_id, IfMatch= etag)
+    print('Deleted cdn '+dist_id)
+    return {'cdn_dist_arn': out['cdn_dist_arn']}
+
+@graph.probe('cdn')
+def find_cdn(var, out, recorded):
+    distribution = inventory.for_site(var).distribution_for(var.website_fqdn)
+    if distribution is None:
+        return None
+    tags = aws.client('cloudfront').list_tags_for_resource(Resource= distribution['ARN'])['Tags']
+    if name_tag(tags.get('Items', [])) != var.proj_name:
+        return None
+    return {'found': [distribution['Id']], 'cdn_dist_id': distribution['Id'], 'cdn_dist_arn': distribution['ARN']}
+
+##########################################
+# Redirects function, once no distribution runs it
+##########################################
+@graph.step('redirects_function', needs=['cdn'])
+def delete_redirects_function(var, out):
+    cloudfront = aws.client('cloudfront')
+    for name in out['found']:
+        described = unless_gone('NoSuchFunctionExists', cloudfront.describe_function, Name= name)
+        if described is None:
+            continue
+        unless_gone('NoSuchFunctionExists', cloudfront.delete_function, Name= name, IfMatch= described['ETag'])
+        print('Deleted function '+name)
+
+@graph.probe('redirects_function')
+def find_redirects_function(var, out, recorded):
+    # whatever the setting says now, it may have been set before
+    name = setup.redirects_function_name(var)
+    if unless_gone('NoSuchFunctionExists', aws.client('cloudfront').describe_function, Name= name) is None:
+        return None
+    return {'found': [name]}
+
+##########################################
+# Redirects store, once no function uses it
+##########################################
+@graph.step('redirects_store', needs=['redirects_function'])
+def delete_redirects_store(var, out):
+    cloudfront = aws.client('cloudfront')
+    for name in out['found']:
+        described = unless_gone('EntityNotFound', cloudfront.describe_key_value_store, Name= name)
+        if described is None:
+            continue
+        unless_gone('EntityNotFound', cloudfront.delete_key_value_store, Name= name, IfMatch= described['ETag'])
+        print('Deleted key value store '+name)
+
+@graph.probe('redirects_store')
+def find_redirects_store(var, out, recorded):
+    name = setup.redirects_store_name(var)
+    if unless_gone('EntityNotFound', aws.client('cloudfront').describe_key_value_store, Name= name) is None:
+        return None
+    return {'found': [name]}
+
+##########################################
+# Certificate
+##########################################
+@graph.step('certificate', needs=['cdn'])
+def delete_certificate(var, out):
+    # Only a certificate this project requested, and only when nothing
+    # else uses it: other sites may have reused it. ACM takes a moment to
+    # notice the distribution is gone. The validation records stay, ACM
+    # uses the same record for every certificate of a name.
+    acm = certificates.client()
+    for arn in out['found']:
+        certificate = unless_gone('ResourceNotFoundException', acm.describe_certificate, CertificateArn= arn)
+        if certificate is None:
+            continue
+        users = [user for user in certificate['Certificate'].get('InUseBy', [])
+                 if user != out.get('cdn_dist_arn')]
+        if users:
+            print('Kept certificate '+arn+', still used by '+', '.join(users))
+            continue
+        readiness.retry('acm certificate '+arn, lambda: unless_gone(
+            'ResourceNotFoundException', acm.delete_certificate, CertificateArn= arn
+        ), retry_if= error_matches('ResourceInUseException'))
+        print('Deleted certificate '+arn)
+
+@graph.probe('certificate')
+def find_certificate(var, out, recorded):
+    acm = certificates.client()
+    candidates = [summary['CertificateArn'] for summary in inventory.for_site(var).certificates()
+                  if certificates.may_cover(summary, var.website_fqdn)]
+    def ours(arn):
+        return name_tag(acm.list_tags_for_certificate(CertificateArn= arn).get('Tags', [])) == var.proj_name
+    found = [arn for arn, mine in zip(candidates, each(ours, candidates)) if mine]
+    return {'found': found} if found else None
+
+##########################################
+# Buckets
+##########################################
+def bucket_tag(s3, bucket):
+    # the bucket's Name tag, None when it has none or is not there
+    try:
+        return name_tag(s3.get_bucket_tagging(Bucket= bucket)['TagSet'])
+    except Exception as err:
+        if error_code(err) in ('NoSuchTagSet', 'NoSuchBucket', '404', 'AccessDenied', '403'):
+            return None
+        raise
+
+
+def delete_batch(s3, bucket, objects):
+    response = s3.delete_objects(Bucket= bucket, Delete= {'Objects': objects, 'Quiet': True})
+    errors = response.get('Errors', [])
+    if errors:
+        raise RuntimeError('%d objects of %s not deleted, first %s: %s' % (
+            len(errors), bucket, errors[0]['Key'], errors[0].get('Message', errors[0].get('Code'))))
+    return len(objects)
+
+
+def empty_bucket(s3, bucket, workers=STEP_WORKERS):
+    # Every version and delete marker, a page of at most 1,000 at a time,
+    # each page deleted in one call while the next one is listed.
+    pages = s3.get_paginator('list_object_versions').paginate(Bucket= bucket)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        batches = []
+        for page in pages:
+            objects = [{'Key': version['Key'], 'VersionId': version['VersionId']}
+                       for version in page.get('Versions', []) + page.get('DeleteMarkers', [])]
+            for start in range(0, len(objects), MAX_DELETE):
+                batches.append(pool.submit(delete_batch, s3, bucket, objects[start:start + MAX_DELETE]))
+        return sum(batch.result() for batch in batches)
+
+
+def delete_bucket(s3, bucket):
+    # anything written since it was emptied goes too
+    empty_bucket(s3, bucket)
+    unless_gone('NoSuchBucket', s3.delete_bucket, Bucket= bucket)
+
+@graph.step('empty_bucket', needs=['functions', 'build_project'])
+def empty_website_bucket(var, out):
+    # S3 would report every deleted object to the invalidation queue
+    s3 = aws.client('s3')
+    s3.put_bucket_notification_configuration(Bucket= var.website_fqdn, NotificationConfiguration= {})
+    deleted = empty_bucket(s3, var.website_fqdn)
+    print('Deleted %d objects from %s' % (deleted, var.website_fqdn))
+    return {'objects_deleted': deleted}
+
+@graph.step('bucket', needs=['empty_bucket', 'cdn'])
+def delete_website_bucket(var, out):
+    delete_bucket(aws.client('s3'), var.website_fqdn)
+    print('Deleted bucket '+var.website_fqdn)
+
+@graph.probe('empty_bucket')
+@graph.probe('bucket')
+def find_website_bucket(var, out, recorded):
+    if bucket_tag(aws.client('s3'), var.website_fqdn) != var.proj_name:
+        return None
+    return {'found': [var.website_fqdn]}
+
+@graph.step('build_cache', needs=['build_project'])
+def delete_build_cache(var, out):
+    s3 = aws.client('s3')
+    bucket = setup.build_cache_bucket(var)
+    delete_bucket(s3, bucket)
+    print('Deleted bucket '+bucket)
+
+@graph.probe('build_cache')
+def find_build_cache(var, out, recorded):
+    # looked for whatever build_cache is now, it may have been 's3' before
+    bucket = setup.build_cache_bucket(var)
+    if bucket_tag(aws.client('s3'), bucket) != var.proj_name:
+        return None
+    return {'found': [bucket]}
+
+##########################################
+# Find, then tear down
+##########################################
+def find(var, workers=8):
+    # every probe at once, they only read
+    steps = list(graph.steps.values())
+    found = each(lambda step: step.probe(var, {}, {}), steps, workers)
+    return OrderedDict((step.name, outputs) for step, outputs in zip(steps, found))
+
+
+def report(found):
+    lines = ['- %-20s %s' % (name, ', '.join(outputs['found']))
+             for name, outputs in found.items() if outputs]
+    lines.append('')
+    lines.append('%d steps to run, %d with nothing left' % (
+        len([outputs for outputs in found.values() if outputs]),
+        len([outputs for outputs in found.values() if not outputs])))
+    return '\n'.join(lines)
+
+
+def teardown(var, found, workers=8, log=print):
+    # Runs every step in dependency order, those that found nothing
+    # finish straight away. Each step sees what its probe found.
+    def remove(step, var, out):
+        if not found.get(step.name):
+            return {}
+        return step.func(var, dict(out, **found[step.name]))
+    return graph.run(var, workers=workers, log=log, action=remove)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Delete everything setup.py created for the site.')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='list what would be deleted and stop')
+    parser.add_argument('--yes', action='store_true',
+                        help='do not ask for confirmation')
+    parser.add_argument('--state', metavar='FILE',
+                        help='state file removed once everything is gone (default: <proj_name>.state.json)')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='number of teardown steps run at the same time')
+    args = parser.parse_args(argv)
+    state = State(args.state or state_path(settings))
+    print('Finding the resources of '+settings.proj_name+'...')
+    found = find(settings, workers=args.workers)
+    print()
+    print(report(found))
+    print()
+    if not any(found.values()):
+        print('Nothing to delete.')
+    elif args.dry_run:
+        return 0
+    else:
+        if not args.yes:
+            answer = input('Type the project name to delete all of the above: ')
+            if answer.strip() != settings.proj_name:
+                print('Nothing deleted.')
+                return 1
+        try:
+            _, timings = teardown(settings, found, workers=args.workers)
+        except StepFailed as err:
+            for name, failure in err.failures:
+                print(name+': '+repr(failure))
+            if err.skipped:
+                print('Not started: '+', '.join(err.skipped))
+            print('Run destroy.py again to delete what is left.')
+            return 1
+        print()
+        print(timings.report())
+        print()
+        print(readiness.metrics.report())
+    if os.path.exists(state.path):
+        os.remove(state.path)
+        print('Removed '+state.path)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
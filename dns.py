@@ -0,0 +1,247 @@
+import threading
+import aws
+import inventory
+import readiness
+
+##########################################
+# Route 53 zones and batched record changes
+##########################################
+# The hosted zone of a site is the public zone named exactly dns_domain,
+# found in the zone listing the inventory fetches once per domain.
+#
+# Record changes are submitted through one batcher per process, with a
+# queue per zone. While a change_resource_record_sets call for a zone is
+# in flight, changes submitted for that zone by other steps (or other
+# sites, see multisite.py) wait and go out together in the next call.
+# Nothing is held back when the zone is idle, so a single site pays no
+# extra latency and many sites share their round trips. A change is
+# live once get_change reports it INSYNC, polled with backoff and
+# shared by everyone waiting on the same change.
+
+# Zone id of every CloudFront distribution, for alias records
+CLOUDFRONT_ZONE_ID = 'Z2FDTNDATAQYW2'
+# ChangeBatch limits: 1,000 changes (UPSERTs count twice) and 32,000
+# characters of record values per request
+MAX_CHANGES = 1000
+MAX_VALUE_CHARS = 32000
+
+
+def zone_id(zone):
+    # '/hostedzone/Z0123456789ABC' -> 'Z0123456789ABC', whatever its length
+    return zone['Id'].split('/')[-1]
+
+
+def normalize(name):
+    return name.rstrip('.').lower()+'.'
+
+
+def find_zone(var):
+    # The public zone named dns_domain. The listing starts at dns_domain
+    # but goes on to the zones after it, so the first zone returned is
+    # not necessarily a match.
+    zones = [zone for zone in inventory.for_site(var).hosted_zones()
+             if normalize(zone['Name']) == normalize(var.dns_domain)
+             and not zone.get('Config', {}).get('PrivateZone')]
+    if getattr(var, 'hosted_zone_id', ''):
+        zones = [zone for zone in zones if zone_id(zone) == var.hosted_zone_id]
+    if not zones:
+        raise LookupError('no public hosted zone named '+var.dns_domain)
+    if len(zones) > 1:
+        raise LookupError('several public hosted zones are named '+var.dns_domain+' ('
+                          + ', '.join(zone_id(zone) for zone in zones)+'), set hosted_zone_id')
+    return zones[0]
+
+
+def cname(name, value, ttl=300):
+    return {
+        'Name': name,
+        'Type': 'CNAME',
+        'TTL': ttl,
+        'ResourceRecords': [{'Value': value}]
+    }
+
+
+def cdn_aliases(name, cdn_dns_domain):
+    # A and AAAA aliases of name to a distribution
+    return [
+        {
+            'Name': name,
+            'Type': record_type,
+            'AliasTarget': {
+                'DNSName': cdn_dns_domain,
+                'EvaluateTargetHealth': False,
+                'HostedZoneId': CLOUDFRONT_ZONE_ID
+            }
+        }
+        for record_type in ('A', 'AAAA')
+    ]
+
+
+def upserts(records):
+    return [{'Action': 'UPSERT', 'ResourceRecordSet': record} for record in records]
+
+
+def deletes(records):
+    return [{'Action': 'DELETE', 'ResourceRecordSet': record} for record in records]
+
+
+def change_key(change):
+    record = change['ResourceRecordSet']
+    return (normalize(record['Name']), record['Type'], record.get('SetIdentifier'))
+
+
+def change_size(change):
+    record = change['ResourceRecordSet']
+    values = sum(len(value['Value']) for value in record.get('ResourceRecords', []))
+    return (2 if change['Action'] == 'UPSERT' else 1), values
+
+
+class Submission:
+    def __init__(self, changes, comment):
+        self.changes = changes
+        self.comment = comment
+        self.done = threading.Event()
+        self.change_id = None
+        self.error = None
+
+
+class Batcher:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queues = {}
+        self._busy = set()
+        self._insync = set()
+        self._waiting = {}
+        self.calls = 0
+        self.submissions = 0
+
+    def submit(self, zone, changes, comment=''):
+        # Queue changes for a zone and return the id of the change they
+        # went out in, once they have been accepted. The caller that
+        # finds the zone idle sends everything queued, repeatedly, until
+        # the queue is empty; anyone else just waits for their turn.
+        submission = Submission(list(changes), comment)
+        with self._lock:
+            self.submissions += 1
+            self._queues.setdefault(zone, []).append(submission)
+            leader = zone not in self._busy
+            if leader:
+                self._busy.add(zone)
+        if leader:
+            self._drain(zone)
+        submission.done.wait()
+        if submission.error is not None:
+            raise submission.error
+        return submission.change_id
+
+    def _drain(self, zone):
+        while True:
+            with self._lock:
+                queued = self._queues.get(zone, [])
+                if not queued:
+                    self._busy.discard(zone)
+                    return
+                batch, self._queues[zone] = self._batch(queued)
+            self._send(zone, batch)
+
+    def _batch(self, queued):
+        # Take submissions in order while they fit in one request and do
+        # not change a record differently from another submission in the
+        # batch. The same change from two submissions (two sites sharing
+        # a validation record) is sent once.
+        batch, rest = [], []
+        keys = {}
+        changes = values = 0
+        for submission in queued:
+            new = [change for change in submission.changes if change_key(change) not in keys]
+            conflict = any(keys.get(change_key(change), change) != change for change in submission.changes)
+            sub_changes = sum(change_size(change)[0] for change in new)
+            sub_values = sum(change_size(change)[1] for change in new)
+            fits = changes + sub_changes <= MAX_CHANGES and values + sub_values <= MAX_VALUE_CHARS
+            if rest or (batch and (conflict or not fits)):
+                rest.append(submission)
+                continue
+            batch.append(submission)
+            keys.update((change_key(change), change) for change in new)
+            changes += sub_changes
+            values += sub_values
+        return batch, rest
+
+    def _send(self, zone, batch):
+        changes = {}
+        for submission in batch:
+            for change in submission.changes:
+                changes.setdefault(change_key(change), change)
+        comments = sorted(set(submission.comment for submission in batch if submission.comment))
+        try:
+            change_id = self._call(zone, list(changes.values()), '; '.join(comments)[:256])
+        except Exception as err:
+            if len(batch) == 1:
+                batch[0].error = err
+                batch[0].done.set()
+                return
+            # one bad submission fails the whole batch: find it
+            self._send_each(zone, batch)
+            return
+        for submission in batch:
+            submission.change_id = change_id
+            submission.done.set()
+
+    def _send_each(self, zone, submissions):
+        for submission in submissions:
+            self._send(zone, [submission])
+
+    def _call(self, zone, changes, comment):
+        with self._lock:
+            self.calls += 1
+        change_batch = {'Changes': changes}
+        if comment:
+            change_batch['Comment'] = comment
+        response = aws.client('route53').change_resource_record_sets(
+            HostedZoneId= zone,
+            ChangeBatch= change_batch
+        )
+        return response['ChangeInfo']['Id'].split('/')[-1]
+
+    def wait_insync(self, change_id, timeout=600):
+        # Changes usually sync within a minute. One thread polls a given
+        # change, the others wait on it and reuse the answer.
+        with self._lock:
+            if change_id in self._insync:
+                return
+            lock = self._waiting.setdefault(change_id, threading.Lock())
+        with lock:
+            if change_id in self._insync:
+                return
+            route53 = aws.client('route53')
+            readiness.wait_until(
+                'route53 change '+change_id,
+                lambda: route53.get_change(Id= change_id)['ChangeInfo']['Status'] == 'INSYNC',
+                timeout= timeout, base= 2, cap= 15
+            )
+            with self._lock:
+                self._insync.add(change_id)
+
+    def as_dict(self):
+        with self._lock:
+            return {'submissions': self.submissions, 'calls': self.calls, 'insync': len(self._insync)}
+
+
+batcher = Batcher()
+
+
+def change(zone, records, comment='', wait=True):
+    # UPSERT records in a zone and, unless told not to, wait until every
+    # name server has them
+    change_id = batcher.submit(zone, upserts(records), comment)
+    if wait:
+        batcher.wait_insync(change_id)
+    return change_id
+
+
+def delete(zone, records, comment='', wait=True):
+    # DELETE records, each exactly as the zone lists it
+    change_id = batcher.submit(zone, deletes(records), comment)
+    if wait:
+        batcher.wait_insync(change_id)
+    return change_id
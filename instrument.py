@@ -0,0 +1,252 @@
+import json
+import time
+import threading
+import contextlib
+from urllib.parse import urlencode
+
+##########################################
+# Tracing of AWS calls and provisioning steps
+##########################################
+# Handlers on botocore's before-call, needs-retry, after-call and
+# after-call-error events time every API call made by clients of a
+# session and count its attempts, throttled attempts and payload sizes.
+# Together with the step timings of a run and the readiness waits this
+# splits each step's time into time spent in AWS calls, time spent
+# sleeping until something became ready, and local work. The result is
+# written as a json trace and as a Chrome trace timeline that loads in
+# chrome://tracing, Perfetto or speedscope.
+
+THROTTLE_CODES = (
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'TooManyRequestsException',
+    'RequestLimitExceeded',
+    'RequestThrottled',
+    'RequestThrottledException',
+    'SlowDown',
+    'PriorRequestNotComplete',
+    'TooManyUpdates'
+)
+
+
+def payload_size(body):
+    if isinstance(body, bytes):
+        return len(body)
+    if isinstance(body, str):
+        return len(body.encode('utf-8'))
+    if isinstance(body, dict):
+        return len(urlencode(body, doseq=True))
+    # streamed bodies (file uploads) are not read here
+    return 0
+
+
+def call_name(event_name):
+    # after-call.<service id>.<operation>
+    parts = event_name.split('.')
+    return parts[1], parts[2] if len(parts) > 2 else ''
+
+
+class Tracer:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.origin = time.monotonic()
+        self.calls = []
+        self.spans = []
+        self.runs = []
+
+    def install(self, session):
+        # before any client is created: clients copy the session's handlers
+        session.events.register('before-call', self.before_call)
+        session.events.register('needs-retry', self.needs_retry)
+        session.events.register('after-call', self.after_call)
+        session.events.register('after-call-error', self.after_call_error)
+
+    # Event handlers must return None, anything else changes the call.
+    def before_call(self, params, context, **kwargs):
+        context['trace'] = {
+            'started': time.monotonic(),
+            'attempts': 1,
+            'throttles': 0,
+            'request_bytes': payload_size(params.get('body'))
+        }
+
+    def needs_retry(self, request_dict, attempts, response=None, **kwargs):
+        trace = request_dict.get('context', {}).get('trace')
+        if trace is None:
+            return
+        trace['attempts'] = attempts
+        if response is not None and response[1].get('Error', {}).get('Code') in THROTTLE_CODES:
+            trace['throttles'] += 1
+
+    def after_call(self, event_name, context, http_response=None, parsed=None, **kwargs):
+        status = http_response.status_code if http_response is not None else None
+        size = 0
+        if http_response is not None and http_response.headers:
+            size = int(http_response.headers.get('content-length', 0) or 0)
+        error = (parsed or {}).get('Error', {}).get('Code')
+        self._record(event_name, context, status, size, error)
+
+    def after_call_error(self, event_name, context, exception=None, **kwargs):
+        self._record(event_name, context, None, 0, type(exception).__name__)
+
+    def _record(self, event_name, context, status, response_bytes, error):
+        trace = context.get('trace')
+        if trace is None:
+            return
+        service, operation = call_name(event_name)
+        ended = time.monotonic()
+        with self._lock:
+            self.calls.append({
+                'service': service,
+                'operation': operation,
+                'start': trace['started'] - self.origin,
+                'latency': ended - trace['started'],
+                'attempts': trace['attempts'],
+                'throttles': trace['throttles'],
+                'request_bytes': trace['request_bytes'],
+                'response_bytes': response_bytes,
+                'status': status,
+                'error': error,
+                'thread': threading.current_thread().name
+            })
+
+    @contextlib.contextmanager
+    def span(self, name):
+        # a phase of the run (plan, apply...) on the calling thread
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.spans.append({
+                    'name': name,
+                    'start': started - self.origin,
+                    'duration': time.monotonic() - started,
+                    'thread': threading.current_thread().name
+                })
+
+    def add_timings(self, timings, category='step'):
+        # step timings of a Graph.run, probes when category is 'probe'
+        self.runs.append((timings, category))
+
+    def steps(self, waits=()):
+        # every step with its time split into aws calls, readiness sleeps
+        # and local work, from the calls and waits on the step's thread
+        steps = []
+        for timings, category in self.runs:
+            offset = timings.origin - self.origin
+            for name in sorted(timings.stopped, key=timings.started.get):
+                start = offset + timings.started[name]
+                end = offset + timings.stopped[name]
+                thread = timings.threads.get(name)
+                def inside(item, start=start, end=end, thread=thread):
+                    return item['thread'] == thread and start <= item['start'] < end
+                calls = [call for call in self.calls if inside(call)]
+                in_waits = 0.0
+                sleeping = 0.0
+                for wait in waits:
+                    if inside(wait):
+                        during = sum(call['latency'] for call in calls
+                                     if wait['start'] <= call['start'] < wait['start'] + wait['elapsed'])
+                        in_waits += during
+                        sleeping += max(0.0, wait['elapsed'] - during)
+                aws_time = sum(call['latency'] for call in calls)
+                steps.append({
+                    'name': name,
+                    'category': category,
+                    'start': start,
+                    'duration': end - start,
+                    'thread': thread,
+                    'calls': len(calls),
+                    'aws': aws_time,
+                    'sleeping': sleeping,
+                    'local': max(0.0, end - start - aws_time - sleeping)
+                })
+        return steps
+
+    def summary(self):
+        by_call = {}
+        for call in self.calls:
+            key = call['service']+'.'+call['operation']
+            entry = by_call.setdefault(key, {
+                'calls': 0, 'latency': 0.0, 'max_latency': 0.0, 'retries': 0,
+                'throttles': 0, 'errors': 0, 'request_bytes': 0, 'response_bytes': 0
+            })
+            entry['calls'] += 1
+            entry['latency'] += call['latency']
+            entry['max_latency'] = max(entry['max_latency'], call['latency'])
+            entry['retries'] += call['attempts'] - 1
+            entry['throttles'] += call['throttles']
+            entry['errors'] += 1 if call['error'] else 0
+            entry['request_bytes'] += call['request_bytes']
+            entry['response_bytes'] += call['response_bytes']
+        return by_call
+
+    def waits(self, metrics):
+        return [dict(wait, start=wait['started'] - self.origin) for wait in metrics.as_dict()]
+
+    def trace(self, metrics):
+        waits = self.waits(metrics)
+        return {
+            'spans': self.spans,
+            'steps': self.steps(waits),
+            'waits': waits,
+            'calls': self.calls,
+            'summary': self.summary()
+        }
+
+    def timeline(self, metrics):
+        # Chrome trace event format: complete events in microseconds,
+        # one row per thread, steps enclosing their waits and calls
+        waits = self.waits(metrics)
+        threads = {}
+        def tid(name):
+            return threads.setdefault(name, len(threads) + 1)
+        events = []
+        def complete(name, category, start, duration, thread, args=None):
+            events.append({
+                'name': name, 'cat': category, 'ph': 'X', 'pid': 1, 'tid': tid(thread),
+                'ts': round(start * 1e6), 'dur': max(1, round(duration * 1e6)), 'args': args or {}
+            })
+        for span in self.spans:
+            complete(span['name'], 'phase', span['start'], span['duration'], span['thread'])
+        for step in self.steps(waits):
+            complete(step['name'], step['category'], step['start'], step['duration'], step['thread'], {
+                'calls': step['calls'], 'aws': step['aws'], 'sleeping': step['sleeping'], 'local': step['local']
+            })
+        for wait in waits:
+            complete('wait: '+wait['name'], 'wait', wait['start'], wait['elapsed'], wait['thread'], {
+                'attempts': wait['attempts'], 'ready': wait['ready']
+            })
+        for call in self.calls:
+            complete(call['service']+'.'+call['operation'], 'aws', call['start'], call['latency'], call['thread'], {
+                'attempts': call['attempts'], 'throttles': call['throttles'],
+                'request_bytes': call['request_bytes'], 'response_bytes': call['response_bytes'],
+                'status': call['status'], 'error': call['error']
+            })
+        for name, number in threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': number, 'args': {'name': name}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def report(self, metrics, top=10):
+        lines = ['%-28s %6s %9s %9s %9s' % ('step', 'calls', 'aws', 'sleeping', 'local')]
+        for step in self.steps(self.waits(metrics)):
+            if step['category'] == 'step':
+                lines.append('%-28s %6d %8.1fs %8.1fs %8.1fs' % (
+                    step['name'], step['calls'], step['aws'], step['sleeping'], step['local']))
+        lines.append('')
+        lines.append('%-40s %6s %9s %8s %9s' % ('slowest api calls (total)', 'calls', 'latency', 'retries', 'throttles'))
+        summary = sorted(self.summary().items(), key=lambda item: -item[1]['latency'])
+        for name, entry in summary[:top]:
+            lines.append('%-40s %6d %8.1fs %8d %9d' % (
+                name, entry['calls'], entry['latency'], entry['retries'], entry['throttles']))
+        return '\n'.join(lines)
+
+    def write(self, metrics, trace_path=None, timeline_path=None):
+        if trace_path:
+            with open(trace_path, 'w') as trace_file:
+                json.dump(self.trace(metrics), trace_file, indent=2)
+        if timeline_path:
+            with open(timeline_path, 'w') as timeline_file:
+                json.dump(self.timeline(metrics), timeline_file)
@@ -0,0 +1,166 @@
+import threading
+import aws
+from readiness import error_code
+
+##########################################
+# Batched lookups of what already exists
+##########################################
+# Probes ask the inventory rather than AWS directly. Each kind of
+# resource is fetched once with a single paginated list/describe call
+# covering every resource of the project, then answered from memory.
+# Lookups that list the whole account (functions, distributions,
+# certificates, hosted zones) go through one Account shared by every
+# site provisioned from this process.
+
+
+class Cache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {}
+        self._cache = {}
+
+    def _cached(self, key, fetch):
+        # one lock per key so different lookups can run side by side
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            if key not in self._cache:
+                self._cache[key] = fetch()
+            return self._cache[key]
+
+    def _paginate(self, client, operation, result_key, **kwargs):
+        items = []
+        for page in client.get_paginator(operation).paginate(**kwargs):
+            items.extend(page.get(result_key, []))
+        return items
+
+
+class Account(Cache):
+    def functions(self):
+        def fetch():
+            functions = self._paginate(aws.client('lambda'), 'list_functions', 'Functions')
+            return {function['FunctionName']: function for function in functions}
+        return self._cached('functions', fetch)
+
+    def distributions(self):
+        def fetch():
+            pages = aws.client('cloudfront').get_paginator('list_distributions').paginate()
+            distributions = []
+            for page in pages:
+                distributions.extend(page['DistributionList'].get('Items', []))
+            return distributions
+        return self._cached('distributions', fetch)
+
+    def certificates(self):
+        def fetch():
+            acm = aws.client('acm', region_name='us-east-1')
+            return self._paginate(acm, 'list_certificates', 'CertificateSummaryList',
+                                  CertificateStatuses=['PENDING_VALIDATION', 'ISSUED'])
+        return self._cached('certificates', fetch)
+
+    def certificate(self, arn):
+        # only asked about ISSUED certificates, which do not change
+        def fetch():
+            return aws.client('acm', region_name='us-east-1').describe_certificate(
+                CertificateArn= arn
+            )['Certificate']
+        return self._cached(('certificate', arn), fetch)
+
+    def hosted_zones_by_name(self, domain):
+        # one lookup per domain however many sites it serves
+        def fetch():
+            return aws.client('route53').list_hosted_zones_by_name(DNSName= domain)['HostedZones']
+        return self._cached(('hosted_zones', domain), fetch)
+
+
+class Inventory(Cache):
+    def __init__(self, var, account=None):
+        Cache.__init__(self)
+        self.var = var
+        self.account = account or Account()
+
+    def roles(self):
+        def fetch():
+            iam = aws.client('iam')
+            roles = self._paginate(iam, 'list_roles', 'Roles', PathPrefix='/'+self.var.proj_name+'/')
+            return {role['RoleName']: role for role in roles}
+        return self._cached('roles', fetch)
+
+    def policies(self):
+        def fetch():
+            iam = aws.client('iam')
+            policies = self._paginate(iam, 'list_policies', 'Policies',
+                                      Scope='Local', PathPrefix='/'+self.var.proj_name+'/')
+            return {policy['PolicyName']: policy for policy in policies}
+        return self._cached('policies', fetch)
+
+    def policy_tags(self, policy):
+        def fetch():
+            tags = self._paginate(aws.client('iam'), 'list_policy_tags', 'Tags', PolicyArn=policy['Arn'])
+            return dict((tag['Key'], tag['Value']) for tag in tags)
+        return self._cached(('policy_tags', policy['Arn']), fetch)
+
+    def attached_policies(self, role_name):
+        def fetch():
+            attached = self._paginate(aws.client('iam'), 'list_attached_role_policies',
+                                      'AttachedPolicies', RoleName=role_name)
+            return [policy['PolicyArn'] for policy in attached]
+        return self._cached(('attached', role_name), fetch)
+
+    def functions(self):
+        def fetch():
+            return {name: function for name, function in self.account.functions().items()
+                    if name.startswith(self.var.proj_name+'-')}
+        return self._cached('functions', fetch)
+
+    def event_source_mappings(self, function_name):
+        def fetch():
+            return self._paginate(aws.client('lambda'), 'list_event_source_mappings',
+                                  'EventSourceMappings', FunctionName=function_name)
+        return self._cached(('mappings', function_name), fetch)
+
+    def repository(self):
+        def fetch():
+            try:
+                return aws.client('codecommit').get_repository(
+                    repositoryName= self.var.proj_name
+                )['repositoryMetadata']
+            except Exception as err:
+                if error_code(err) != 'RepositoryDoesNotExistException':
+                    raise
+        return self._cached('repository', fetch)
+
+    def build_project(self):
+        def fetch():
+            projects = aws.client('codebuild').batch_get_projects(
+                names= [self.var.proj_name]
+            )['projects']
+            return projects[0] if projects else None
+        return self._cached('build_project', fetch)
+
+    def distributions(self):
+        return self.account.distributions()
+
+    def distribution_for(self, fqdn):
+        for distribution in self.distributions():
+            if fqdn in distribution['Aliases'].get('Items', []):
+                return distribution
+        return None
+
+    def certificates(self):
+        return self.account.certificates()
+
+    def hosted_zones(self):
+        return self.account.hosted_zones_by_name(self.var.dns_domain)
+
+
+account = Account()
+_inventories = {}
+_inventories_lock = threading.Lock()
+
+
+def for_site(var):
+    with _inventories_lock:
+        if var.proj_name not in _inventories:
+            _inventories[var.proj_name] = Inventory(var, account)
+        return _inventories[var.proj_name]
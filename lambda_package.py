@@ -0,0 +1,156 @@
+import os
+import sys
+import glob
+import base64
+import hashlib
+import zipfile
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+##########################################
+# Reproducible, cached lambda packages
+##########################################
+# A function's zip is built from its handler directory, the shared
+# runtime and, when the directory has a requirements.txt, the packages
+# it lists installed for the lambda platform. Entries are written in
+# sorted order with a fixed timestamp and permissions, so the same
+# sources always give the same bytes and the same CodeSha256 lambda
+# reports for the deployed code. Zips are kept in a cache directory
+# named by a hash of their inputs and only rebuilt when those change.
+
+CACHE_DIR = '.lambda-cache'
+# bump when the zip layout changes so cached zips are rebuilt
+FORMAT = '1'
+FIXED_DATE = (1980, 1, 1, 0, 0, 0)
+KEEP = 3
+
+
+class Package:
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        digest = hashlib.sha256()
+        with open(path, 'rb') as blob:
+            for chunk in iter(lambda: blob.read(1024 * 1024), b''):
+                digest.update(chunk)
+        self.sha256 = digest.hexdigest()
+        # what lambda reports as CodeSha256 for this zip
+        self.code_sha256 = base64.b64encode(digest.digest()).decode('ascii')
+        self.size = os.path.getsize(path)
+
+    def code(self):
+        with open(self.path, 'rb') as blob:
+            return blob.read()
+
+
+def source_files(name, shared=()):
+    # {archive name: path} of the handler's own files and the shared ones
+    files = {}
+    for path in list(shared) + glob.glob(os.path.join('lambdas', name, '*.py')):
+        files[os.path.basename(path)] = path
+    return files
+
+
+def requirements_file(name):
+    path = os.path.join('lambdas', name, 'requirements.txt')
+    return path if os.path.exists(path) else None
+
+
+def input_hash(name, files, requirements, runtime):
+    digest = hashlib.sha256()
+    digest.update(('%s\0%s\0%s\0' % (FORMAT, name, runtime)).encode('utf-8'))
+    for arcname in sorted(files):
+        digest.update(arcname.encode('utf-8')+b'\0')
+        with open(files[arcname], 'rb') as blob:
+            digest.update(hashlib.sha256(blob.read()).digest())
+    if requirements:
+        with open(requirements, 'rb') as blob:
+            digest.update(b'requirements\0'+blob.read())
+    return digest.hexdigest()
+
+
+def vendor(requirements, target, runtime):
+    # install wheels built for the lambda platform, whatever platform we run on
+    subprocess.run([
+        sys.executable, '-m', 'pip', 'install', '--quiet', '--no-compile',
+        '--target', target,
+        '--requirement', requirements,
+        '--platform', 'manylinux2014_x86_64',
+        '--implementation', 'cp',
+        '--python-version', runtime.replace('python', ''),
+        '--only-binary=:all:'
+    ], check=True)
+    files = {}
+    for root, dirs, names in os.walk(target):
+        dirs[:] = [d for d in dirs if d != '__pycache__']
+        for file_name in names:
+            if file_name.endswith('.pyc'):
+                continue
+            path = os.path.join(root, file_name)
+            files[os.path.relpath(path, target).replace(os.sep, '/')] = path
+    return files
+
+
+def write_zip(path, files):
+    tmp_path = path+'.tmp'
+    with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for arcname in sorted(files):
+            info = zipfile.ZipInfo(arcname, date_time=FIXED_DATE)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.create_system = 3
+            executable = os.stat(files[arcname]).st_mode & 0o111
+            info.external_attr = (0o755 if executable else 0o644) << 16
+            with open(files[arcname], 'rb') as blob:
+                archive.writestr(info, blob.read(), compresslevel=9)
+    os.replace(tmp_path, path)
+
+
+def prune(name, cache_dir, keep=KEEP):
+    # keep the most recently used zips of each function
+    zips = sorted(glob.glob(os.path.join(cache_dir, name+'-*.zip')), key=os.path.getmtime)
+    for path in zips[:-keep]:
+        os.remove(path)
+
+
+def build(name, shared=(), runtime='python3.11', cache_dir=CACHE_DIR):
+    files = source_files(name, shared)
+    requirements = requirements_file(name)
+    path = os.path.join(cache_dir, '%s-%s.zip' % (name, input_hash(name, files, requirements, runtime)[:32]))
+    if os.path.exists(path):
+        os.utime(path)
+        return Package(name, path)
+    os.makedirs(cache_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory() as target:
+        if requirements:
+            vendored = vendor(requirements, target, runtime)
+            vendored.update(files)
+            files = vendored
+        write_zip(path, files)
+    prune(name, cache_dir)
+    return Package(name, path)
+
+
+def build_all(names, shared=(), runtime='python3.11', cache_dir=CACHE_DIR, workers=None):
+    with ThreadPoolExecutor(max_workers=workers or len(names)) as pool:
+        futures = dict((name, pool.submit(build, name, shared, runtime, cache_dir)) for name in names)
+        return dict((name, future.result()) for name, future in futures.items())
+
+
+class Packager:
+    # Builds every function's package, in parallel, the first time any
+    # of them is asked for.
+    def __init__(self, names, shared=(), runtime='python3.11', cache_dir=CACHE_DIR):
+        self.names = list(names)
+        self.shared = list(shared)
+        self.runtime = runtime
+        self.cache_dir = cache_dir
+        self._lock = threading.Lock()
+        self._packages = None
+
+    def get(self, name):
+        with self._lock:
+            if self._packages is None:
+                self._packages = build_all(self.names, self.shared, self.runtime, self.cache_dir)
+            return self._packages[name]
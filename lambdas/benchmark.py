@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+import os
+import io
+import sys
+import json
+import time
+import types
+import argparse
+import importlib
+import statistics
+import subprocess
+import contextlib
+
+##########################################
+# Cold and warm latency of the lambda handlers
+##########################################
+# Every handler runs against stubbed AWS: real boto3 clients are built,
+# but a before-call hook on the shared runtime's session answers each
+# API call with a canned response, so nothing leaves the machine and
+# what is measured is our own code plus botocore. A cold start runs in
+# a fresh interpreter (importing the handler, which builds its clients,
+# then the first invocation); warm invocations reuse the loaded module.
+# The cost of building the clients inside every invocation, as the
+# handlers used to, is measured alongside for comparison.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+ENVIRONMENT = {
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'AWS_ACCESS_KEY_ID': 'benchmark',
+    'AWS_SECRET_ACCESS_KEY': 'benchmark',
+    'BUILD_PROJECT_NAME': 'benchmark',
+    'REPOSITORY_NAME': 'benchmark',
+    'CDN_DIST_ID': 'EBENCHMARK',
+    'BUILD_LOG': '/aws/codebuild/benchmark',
+    'TRIGGER_LOG': '/aws/lambda/benchmark-build-phase-trigger',
+    'CDN_INVALIDATION_LOG': '/aws/lambda/benchmark-cdn-cached-objects-invalidation'
+}
+
+HANDLERS = {
+    'build_trigger': {
+        'services': ['codebuild', 'codecommit'],
+        'event': {'Records': [{'codecommit': {'references': [
+            {'ref': 'refs/heads/master', 'commit': 'c0ffee'}
+        ]}}]},
+        'responses': {
+            'ListBuildsForProject': {'ids': []},
+            'StartBuild': {'build': {'id': 'benchmark:1'}}
+        }
+    },
+    'invalidate_cdn': {
+        'services': ['cloudfront'],
+        'event': {'Records': [{'s3': {'object': {'key': 'posts/%d/index.html' % i}}} for i in range(20)]},
+        'responses': {
+            'CreateInvalidation': {'Invalidation': {'Id': 'IBENCHMARK', 'Status': 'InProgress'}}
+        }
+    },
+    'log_cleanup': {
+        'services': ['logs'],
+        'event': {},
+        'responses': {
+            'DescribeLogGroups': {'logGroups': [
+                {'logGroupName': ENVIRONMENT[name], 'retentionInDays': 30, 'storedBytes': 1024}
+                for name in ('BUILD_LOG', 'TRIGGER_LOG', 'CDN_INVALIDATION_LOG')
+            ]},
+            'DescribeLogStreams': {'logStreams': [
+                {'logStreamName': 'old', 'lastEventTimestamp': 0, 'storedBytes': 512}
+            ]},
+            'DeleteLogStream': {}
+        }
+    }
+}
+
+
+# canned responses by operation name, for every handler loaded so far
+RESPONSES = {}
+_stubbed = []
+
+
+def stub(session):
+    # answer every call made through clients of `session` without sending it
+    from botocore.awsrequest import AWSResponse
+    def answer(model, **kwargs):
+        return AWSResponse(None, 200, {}, None), dict(RESPONSES.get(model.name, {}))
+    session.events.register('before-call', answer)
+    _stubbed.append(session)
+
+
+def context(n):
+    return types.SimpleNamespace(
+        aws_request_id='benchmark-%d' % n,
+        function_name='benchmark',
+        get_remaining_time_in_millis=lambda: 300000
+    )
+
+
+def load(name):
+    os.environ.update(ENVIRONMENT)
+    for path in (os.path.join(HERE, 'shared'), os.path.join(HERE, name)):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    import runtime
+    RESPONSES.update(HANDLERS[name]['responses'])
+    if runtime.session not in _stubbed:
+        stub(runtime.session)
+    return runtime, importlib.import_module(name)
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def cold_child(name):
+    # runs in a fresh interpreter, prints one json line
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        runtime, module = load(name)
+        loaded = time.perf_counter()
+        module.lambda_handler(HANDLERS[name]['event'], context(0))
+        finished = time.perf_counter()
+    print(json.dumps({
+        'init_ms': (loaded - started) * 1000,
+        'first_ms': (finished - loaded) * 1000,
+        'cold_start': runtime.invocations == 1
+    }))
+
+
+def cold(name, runs):
+    samples = []
+    for _ in range(runs):
+        child = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--cold-child', name],
+            check=True, stdout=subprocess.PIPE, universal_newlines=True
+        )
+        samples.append(json.loads(child.stdout.strip().splitlines()[-1]))
+    return {
+        'init_ms': statistics.median(sample['init_ms'] for sample in samples),
+        'first_ms': statistics.median(sample['first_ms'] for sample in samples)
+    }
+
+
+def warm(name, invocations):
+    runtime, module = load(name)
+    handler = HANDLERS[name]
+    samples = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        module.lambda_handler(handler['event'], context(0))
+        for n in range(invocations):
+            started = time.perf_counter()
+            module.lambda_handler(handler['event'], context(n + 1))
+            samples.append((time.perf_counter() - started) * 1000)
+    # what each invocation paid when it built its own clients
+    clients = []
+    for _ in range(max(1, invocations // 10)):
+        started = time.perf_counter()
+        for service in handler['services']:
+            runtime.session.client(service, config=runtime.CONFIG)
+        clients.append((time.perf_counter() - started) * 1000)
+    return {
+        'invocations': invocations,
+        'p50_ms': percentile(samples, 0.50),
+        'p95_ms': percentile(samples, 0.95),
+        'p99_ms': percentile(samples, 0.99),
+        'client_per_invocation_ms': statistics.median(clients),
+        'cold_start_after_warmup': runtime.cold_start
+    }
+
+
+def report(results):
+    lines = ['%-16s %9s %9s %9s %9s %9s %13s' % (
+        'handler', 'init', 'first', 'warm p50', 'warm p95', 'warm p99', 'client/call')]
+    for name, result in results.items():
+        lines.append('%-16s %7.1fms %7.1fms %7.3fms %7.3fms %7.3fms %11.2fms' % (
+            name, result['cold']['init_ms'], result['cold']['first_ms'],
+            result['warm']['p50_ms'], result['warm']['p95_ms'], result['warm']['p99_ms'],
+            result['warm']['client_per_invocation_ms']))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure cold and warm latency of the lambda handlers.')
+    parser.add_argument('handlers', nargs='*', metavar='HANDLER',
+                        help='handlers to measure (default: all of %s)' % ', '.join(sorted(HANDLERS)))
+    parser.add_argument('--cold-runs', type=int, default=5, help='fresh interpreters per handler')
+    parser.add_argument('--invocations', type=int, default=1000, help='warm invocations per handler')
+    parser.add_argument('--json', metavar='FILE', help='save the results to FILE')
+    parser.add_argument('--cold-child', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.cold_child:
+        cold_child(args.cold_child)
+        return 0
+    unknown = [name for name in args.handlers if name not in HANDLERS]
+    if unknown:
+        parser.error('unknown handler: '+', '.join(unknown))
+    results = {}
+    for name in args.handlers or sorted(HANDLERS):
+        results[name] = {
+            'cold': cold(name, args.cold_runs),
+            'warm': warm(name, args.invocations)
+        }
+    print(report(results))
+    if args.json:
+        with open(args.json, 'w') as results_file:
+            json.dump(results, results_file, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
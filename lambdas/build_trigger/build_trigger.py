@@ -1,7 +1,107 @@
-import boto3
 import os
+import runtime
 
+# What to do with a push that arrives while a build is running:
+#   cancel   - stop the running build and build the new commit now
+#   queue    - let the running build finish, then build the branch head
+#   coalesce - restart the running build on the new commit if it has not
+#              started rendering yet, otherwise queue
+MODE = os.environ.get('BUILD_CONCURRENCY', 'cancel')
+BRANCH = os.environ.get('BRANCH', 'master')
+EARLY_PHASES = ('SUBMITTED', 'QUEUED', 'PROVISIONING', 'DOWNLOAD_SOURCE')
+FINISHED = ('SUCCEEDED', 'FAILED', 'FAULT', 'TIMED_OUT', 'STOPPED')
+
+codebuild = runtime.client('codebuild')
+codecommit = runtime.client('codecommit')
+
+
+def pushed_commit(event):
+    # newest commit pushed to BRANCH, ignoring deletes, tags and other branches
+    commit = None
+    for record in event.get('Records', []):
+        for reference in record.get('codecommit', {}).get('references', []):
+            if reference.get('ref') != 'refs/heads/'+BRANCH:
+                continue
+            if reference.get('deleted'):
+                continue
+            commit = reference.get('commit')
+    return commit
+
+
+def push_time(event):
+    # when the newest record was pushed, for pipeline_metrics
+    times = [record['eventTime'] for record in event.get('Records', []) if record.get('eventTime')]
+    return times[-1] if times else None
+
+
+def running_builds(codebuild, project):
+    ids = codebuild.list_builds_for_project(
+        projectName= project,
+        sortOrder= 'DESCENDING'
+    ).get('ids', [])[:25]
+    if not ids:
+        return []
+    builds = codebuild.batch_get_builds(ids= ids)['builds']
+    return [build for build in builds if build['buildStatus'] == 'IN_PROGRESS']
+
+
+def build_commit(build):
+    return build.get('resolvedSourceVersion') or build.get('sourceVersion')
+
+
+def start(codebuild, project, commit, pushed_at=None):
+    params = {'projectName': project, 'sourceVersion': commit}
+    if pushed_at:
+        # the build carries its push time, so its latency can be measured
+        params['environmentVariablesOverride'] = [{'name': 'PUSHED_AT', 'value': pushed_at, 'type': 'PLAINTEXT'}]
+    build = codebuild.start_build(**params)['build']
+    return {'action': 'started', 'build': build['id'], 'commit': commit}
+
+
+def on_push(codebuild, project, commit, pushed_at=None):
+    running = running_builds(codebuild, project)
+    if any(build_commit(build) == commit for build in running):
+        return {'action': 'skipped', 'reason': 'already building', 'commit': commit}
+    if not running:
+        return start(codebuild, project, commit, pushed_at)
+    if MODE == 'queue':
+        return {'action': 'queued', 'commit': commit}
+    if MODE == 'coalesce' and any(build.get('currentPhase') not in EARLY_PHASES for build in running):
+        return {'action': 'queued', 'commit': commit}
+    for build in running:
+        codebuild.stop_build(id= build['id'])
+    result = start(codebuild, project, commit, pushed_at)
+    result['superseded'] = [build['id'] for build in running]
+    return result
+
+
+def on_build_finished(codebuild, project, detail):
+    # A build ended: if the branch moved on while it ran (queued pushes),
+    # build the head now. Only the newest commit is ever built.
+    if detail.get('project-name') != project or detail.get('build-status') not in FINISHED:
+        return {'action': 'skipped', 'reason': 'not a finished build of '+project}
+    if running_builds(codebuild, project):
+        return {'action': 'skipped', 'reason': 'another build is running'}
+    head = codecommit.get_branch(
+        repositoryName= os.environ.get('REPOSITORY_NAME', project),
+        branchName= BRANCH
+    )['branch']['commitId']
+    finished = codebuild.batch_get_builds(ids= [detail['build-id']])['builds']
+    if finished and build_commit(finished[0]) == head:
+        return {'action': 'skipped', 'reason': 'head already built', 'commit': head}
+    return start(codebuild, project, head)
+
+
+@runtime.handler
 def lambda_handler(event, context):
-    boto3.client('codebuild').start_build(
-    projectName= os.environ['BUILD_PROJECT_NAME']
-)
\ No newline at end of file
+    project = os.environ['BUILD_PROJECT_NAME']
+    if event.get('source') == 'aws.codebuild':
+        result = on_build_finished(codebuild, project, event.get('detail', {}))
+    else:
+        commit = pushed_commit(event)
+        if commit is None:
+            result = {'action': 'skipped', 'reason': 'no new commit on '+BRANCH}
+        else:
+            result = on_push(codebuild, project, commit, push_time(event))
+    print(result)
+    return result
@@ -1,21 +1,101 @@
-import boto3
 import os
-import time
-import datetime
+import json
+import runtime
+from collections import defaultdict
+from urllib.parse import quote, unquote_plus
 
+# CloudFront allows 3,000 file paths and 15 wildcard paths in progress,
+# past either of those we flush the whole distribution instead.
+MAX_PATHS = int(os.environ.get('MAX_INVALIDATION_PATHS', '3000'))
+MAX_WILDCARDS = int(os.environ.get('MAX_INVALIDATION_WILDCARDS', '15'))
+# Once a directory has more changed paths than this they are replaced by
+# a single '/dir/*' wildcard.
+WILDCARD_THRESHOLD = int(os.environ.get('WILDCARD_THRESHOLD', '10'))
+INDEX_DOCUMENT = os.environ.get('INDEX_DOCUMENT', 'index.html')
+# Releases are not served by their keys: the paths sync.py sends after
+# a switch are what gets invalidated.
+RELEASES_PREFIX = os.environ.get('RELEASES_PREFIX', 'releases/')
+
+cloudfront = runtime.client('cloudfront')
+
+
+def keys_from_event(event):
+    # Accepts S3 notifications directly or wrapped in the body of the SQS
+    # messages the invalidation queue delivers in batches, as well as
+    # {'keys': [...]} messages sent by deploy_tools/sync.py.
+    keys = list(event.get('keys', []))
+    for record in event.get('Records', []):
+        if 'body' in record:
+            keys.extend(keys_from_event(json.loads(record['body'])))
+        elif 's3' in record:
+            keys.append(unquote_plus(record['s3']['object']['key']))
+    return keys
+
+
+def unserved(key):
+    key = key.lstrip('/')
+    return key.startswith(RELEASES_PREFIX)
+
+
+def paths_for_key(key):
+    path = '/'+quote(key.lstrip('/'), safe="/-_.~!$&'()+,;=:@")
+    paths = [path]
+    if path.rsplit('/', 1)[-1] == INDEX_DOCUMENT:
+        paths.append(path[:-len(INDEX_DOCUMENT)])
+    return paths
+
+
+def parent(path):
+    # '/a/b/c.html' -> '/a/b/', '/a/b/' -> '/a/', '/a/*' -> '/'
+    return path[:path.rstrip('/*').rfind('/') + 1]
+
+
+def collapse(paths, threshold=WILDCARD_THRESHOLD):
+    # Group paths by directory, deepest first, and fold any directory with
+    # more than `threshold` entries into one wildcard. The wildcard then
+    # counts as a single entry of its parent, so busy trees keep folding up.
+    # The root is never folded: '/*' flushes the whole distribution and is
+    # left to invalidation_paths, for when CloudFront's limits are passed.
+    paths = set(paths)
+    while True:
+        by_dir = defaultdict(set)
+        for path in paths:
+            if path != '/*':
+                by_dir[parent(path)].add(path)
+        crowded = [d for d, entries in by_dir.items() if d != '/' and len(entries) > threshold]
+        if not crowded:
+            return sorted(paths)
+        directory = max(crowded, key=lambda d: d.count('/'))
+        paths = set(p for p in paths if not p.startswith(directory)) | {directory+'*'}
+
+
+def invalidation_paths(keys):
+    paths = set()
+    for key in keys:
+        if not unserved(key):
+            paths.update(paths_for_key(key))
+    if not paths:
+        return []
+    paths = collapse(paths)
+    wildcards = [path for path in paths if path.endswith('*')]
+    if len(paths) > MAX_PATHS or len(wildcards) > MAX_WILDCARDS:
+        return ['/*']
+    return paths
+
+
+@runtime.handler
 def lambda_handler(event, context):
-    time.sleep(60)
-    dt = datetime.datetime.now()
-    call_ref = dt.strftime('%d/%m/%Y %H:%M:%S')
-    boto3.client('cloudfront').create_invalidation(
+    paths = invalidation_paths(keys_from_event(event))
+    if not paths:
+        return {'paths': []}
+    cloudfront.create_invalidation(
     DistributionId=  os.environ['CDN_DIST_ID'],
     InvalidationBatch={
             'Paths': {
-                'Quantity': 1,
-                'Items': [
-                    '/*',
-                ]
+                'Quantity': len(paths),
+                'Items': paths
             },
-            'CallerReference': call_ref
+            'CallerReference': context.aws_request_id
         }
-)
\ No newline at end of file
+)
+    return {'paths': paths}
@@ -1,10 +1,125 @@
-import boto3
 import os
+import time
+import random
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+import runtime
 
+# Log groups keep RETENTION_DAYS of events: CloudWatch expires old events
+# itself once the retention policy is set. What retention leaves behind
+# are streams with no events left in them, which are deleted here, oldest
+# first, a few at a time.
+RETENTION_DAYS = int(os.environ.get('RETENTION_DAYS', '30'))
+PRUNE_STREAMS = os.environ.get('PRUNE_STREAMS', 'true') == 'true'
+CONCURRENCY = int(os.environ.get('DELETE_CONCURRENCY', '4'))
+# stop starting deletes this long before the function would time out
+TIME_MARGIN_MS = int(os.environ.get('TIME_MARGIN_MS', '10000'))
+THROTTLED = ('ThrottlingException', 'LimitExceededException', 'ServiceUnavailableException')
+DAY_MS = 24 * 60 * 60 * 1000
+
+logs = runtime.client('logs')
+
+
+def log_groups():
+    names = [os.environ['BUILD_LOG'], os.environ['TRIGGER_LOG'], os.environ['CDN_INVALIDATION_LOG']]
+    if os.environ.get('METRICS_LOG'):
+        names.append(os.environ['METRICS_LOG'])
+    if os.environ.get('AWS_LAMBDA_LOG_GROUP_NAME'):
+        names.append(os.environ['AWS_LAMBDA_LOG_GROUP_NAME'])
+    return names
+
+
+def with_retries(call, attempts=8, base=0.2, cap=5.0):
+    # on top of botocore's own retries: deletes are rate limited per account
+    for attempt in range(attempts):
+        try:
+            return call()
+        except ClientError as err:
+            if err.response['Error']['Code'] not in THROTTLED or attempt == attempts - 1:
+                raise
+            delay = min(cap, base * 2 ** attempt)
+            time.sleep(delay / 2 + random.uniform(0, delay / 2))
+
+
+def describe_group(name):
+    for page in logs.get_paginator('describe_log_groups').paginate(logGroupNamePrefix= name):
+        for group in page['logGroups']:
+            if group['logGroupName'] == name:
+                return group
+    return None
+
+
+def expired_streams(name, cutoff):
+    # Streams come oldest last event first, so paging stops at the first
+    # stream still inside the retention period.
+    pages = logs.get_paginator('describe_log_streams').paginate(
+        logGroupName= name,
+        orderBy= 'LastEventTime',
+        descending= False
+    )
+    for page in pages:
+        for stream in page['logStreams']:
+            last_event = stream.get('lastEventTimestamp', stream.get('creationTime', 0))
+            if last_event >= cutoff:
+                return
+            yield stream
+
+
+def prune(name, cutoff, context):
+    result = {'streams_deleted': 0, 'bytes_reclaimed': 0, 'complete': True}
+    def delete(stream):
+        try:
+            with_retries(lambda: logs.delete_log_stream(
+                logGroupName= name,
+                logStreamName= stream['logStreamName']
+            ))
+        except ClientError as err:
+            if err.response['Error']['Code'] != 'ResourceNotFoundException':
+                raise
+            return 0
+        # storedBytes is only reported for some streams, 0 otherwise
+        return stream.get('storedBytes', 0)
+    with ThreadPoolExecutor(max_workers= CONCURRENCY) as pool:
+        batch = []
+        for stream in expired_streams(name, cutoff):
+            if context.get_remaining_time_in_millis() < TIME_MARGIN_MS:
+                # the next scheduled run carries on from here
+                result['complete'] = False
+                break
+            batch.append(stream)
+            if len(batch) == CONCURRENCY * 10:
+                deleted = list(pool.map(delete, batch))
+                result['streams_deleted'] += len(deleted)
+                result['bytes_reclaimed'] += sum(deleted)
+                batch = []
+        deleted = list(pool.map(delete, batch))
+        result['streams_deleted'] += len(deleted)
+        result['bytes_reclaimed'] += sum(deleted)
+    return result
+
+
+def clean(name, context, now_ms):
+    group = describe_group(name)
+    if group is None:
+        return {'log_group': name, 'skipped': 'does not exist'}
+    result = {'log_group': name, 'stored_bytes': group.get('storedBytes', 0)}
+    if group.get('retentionInDays') != RETENTION_DAYS:
+        logs.put_retention_policy(logGroupName= name, retentionInDays= RETENTION_DAYS)
+        result['retention_set'] = RETENTION_DAYS
+    if PRUNE_STREAMS:
+        result.update(prune(name, now_ms - RETENTION_DAYS * DAY_MS, context))
+    return result
+
+
+@runtime.handler
 def lambda_handler(event, context):
-    logs = boto3.client('logs')
-    log_groups = [os.environ['BUILD_LOG'], os.environ['TRIGGER_LOG'], os.environ['CDN_INVALIDATION_LOG']]
-    for log_group in log_groups:
-            logs.delete_log_group(
-                logGroupName= log_group
-    )
\ No newline at end of file
+    now_ms = int(time.time() * 1000)
+    results = [clean(name, context, now_ms) for name in log_groups()]
+    report = {
+        'log_groups': results,
+        'streams_deleted': sum(result.get('streams_deleted', 0) for result in results),
+        'bytes_reclaimed': sum(result.get('bytes_reclaimed', 0) for result in results),
+        'complete': all(result.get('complete', True) for result in results)
+    }
+    print(report)
+    return report
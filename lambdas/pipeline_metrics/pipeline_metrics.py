@@ -0,0 +1,167 @@
+import os
+import json
+import time
+import datetime
+import runtime
+
+# How long a push takes to go live, stage by stage. Invoked with the
+# build trigger by the build-finished events: for a successful build it
+# reads the build's phases, waits for the cdn invalidation of what the
+# build synced to complete, and logs one record per build in CloudWatch
+# embedded metric format. CloudWatch turns every record into metric
+# values, so each stage's p50, p90 or p99 over any period is a statistic
+# of its metric, graphed next to the others.
+#
+# Stages, in milliseconds:
+#   Trigger       push -> build submitted (repository trigger, build_trigger)
+#   Queue         build submitted -> build host ready
+#   Source        commit fetched, dependencies installed
+#   Build         site rendered and synced to S3
+#   Invalidation  sync finished -> invalidation created (the invalidation window)
+#   Propagation   invalidation created -> completed everywhere
+#   PushToLive    push -> invalidation completed
+#   BuildToLive   build submitted -> invalidation completed, only for
+#                 builds started for queued pushes, which have no push
+#                 time (and no Trigger or PushToLive)
+NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'StaticSitePipeline')
+# the invalidation window plus a typical invalidation, then give up
+MAX_WAIT = int(os.environ.get('MAX_WAIT_SECONDS', '600'))
+# A build that changed nothing causes no invalidation: once the window
+# and this much more have passed since the sync without one, stop.
+INVALIDATION_WINDOW = int(os.environ.get('INVALIDATION_WINDOW', '60'))
+GRACE_SECONDS = int(os.environ.get('GRACE_SECONDS', '30'))
+POLL_SECONDS = float(os.environ.get('POLL_SECONDS', '10'))
+# stop waiting this long before the function would time out
+TIME_MARGIN_MS = int(os.environ.get('TIME_MARGIN_MS', '10000'))
+QUEUE_PHASES = ('SUBMITTED', 'QUEUED', 'PROVISIONING')
+SOURCE_PHASES = ('DOWNLOAD_SOURCE', 'INSTALL', 'PRE_BUILD')
+STAGES = ('Trigger', 'Queue', 'Source', 'Build', 'Invalidation', 'Propagation')
+
+codebuild = runtime.client('codebuild')
+cloudfront = runtime.client('cloudfront')
+
+
+def parse_time(value):
+    # CodeCommit sends '2016-01-01T23:59:59.000+0000'
+    for layout in ('%Y-%m-%dT%H:%M:%S.%f%z', '%Y-%m-%dT%H:%M:%S%z'):
+        try:
+            return datetime.datetime.strptime(value, layout)
+        except ValueError:
+            pass
+    return None
+
+
+def ms(start, end):
+    # clock skew between services must not make a stage negative
+    return max(0, int((end - start).total_seconds() * 1000))
+
+
+def pushed_at(build):
+    # set by build_trigger on the builds it starts for a push
+    for variable in build.get('environment', {}).get('environmentVariables', []):
+        if variable['name'] == 'PUSHED_AT':
+            return parse_time(variable['value'])
+    return None
+
+
+def phase_span(build, phases):
+    # (start, end) of a run of consecutive phases, None if none ran
+    spans = [(phase['startTime'], phase.get('endTime', phase['startTime']))
+             for phase in build.get('phases', []) if phase['phaseType'] in phases]
+    if not spans:
+        return None
+    return min(start for start, _ in spans), max(end for _, end in spans)
+
+
+def build_stages(build):
+    stages = {}
+    pushed = pushed_at(build)
+    if pushed:
+        stages['Trigger'] = ms(pushed, build['startTime'])
+    for name, phases in (('Queue', QUEUE_PHASES), ('Source', SOURCE_PHASES), ('Build', ('BUILD',))):
+        span = phase_span(build, phases)
+        if span:
+            stages[name] = ms(*span)
+    return stages
+
+
+def invalidations_since(dist_id, since):
+    # newest first, so paging stops at the first one older than since
+    found = []
+    for page in cloudfront.get_paginator('list_invalidations').paginate(DistributionId= dist_id):
+        for invalidation in page['InvalidationList'].get('Items', []):
+            if invalidation['CreateTime'] < since:
+                return found
+            found.append(invalidation)
+    return found
+
+
+def wait_for_invalidations(dist_id, since, synced, context):
+    # (newest invalidation created since the sync started, when all of
+    # them were seen completed), or None when nothing completed in time
+    started = time.monotonic()
+    give_up = synced + datetime.timedelta(seconds= INVALIDATION_WINDOW + GRACE_SECONDS)
+    while True:
+        invalidations = invalidations_since(dist_id, since)
+        if invalidations and all(invalidation['Status'] == 'Completed' for invalidation in invalidations):
+            return max(invalidation['CreateTime'] for invalidation in invalidations), \
+                datetime.datetime.now(datetime.timezone.utc)
+        if not invalidations and datetime.datetime.now(datetime.timezone.utc) >= give_up:
+            return None
+        out_of_time = context.get_remaining_time_in_millis() < TIME_MARGIN_MS + POLL_SECONDS * 1000
+        if time.monotonic() - started > MAX_WAIT or out_of_time:
+            return None
+        time.sleep(POLL_SECONDS)
+
+
+def emf_record(project, build, stages):
+    # one embedded metric format record: the values, the metric
+    # definitions CloudWatch extracts them by, and properties to search on
+    metrics = [name for name in STAGES + ('PushToLive', 'BuildToLive') if name in stages]
+    record = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': NAMESPACE,
+                'Dimensions': [['Project']],
+                'Metrics': [{'Name': name, 'Unit': 'Milliseconds'} for name in metrics]
+            }]
+        },
+        'Project': project,
+        'build_id': build['id'],
+        'commit': build.get('resolvedSourceVersion') or build.get('sourceVersion'),
+        'slowest_stage': max((name for name in STAGES if name in stages), key=lambda name: stages[name], default=None)
+    }
+    record.update((name, stages[name]) for name in metrics)
+    return record
+
+
+@runtime.handler
+def lambda_handler(event, context):
+    project = os.environ['BUILD_PROJECT_NAME']
+    detail = event.get('detail', {})
+    if detail.get('project-name') != project or detail.get('build-status') != 'SUCCEEDED':
+        return {'action': 'skipped', 'reason': 'not a successful build of '+project}
+    builds = codebuild.batch_get_builds(ids= [detail['build-id']])['builds']
+    if not builds:
+        return {'action': 'skipped', 'reason': 'build not found'}
+    build = builds[0]
+    stages = build_stages(build)
+    sync = phase_span(build, ('BUILD',))
+    live = wait_for_invalidations(os.environ['CDN_DIST_ID'], sync[0] if sync else build['startTime'],
+                                  sync[1] if sync else build.get('endTime', build['startTime']), context)
+    if live:
+        created, completed = live
+        if sync:
+            stages['Invalidation'] = ms(sync[1], created)
+        stages['Propagation'] = ms(created, completed)
+        pushed = pushed_at(build)
+        if pushed:
+            stages['PushToLive'] = ms(pushed, completed)
+        else:
+            stages['BuildToLive'] = ms(build['startTime'], completed)
+    record = emf_record(project, build, stages)
+    # lambda sends stdout to the function's log group, where CloudWatch
+    # picks up the metrics
+    print(json.dumps(record))
+    return record
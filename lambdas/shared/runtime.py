@@ -0,0 +1,49 @@
+import os
+import functools
+import boto3
+from botocore.config import Config
+
+##########################################
+# Shared runtime for the lambda handlers
+##########################################
+# Bundled into every function zip next to the handler. Handlers ask for
+# their clients at module level, so each client (and its endpoint
+# resolution and connection pool) is built once during the init phase
+# of a cold start and reused by every invocation the execution
+# environment serves afterwards.
+
+CONFIG = Config(
+    connect_timeout= float(os.environ.get('AWS_CONNECT_TIMEOUT', '3')),
+    read_timeout= float(os.environ.get('AWS_READ_TIMEOUT', '10')),
+    max_pool_connections= int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', '10')),
+    retries= {
+        'mode': os.environ.get('AWS_RETRY_MODE', 'standard'),
+        'max_attempts': int(os.environ.get('AWS_MAX_ATTEMPTS', '5'))
+    },
+    tcp_keepalive= True
+)
+
+session = boto3.session.Session()
+_clients = {}
+
+# True while the first invocation of this execution environment runs
+cold_start = True
+invocations = 0
+
+
+def client(service, region_name=None):
+    key = (service, region_name)
+    if key not in _clients:
+        _clients[key] = session.client(service, region_name=region_name, config=CONFIG)
+    return _clients[key]
+
+
+def handler(func):
+    # Wraps a lambda_handler to keep cold_start and invocations current.
+    @functools.wraps(func)
+    def wrapper(event, context):
+        global cold_start, invocations
+        cold_start = invocations == 0
+        invocations += 1
+        return func(event, context)
+    return wrapper
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+import sys
+import json
+import time
+import types
+import argparse
+import threading
+import boto3
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import aws
+import dns
+import readiness
+import settings
+import setup
+from provision import StepFailed
+from ratelimit import RateLimiter, LIMITS
+from state import State, state_path
+
+##########################################
+# Provision many sites from one manifest
+##########################################
+# A manifest lists sites, each with the same settings as settings.py.
+# Anything a site leaves out comes from the manifest's defaults, then
+# from settings.py:
+#
+#   {
+#       "defaults": {"region": "eu-west-1", "generator": "hugo"},
+#       "sites": [
+#           {"proj_name": "blog", "proj_desc": "My blog",
+#            "dns_domain": "example.com", "website_fqdn": "www.example.com"},
+#           ...
+#       ]
+#   }
+#
+# Sites run side by side on a bounded pool, each through the same plan
+# and apply as setup.py with its own state file. They share one boto3
+# session and its clients, one account-wide inventory (so each hosted
+# zone is looked up once per domain, and functions, distributions and
+# certificates are listed once), the lambda packages, and per-service
+# rate limits. IAM roles stay per site: every policy is scoped to the
+# site's own bucket, repository and queue.
+#
+# The shared session is made in the sites' region, so all the sites of a
+# manifest are in the same one.
+
+REQUIRED = ('region', 'proj_name', 'proj_desc', 'dns_domain', 'website_fqdn')
+
+
+def defaults_from(module):
+    return dict((name, value) for name, value in vars(module).items()
+                if not name.startswith('_') and not isinstance(value, types.ModuleType))
+
+
+def load_manifest(path, base=None):
+    with open(path) as manifest_file:
+        manifest = json.load(manifest_file)
+    defaults = dict(defaults_from(settings) if base is None else base)
+    defaults.update(manifest.get('defaults', {}))
+    sites = []
+    names = set()
+    for entry in manifest.get('sites', []):
+        var = types.SimpleNamespace(**dict(defaults, **entry))
+        missing = [name for name in REQUIRED if not getattr(var, name, '')]
+        if missing:
+            raise ValueError('site %s is missing %s' % (entry.get('proj_name', '?'), ', '.join(missing)))
+        if var.proj_name in names:
+            raise ValueError('duplicate site: '+var.proj_name)
+        names.add(var.proj_name)
+        sites.append(var)
+    regions = sorted(set(var.region for var in sites))
+    if len(regions) > 1:
+        # every site shares one session, so one region
+        raise ValueError('sites in %s: a manifest provisions one region, split it per region'
+                         % ', '.join(regions))
+    return sites
+
+
+def use_region(region):
+    # the sites' region for every client, whatever the environment says
+    if region != aws.session().region_name:
+        aws.set_session(boto3.session.Session(region_name= region))
+
+
+class SiteRun:
+    def __init__(self, var):
+        self.var = var
+        self.name = var.proj_name
+        self.status = 'waiting'
+        self.changes = []
+        self.steps_done = 0
+        self.started = None
+        self.finished = None
+        self.timings = None
+        self.error = None
+
+    def wall_time(self):
+        if self.started is None:
+            return 0
+        return (self.finished or time.monotonic()) - self.started
+
+    def as_dict(self):
+        return {
+            'site': self.name,
+            'status': self.status,
+            'changes': self.changes,
+            'wall_time': self.wall_time(),
+            'timings': self.timings.as_dict() if self.timings else None,
+            'error': repr(self.error) if self.error else None
+        }
+
+
+def provision(run, command, workers, log):
+    var = run.var
+    run.started = time.monotonic()
+    state = State(state_path(var))
+    try:
+        run.status = 'planning'
+        plan = setup.graph.plan(var, state.steps, workers=workers)
+        run.changes = plan.changes()
+        if command == 'plan':
+            run.status = 'planned'
+            return
+        if not run.changes:
+            for name in setup.graph.steps:
+                state.record(name, plan.outputs[name])
+            run.status = 'up to date'
+            return
+        run.status = 'applying'
+        def on_result(step, outputs):
+            state.record(step.name, outputs)
+            run.steps_done += 1
+        out, run.timings = setup.graph.apply(var, plan, workers=workers, log=log, on_result=on_result)
+        run.status = 'applied'
+    except StepFailed as err:
+        run.status = 'failed'
+        run.error = err
+        for name, failure in err.failures:
+            log(name+': '+repr(failure))
+    except Exception as err:
+        run.status = 'failed'
+        run.error = err
+        log('failed: '+repr(err))
+    finally:
+        run.finished = time.monotonic()
+
+
+def progress(runs):
+    counts = OrderedDict()
+    for run in runs:
+        counts[run.status] = counts.get(run.status, 0) + 1
+    active = ['%s %d/%d' % (run.name, run.steps_done, len(run.changes))
+              for run in runs if run.status == 'applying']
+    line = ', '.join('%d %s' % (count, status) for status, count in counts.items())
+    if active:
+        line += ' | '+', '.join(active)
+    return line
+
+
+def report(runs, wall_time, limiter):
+    lines = ['%-24s %-11s %7s %9s  %s' % ('site', 'status', 'changes', 'time', 'critical path')]
+    for run in runs:
+        path = ' -> '.join(run.timings.critical_path()) if run.timings else ''
+        lines.append('%-24s %-11s %7d %8.1fs  %s' % (
+            run.name, run.status, len(run.changes), run.wall_time(), path))
+    serial = sum(run.wall_time() for run in runs)
+    failed = [run.name for run in runs if run.status == 'failed']
+    lines.append('')
+    lines.append('%d sites in %.1fs, %.1fs if run one after another%s' % (
+        len(runs), wall_time, serial, ', failed: '+', '.join(failed) if failed else ''))
+    waits = readiness.metrics.as_dict()
+    if waits:
+        lines.append('%d readiness waits, %.1fs in total, %d timed out' % (
+            len(waits), sum(wait['elapsed'] for wait in waits),
+            len([wait for wait in waits if not wait['ready']])))
+    changes = dns.batcher.as_dict()
+    if changes['submissions']:
+        lines.append('%d dns changes sent in %d route53 calls' % (changes['submissions'], changes['calls']))
+    lines.append('')
+    lines.append(limiter.report())
+    return '\n'.join(lines)
+
+
+def run_sites(sites, command='apply', site_workers=4, workers=4, limiter=None,
+              progress_interval=30, log=print):
+    # Provision every site, at most site_workers at a time, each running
+    # up to `workers` of its own steps at once. Returns the SiteRuns and
+    # the overall wall time.
+    if limiter is not None:
+        limiter.install(aws.session())
+    runs = [SiteRun(var) for var in sites]
+    started = time.monotonic()
+    stop = threading.Event()
+    def report_progress():
+        while not stop.wait(progress_interval):
+            log('progress: '+progress(runs))
+    reporter = threading.Thread(target=report_progress, daemon=True)
+    if progress_interval:
+        reporter.start()
+    try:
+        with ThreadPoolExecutor(max_workers=site_workers) as pool:
+            for run in runs:
+                prefix = '['+run.name+'] '
+                pool.submit(provision, run, command, workers, lambda msg, prefix=prefix: log(prefix+msg))
+    finally:
+        stop.set()
+    return runs, time.monotonic() - started
+
+
+def parse_limits(values):
+    limits = dict(LIMITS)
+    for value in values:
+        service, _, rate = value.partition('=')
+        limits[service] = float(rate)
+    return limits
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Provision many static website pipelines at once.')
+    parser.add_argument('manifest', help='json file listing the sites')
+    parser.add_argument('command', nargs='?', default='apply', choices=['plan', 'apply'],
+                        help='plan lists what is missing or has drifted, apply creates or updates it')
+    parser.add_argument('--sites', type=int, default=4, help='number of sites provisioned at the same time')
+    parser.add_argument('--workers', type=int, default=4, help='steps run at the same time within each site')
+    parser.add_argument('--wait', action='store_true',
+                        help='wait for every cdn to finish deploying before exiting')
+    parser.add_argument('--only', action='append', metavar='PROJ_NAME',
+                        help='only provision this site (repeatable)')
+    parser.add_argument('--rate', action='append', default=[], metavar='SERVICE=N',
+                        help='requests per second allowed for a service, eg: iam=5')
+    parser.add_argument('--progress', type=float, default=30, metavar='SECONDS',
+                        help='print progress this often, 0 to turn off')
+    parser.add_argument('--report', metavar='FILE', help='write the aggregate report to FILE as json')
+    args = parser.parse_args(argv)
+    try:
+        sites = load_manifest(args.manifest)
+    except ValueError as err:
+        parser.error(str(err))
+    if args.only:
+        sites = [var for var in sites if var.proj_name in args.only]
+    for var in sites:
+        var.wait_for_cdn = var.wait_for_cdn or args.wait
+    if sites:
+        use_region(sites[0].region)
+    limiter = RateLimiter(parse_limits(args.rate))
+    print('Provisioning %d sites, %d at a time...' % (len(sites), args.sites))
+    runs, wall_time = run_sites(sites, args.command, args.sites, args.workers, limiter, args.progress)
+    print()
+    print(report(runs, wall_time, limiter))
+    if args.report:
+        with open(args.report, 'w') as report_file:
+            json.dump({
+                'wall_time': wall_time,
+                'sites': [run.as_dict() for run in runs],
+                'rate_limits': limiter.as_dict(),
+                'waits': readiness.metrics.as_dict()
+            }, report_file, indent=2)
+    return 1 if any(run.status == 'failed' for run in runs) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+import sys
+import json
+import hashlib
+import buildspec
+import settings
+
+##########################################
+# IAM roles and policies, as templates
+##########################################
+# Every role setup.py creates is described here once: its name and
+# path, the service that assumes it and the statements of the managed
+# policy attached to it. A template is rendered from the site settings
+# and the ARNs of what it grants access to. Those ARNs all follow from
+# names (see setup.policy_arns), so every role and policy of a site is
+# known before anything else exists and IAM is provisioned in one batch
+# at the start of a run.
+#
+# A policy carries a hash of its document in its PolicyHash tag. A rerun
+# compares hashes rather than fetching documents: an unchanged policy is
+# reused as it is, a changed one gets a new default version.
+#
+# python3 policies.py prints the documents rendered from settings.py.
+
+HASH_TAG = 'PolicyHash'
+# the ARNs a template is rendered with
+RESOURCES = ('repo', 'bucket', 'build_cache', 'build_project', 'queue', 'distributions', 'redirects_function')
+
+LOGGING = {
+    "Effect": "Allow",
+    "Action": [
+        "logs:CreateLogGroup",
+        "logs:CreateLogStream",
+        "logs:PutLogEvents"
+    ],
+    "Resource": '*'
+}
+
+
+def build_statements(var, arns):
+    statements = [
+        {
+            "Effect": "Allow",
+            "Action": "codecommit:GitPull",
+            "Resource": arns['repo']
+        },
+        {
+            "Effect": "Allow",
+            "Action": [
+                "s3:PutObject",
+                "s3:GetObject",
+                "s3:ListBucket",
+                "s3:GetObjectVersion",
+                "s3:DeleteObject"
+            ],
+            "Resource": arns['bucket']+"*"
+        },
+        {
+            "Effect": "Allow",
+            "Action": "sqs:SendMessage",
+            "Resource": arns['queue']
+        },
+        LOGGING
+    ]
+    if buildspec.deploy_mode(var) == 'release' or var.redirects_file:
+        # to find the cdn; listing can't be narrowed to one distribution,
+        # what a build may do to it is granted by build_cdn_statements
+        statements.append({
+            "Effect": "Allow",
+            "Action": "cloudfront:ListDistributions",
+            "Resource": '*'
+        })
+    if var.redirects_file:
+        # to publish the redirects file to the function the cdn runs
+        statements.append({
+            "Effect": "Allow",
+            "Action": [
+                "cloudfront:GetFunction",
+                "cloudfront:DescribeFunction",
+                "cloudfront:UpdateFunction",
+                "cloudfront:PublishFunction"
+            ],
+            "Resource": arns['redirects_function']
+        })
+    if var.build_cache == 's3':
+        statements.append({
+            "Effect": "Allow",
+            "Action": [
+                "s3:PutObject",
+                "s3:GetObject",
+                "s3:GetBucketAcl",
+                "s3:GetBucketLocation"
+            ],
+            "Resource": [
+                arns['build_cache'],
+                arns['build_cache']+'/*'
+            ]
+        })
+    return statements
+
+
+def build_cdn_statements(var, distribution_arn, store_arn=None):
+    # The build's access to the site's own distribution and redirects
+    # store. Their ARNs are only known once they exist, so this is not a
+    # template but a policy of the build role's own, put in place after
+    # the cdn step.
+    if buildspec.deploy_mode(var) == 'release':
+        # to switch the origin path to a new release
+        actions = [
+            "cloudfront:GetDistribution",
+            "cloudfront:GetDistributionConfig",
+            "cloudfront:UpdateDistribution"
+        ]
+    elif var.redirects_file:
+        # to find the redirects function the cdn runs
+        actions = ["cloudfront:GetDistributionConfig"]
+    else:
+        return []
+    statements = [
+        {
+            "Effect": "Allow",
+            "Action": actions,
+            "Resource": distribution_arn
+        }
+    ]
+    if var.redirects_file and store_arn:
+        # to bring the rules in the store in line with the redirects file
+        statements.append({
+            "Effect": "Allow",
+            "Action": [
+                "cloudfront-keyvaluestore:DescribeKeyValueStore",
+                "cloudfront-keyvaluestore:ListKeys",
+                "cloudfront-keyvaluestore:UpdateKeys"
+            ],
+            "Resource": store_arn
+        })
+    return statements
+
+
+def build_cdn_document(var, distribution_arn, store_arn=None):
+    # None when the build needs no access to the distribution
+    statements = build_cdn_statements(var, distribution_arn, store_arn)
+    return {"Version": "2012-10-17", "Statement": statements} if statements else None
+
+
+def build_cdn_policy_name(var):
+    return var.proj_name+'-codebuild-cdn-policy'
+
+
+def trigger_statements(var, arns):
+    return [
+        {
+            "Effect": "Allow",
+            "Action": [
+                "codecommit:GitPull",
+                "codecommit:GetBranch"
+            ],
+            "Resource": arns['repo']
+        },
+        {
+            "Effect": "Allow",
+            "Action": [
+                "codebuild:StartBuild",
+                "codebuild:StopBuild",
+                "codebuild:BatchGetBuilds",
+                "codebuild:ListBuildsForProject"
+            ],
+            "Resource": arns['build_project']
+        },
+        LOGGING
+    ]
+
+
+def invalidate_cdn_statements(var, arns):
+    return [
+        {
+            "Effect": "Allow",
+            "Action": "cloudfront:CreateInvalidation",
+            "Resource": '*'
+        },
+        {
+            "Effect": "Allow",
+            "Action": [
+                "sqs:ReceiveMessage",
+                "sqs:DeleteMessage",
+                "sqs:GetQueueAttributes"
+            ],
+            "Resource": arns['queue']
+        },
+        LOGGING
+    ]
+
+
+def log_clean_statements(var, arns):
+    functions = ('-build-phase-trigger', '-cdn-cached-objects-invalidation', '-log-cleanup',
+                 '-pipeline-metrics')
+    return [
+        LOGGING,
+        {
+            "Effect": "Allow",
+            "Action": [
+                "logs:PutRetentionPolicy",
+                "logs:DescribeLogStreams",
+                "logs:DeleteLogStream"
+            ],
+            "Resource": ['arn:aws:logs:*:*:*/aws/lambda/'+var.proj_name+suffix+'*' for suffix in functions]
+                        + ['arn:aws:logs:*:*:*/aws/codebuild/'+var.proj_name+'*']
+        },
+        {
+            "Effect": "Allow",
+            "Action": "logs:DescribeLogGroups",
+            "Resource": '*'
+        }
+    ]
+
+
+def metrics_statements(var, arns):
+    # the distribution's id is only known once it exists, the account's
+    # distributions stand for it
+    return [
+        LOGGING,
+        {
+            "Effect": "Allow",
+            "Action": "codebuild:BatchGetBuilds",
+            "Resource": arns['build_project']
+        },
+        {
+            "Effect": "Allow",
+            "Action": [
+                "cloudfront:ListInvalidations",
+                "cloudfront:GetInvalidation"
+            ],
+            "Resource": arns['distributions']
+        }
+    ]
+
+
+class Template:
+    def __init__(self, key, name, path, service, description, statements, policy_path=None):
+        # the role's ARN is published as <key>_role_arn
+        self.key = key
+        self.name = name
+        self.path = path
+        self.policy_path = policy_path or path
+        self.service = service
+        self.description = description
+        self.statements = statements
+
+    def role_name(self, var):
+        return var.proj_name+'-'+self.name+'-role'
+
+    def policy_name(self, var):
+        return var.proj_name+'-'+self.name+'-policy'
+
+    def role_path(self, var):
+        return '/'+var.proj_name+'/'+self.path+'/'
+
+    def policy_arn_path(self, var):
+        return '/'+var.proj_name+'/'+self.policy_path+'/'
+
+    def role_description(self, var):
+        return self.description+'. Part of '+var.proj_desc
+
+    def policy_description(self, var):
+        return 'Policy attached to '+self.service.split('.')[0]+'. Part of '+var.proj_desc
+
+    def document(self, var, arns):
+        return {
+            "Version": "2012-10-17",
+            "Statement": self.statements(var, arns)
+        }
+
+
+TEMPLATES = [
+    Template('build', 'codebuild', 'codebuild', 'codebuild.amazonaws.com',
+             'Codebuild service execution role', build_statements),
+    Template('trigger', 'lambda-build-trigger', 'lambda/trigger', 'lambda.amazonaws.com',
+             'Lambda role to trigger build', trigger_statements),
+    Template('invalidate_cdn', 'lambda-invalidate-cdn', 'lambda/invalidatecdn', 'lambda.amazonaws.com',
+             'Lambda role to purge cdn cache', invalidate_cdn_statements, policy_path='lambda/clearcache'),
+    Template('log_clean', 'lambda-log-clean', 'lambda/logclean', 'lambda.amazonaws.com',
+             'Lambda role to cleardown logs', log_clean_statements),
+    Template('metrics', 'lambda-pipeline-metrics', 'lambda/metrics', 'lambda.amazonaws.com',
+             'Lambda role to time deploys', metrics_statements)
+]
+
+
+def template_for(key):
+    return next(template for template in TEMPLATES if template.key == key)
+
+
+def assume_role_policy(service):
+    return {
+      "Version": "2012-10-17",
+      "Statement": [
+        {
+          "Effect": "Allow",
+          "Principal": {
+            "Service": service
+          },
+          "Action": "sts:AssumeRole"
+        }
+      ]
+    }
+
+
+def document_hash(document):
+    # the same for any key order or spacing
+    canonical = json.dumps(document, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def tags(var, document):
+    return [
+        {'Key': 'Name', 'Value': var.proj_name},
+        {'Key': HASH_TAG, 'Value': document_hash(document)}
+    ]
+
+
+def main(argv=None):
+    # every document settings.py would create, with placeholder ARNs
+    arns = dict((name, '<'+name+'>') for name in RESOURCES)
+    for template in TEMPLATES:
+        document = template.document(settings, arns)
+        print('# '+template.policy_arn_path(settings)+template.policy_name(settings)
+              + ' ('+HASH_TAG+' '+document_hash(document)[:12]+'...)')
+        print(json.dumps(document, indent=2))
+    document = build_cdn_document(settings, '<distribution>')
+    if document:
+        print('# '+template_for('build').role_name(settings)+' inline '+build_cdn_policy_name(settings))
+        print(json.dumps(document, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,286 @@
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+##########################################
+# Dependency graph of provisioning steps
+##########################################
+# A step is a function taking (var, out) where var is the site settings
+# and out the outputs published so far by the steps it needs. It returns
+# a dict of new outputs. Steps run on a thread pool as soon as all of
+# their dependencies have finished.
+#
+# A step may also have a probe, taking the same arguments plus the
+# outputs recorded for it in the state file. It looks the resource up in
+# AWS and returns its outputs when it already exists, Drift(...) when it
+# exists but differs from what the step would create, or None.
+
+OK = 'ok'
+MISSING = 'missing'
+DRIFT = 'drift'
+
+
+class Step:
+    def __init__(self, name, func, needs=()):
+        self.name = name
+        self.func = func
+        self.needs = tuple(needs)
+        self.probe = None
+
+
+class Drift:
+    def __init__(self, outputs, *reasons):
+        self.outputs = outputs
+        self.reasons = list(reasons)
+
+
+class StepFailed(Exception):
+    def __init__(self, failures, skipped):
+        self.failures = failures
+        self.skipped = skipped
+        names = ', '.join(name for name, _ in failures)
+        super().__init__('provisioning failed in: '+names)
+
+
+class Graph:
+    def __init__(self):
+        self.steps = OrderedDict()
+
+    def add(self, name, func, needs=()):
+        if name in self.steps:
+            raise ValueError('duplicate step: '+name)
+        self.steps[name] = Step(name, func, needs)
+        return func
+
+    def step(self, name, needs=()):
+        def register(func):
+            return self.add(name, func, needs)
+        return register
+
+    def probe(self, name):
+        def register(func):
+            self.steps[name].probe = func
+            return func
+        return register
+
+    def validate(self):
+        for step in self.steps.values():
+            for dep in step.needs:
+                if dep not in self.steps:
+                    raise ValueError(step.name+' needs unknown step '+dep)
+        # Kahn's algorithm, anything left over sits on a cycle
+        pending = {name: set(step.needs) for name, step in self.steps.items()}
+        while True:
+            ready = [name for name, deps in pending.items() if not deps]
+            if not ready:
+                break
+            for name in ready:
+                del pending[name]
+            for deps in pending.values():
+                deps.difference_update(ready)
+        if pending:
+            raise ValueError('dependency cycle between: '+', '.join(sorted(pending)))
+
+    def run(self, var, out=None, workers=8, log=print, action=None, on_result=None):
+        # action(step, var, out) replaces the call to step.func, which is
+        # how plan() probes and apply() skips steps already in place.
+        # on_result(step, outputs) is called as each step finishes.
+        self.validate()
+        out = dict(out or {})
+        timings = Timings()
+        done = set()
+        failures = []
+        running = {}
+        waiting = OrderedDict(self.steps)
+        if action is None:
+            action = lambda step, var, out: step.func(var, out)
+
+        def call(step, snapshot):
+            timings.start(step.name)
+            try:
+                return action(step, var, snapshot) or {}
+            finally:
+                timings.stop(step.name)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while waiting or running:
+                if not failures:
+                    for name, step in list(waiting.items()):
+                        if all(dep in done for dep in step.needs):
+                            del waiting[name]
+                            log('Starting '+name+'...')
+                            running[pool.submit(call, step, dict(out))] = step
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    step = running.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as err:
+                        log('Step '+step.name+' failed: '+repr(err))
+                        failures.append((step.name, err))
+                        continue
+                    out.update(result)
+                    done.add(step.name)
+                    if on_result is not None:
+                        on_result(step, result)
+                    log('Finished '+step.name+' in %.1fs' % timings.duration(step.name))
+        timings.graph = self
+        if failures:
+            raise StepFailed(failures, list(waiting))
+        return out, timings
+
+    def plan(self, var, recorded=None, workers=8, log=print):
+        # Probe every step in dependency order so each probe sees what its
+        # upstream probes found. Nothing is created or changed.
+        recorded = recorded or {}
+        plan = Plan()
+
+        def probe(step, var, out):
+            if step.probe is None:
+                plan.set(step.name, MISSING, {}, ['no probe, always applied'])
+                return {}
+            missing = [dep for dep in step.needs if plan.status.get(dep) == MISSING]
+            if missing:
+                # applied anyway once its dependencies are, steps are
+                # written to create or update in place
+                plan.set(step.name, MISSING, {}, ['after '+', '.join(missing)])
+                return {}
+            try:
+                found = step.probe(var, out, recorded.get(step.name, {}))
+            except KeyError as err:
+                found = None
+                plan.set(step.name, MISSING, {}, ['upstream output '+str(err)+' unknown'])
+            if isinstance(found, Drift):
+                plan.set(step.name, DRIFT, found.outputs, found.reasons)
+                return found.outputs
+            if found is None:
+                if step.name not in plan.status:
+                    plan.set(step.name, MISSING, {})
+                return {}
+            plan.set(step.name, OK, found)
+            return found
+
+        _, plan.timings = self.run(var, workers=workers, log=lambda msg: None, action=probe)
+        for name in self.steps:
+            plan.status.move_to_end(name)
+        return plan
+
+    def apply(self, var, plan, workers=8, log=print, on_result=None):
+        # Run only the steps the plan found missing or drifted, reusing
+        # the probed outputs of everything already in place. A drifted
+        # step also sees its own probed outputs so it can update in place.
+        def apply_step(step, var, out):
+            status = plan.status.get(step.name)
+            if status == OK:
+                return plan.outputs[step.name]
+            if status == DRIFT:
+                out = dict(out, **plan.outputs[step.name])
+            return step.func(var, out)
+        return self.run(var, workers=workers, log=log, action=apply_step, on_result=on_result)
+
+
+class Plan:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.status = OrderedDict()
+        self.outputs = {}
+        self.reasons = {}
+        self.timings = None
+
+    def set(self, name, status, outputs, reasons=()):
+        with self._lock:
+            self.status[name] = status
+            self.outputs[name] = outputs
+            self.reasons[name] = list(reasons)
+
+    def changes(self):
+        return [name for name, status in self.status.items() if status != OK]
+
+    def report(self):
+        lines = []
+        for name, status in self.status.items():
+            marker = {OK: ' ', MISSING: '+', DRIFT: '~'}[status]
+            line = '%s %-28s %s' % (marker, name, status)
+            if self.reasons[name]:
+                line += ' ('+'; '.join(self.reasons[name])+')'
+            lines.append(line)
+        lines.append('')
+        lines.append('%d to create or update, %d unchanged' % (
+            len(self.changes()), len(self.status) - len(self.changes())))
+        return '\n'.join(lines)
+
+
+##########################################
+# Per-step timing report
+##########################################
+class Timings:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.origin = time.monotonic()
+        self.started = {}
+        self.stopped = {}
+        self.threads = {}
+        self.graph = None
+
+    def start(self, name):
+        # called on the thread running the step
+        with self._lock:
+            self.started[name] = time.monotonic() - self.origin
+            self.threads[name] = threading.current_thread().name
+
+    def stop(self, name):
+        with self._lock:
+            self.stopped[name] = time.monotonic() - self.origin
+
+    def duration(self, name):
+        return self.stopped.get(name, 0) - self.started.get(name, 0)
+
+    def wall_time(self):
+        return max(self.stopped.values(), default=0)
+
+    def serial_time(self):
+        return sum(self.duration(name) for name in self.stopped)
+
+    def critical_path(self):
+        # Walk back from the last step to finish, always following the
+        # dependency that finished last: that is what held each step up.
+        if not self.stopped or self.graph is None:
+            return []
+        name = max(self.stopped, key=self.stopped.get)
+        path = [name]
+        while True:
+            needs = [dep for dep in self.graph.steps[name].needs if dep in self.stopped]
+            if not needs:
+                break
+            name = max(needs, key=self.stopped.get)
+            path.append(name)
+        return list(reversed(path))
+
+    def as_dict(self):
+        return {
+            'wall_time': self.wall_time(),
+            'serial_time': self.serial_time(),
+            'critical_path': self.critical_path(),
+            'steps': [
+                {
+                    'name': name,
+                    'start': self.started[name],
+                    'end': self.stopped[name],
+                    'duration': self.duration(name)
+                }
+                for name in sorted(self.stopped, key=self.started.get)
+            ]
+        }
+
+    def report(self):
+        lines = ['%-28s %9s %9s %9s' % ('step', 'start', 'end', 'duration')]
+        for step in self.as_dict()['steps']:
+            lines.append('%-28s %8.1fs %8.1fs %8.1fs' % (
+                step['name'], step['start'], step['end'], step['duration']))
+        lines.append('')
+        lines.append('wall time %.1fs, sum of steps %.1fs' % (self.wall_time(), self.serial_time()))
+        lines.append('critical path: '+' -> '.join(self.critical_path()))
+        return '\n'.join(lines)
@@ -0,0 +1,89 @@
+import time
+import threading
+
+##########################################
+# Per-service API rate limits
+##########################################
+# Provisioning many sites at once easily goes past the request rates
+# AWS allows per account, and the throttled calls then spend their time
+# in botocore's retry backoff. Instead every call waits for a token from
+# its service's bucket before it is sent: a handler on botocore's
+# before-call event, installed on the session before any client is
+# created, so every client built from the session shares the buckets.
+# Rates are requests per second, keyed by botocore's service id in the
+# form used in event names.
+
+LIMITS = {
+    'iam': 10,
+    'cloudfront': 5,
+    'route-53': 5,
+    'acm': 10,
+    'lambda': 15,
+    'codebuild': 10,
+    'codecommit': 10,
+    'eventbridge': 10,
+    'cloudwatch-logs': 5,
+    'sts': 10,
+    'sqs': 50,
+    's3': 50
+}
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, sleep=time.sleep):
+        # take a token, waiting for one if the bucket is empty, and
+        # return how long that took
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            sleep(delay)
+        return delay
+
+
+class RateLimiter:
+    def __init__(self, limits=None):
+        self.buckets = dict((service, TokenBucket(rate))
+                            for service, rate in (LIMITS if limits is None else limits).items())
+        self._lock = threading.Lock()
+        self.calls = {}
+        self.waited = {}
+
+    def before_call(self, event_name, **kwargs):
+        # before-call.<service id>.<operation>; must return None or the
+        # call would be answered with whatever was returned
+        service = event_name.split('.')[1]
+        bucket = self.buckets.get(service)
+        waited = bucket.acquire() if bucket else 0
+        with self._lock:
+            self.calls[service] = self.calls.get(service, 0) + 1
+            self.waited[service] = self.waited.get(service, 0) + waited
+
+    def install(self, session):
+        session.events.register('before-call', self.before_call)
+
+    def as_dict(self):
+        with self._lock:
+            return dict((service, {
+                'calls': self.calls[service],
+                'waited': self.waited[service],
+                'limit': self.buckets[service].rate if service in self.buckets else None
+            }) for service in sorted(self.calls))
+
+    def report(self):
+        lines = ['%-20s %8s %8s %9s' % ('service', 'limit/s', 'calls', 'waited')]
+        for service, usage in self.as_dict().items():
+            lines.append('%-20s %8s %8d %8.1fs' % (
+                service, '-' if usage['limit'] is None else '%g' % usage['limit'],
+                usage['calls'], usage['waited']))
+        return '\n'.join(lines)
@@ -0,0 +1,109 @@
+import time
+import random
+import threading
+from botocore.exceptions import ClientError
+
+##########################################
+# Adaptive readiness polling
+##########################################
+# Instead of sleeping for a fixed time after creating a resource we probe
+# it until it is usable. The delay between probes grows exponentially
+# from `base` up to `cap` seconds with jitter, and gives up after
+# `timeout` seconds. Every wait is recorded so the real cost of each one
+# shows up in the run report.
+
+
+class NotReady(Exception):
+    pass
+
+
+def error_code(err):
+    if isinstance(err, ClientError):
+        return err.response.get('Error', {}).get('Code', '')
+    return ''
+
+
+def error_matches(codes, message=None):
+    # Predicate for retry(): a ClientError with one of `codes` and, when
+    # given, `message` somewhere in its text.
+    codes = (codes,) if isinstance(codes, str) else tuple(codes)
+    def matches(err):
+        if error_code(err) not in codes:
+            return False
+        return message is None or message.lower() in str(err).lower()
+    return matches
+
+
+def backoff(attempt, base=0.5, cap=15.0):
+    delay = min(cap, base * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.waits = []
+
+    def record(self, name, attempts, elapsed, ready):
+        # called on the waiting thread once the wait is over
+        with self._lock:
+            self.waits.append({
+                'name': name,
+                'attempts': attempts,
+                'elapsed': elapsed,
+                'ready': ready,
+                'started': time.monotonic() - elapsed,
+                'thread': threading.current_thread().name
+            })
+
+    def as_dict(self):
+        with self._lock:
+            return list(self.waits)
+
+    def report(self):
+        lines = ['%-48s %8s %9s' % ('wait', 'attempts', 'elapsed')]
+        for wait in self.as_dict():
+            lines.append('%-48s %8d %8.1fs%s' % (
+                wait['name'], wait['attempts'], wait['elapsed'],
+                '' if wait['ready'] else ' (timed out)'))
+        return '\n'.join(lines)
+
+
+metrics = Metrics()
+
+
+def wait_until(name, probe, timeout=300, base=0.5, cap=15.0, retry_if=None, sleep=time.sleep):
+    # Call probe() until it returns something truthy and return that.
+    # Exceptions accepted by retry_if count as "not ready yet".
+    started = time.monotonic()
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            result = probe()
+        except Exception as err:
+            if retry_if is None or not retry_if(err):
+                metrics.record(name, attempt, time.monotonic() - started, False)
+                raise
+            result = None
+        elapsed = time.monotonic() - started
+        if result:
+            metrics.record(name, attempt, elapsed, True)
+            return result
+        delay = backoff(attempt - 1, base, cap)
+        if elapsed + delay > timeout:
+            metrics.record(name, attempt, elapsed, False)
+            raise NotReady(name+' not ready after %.0fs' % elapsed)
+        sleep(delay)
+
+
+def retry(name, call, retry_if, timeout=300, base=0.5, cap=15.0, sleep=time.sleep):
+    # Repeat call() while it raises an error accepted by retry_if, for
+    # requests that only succeed once something they depend on has
+    # propagated (an IAM role, a new rule...).
+    box = []
+    def probe():
+        box.append(call())
+        return True
+    wait_until(name, probe, timeout, base, cap, retry_if, sleep)
+    return box[-1]
@@ -3,3 +3,24 @@ proj_name= ''               # Enter a name that identifies your project, eg: 'my
 proj_desc= ''               # Enter a description here, eg: 'automated CI/CD process for my website'
 dns_domain= ''              # Enter your domain, eg: 'mydomain.com'
 website_fqdn= ''            #Add a prefix for non-apex domain sites, eg: 'www.mydomain.com'
+hosted_zone_id= ''          # Only needed when several public zones are named dns_domain, eg: 'Z0123456789ABC'
+invalidation_window= 60     # Seconds of s3 changes collected into one cdn invalidation (max 300)
+build_concurrency= 'cancel'  # Push during a running build: 'cancel' it, 'queue' behind it or 'coalesce'
+generator= 'hugo'           # Site generator the build installs and runs: 'hugo', 'jekyll' or 'pelican'
+build_cache= 'local'        # Keep dependencies between builds: 'local', 's3' or 'none'
+build_image= ''             # Overrides the generator's CodeBuild image, eg: 'aws/codebuild/standard:7.0'
+build_compute_type= ''      # Overrides the generator's compute type, eg: 'BUILD_GENERAL1_MEDIUM'
+sync_mode= 'after'          # Upload the site 'after' it is rendered, or 'stream' it while rendering (needs deploy_mode 'release')
+deploy_mode= 'inplace'      # Deploy each build as a new 'release' the cdn switches to, or overwrite the site 'inplace'
+releases_kept= 5            # Releases kept to roll back to, older ones are deleted after each deploy
+log_retention_days= 30      # Days of build and lambda logs kept (1, 3, 5, 7, 14, 30, 60, 90, 120, 150, 180, 365...)
+cache_policy= 'CachingOptimized'   # Managed cache policy name or the id of your own
+origin_request_policy= ''   # Managed origin request policy name or id, eg: 'CORS-S3Origin'
+compress= True              # Let the cdn serve gzip and brotli to viewers that accept them
+http_version= 'http2and3'   # 'http2and3', 'http2', 'http3' or 'http1.1'
+origin_shield= ''           # Region of an extra cache in front of the bucket, eg: 'eu-west-1', or 'auto'
+min_tls_version= 'TLSv1.2_2021'  # Oldest TLS viewers may use, eg: 'TLSv1.2_2019'
+redirects_file= ''          # Redirects file in the site repo, answered by the cdn without reaching the bucket (up to 5MB of rules, over 100,000), eg: '_redirects'
+error_page= '404.html'      # Page of the site served for missing paths, '' for the bare 404
+error_caching_ttl= 300      # Seconds the cdn keeps a 404 before asking the bucket again (a deploy clears new paths)
+wait_for_cdn= False         # Block until the cdn has deployed instead of leaving it to 'setup.py wait'
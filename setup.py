@@ -1,282 +1,559 @@
 #!/usr/bin/env python3
-from pathlib import Path
-import os
-import glob
-import zipfile
-import time
+import sys
 import datetime
 import json
-import boto3
-import settings as var
+import argparse
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+import aws
+import buildspec
+import cdn_config
+import certificates
+import dns
+import instrument
+import inventory
+import lambda_package
+import policies
+import readiness
+import settings
+from provision import Graph, Drift, StepFailed
+from readiness import error_code, error_matches
+from state import State, state_path
 #boto3.set_stream_logger('')
 
+graph = Graph()
+
+# Errors returned while a freshly created IAM role is still propagating
+LAMBDA_ROLE_NOT_READY = error_matches('InvalidParameterValueException', 'cannot be assumed')
+CODEBUILD_ROLE_NOT_READY = error_matches('InvalidInputException', 'not authorized')
+
+
+def wait_for_roles(iam, role_names):
+    # One wait for the whole batch: the roles were created together and
+    # propagate together.
+    pending = set(role_names)
+    def visible():
+        for name in sorted(pending):
+            try:
+                iam.get_role(RoleName= name)
+            except Exception as err:
+                if error_code(err) != 'NoSuchEntity':
+                    raise
+                return False
+            pending.discard(name)
+        return True
+    readiness.wait_until('iam roles', visible)
+
+##########################################
+# Create or update IAM policies and roles
+##########################################
+# Rendered from the templates in policies.py, all in one batch at the
+# start of the run (see the 'iam' step below).
+def policy_hash(iam, policy_arn):
+    tags = iam.list_policy_tags(PolicyArn= policy_arn)['Tags']
+    return next((tag['Value'] for tag in tags if tag['Key'] == policies.HASH_TAG), None)
+
+
+def ensure_policy(iam, var, template, document):
+    name, path = template.policy_name(var), template.policy_arn_path(var)
+    try:
+        create_policy = iam.create_policy(
+            PolicyName= name,
+            Path= path,
+            PolicyDocument= json.dumps(document),
+            Description= template.policy_description(var),
+            Tags= policies.tags(var, document)
+        )
+        return create_policy['Policy']['Arn']
+    except Exception as err:
+        if error_code(err) != 'EntityAlreadyExists':
+            raise
+    # Already there from an earlier run: reused when its hash says the
+    # document is the same, otherwise made current with a new default
+    # version, dropping the oldest when at the 5 version limit.
+    policy_arn = 'arn:aws:iam::'+aws.account_id()+':policy'+path+name
+    if policy_hash(iam, policy_arn) == policies.document_hash(document):
+        return policy_arn
+    versions = iam.list_policy_versions(PolicyArn= policy_arn)['Versions']
+    if len(versions) >= 5:
+        oldest = min((v for v in versions if not v['IsDefaultVersion']), key=lambda v: v['CreateDate'])
+        iam.delete_policy_version(PolicyArn= policy_arn, VersionId= oldest['VersionId'])
+    iam.create_policy_version(
+        PolicyArn= policy_arn,
+        PolicyDocument= json.dumps(document),
+        SetAsDefault= True
+    )
+    iam.tag_policy(PolicyArn= policy_arn, Tags= policies.tags(var, document))
+    return policy_arn
+
+
+def ensure_role(iam, var, template):
+    try:
+        return iam.create_role(
+            RoleName= template.role_name(var),
+            Path= template.role_path(var),
+            AssumeRolePolicyDocument= json.dumps(policies.assume_role_policy(template.service)),
+            Description= template.role_description(var),
+            Tags= [
+                {
+                    'Key': 'Name',
+                    'Value': var.proj_name
+                },
+            ]
+        )['Role']
+    except Exception as err:
+        if error_code(err) != 'EntityAlreadyExists':
+            raise
+    return iam.get_role(RoleName= template.role_name(var))['Role']
+
+
+def policy_arns(var):
+    # every ARN the templates name, known from the settings before any of
+    # these resources exist; the repository and project are made in the
+    # region of the clients that create them
+    account = aws.account_id()
+    repo_region = aws.client('codecommit').meta.region_name
+    build_region = aws.client('codebuild').meta.region_name
+    return {
+        'repo': 'arn:aws:codecommit:'+repo_region+':'+account+':'+var.proj_name,
+        'bucket': 'arn:aws:s3:::'+var.website_fqdn,
+        'build_cache': 'arn:aws:s3:::'+build_cache_bucket(var),
+        'build_project': 'arn:aws:codebuild:'+build_region+':'+account+':project/'+var.proj_name,
+        'queue': 'arn:aws:sqs:*:*:'+var.proj_name+'-cdn-invalidation',
+        'distributions': 'arn:aws:cloudfront::'+account+':distribution/*',
+        'redirects_function': 'arn:aws:cloudfront::'+account+':function/'+redirects_function_name(var)
+    }
+
+def probe_template(var, template, arns):
+    # (role, reasons it differs from the template), role None if missing
+    found = inventory.for_site(var)
+    role = found.roles().get(template.role_name(var))
+    policy = found.policies().get(template.policy_name(var))
+    if role is None or policy is None:
+        return None, [template.role_name(var)+' missing']
+    reasons = []
+    if policy['Arn'] not in found.attached_policies(role['RoleName']):
+        reasons.append(template.policy_name(var)+' not attached')
+    if found.policy_tags(policy).get(policies.HASH_TAG) != policies.document_hash(template.document(var, arns)):
+        reasons.append(template.policy_name(var)+' document changed')
+    return role, reasons
+
+def probe_templates(var, arns):
+    with ThreadPoolExecutor(max_workers=len(policies.TEMPLATES)) as pool:
+        return list(pool.map(lambda template: probe_template(var, template, arns), policies.TEMPLATES))
+
+@graph.step('iam')
+def create_iam(var, out):
+    # Every policy and role left to create or update is done at once,
+    # then every policy is attached, then the batch is waited on once.
+    # Lambda and CodeBuild retry until they may assume their role, by
+    # then the roles have been propagating since the start of the run.
+    # Templates the plan found in place are left alone.
+    print('Creating roles and policies...')
+    iam = aws.client('iam')
+    arns = policy_arns(var)
+    probed = probe_templates(var, arns)
+    todo = [template for template, (role, reasons) in zip(policies.TEMPLATES, probed) if role is None or reasons]
+    roles = dict((template.key, role) for template, (role, _) in zip(policies.TEMPLATES, probed) if role)
+    with ThreadPoolExecutor(max_workers=2 * max(len(todo), 1)) as pool:
+        created = [pool.submit(ensure_policy, iam, var, template, template.document(var, arns))
+                   for template in todo]
+        made = [pool.submit(ensure_role, iam, var, template) for template in todo]
+        attached = [future.result() for future in created]
+        made = [future.result() for future in made]
+        list(pool.map(lambda role, policy_arn: iam.attach_role_policy(
+            RoleName= role['RoleName'],
+            PolicyArn= policy_arn
+        ), made, attached))
+    if made:
+        wait_for_roles(iam, [role['RoleName'] for role in made])
+    roles.update((template.key, role) for template, role in zip(todo, made))
+    return dict((key+'_role_arn', role['Arn']) for key, role in roles.items())
+
+@graph.probe('iam')
+def probe_iam(var, out, recorded):
+    probed = probe_templates(var, policy_arns(var))
+    if not any(role for role, _ in probed):
+        return None
+    outputs = dict((template.key+'_role_arn', role['Arn'])
+                   for template, (role, _) in zip(policies.TEMPLATES, probed) if role)
+    reasons = [reason for _, role_reasons in probed for reason in role_reasons]
+    return Drift(outputs, *reasons) if reasons else outputs
+
+##########################################
+# Create or update lambda functions
+##########################################
+LAMBDA_RUNTIME = 'python3.11'
+# bundled into every function zip
+LAMBDA_SHARED = ['lambdas/shared/runtime.py']
+packages = lambda_package.Packager(['build_trigger', 'invalidate_cdn', 'log_cleanup', 'pipeline_metrics'],
+                                   shared= LAMBDA_SHARED, runtime= LAMBDA_RUNTIME)
+
+def configuration_changes(function, config):
+    # settings in config (create_function arguments) that differ from the
+    # function as lambda describes it
+    changes = []
+    for key, value in config.items():
+        if key in ('FunctionName', 'Tags', 'Publish'):
+            continue
+        current = function.get(key)
+        if key == 'Environment':
+            current = {'Variables': function.get('Environment', {}).get('Variables', {})}
+        if current != value:
+            changes.append(key)
+    return changes
+
+
+def deploy_function(serverless, config, package):
+    # config holds the create_function arguments other than Code. An
+    # existing function only gets its code or configuration updated
+    # where they differ from what is deployed.
+    try:
+        return readiness.retry('lambda '+config['FunctionName'], lambda: serverless.create_function(
+            Code={
+                'ZipFile': package.code()
+            },
+            **config
+        ), retry_if= LAMBDA_ROLE_NOT_READY)
+    except Exception as err:
+        if error_code(err) != 'ResourceConflictException':
+            raise
+    function = serverless.get_function_configuration(FunctionName= config['FunctionName'])
+    if function['CodeSha256'] != package.code_sha256:
+        function = serverless.update_function_code(
+            FunctionName= config['FunctionName'],
+            ZipFile= package.code(),
+            Publish= config.get('Publish', False)
+        )
+    if not configuration_changes(function, config):
+        return function
+    update = dict((key, value) for key, value in config.items() if key not in ('Tags', 'Publish'))
+    # only one update may be in progress per function
+    return readiness.retry('lambda '+config['FunctionName']+' configuration',
+        lambda: serverless.update_function_configuration(**update),
+        retry_if= error_matches('ResourceConflictException'))
+
+
+def add_permission(serverless, **kwargs):
+    try:
+        serverless.add_permission(**kwargs)
+    except Exception as err:
+        if error_code(err) != 'ResourceConflictException':
+            raise
+
+
+def probe_function(var, config, package):
+    function = inventory.for_site(var).functions().get(config['FunctionName'])
+    if function is None:
+        return None
+    reasons = [key+' changed' for key in configuration_changes(function, config)]
+    if function['CodeSha256'] != package.code_sha256:
+        reasons.append('code changed')
+    return function, reasons
+
 ##########################################
 # Create S3 bucket
 ##########################################
-print()
-print('Creating S3 bucket...')
-s3 = boto3.client('s3')
-s3.create_bucket(
-    Bucket= var.website_fqdn,
-    ACL = 'public-read',
-    CreateBucketConfiguration = {
-    'LocationConstraint': var.region
-}
-)
-s3.put_bucket_tagging(
-    Bucket= var.website_fqdn,
-    Tagging={
-        'TagSet':[
+def bucket_policy_document(var):
+    bucket_arn = 'arn:aws:s3:::'+var.website_fqdn
+    return {
+        "Version": "2012-10-17",
+        "Statement": [
             {
-              'Key': 'Name',
-              'Value': var.proj_name
+                "Sid": "CodeBuildPushFromSCM",
+                "Effect": "Allow",
+                "Principal": {
+                    "Service": "codebuild.amazonaws.com"
+                },
+                "Action": [
+                    "s3:PutObject",
+                    "s3:ListBucket",
+                    "s3:GetObject",
+                    "s3:GetObjectVersion",
+                    "s3:DeleteObject"
+                ],
+                "Resource": [
+                    bucket_arn,
+                    bucket_arn+'/*'
+                ]
             },
+            {
+                "Sid": "AllowPublicRead",
+                "Effect": "Allow",
+                "Principal": '*',
+                "Action": "s3:GetObject",
+                "Resource": bucket_arn+'/*'
+            }
         ]
     }
-)
-s3.put_bucket_website(
-    Bucket= var.website_fqdn,
-    WebsiteConfiguration={
-        'ErrorDocument': {
-            'Key': 'error.html'
-        },
-        'IndexDocument': {
-            'Suffix': 'index.html'
+
+@graph.step('bucket')
+def create_bucket(var, out):
+    print('Creating S3 bucket...')
+    s3 = aws.client('s3')
+    try:
+        s3.create_bucket(
+            Bucket= var.website_fqdn,
+            ACL = 'public-read',
+            CreateBucketConfiguration = {
+            'LocationConstraint': var.region
         }
-    }
-)
-bucket_arn = 'arn:aws:s3:::'+var.website_fqdn
-print()
-###########################################
-## Update s3 bucket policy
-###########################################
-print('Updating s3 bucket policy...')
-bucket_policy = {
-    "Version": "2012-10-17",
-    "Statement": [
-        {
-            "Sid": "CodeBuildPushFromSCM",
-            "Effect": "Allow",
-            "Principal": {
-                "Service": "codebuild.amazonaws.com"
-            },
-            "Action": [
-                "s3:PutObject",
-                "s3:ListBucket",
-                "s3:GetObject",
-                "s3:GetObjectVersion"
-            ],
-            "Resource": [
-                bucket_arn,
-                bucket_arn+'/*'
+        )
+    except Exception as err:
+        if error_code(err) != 'BucketAlreadyOwnedByYou':
+            raise
+    s3.put_bucket_tagging(
+        Bucket= var.website_fqdn,
+        Tagging={
+            'TagSet':[
+                {
+                  'Key': 'Name',
+                  'Value': var.proj_name
+                },
             ]
-        },
-        {
-            "Sid": "AllowPublicRead",
-            "Effect": "Allow",
-            "Principal": '*',
-            "Action": "s3:GetObject",
-            "Resource": bucket_arn+'/*'
         }
-    ]
-}
-bucket_policy = json.dumps(bucket_policy)
-s3.put_bucket_policy(Bucket= var.website_fqdn, Policy=bucket_policy)
-time.sleep(5)
-print()
+    )
+    s3.put_bucket_website(
+        Bucket= var.website_fqdn,
+        WebsiteConfiguration={
+            'ErrorDocument': {
+                'Key': 'error.html'
+            },
+            'IndexDocument': {
+                'Suffix': 'index.html'
+            }
+        }
+    )
+    ###########################################
+    ## Update s3 bucket policy
+    ###########################################
+    print('Updating s3 bucket policy...')
+    bucket_policy = json.dumps(bucket_policy_document(var))
+    s3.put_bucket_policy(Bucket= var.website_fqdn, Policy=bucket_policy)
+    readiness.wait_until(
+        's3 bucket policy',
+        lambda: s3.get_bucket_policy(Bucket= var.website_fqdn),
+        retry_if= error_matches(['NoSuchBucketPolicy', 'NoSuchBucket'])
+    )
+    return {'bucket_arn': 'arn:aws:s3:::'+var.website_fqdn}
+
+@graph.probe('bucket')
+def probe_bucket(var, out, recorded):
+    s3 = aws.client('s3')
+    try:
+        s3.head_bucket(Bucket= var.website_fqdn)
+    except Exception as err:
+        if error_code(err) in ('404', 'NoSuchBucket'):
+            return None
+        raise
+    outputs = {'bucket_arn': 'arn:aws:s3:::'+var.website_fqdn}
+    try:
+        policy = json.loads(s3.get_bucket_policy(Bucket= var.website_fqdn)['Policy'])
+    except Exception as err:
+        if error_code(err) != 'NoSuchBucketPolicy':
+            raise
+        return Drift(outputs, 'no bucket policy')
+    if policy != bucket_policy_document(var):
+        return Drift(outputs, 'bucket policy changed')
+    return outputs
+
 ##########################################
 # Create Codecommit Repository
 ##########################################
-print('Creating repository...')
-create_repo = boto3.client('codecommit').create_repository(
-    repositoryName= var.proj_name,
-    repositoryDescription= 'Software repository for '+var.proj_desc
-)
-http_repo_url = create_repo['repositoryMetadata']['cloneUrlHttp']
-ssh_repo_url = create_repo['repositoryMetadata']['cloneUrlSsh']
-repo_arn= create_repo['repositoryMetadata']['Arn']
-print()
+@graph.step('repo')
+def create_repo(var, out):
+    print('Creating repository...')
+    create_repo = aws.client('codecommit').create_repository(
+        repositoryName= var.proj_name,
+        repositoryDescription= 'Software repository for '+var.proj_desc
+    )
+    return repo_outputs(create_repo['repositoryMetadata'])
+
+def repo_outputs(metadata):
+    return {
+        'http_repo_url': metadata['cloneUrlHttp'],
+        'ssh_repo_url': metadata['cloneUrlSsh'],
+        'repo_arn': metadata['Arn']
+    }
+
+@graph.probe('repo')
+def probe_repo(var, out, recorded):
+    metadata = inventory.for_site(var).repository()
+    return repo_outputs(metadata) if metadata else None
+
 ################################################
-# Set permissions for Codebuild project
+# Bucket for the build cache
 ################################################
-print('Creating role for build...')
-build_policy = {
-    "Version": "2012-10-17",
-    "Statement": [
-        {
-            "Effect": "Allow",
-            "Action": "codecommit:GitPull",
-            "Resource": repo_arn
-        },
-        {
-            "Effect": "Allow",
-            "Action": [
-                "s3:PutObject",
-                "s3:GetObject",
-                "s3:ListBucket",
-                "s3:GetObjectVersion"
-            ],
-            "Resource": bucket_arn+"*"
-        },
-        {
-            "Effect": "Allow",
-            "Action": [
-                "logs:CreateLogGroup",
-                "logs:CreateLogStream",
-                "logs:PutLogEvents"
-            ],
-            "Resource": '*'
+# Only used with build_cache = 's3'. The website bucket is publicly
+# readable so the cache gets a private bucket of its own.
+def build_cache_bucket(var):
+    return var.proj_name+'-build-cache-'+aws.account_id()
+
+def build_cache_config(var, out):
+    if var.build_cache == 's3':
+        return {
+            'type': 'S3',
+            'location': build_cache_bucket(var)+'/codebuild'
         }
-    ]
-}
-build_policy = json.dumps(build_policy)
-iam = boto3.client('iam')
-create_build_policy = iam.create_policy(
-    PolicyName= var.proj_name+'-codebuild-policy',
-    Path= '/'+var.proj_name+'/codebuild/',
-    PolicyDocument= build_policy,
-    Description= 'Policy attached to codebuild. Part of '+var.proj_desc
-)
-build_policy_arn = create_build_policy['Policy']['Arn']
-assume_role_policy = {
-  "Version": "2012-10-17",
-  "Statement": [
-    {
-      "Effect": "Allow",
-      "Principal": {
-        "Service": "codebuild.amazonaws.com"
-      },
-      "Action": "sts:AssumeRole"
-    }
-  ]
-}
-assume_role_policy = json.dumps(assume_role_policy)
-create_build_role = iam.create_role(
-    RoleName= var.proj_name+'-codebuild-role',
-    Path= '/'+var.proj_name+'/codebuild/',
-    AssumeRolePolicyDocument= assume_role_policy,
-    Description= 'Codebuild service execution role. Part of '+var.proj_desc
-)
-iam.attach_role_policy(
-    RoleName= create_build_role['Role']['RoleName'],
-    PolicyArn= build_policy_arn
-)
-build_role_arn = create_build_role['Role']['Arn']
-time.sleep(30)
-print()
+    if var.build_cache == 'local':
+        return {
+            'type': 'LOCAL',
+            'modes': ['LOCAL_SOURCE_CACHE', 'LOCAL_CUSTOM_CACHE']
+        }
+    return {'type': 'NO_CACHE'}
+
+@graph.step('build_cache')
+def create_build_cache(var, out):
+    if var.build_cache != 's3':
+        return {}
+    print('Creating S3 bucket for the build cache...')
+    s3 = aws.client('s3')
+    bucket = build_cache_bucket(var)
+    try:
+        s3.create_bucket(
+            Bucket= bucket,
+            CreateBucketConfiguration = {
+                'LocationConstraint': var.region
+            }
+        )
+    except Exception as err:
+        if error_code(err) != 'BucketAlreadyOwnedByYou':
+            raise
+    s3.put_public_access_block(
+        Bucket= bucket,
+        PublicAccessBlockConfiguration={
+            'BlockPublicAcls': True,
+            'IgnorePublicAcls': True,
+            'BlockPublicPolicy': True,
+            'RestrictPublicBuckets': True
+        }
+    )
+    s3.put_bucket_tagging(
+        Bucket= bucket,
+        Tagging={
+            'TagSet':[
+                {
+                  'Key': 'Name',
+                  'Value': var.proj_name
+                },
+            ]
+        }
+    )
+    return {'build_cache_arn': 'arn:aws:s3:::'+bucket}
+
+@graph.probe('build_cache')
+def probe_build_cache(var, out, recorded):
+    if var.build_cache != 's3':
+        return {}
+    try:
+        aws.client('s3').head_bucket(Bucket= build_cache_bucket(var))
+    except Exception as err:
+        if error_code(err) in ('404', 'NoSuchBucket'):
+            return None
+        raise
+    return {'build_cache_arn': 'arn:aws:s3:::'+build_cache_bucket(var)}
+
 ################################################
 # Create Build project
 ################################################
-print('Creating build project...')
-create_build_project = boto3.client('codebuild').create_project(
-    name= var.proj_name,
-    description= 'Build steps of '+var.proj_desc,
-    source= {
-        'type': 'CODECOMMIT',
-        'location': http_repo_url,
-        'gitCloneDepth': 1,        
-    },
-    artifacts={
-        'type': 'NO_ARTIFACTS'
-    },
-    environment={
-        'type': 'LINUX_CONTAINER',
-        'image': 'aws/codebuild/python:latest',
-        'computeType': 'BUILD_GENERAL1_SMALL'
-    },
-    logsConfig={
-        'cloudWatchLogs': {
-            'status': 'ENABLED'
-        }
-    },
-    serviceRole= build_role_arn
-)
-build_project_arn = create_build_project['project']['arn']
-print()
-################################################
-#  Set permissions for lambda trigger
-###############################################
-print('Creating role for lambda build trigger...')
-build_trigger_policy = {
-    "Version": "2012-10-17",
-    "Statement": [
-        {
-            "Effect": "Allow",
-            "Action": "codecommit:GitPull",
-            "Resource": repo_arn
-        },
-        {
-            "Effect": "Allow",
-            "Action": "codebuild:StartBuild",
-            "Resource": build_project_arn
-        },
+def build_environment_variables(var, out):
+    variables = [
         {
-            "Effect": "Allow",
-            "Action": [
-                "logs:CreateLogGroup",
-                "logs:CreateLogStream",
-                "logs:PutLogEvents"
-            ],
-            "Resource": '*'
+            'name': 'SITE_BUCKET',
+            'value': var.website_fqdn,
+            'type': 'PLAINTEXT'
         }
     ]
-}
-build_trigger_policy = json.dumps(build_trigger_policy)
-iam = boto3.client('iam')
-create_trigger_policy = iam.create_policy(
-    PolicyName= var.proj_name+'-lambda-build-trigger-policy',
-    Path= '/'+var.proj_name+'/lambda/trigger/',
-    PolicyDocument= build_trigger_policy,
-    Description= 'Policy attached to lambda. Part of '+var.proj_desc
-)
-assume_role_policy = {
-  "Version": "2012-10-17",
-  "Statement": [
-    {
-      "Effect": "Allow",
-      "Principal": {
-        "Service": "lambda.amazonaws.com"
-      },
-      "Action": "sts:AssumeRole"
-    }
-  ]
-}
-assume_role_policy = json.dumps(assume_role_policy)
-create_trigger_role = iam.create_role(
-    RoleName= var.proj_name+'-lambda-build-trigger-role',
-    Path= '/'+var.proj_name+'/lambda/trigger/',
-    AssumeRolePolicyDocument= assume_role_policy,
-    Description= 'Lambda role to trigger build. Part of '+var.proj_desc
-)
-iam.attach_role_policy(
-    RoleName= create_trigger_role['Role']['RoleName'],
-    PolicyArn= create_trigger_policy['Policy']['Arn']
-)
-time.sleep(30)
-print()
+    if buildspec.deploy_mode(var) == 'release':
+        variables.append({
+            'name': 'INVALIDATION_QUEUE_URL',
+            'value': out['invalidation_queue_url'],
+            'type': 'PLAINTEXT'
+        })
+    return variables
+
+def build_project_config(var, out):
+    return dict(
+        name= var.proj_name,
+        description= 'Build steps of '+var.proj_desc,
+        source= {
+            'type': 'CODECOMMIT',
+            'location': out['http_repo_url'],
+            'gitCloneDepth': 1,
+            'buildspec': buildspec.render(var)
+        },
+        artifacts={
+            'type': 'NO_ARTIFACTS'
+        },
+        environment={
+            'type': 'LINUX_CONTAINER',
+            'image': buildspec.image(var),
+            'computeType': buildspec.compute_type(var),
+            'environmentVariables': build_environment_variables(var, out)
+        },
+        cache= build_cache_config(var, out),
+        logsConfig={
+            'cloudWatchLogs': {
+                'status': 'ENABLED'
+            }
+        },
+        serviceRole= out['build_role_arn']
+    )
+
+@graph.step('build_project', needs=['repo', 'iam', 'build_cache', 'invalidation_queue'])
+def create_build_project(var, out):
+    print('Creating build project...')
+    codebuild = aws.client('codebuild')
+    config = build_project_config(var, out)
+    def create_or_update():
+        try:
+            return codebuild.create_project(**config)
+        except Exception as err:
+            if error_code(err) != 'ResourceAlreadyExistsException':
+                raise
+        return codebuild.update_project(**config)
+    # retried until codebuild is allowed to assume the new service role
+    create_build_project = readiness.retry('codebuild project', create_or_update,
+                                           retry_if= CODEBUILD_ROLE_NOT_READY)
+    return {'build_project_arn': create_build_project['project']['arn']}
+
+@graph.probe('build_project')
+def probe_build_project(var, out, recorded):
+    project = inventory.for_site(var).build_project()
+    if project is None:
+        return None
+    outputs = {'build_project_arn': project['arn']}
+    config = build_project_config(var, out)
+    reasons = []
+    if project['serviceRole'] != config['serviceRole']:
+        reasons.append('service role changed')
+    if project['source'].get('location') != config['source']['location']:
+        reasons.append('source changed')
+    if project['source'].get('buildspec') != config['source']['buildspec']:
+        reasons.append('buildspec changed')
+    cache = project.get('cache', {'type': 'NO_CACHE'})
+    if any(cache.get(key) != value for key, value in config['cache'].items()):
+        reasons.append('cache changed')
+    for key, value in config['environment'].items():
+        if project['environment'].get(key) != value:
+            reasons.append('environment '+key+' changed')
+    return Drift(outputs, *reasons) if reasons else outputs
+
 ################################################
 # Create lambda trigger
 ################################################
-print('Creating lambda function to trigger build...')
-# zip lambda code for upload
-zf = zipfile.ZipFile('build_trigger.zip', 'w')
-for name in glob.glob('lambdas/build_trigger/*.py'):
-    zf.write(name, os.path.basename(name), zipfile.ZIP_DEFLATED)
-zf.close()
-# Create lambda
-serverless = boto3.client('lambda')
-with open('build_trigger.zip', 'rb') as zip_blob:
-    create_trigger_function = serverless.create_function(
+def trigger_function_config(var, out):
+    return dict(
         FunctionName= var.proj_name+'-build-phase-trigger',
-        Runtime= 'python3.6',
-        Role= create_trigger_role['Role']['Arn'],
+        Runtime= LAMBDA_RUNTIME,
+        Role= out['trigger_role_arn'],
         Handler= 'build_trigger.lambda_handler',
-        Code={
-            'ZipFile': zip_blob.read()
-        },
         Environment={
             'Variables': {
-                'BUILD_PROJECT_NAME': var.proj_name
+                'BUILD_PROJECT_NAME': var.proj_name,
+                'REPOSITORY_NAME': var.proj_name,
+                'BRANCH': 'master',
+                'BUILD_CONCURRENCY': var.build_concurrency
             }
         },
         Timeout= 30,
@@ -285,238 +562,410 @@ with open('build_trigger.zip', 'rb') as zip_blob:
             'Name': var.proj_name
         },
         Publish= True
-)
-lambda_policy = serverless.add_permission(
-    FunctionName= var.proj_name+'-build-phase-trigger',
-    StatementId= 'enable-codecommit-to-invoke-function',
-    Action= 'lambda:InvokeFunction',
-    Principal= 'codecommit.amazonaws.com',
-    SourceArn= repo_arn
-)
-print()
+    )
+
+@graph.step('trigger_function', needs=['repo', 'iam'])
+def create_trigger_function(var, out):
+    print('Creating lambda function to trigger build...')
+    serverless = aws.client('lambda')
+    create_trigger_function = deploy_function(serverless, trigger_function_config(var, out),
+                                              packages.get('build_trigger'))
+    add_permission(serverless,
+        FunctionName= var.proj_name+'-build-phase-trigger',
+        StatementId= 'enable-codecommit-to-invoke-function',
+        Action= 'lambda:InvokeFunction',
+        Principal= 'codecommit.amazonaws.com',
+        SourceArn= out['repo_arn']
+    )
+    # one push handled at a time so two pushes never both start a build
+    serverless.put_function_concurrency(
+        FunctionName= var.proj_name+'-build-phase-trigger',
+        ReservedConcurrentExecutions= 1
+    )
+    return {
+        'trigger_function_arn': create_trigger_function['FunctionArn'],
+        'trigger_function_name': create_trigger_function['FunctionName']
+    }
+
+@graph.probe('trigger_function')
+def probe_trigger_function(var, out, recorded):
+    config = trigger_function_config(var, out)
+    found = probe_function(var, config, packages.get('build_trigger'))
+    if found is None:
+        return None
+    function, reasons = found
+    outputs = {
+        'trigger_function_arn': function['FunctionArn'],
+        'trigger_function_name': function['FunctionName']
+    }
+    return Drift(outputs, *reasons) if reasons else outputs
+
 #################################################
 ## Create repo trigger
 #################################################
-boto3.client('codecommit').put_repository_triggers(
-    repositoryName= var.proj_name,
-    triggers= [
+def repo_triggers(var, out):
+    return [
         {
             'name': var.proj_name+'-trigger',
-            'destinationArn': create_trigger_function['FunctionArn'],
+            'destinationArn': out['trigger_function_arn'],
             'branches': [
                 'master',
             ],
             'events': [
-                'all'
+                'createReference',
+                'updateReference'
             ]
         }
     ]
-)
+
+@graph.step('repo_trigger', needs=['repo', 'trigger_function'])
+def create_repo_trigger(var, out):
+    print('Creating repository trigger...')
+    aws.client('codecommit').put_repository_triggers(
+        repositoryName= var.proj_name,
+        triggers= repo_triggers(var, out)
+    )
+
+@graph.probe('repo_trigger')
+def probe_repo_trigger(var, out, recorded):
+    triggers = aws.client('codecommit').get_repository_triggers(
+        repositoryName= var.proj_name
+    )['triggers']
+    for trigger in triggers:
+        trigger.pop('customData', None)
+    return {} if triggers == repo_triggers(var, out) else None
+
+#################################################
+## Notify build trigger when a build finishes
+#################################################
+def build_finished_pattern(var):
+    return {
+        'source': ['aws.codebuild'],
+        'detail-type': ['CodeBuild Build State Change'],
+        'detail': {
+            'project-name': [var.proj_name],
+            'build-status': ['SUCCEEDED', 'FAILED', 'STOPPED']
+        }
+    }
+
+def build_finished_targets(var, out):
+    return [
+        {
+            'Id': var.proj_name+'-build-trigger',
+            'Arn': out['trigger_function_arn']
+        },
+        {
+            'Id': var.proj_name+'-pipeline-metrics',
+            'Arn': out['metrics_function_arn']
+        }
+    ]
+
+@graph.step('build_finished_rule', needs=['trigger_function', 'metrics_function'])
+def create_build_finished_rule(var, out):
+    # lets the trigger build the branch head once a running build ends,
+    # which is how pushes queued behind a running build get deployed, and
+    # the metrics function time the build's deploy
+    print('Creating rule to notify build trigger of finished builds...')
+    events = aws.client('events')
+    rule = events.put_rule(
+        Name= var.proj_name+'-build-finished',
+        EventPattern= json.dumps(build_finished_pattern(var)),
+        State= 'ENABLED',
+        Description= 'Start queued builds and time deploys when a build ends. Part of '+var.proj_desc
+    )
+    for function_name in (var.proj_name+'-build-phase-trigger', var.proj_name+'-pipeline-metrics'):
+        add_permission(aws.client('lambda'),
+            FunctionName= function_name,
+            StatementId= 'enable-events-to-invoke-function',
+            Action= 'lambda:InvokeFunction',
+            Principal= 'events.amazonaws.com',
+            SourceArn= rule['RuleArn']
+        )
+    readiness.retry('events build rule targets', lambda: events.put_targets(
+        Rule= var.proj_name+'-build-finished',
+        Targets= build_finished_targets(var, out)
+    ), retry_if= error_matches('ResourceNotFoundException'))
+
+@graph.probe('build_finished_rule')
+def probe_build_finished_rule(var, out, recorded):
+    events = aws.client('events')
+    try:
+        rule = events.describe_rule(Name= var.proj_name+'-build-finished')
+    except Exception as err:
+        if error_code(err) != 'ResourceNotFoundException':
+            raise
+        return None
+    if json.loads(rule.get('EventPattern', '{}')) != build_finished_pattern(var):
+        return None
+    targets = events.list_targets_by_rule(Rule= var.proj_name+'-build-finished')['Targets']
+    wanted = build_finished_targets(var, out)
+    if sorted(target['Arn'] for target in targets) != sorted(target['Arn'] for target in wanted):
+        return None
+    return {}
+
+##########################################
+# Look up hosted zone
+##########################################
+@graph.step('hosted_zone')
+def find_hosted_zone(var, out):
+    print('Looking up hosted zone for '+var.dns_domain+'...')
+    return {'zone_id': dns.zone_id(dns.find_zone(var))}
+
+@graph.probe('hosted_zone')
+def probe_hosted_zone(var, out, recorded):
+    # a read-only lookup, so planning simply performs it
+    return find_hosted_zone(var, out)
+
 ##########################################
 # Request SSL certificate
 ##########################################
-print('Request ssl certificate for '+var.website_fqdn+'...')
-acm = boto3.client('acm', region_name='us-east-1')
-cert = acm.request_certificate(
-        DomainName= var.website_fqdn,
-        ValidationMethod= 'DNS'
+@graph.step('certificate', needs=['hosted_zone'])
+def request_certificate(var, out):
+    # Only reached when the probe found no issued certificate to reuse.
+    # A cert_arn here was requested by an earlier run that stopped before
+    # it was issued.
+    arn = out.get('cert_arn') or certificates.request(var)
+    certificates.validate(var, out['zone_id'], arn)
+    return {'cert_arn': arn}
+
+@graph.probe('certificate')
+def probe_certificate(var, out, recorded):
+    issued = certificates.find_issued(var, recorded.get('cert_arn'))
+    if issued:
+        return {'cert_arn': issued['CertificateArn']}
+    pending = certificates.find_pending(var)
+    if pending:
+        return Drift({'cert_arn': pending}, 'waiting for validation')
+    return None
+
+##########################################
+# Create cloudfront function answering redirects
+##########################################
+# The rules live in a key value store associated with the function,
+# both created with no rules; each build puts the rules of the site's
+# redirects file in the store and publishes the code answering them
+# (see deploy_tools/redirects.py). Only published code can be associated
+# with the distribution.
+REDIRECTS_RUNTIME = 'cloudfront-js-2.0'
+PASS_THROUGH = b'function handler(event) {\n    return event.request;\n}\n'
+
+def redirects_function_name(var):
+    return var.proj_name+'-redirects'
+
+def redirects_store_name(var):
+    return var.proj_name+'-redirects'
+
+def associated_store(function_config):
+    items = function_config.get('KeyValueStoreAssociations', {}).get('Items', [])
+    return items[0]['KeyValueStoreARN'] if items else None
+
+def describe_redirects_store(var):
+    try:
+        return aws.client('cloudfront').describe_key_value_store(Name= redirects_store_name(var))['KeyValueStore']
+    except Exception as err:
+        if error_code(err) == 'EntityNotFound':
+            return None
+        raise
+
+@graph.step('redirects_store')
+def create_redirects_store(var, out):
+    if not var.redirects_file:
+        return {}
+    print('Creating key value store for redirects...')
+    try:
+        aws.client('cloudfront').create_key_value_store(
+            Name= redirects_store_name(var),
+            Comment= 'Redirects of '+var.website_fqdn
         )
-time.sleep(5)
-acm.add_tags_to_certificate(
-    CertificateArn= cert['CertificateArn'],
-    Tags=[
-        {
-            'Key': 'Name',
-            'Value': var.proj_name
-        },
-    ]
-)
-time.sleep(5)
-domain_validation = acm.describe_certificate(
-    CertificateArn= cert['CertificateArn']
-)
-rr_name = domain_validation['Certificate']['DomainValidationOptions'][0]['ResourceRecord']['Name']
-rr_value = domain_validation['Certificate']['DomainValidationOptions'][0]['ResourceRecord']['Value']
-r53 = boto3.client('route53')
-hosted_zone = r53.list_hosted_zones_by_name(
-    DNSName= var.dns_domain
-)
-zone_id = hosted_zone['HostedZones'][0]['Id'][-14:]
-r53.change_resource_record_sets(
-    HostedZoneId= zone_id,
-    ChangeBatch= {
-    'Comment': 'Validate ownership of DNS domain',
-    'Changes': [
-        {
-            'Action': 'UPSERT',
-                    'ResourceRecordSet': {
-                            'Name': rr_name,
-                            'ResourceRecords': [
-                                {
-                                    'Value': rr_value
-                                },
-                            ],
-                            'Type': 'CNAME',
-                            'TTL': 300
-                    }
-            },
-        ]
+    except Exception as err:
+        if error_code(err) != 'EntityAlreadyExists':
+            raise
+    # usable once provisioned, within seconds
+    def ready():
+        store = describe_redirects_store(var)
+        return store if store is not None and store['Status'] == 'READY' else None
+    store = readiness.wait_until('key value store '+redirects_store_name(var), ready)
+    return {'redirects_store_arn': store['ARN']}
+
+@graph.probe('redirects_store')
+def probe_redirects_store(var, out, recorded):
+    if not var.redirects_file:
+        return {}
+    store = describe_redirects_store(var)
+    if store is None:
+        return None
+    outputs = {'redirects_store_arn': store['ARN']}
+    return outputs if store['Status'] == 'READY' else Drift(outputs, 'provisioning')
+
+@graph.step('redirects_function', needs=['redirects_store'])
+def create_redirects_function(var, out):
+    if not var.redirects_file:
+        return {}
+    print('Creating redirects function...')
+    cdn = aws.client('cloudfront')
+    config = {
+        'Comment': 'Redirects of '+var.website_fqdn,
+        'Runtime': REDIRECTS_RUNTIME,
+        'KeyValueStoreAssociations': {'Quantity': 1, 'Items': [{'KeyValueStoreARN': out['redirects_store_arn']}]}
     }
-)
-print()
-print('Wait for certificate to be issued before proceeding...')
-time.sleep(120)
-print()
-input('Press enter to continue...')
-print()
+    try:
+        etag = cdn.create_function(
+            Name= redirects_function_name(var),
+            FunctionConfig= config,
+            FunctionCode= PASS_THROUGH
+        )['ETag']
+    except Exception as err:
+        # created by a run that stopped before publishing it
+        if error_code(err) != 'FunctionAlreadyExists':
+            raise
+        described = cdn.describe_function(Name= redirects_function_name(var), Stage= 'DEVELOPMENT')
+        etag = described['ETag']
+        if associated_store(described['FunctionSummary']['FunctionConfig']) != out['redirects_store_arn']:
+            etag = cdn.update_function(
+                Name= redirects_function_name(var),
+                IfMatch= etag,
+                FunctionConfig= config,
+                FunctionCode= PASS_THROUGH
+            )['ETag']
+    published = cdn.publish_function(Name= redirects_function_name(var), IfMatch= etag)
+    return {'redirects_function_arn': published['FunctionSummary']['FunctionMetadata']['FunctionARN']}
+
+@graph.probe('redirects_function')
+def probe_redirects_function(var, out, recorded):
+    if not var.redirects_file:
+        return {}
+    try:
+        described = aws.client('cloudfront').describe_function(Name= redirects_function_name(var), Stage= 'LIVE')
+    except Exception as err:
+        if error_code(err) == 'NoSuchFunctionExists':
+            return None
+        raise
+    outputs = {'redirects_function_arn': described['FunctionSummary']['FunctionMetadata']['FunctionARN']}
+    if associated_store(described['FunctionSummary']['FunctionConfig']) != out['redirects_store_arn']:
+        return Drift(outputs, 'not associated with the redirects store')
+    return outputs
+
 ##########################################
 # Create cloudfront cdn
 ##########################################
-print('Creating cdn for '+var.website_fqdn+'...')
-dt = datetime.datetime.now()
-call_ref = dt.strftime('%d/%m/%Y %H:%M:%S')
-cdn = boto3.client('cloudfront')
-create_cdn = cdn.create_distribution_with_tags(
-    DistributionConfigWithTags={
-        'DistributionConfig': {
-            'CallerReference': call_ref,
-            'Aliases': {
-                'Quantity': 1,
-                'Items': [
-                    var.website_fqdn,
-                ]
-            },
-            'DefaultRootObject': 'index.html',
-            'Origins': {
-                'Quantity': 1,
-                'Items': [
-                    {
-                        'Id': var.website_fqdn,
-                        'DomainName': var.website_fqdn+'.s3.amazonaws.com',
-                        'CustomOriginConfig': {
-                            'HTTPPort': 80,
-                            'HTTPSPort': 443,
-                            'OriginProtocolPolicy': 'http-only'
-                        }
-                    },
-                ]
-            },
-            'DefaultCacheBehavior': {
-                'TargetOriginId': var.website_fqdn,
-                'ForwardedValues': {
-                    'QueryString': False,
-                    'Cookies': {
-                        'Forward': 'none',
-                        }
-                    },
-                'TrustedSigners': {
-                    'Enabled': False,
-                    'Quantity': 0
-                },
-                'ViewerProtocolPolicy': 'redirect-to-https',
-                'MinTTL': 0,
-                'DefaultTTL': 86400,
-                'MaxTTL': 31536000
-            },
-            'Comment': 'Static website cdn',
-            'Enabled': True,
-            'ViewerCertificate': {
-                'CloudFrontDefaultCertificate': False,
-                'ACMCertificateArn': cert['CertificateArn'],
-                'SSLSupportMethod': 'sni-only',
-                'MinimumProtocolVersion': 'TLSv1.1_2016'
-            },
-            'HttpVersion': 'http2'
-        },
-        'Tags': {
-            'Items': [
-                {
-                    'Key': 'Name',
-                    'Value': var.proj_name
-                },
-            ]
-        }
-    }  
-)
-cdn_dist_id = create_cdn['Distribution']['Id']
-cdn_dns_domain = create_cdn['Distribution']['DomainName']
-cdn_dist_arn = create_cdn['Distribution']['ARN']
-print()
-####################################################
-##  Set permissions for lambda function to purge cdn
-###################################################
-print('Creating role for lambda to flush cdn cache...')
-invalidate_cdn_policy = {
-    "Version": "2012-10-17",
-    "Statement": [
-        {
-            "Effect": "Allow",
-            "Action": "cloudfront:CreateInvalidation",
-            "Resource": '*'
-        },
-        {
-            "Effect": "Allow",
-            "Action": [
-                "logs:CreateLogGroup",
-                "logs:CreateLogStream",
-                "logs:PutLogEvents"
-            ],
-            "Resource": '*'
-        }
-    ]
-}
-invalidate_cdn_policy = json.dumps(invalidate_cdn_policy)
-iam = boto3.client('iam')
-create_invalidate_cdn_policy = iam.create_policy(
-    PolicyName= var.proj_name+'-lambda-invalidate-cdn-policy',
-    Path= '/'+var.proj_name+'/lambda/clearcache/',
-    PolicyDocument= invalidate_cdn_policy,
-    Description= 'Policy attached to lambda. Part of '+var.proj_desc   
-)
-assume_role_policy = {
-  "Version": "2012-10-17",
-  "Statement": [
-    {
-      "Effect": "Allow",
-      "Principal": {
-        "Service": "lambda.amazonaws.com"
-      },
-      "Action": "sts:AssumeRole"
+def distribution_config(var, out, call_ref, path=''):
+    # checked offline first, a bad setting fails before anything is created
+    return cdn_config.validate(cdn_config.config(var, out['cert_arn'], call_ref, path,
+                                                 out.get('redirects_function_arn')))
+
+@graph.step('cdn', needs=['certificate', 'redirects_function'])
+def create_cdn(var, out):
+    cdn = aws.client('cloudfront')
+    if 'cdn_dist_id' in out:
+        print('Updating cdn for '+var.website_fqdn+'...')
+        current = cdn.get_distribution_config(Id= out['cdn_dist_id'])
+        # the release being served stays served
+        config = distribution_config(var, out, current['DistributionConfig']['CallerReference'],
+                                     cdn_config.origin_path(current['DistributionConfig']))
+        # keep whatever else was set on the distribution, e.g. logging
+        merged = dict(current['DistributionConfig'], **config)
+        update_cdn = cdn.update_distribution(
+            Id= out['cdn_dist_id'],
+            IfMatch= current['ETag'],
+            DistributionConfig= merged
+        )
+        distribution = update_cdn['Distribution']
+    else:
+        print('Creating cdn for '+var.website_fqdn+'...')
+        dt = datetime.datetime.now()
+        call_ref = dt.strftime('%d/%m/%Y %H:%M:%S')
+        create_cdn = cdn.create_distribution_with_tags(
+            DistributionConfigWithTags={
+                'DistributionConfig': distribution_config(var, out, call_ref),
+                'Tags': {
+                    'Items': [
+                        {
+                            'Key': 'Name',
+                            'Value': var.proj_name
+                        },
+                    ]
+                }
+            }
+        )
+        distribution = create_cdn['Distribution']
+    return {
+        'cdn_dist_id': distribution['Id'],
+        'cdn_dns_domain': distribution['DomainName'],
+        'cdn_dist_arn': distribution['ARN']
+    }
+
+@graph.probe('cdn')
+def probe_cdn(var, out, recorded):
+    distribution = inventory.for_site(var).distribution_for(var.website_fqdn)
+    if distribution is None:
+        return None
+    outputs = {
+        'cdn_dist_id': distribution['Id'],
+        'cdn_dns_domain': distribution['DomainName'],
+        'cdn_dist_arn': distribution['ARN']
     }
-  ]
-}
-assume_role_policy = json.dumps(assume_role_policy)
-create_invalidate_cdn_role = iam.create_role(
-    RoleName= var.proj_name+'-lambda-invalidate-cdn-role',
-    Path= '/'+var.proj_name+'/lambda/invalidatecdn/',
-    AssumeRolePolicyDocument= assume_role_policy,
-    Description= 'Lambda role to purge cdn cache as part of '+var.proj_desc
-)
-iam.attach_role_policy(
-    RoleName= create_invalidate_cdn_role['Role']['RoleName'],
-    PolicyArn= create_invalidate_cdn_policy['Policy']['Arn']
-)
-time.sleep(30)
-print()
+    reasons = cdn_config.differences(var, distribution, out.get('redirects_function_arn'))
+    if distribution['ViewerCertificate'].get('ACMCertificateArn') != out.get('cert_arn'):
+        reasons.insert(0, 'certificate changed')
+    if reasons:
+        return Drift(outputs, *reasons)
+    return outputs
+
+#################################################
+## Let the builds switch the cdn
+#################################################
+# The build role's access to the distribution and the redirects store is
+# scoped to their ARNs, so it is put in place once they exist rather than
+# with the templates.
+def build_cdn_policy(iam, var):
+    # the document in place, None when there is none
+    try:
+        return iam.get_role_policy(
+            RoleName= policies.template_for('build').role_name(var),
+            PolicyName= policies.build_cdn_policy_name(var)
+        )['PolicyDocument']
+    except Exception as err:
+        if error_code(err) != 'NoSuchEntity':
+            raise
+        return None
+
+@graph.step('build_cdn_access', needs=['cdn', 'iam', 'redirects_store'])
+def grant_build_cdn_access(var, out):
+    iam = aws.client('iam')
+    document = policies.build_cdn_document(var, out['cdn_dist_arn'], out.get('redirects_store_arn'))
+    if document:
+        iam.put_role_policy(
+            RoleName= policies.template_for('build').role_name(var),
+            PolicyName= policies.build_cdn_policy_name(var),
+            PolicyDocument= json.dumps(document)
+        )
+    elif build_cdn_policy(iam, var) is not None:
+        iam.delete_role_policy(
+            RoleName= policies.template_for('build').role_name(var),
+            PolicyName= policies.build_cdn_policy_name(var)
+        )
+    return {}
+
+@graph.probe('build_cdn_access')
+def probe_build_cdn_access(var, out, recorded):
+    found = build_cdn_policy(aws.client('iam'), var)
+    if found == policies.build_cdn_document(var, out['cdn_dist_arn'], out.get('redirects_store_arn')):
+        return {}
+    return None if found is None else Drift({}, 'build access to the cdn changed')
+
 #################################################
 ## Create lambda to clear cdn cache
 #################################################
-print('Creating lambda function to flush cdn cache...')
-## zip code for upload
-zf = zipfile.ZipFile('invalidate_cdn.zip', 'w')
-for name in glob.glob('lambdas/invalidate_cdn/*.py'):
-    zf.write(name, os.path.basename(name), zipfile.ZIP_DEFLATED)
-zf.close()
-## Create lambda
-with open('invalidate_cdn.zip', 'rb') as zip_blob:
-    create_invalidate_cdn_function = serverless.create_function(
+# the least the queue's pollers can be capped to; a window's changes are
+# seldom split over more than one batch
+INVALIDATION_CONSUMERS = 2
+
+def invalidate_cdn_function_config(var, out):
+    return dict(
         FunctionName= var.proj_name+'-cdn-cached-objects-invalidation',
-        Runtime= 'python3.6',
-        Role= create_invalidate_cdn_role['Role']['Arn'],
+        Runtime= LAMBDA_RUNTIME,
+        Role= out['invalidate_cdn_role_arn'],
         Handler= 'invalidate_cdn.lambda_handler',
-        Code={
-            'ZipFile': zip_blob.read()
-        },
         Description= 'Flush cached cdn objects function. Part of '+var.proj_desc,
         Timeout= 180,
         Publish= True,
@@ -525,220 +974,525 @@ with open('invalidate_cdn.zip', 'rb') as zip_blob:
         },
         Environment={
             'Variables': {
-                'CDN_DIST_ID' : cdn_dist_id
+                'CDN_DIST_ID' : out['cdn_dist_id']
             }
         }
-)
-lambda_policy = serverless.add_permission(
-    FunctionName= var.proj_name+'-cdn-cached-objects-invalidation',
-    StatementId= 'enable-s3-to-invoke-function',
-    Action= 'lambda:InvokeFunction',
-    Principal= 's3.amazonaws.com',
-    SourceArn= bucket_arn
-)
-print()
+    )
+
+@graph.step('invalidate_cdn_function', needs=['cdn', 'iam', 'invalidation_queue'])
+def create_invalidate_cdn_function(var, out):
+    print('Creating lambda function to flush cdn cache...')
+    serverless = aws.client('lambda')
+    create_invalidate_cdn_function = deploy_function(serverless, invalidate_cdn_function_config(var, out),
+                                                     packages.get('invalidate_cdn'))
+    # Reserved concurrency would throttle the queue's pollers and a throttled
+    # batch only comes back after the visibility timeout, so the mapping caps
+    # the pollers instead. Drop the reservation earlier setups made.
+    serverless.delete_function_concurrency(
+        FunctionName= var.proj_name+'-cdn-cached-objects-invalidation'
+    )
+    mapping = dict(
+        FunctionName= var.proj_name+'-cdn-cached-objects-invalidation',
+        BatchSize= 10000,
+        MaximumBatchingWindowInSeconds= var.invalidation_window,
+        ScalingConfig= {
+            'MaximumConcurrency': INVALIDATION_CONSUMERS
+        },
+        Enabled= True
+    )
+    existing = [m for m in inventory.for_site(var).event_source_mappings(mapping['FunctionName'])
+                if m['EventSourceArn'] == out['invalidation_queue_arn']]
+    if existing:
+        serverless.update_event_source_mapping(UUID= existing[0]['UUID'], **mapping)
+    else:
+        readiness.retry('lambda invalidate cdn queue mapping', lambda: serverless.create_event_source_mapping(
+            EventSourceArn= out['invalidation_queue_arn'],
+            **mapping
+        ), retry_if= error_matches('InvalidParameterValueException', 'execution role'))
+    return {
+        'invalidate_cdn_function_arn': create_invalidate_cdn_function['FunctionArn'],
+        'invalidate_cdn_function_name': create_invalidate_cdn_function['FunctionName']
+    }
+
+@graph.probe('invalidate_cdn_function')
+def probe_invalidate_cdn_function(var, out, recorded):
+    config = invalidate_cdn_function_config(var, out)
+    found = probe_function(var, config, packages.get('invalidate_cdn'))
+    if found is None:
+        return None
+    function, reasons = found
+    outputs = {
+        'invalidate_cdn_function_arn': function['FunctionArn'],
+        'invalidate_cdn_function_name': function['FunctionName']
+    }
+    mappings = [m for m in inventory.for_site(var).event_source_mappings(config['FunctionName'])
+                if m['EventSourceArn'] == out['invalidation_queue_arn']]
+    if not mappings:
+        reasons.append('not subscribed to the invalidation queue')
+    elif mappings[0].get('MaximumBatchingWindowInSeconds') != var.invalidation_window:
+        reasons.append('batching window changed')
+    elif mappings[0].get('ScalingConfig', {}).get('MaximumConcurrency') != INVALIDATION_CONSUMERS:
+        reasons.append('consumer concurrency changed')
+    return Drift(outputs, *reasons) if reasons else outputs
+
+#################################################
+## Create queue to coalesce s3 object notifications
+#################################################
+def invalidation_queue_attributes(var, out):
+    queue_name = var.proj_name+'-cdn-invalidation'
+    queue_policy = {
+        "Version": "2012-10-17",
+        "Statement": [
+            {
+                "Sid": "S3ObjectNotifications",
+                "Effect": "Allow",
+                "Principal": {
+                    "Service": "s3.amazonaws.com"
+                },
+                "Action": "sqs:SendMessage",
+                "Resource": 'arn:aws:sqs:*:*:'+queue_name,
+                "Condition": {
+                    "ArnLike": {
+                        "aws:SourceArn": out['bucket_arn']
+                    }
+                }
+            }
+        ]
+    }
+    return {
+        # six times the consumer timeout, as recommended for lambda
+        'VisibilityTimeout': '1080',
+        'Policy': json.dumps(queue_policy)
+    }
+
+@graph.step('invalidation_queue', needs=['bucket'])
+def create_invalidation_queue(var, out):
+    print('Creating queue for cdn invalidation requests...')
+    sqs = aws.client('sqs')
+    attributes = invalidation_queue_attributes(var, out)
+    try:
+        queue_url = sqs.create_queue(
+            QueueName= var.proj_name+'-cdn-invalidation',
+            Attributes= attributes,
+            tags= {
+                'Name': var.proj_name
+            }
+        )['QueueUrl']
+    except Exception as err:
+        if error_code(err) not in ('QueueAlreadyExists', 'QueueNameExists'):
+            raise
+        queue_url = sqs.get_queue_url(QueueName= var.proj_name+'-cdn-invalidation')['QueueUrl']
+        sqs.set_queue_attributes(QueueUrl= queue_url, Attributes= attributes)
+    queue_arn = sqs.get_queue_attributes(
+        QueueUrl= queue_url,
+        AttributeNames= ['QueueArn']
+    )['Attributes']['QueueArn']
+    return {
+        'invalidation_queue_url': queue_url,
+        'invalidation_queue_arn': queue_arn
+    }
+
+@graph.probe('invalidation_queue')
+def probe_invalidation_queue(var, out, recorded):
+    sqs = aws.client('sqs')
+    try:
+        queue_url = sqs.get_queue_url(QueueName= var.proj_name+'-cdn-invalidation')['QueueUrl']
+    except Exception as err:
+        if error_code(err) not in ('AWS.SimpleQueueService.NonExistentQueue', 'QueueDoesNotExist'):
+            raise
+        return None
+    current = sqs.get_queue_attributes(
+        QueueUrl= queue_url,
+        AttributeNames= ['QueueArn', 'VisibilityTimeout', 'Policy']
+    )['Attributes']
+    outputs = {
+        'invalidation_queue_url': queue_url,
+        'invalidation_queue_arn': current['QueueArn']
+    }
+    wanted = invalidation_queue_attributes(var, out)
+    reasons = []
+    if current.get('VisibilityTimeout') != wanted['VisibilityTimeout']:
+        reasons.append('visibility timeout changed')
+    if json.loads(current.get('Policy', '{}')) != json.loads(wanted['Policy']):
+        reasons.append('queue policy changed')
+    return Drift(outputs, *reasons) if reasons else outputs
+
 #################################################
 ## Configure S3 object notifications
 #################################################
-print('Enabling s3 object notifications...')
-s3.put_bucket_notification_configuration(
-    Bucket= var.website_fqdn,
-    NotificationConfiguration={
-        'LambdaFunctionConfigurations': [
+def notification_configuration(var, out):
+    # a new release is not served until the build switches to it, the
+    # build then sends the changed paths to the queue itself
+    if buildspec.deploy_mode(var) == 'release':
+        return {}
+    return {
+        'QueueConfigurations': [
             {
-                'LambdaFunctionArn': create_invalidate_cdn_function['FunctionArn'],
+                'QueueArn': out['invalidation_queue_arn'],
                 'Events': [
                     's3:ObjectCreated:*','s3:ObjectRemoved:*',
                 ]
             },
-        ]   
-    }
-)
-print()
-################################################
-#  Set permissions for lambda trigger
-###############################################
-print('Creating role for lambda to delete logs...')
-log_clean_policy = {
-    "Version": "2012-10-17",
-    "Statement": [
-        {
-            "Effect": "Allow",
-            "Action": [
-                "logs:CreateLogGroup",
-                "logs:CreateLogStream",
-                "logs:PutLogEvents"
-            ],
-            "Resource": '*'
-        },
-        {
-            "Effect": "Allow",
-            "Action": [
-                "logs:DeleteLogGroup",
-                "logs:DescribeLogStreams",
-                "logs:DeleteLogStream"
-            ],
-            "Resource": [
-                'arn:aws:logs:*:*:*/aws/lambda/'+create_trigger_function['FunctionName']+'*',
-                'arn:aws:logs:*:*:*/aws/lambda/'+create_invalidate_cdn_function['FunctionName']+'*',
-                'arn:aws:logs:*:*:*/aws/codebuild/'+var.proj_name+'*'
-            ]
-        }  
-    ]
-}
-log_clean_policy = json.dumps(log_clean_policy)
-iam = boto3.client('iam')
-create_log_clean_policy = iam.create_policy(
-    PolicyName= var.proj_name+'-lambda-log-clean-policy',
-    Path= '/'+var.proj_name+'/lambda/logclean/',
-    PolicyDocument= log_clean_policy,
-    Description= 'Policy attached to lambda. Part of '+var.proj_desc
-)
-assume_role_policy = {
-  "Version": "2012-10-17",
-  "Statement": [
-    {
-      "Effect": "Allow",
-      "Principal": {
-        "Service": "lambda.amazonaws.com"
-      },
-      "Action": "sts:AssumeRole"
+        ]
     }
-  ]
-}
-assume_role_policy = json.dumps(assume_role_policy)
-create_log_clean_role = iam.create_role(
-    RoleName= var.proj_name+'-lambda-log-clean-role',
-    Path= '/'+var.proj_name+'/lambda/logclean/',
-    AssumeRolePolicyDocument= assume_role_policy,
-    Description= 'Lambda role to cleardown logs. Part of '+var.proj_desc
-)
-iam.attach_role_policy(
-    RoleName= create_log_clean_role['Role']['RoleName'],
-    PolicyArn= create_log_clean_policy['Policy']['Arn']
-)
-time.sleep(30)
-print()
+
+@graph.step('bucket_notifications', needs=['bucket', 'invalidation_queue'])
+def enable_bucket_notifications(var, out):
+    print('Enabling s3 object notifications...')
+    aws.client('s3').put_bucket_notification_configuration(
+        Bucket= var.website_fqdn,
+        NotificationConfiguration= notification_configuration(var, out)
+    )
+
+@graph.probe('bucket_notifications')
+def probe_bucket_notifications(var, out, recorded):
+    current = aws.client('s3').get_bucket_notification_configuration(Bucket= var.website_fqdn)
+    queues = [(q['QueueArn'], sorted(q['Events'])) for q in current.get('QueueConfigurations', [])]
+    wanted = [(q['QueueArn'], sorted(q['Events']))
+              for q in notification_configuration(var, out).get('QueueConfigurations', [])]
+    return {} if queues == wanted else None
+
 ################################################
 # Create lambda trigger to clean up logs
 ################################################
-print('Creating lambda function to delete logs...')
-# zip lambda code for upload
-zf = zipfile.ZipFile('log_cleanup.zip', 'w')
-for name in glob.glob('lambdas/log_cleanup/*.py'):
-    zf.write(name, os.path.basename(name), zipfile.ZIP_DEFLATED)
-zf.close()
-# Create lambda
-serverless = boto3.client('lambda')
-with open('log_cleanup.zip', 'rb') as zip_blob:
-    create_log_clean_function = serverless.create_function(
+def log_clean_function_config(var, out):
+    return dict(
         FunctionName= var.proj_name+'-log-cleanup',
-        Runtime= 'python3.6',
-        Role= create_log_clean_role['Role']['Arn'],
+        Runtime= LAMBDA_RUNTIME,
+        Role= out['log_clean_role_arn'],
         Handler= 'log_cleanup.lambda_handler',
-        Code={
-            'ZipFile': zip_blob.read()
-        },
         Environment={
             'Variables': {
                 'BUILD_LOG': '/aws/codebuild/'+var.proj_name,
-                'TRIGGER_LOG': '/aws/lambda/'+create_trigger_function['FunctionName'],
-                'CDN_INVALIDATION_LOG': '/aws/lambda/'+create_invalidate_cdn_function['FunctionName']
+                'TRIGGER_LOG': '/aws/lambda/'+out['trigger_function_name'],
+                'CDN_INVALIDATION_LOG': '/aws/lambda/'+out['invalidate_cdn_function_name'],
+                'METRICS_LOG': '/aws/lambda/'+var.proj_name+'-pipeline-metrics',
+                'RETENTION_DAYS': str(var.log_retention_days)
             }
         },
-        Timeout= 120,
+        Timeout= 300,
         Description= 'Log cleanup function. Part of '+var.proj_desc,
         Tags={
             'Name': var.proj_name
         },
         Publish= True
-)
-print()
+    )
+
+@graph.step('log_clean_function', needs=['trigger_function', 'invalidate_cdn_function', 'iam'])
+def create_log_clean_function(var, out):
+    print('Creating lambda function to delete logs...')
+    create_log_clean_function = deploy_function(aws.client('lambda'), log_clean_function_config(var, out),
+                                                packages.get('log_cleanup'))
+    return {'log_clean_function_arn': create_log_clean_function['FunctionArn']}
+
+@graph.probe('log_clean_function')
+def probe_log_clean_function(var, out, recorded):
+    config = log_clean_function_config(var, out)
+    found = probe_function(var, config, packages.get('log_cleanup'))
+    if found is None:
+        return None
+    function, reasons = found
+    outputs = {'log_clean_function_arn': function['FunctionArn']}
+    return Drift(outputs, *reasons) if reasons else outputs
+
 ###################################################
 ## Create cloudwatch event to schedule log cleanup
 ###################################################
-print('Creating schedule to delete logs every 30 days...')
-boto3.client('events').put_rule(
-    Name= var.proj_name+'-log-cleanup',
-    ScheduleExpression= 'rate(30 days)',
-    State= 'ENABLED',
-    Description= 'Scheduled event to delete logs. Part of '+var.proj_desc
-)
-time.sleep(10)
-boto3.client('events').put_targets(
-    Rule= var.proj_name+'-log-cleanup',
-    Targets= [
-        {
-            'Id': var.proj_name+'-log-cleanup',
-            'Arn': create_log_clean_function['FunctionArn']
-        }
-    ]
-)
-print()
+# daily, so each run only has a day's worth of expired streams to delete
+LOG_CLEAN_SCHEDULE = 'rate(1 day)'
+
+@graph.step('log_clean_schedule', needs=['log_clean_function'])
+def create_log_clean_schedule(var, out):
+    print('Creating daily schedule to expire old logs...')
+    events = aws.client('events')
+    rule = events.put_rule(
+        Name= var.proj_name+'-log-cleanup',
+        ScheduleExpression= LOG_CLEAN_SCHEDULE,
+        State= 'ENABLED',
+        Description= 'Scheduled event to expire old logs. Part of '+var.proj_desc
+    )
+    add_permission(aws.client('lambda'),
+        FunctionName= var.proj_name+'-log-cleanup',
+        StatementId= 'enable-events-to-invoke-function',
+        Action= 'lambda:InvokeFunction',
+        Principal= 'events.amazonaws.com',
+        SourceArn= rule['RuleArn']
+    )
+    readiness.retry('events rule targets', lambda: events.put_targets(
+        Rule= var.proj_name+'-log-cleanup',
+        Targets= [
+            {
+                'Id': var.proj_name+'-log-cleanup',
+                'Arn': out['log_clean_function_arn']
+            }
+        ]
+    ), retry_if= error_matches('ResourceNotFoundException'))
+
+@graph.probe('log_clean_schedule')
+def probe_log_clean_schedule(var, out, recorded):
+    events = aws.client('events')
+    try:
+        rule = events.describe_rule(Name= var.proj_name+'-log-cleanup')
+    except Exception as err:
+        if error_code(err) != 'ResourceNotFoundException':
+            raise
+        return None
+    targets = events.list_targets_by_rule(Rule= var.proj_name+'-log-cleanup')['Targets']
+    if rule.get('ScheduleExpression') != LOG_CLEAN_SCHEDULE:
+        return Drift({}, 'schedule changed')
+    if [target['Arn'] for target in targets] != [out['log_clean_function_arn']]:
+        return None
+    try:
+        policy = aws.client('lambda').get_policy(FunctionName= var.proj_name+'-log-cleanup')['Policy']
+    except Exception as err:
+        if error_code(err) != 'ResourceNotFoundException':
+            raise
+        policy = '{}'
+    if 'enable-events-to-invoke-function' not in policy:
+        return Drift({}, 'events not allowed to invoke the function')
+    return {}
+
+################################################
+# Create lambda to time deploys
+################################################
+# Namespace of the per stage latency metrics
+METRICS_NAMESPACE = 'StaticSitePipeline'
+
+def metrics_function_config(var, out):
+    return dict(
+        FunctionName= var.proj_name+'-pipeline-metrics',
+        Runtime= LAMBDA_RUNTIME,
+        Role= out['metrics_role_arn'],
+        Handler= 'pipeline_metrics.lambda_handler',
+        Environment={
+            'Variables': {
+                'BUILD_PROJECT_NAME': var.proj_name,
+                'CDN_DIST_ID': out['cdn_dist_id'],
+                'METRICS_NAMESPACE': METRICS_NAMESPACE,
+                'INVALIDATION_WINDOW': str(var.invalidation_window),
+                # the invalidation window, then 5 minutes for the invalidation
+                'MAX_WAIT_SECONDS': str(var.invalidation_window + 300)
+            }
+        },
+        # waits for the invalidation, mostly asleep
+        Timeout= var.invalidation_window + 360,
+        Description= 'Push to live latency metrics. Part of '+var.proj_desc,
+        Tags={
+            'Name': var.proj_name
+        },
+        Publish= True
+    )
+
+@graph.step('metrics_function', needs=['cdn', 'iam'])
+def create_metrics_function(var, out):
+    print('Creating lambda function to time deploys...')
+    create_metrics_function = deploy_function(aws.client('lambda'), metrics_function_config(var, out),
+                                              packages.get('pipeline_metrics'))
+    return {'metrics_function_arn': create_metrics_function['FunctionArn']}
+
+@graph.probe('metrics_function')
+def probe_metrics_function(var, out, recorded):
+    config = metrics_function_config(var, out)
+    found = probe_function(var, config, packages.get('pipeline_metrics'))
+    if found is None:
+        return None
+    function, reasons = found
+    outputs = {'metrics_function_arn': function['FunctionArn']}
+    return Drift(outputs, *reasons) if reasons else outputs
+
 #################################################
-## Wait for CDN to be deployed
+## Track CDN deployment
 #################################################
-print('''NOTE: It takes on average 30 to 40 minutes for
-cloudfront distribution setup to complete, I suggest 
-grabbing a tasty beverage at this point, the script will
-automatically proceed once the cdn is ready.''')
-waiter = cdn.get_waiter('distribution_deployed')
-waiter.wait(
-    Id= cdn_dist_id,
-    WaiterConfig={
-        'Delay': 60,
-        'MaxAttempts': 60
+def wait_for_deploy(dist_id):
+    # Polled every few seconds at first, backing off to once a minute:
+    # small changes deploy in a few minutes, new distributions can take
+    # much longer. Returns the distribution and the seconds from its
+    # change to the first poll that saw it deployed, or None if it already
+    # was at the first poll (the deploy may have finished long before).
+    cloudfront = aws.client('cloudfront')
+    polls = []
+    def deployed():
+        distribution = cloudfront.get_distribution(Id= dist_id)['Distribution']
+        polls.append(datetime.datetime.now(datetime.timezone.utc))
+        return distribution if distribution['Status'] == 'Deployed' else None
+    distribution = readiness.wait_until('cloudfront deploy '+dist_id, deployed, timeout= 3600, base= 5, cap= 60)
+    if len(polls) == 1:
+        return distribution, None
+    return distribution, (polls[-1] - distribution['LastModifiedTime']).total_seconds()
+
+def since_change(distribution):
+    # seconds since the change last deployed, an upper bound of its latency
+    started = distribution['LastModifiedTime']
+    return (datetime.datetime.now(started.tzinfo) - started).total_seconds()
+
+def report_deploy(distribution, latency):
+    if latency is None:
+        print('cdn was already deployed, latency unknown (at most %.0fs after the change)'
+              % since_change(distribution))
+    else:
+        print('cdn deployed %.0fs after the change was made' % latency)
+
+@graph.step('cdn_deployed', needs=['cdn'])
+def track_cdn_deploy(var, out):
+    # Nothing else waits for the deploy: the dns alias records can point
+    # at the distribution straight away. Unless asked to wait, record the
+    # deploy and let 'setup.py wait' follow it later.
+    distribution = aws.client('cloudfront').get_distribution(Id= out['cdn_dist_id'])['Distribution']
+    handle = {
+        'cdn_deploy_started': distribution['LastModifiedTime'].isoformat(),
+        'cdn_deployed': distribution['Status'] == 'Deployed',
+        'cdn_deploy_latency': None
     }
-)
-print()
-print('cdn successfully deployed...')
-print()
+    if distribution['Status'] == 'Deployed':
+        report_deploy(distribution, None)
+        return handle
+    if not var.wait_for_cdn:
+        print('cdn '+out['cdn_dist_id']+' is deploying in the background...')
+        return handle
+    print('Waiting for cdn '+out['cdn_dist_id']+' to deploy...')
+    distribution, latency = wait_for_deploy(out['cdn_dist_id'])
+    report_deploy(distribution, latency)
+    return dict(handle, cdn_deployed= True, cdn_deploy_latency= latency)
+
+@graph.probe('cdn_deployed')
+def probe_cdn_deployed(var, out, recorded):
+    distribution = aws.client('cloudfront').get_distribution(Id= out['cdn_dist_id'])['Distribution']
+    outputs = {
+        'cdn_deploy_started': distribution['LastModifiedTime'].isoformat(),
+        'cdn_deployed': distribution['Status'] == 'Deployed',
+        'cdn_deploy_latency': recorded.get('cdn_deploy_latency')
+    }
+    if distribution['Status'] != 'Deployed':
+        return Drift(outputs, 'deploying')
+    return outputs
+
 #################################################
 ## Create dns records
 #################################################
-print('Updating dns for '+var.website_fqdn+'...')
-r53.change_resource_record_sets(
-HostedZoneId= zone_id,
-    ChangeBatch= {
-    'Comment': 'Create dns records for '+var.website_fqdn,
-    'Changes': [
-        {
-            'Action': 'UPSERT',
-                    'ResourceRecordSet': {
-                            'Name': var.website_fqdn,
-                            'Type': 'A',
-                            'AliasTarget': {
-                                'DNSName': cdn_dns_domain,
-                                'EvaluateTargetHealth': False,
-                                'HostedZoneId': 'Z2FDTNDATAQYW2',
-                            }
-                    }
-                },
-        {
-            'Action': 'UPSERT',
-                    'ResourceRecordSet': {
-                            'Name': var.website_fqdn,
-                            'Type': 'AAAA',
-                            'AliasTarget': {
-                                'DNSName': cdn_dns_domain,
-                                'EvaluateTargetHealth': False,
-                                'HostedZoneId': 'Z2FDTNDATAQYW2'
-                            }
-                    }
-            }
-        ]
-    }
-)
-print()
-print('Cleaning up zip files...')
-dir_path = Path.cwd()
-file_path = dir_path / 'file'
-for each_file_path in dir_path.glob('*.zip'):
-    print(f'removing {each_file_path}')
-    each_file_path.unlink()
-print()
-print('''Deployment complete. The url of your newly 
+@graph.step('dns_records', needs=['hosted_zone', 'cdn'])
+def create_dns_records(var, out):
+    print('Updating dns for '+var.website_fqdn+'...')
+    change_id = dns.change(out['zone_id'], dns.cdn_aliases(var.website_fqdn, out['cdn_dns_domain']),
+                           'Alias '+var.website_fqdn+' to its cdn')
+    print('dns for '+var.website_fqdn+' is in sync')
+    return {'dns_change_id': change_id}
+
+@graph.probe('dns_records')
+def probe_dns_records(var, out, recorded):
+    records = aws.client('route53').list_resource_record_sets(
+        HostedZoneId= out['zone_id'],
+        StartRecordName= var.website_fqdn,
+        StartRecordType= 'A',
+        MaxItems= '2'
+    )['ResourceRecordSets']
+    aliases = dict((record['Type'], record.get('AliasTarget', {}).get('DNSName', '').rstrip('.'))
+                   for record in records if record['Name'].rstrip('.') == var.website_fqdn)
+    wanted = out['cdn_dns_domain'].rstrip('.')
+    return {} if aliases.get('A') == wanted and aliases.get('AAAA') == wanted else None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Provision the static website pipeline.')
+    parser.add_argument('command', nargs='?', default='apply', choices=['plan', 'apply', 'wait'],
+                        help='plan lists what is missing or has drifted, apply creates or updates it, '
+                             'wait follows a cdn deploy left running by apply')
+    parser.add_argument('--wait', action='store_true',
+                        help='wait for the cdn to finish deploying before exiting')
+    parser.add_argument('--state', metavar='FILE',
+                        help='state file recording created resources (default: <proj_name>.state.json)')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='number of provisioning steps run at the same time')
+    parser.add_argument('--timings', metavar='FILE',
+                        help='write the per-step timing report to FILE as json')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='write every aws call and step to FILE as json')
+    parser.add_argument('--timeline', metavar='FILE',
+                        help='write a Chrome trace timeline of the run to FILE')
+    args = parser.parse_args(argv)
+    tracer = None
+    if args.trace or args.timeline:
+        tracer = instrument.Tracer()
+        tracer.install(aws.session())
+    state = State(args.state or state_path(settings))
+    if args.wait:
+        settings.wait_for_cdn = True
+    if args.command == 'wait':
+        return wait_command(state)
+    print('Reading current state of '+settings.proj_name+'...')
+    with tracing(tracer, 'plan'):
+        plan = graph.plan(settings, state.steps, workers=args.workers)
+    if tracer:
+        tracer.add_timings(plan.timings, 'probe')
+    print()
+    print(plan.report())
+    print()
+    if args.command == 'plan' or not plan.changes():
+        if args.command == 'apply':
+            for name in graph.steps:
+                state.record(name, plan.outputs[name])
+            print('Nothing to do, everything is up to date.')
+        if tracer:
+            tracer.write(readiness.metrics, args.trace, args.timeline)
+        return 0
+    try:
+        with tracing(tracer, 'apply'):
+            out, timings = graph.apply(settings, plan, workers=args.workers,
+                                       on_result=lambda step, outputs: state.record(step.name, outputs))
+    except StepFailed as err:
+        for name, failure in err.failures:
+            print(name+': '+repr(failure))
+        if err.skipped:
+            print('Not started: '+', '.join(err.skipped))
+        print('Progress is saved in '+state.path+', run setup.py again to resume.')
+        if tracer:
+            tracer.write(readiness.metrics, args.trace, args.timeline)
+        return 1
+    print()
+    print(timings.report())
+    print()
+    print(readiness.metrics.report())
+    if tracer:
+        tracer.add_timings(timings)
+        print()
+        print(tracer.report(readiness.metrics))
+        tracer.write(readiness.metrics, args.trace, args.timeline)
+    if args.timings:
+        report = timings.as_dict()
+        report['waits'] = readiness.metrics.as_dict()
+        with open(args.timings, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+    print()
+    print('''Deployment complete. The url of your newly
 created source code repository is:
 '''
-+ssh_repo_url+'''''')
-print()
\ No newline at end of file
++out['ssh_repo_url']+'''''')
+    print()
+    if not out.get('cdn_deployed'):
+        print('The cdn is still deploying, the site will be served once it is done.')
+        print('Run "python setup.py wait" to follow it.')
+        print()
+    return 0
+
+
+def tracing(tracer, name):
+    return tracer.span(name) if tracer else contextlib.nullcontext()
+
+
+def wait_command(state):
+    dist_id = state.outputs().get('cdn_dist_id')
+    if dist_id is None:
+        print('No cdn recorded in '+state.path+', run setup.py first.')
+        return 1
+    print('Waiting for cdn '+dist_id+' to deploy...')
+    distribution, latency = wait_for_deploy(dist_id)
+    state.record('cdn_deployed', {
+        'cdn_deploy_started': distribution['LastModifiedTime'].isoformat(),
+        'cdn_deployed': True,
+        'cdn_deploy_latency': latency
+    })
+    report_deploy(distribution, latency)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
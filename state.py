@@ -0,0 +1,47 @@
+import os
+import json
+import threading
+
+##########################################
+# Local record of provisioned resources
+##########################################
+# Outputs (ARNs, ids, urls) are written per step as soon as each step
+# finishes, so an interrupted run leaves behind everything needed to
+# find what it already created.
+
+
+class State:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.steps = {}
+        if os.path.exists(path):
+            with open(path) as state_file:
+                self.steps = json.load(state_file).get('steps', {})
+
+    def outputs(self):
+        merged = {}
+        for outputs in self.steps.values():
+            merged.update(outputs)
+        return merged
+
+    def record(self, name, outputs):
+        with self._lock:
+            self.steps[name] = dict(outputs)
+            self._save()
+
+    def forget(self, name):
+        with self._lock:
+            self.steps.pop(name, None)
+            self._save()
+
+    def _save(self):
+        # write then rename so a crash never leaves a truncated file
+        tmp_path = self.path+'.tmp'
+        with open(tmp_path, 'w') as state_file:
+            json.dump({'steps': self.steps}, state_file, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+def state_path(var):
+    return var.proj_name+'.state.json'
@@ -0,0 +1,30 @@
+import os
+import sys
+import importlib
+
+##########################################
+# Test setup
+##########################################
+# The tests run offline: every client is built against dummy credentials
+# and its calls are answered by botocore's Stubber or by the bench's
+# in-process stand-in for AWS (bench/standin.py), never sent.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'test')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'test')
+
+for path in (os.path.join(ROOT, 'lambdas', 'shared'), os.path.join(ROOT, 'deploy_tools'),
+             os.path.join(ROOT, 'bench'), ROOT):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+def load_handler(name, environment=None):
+    # import lambdas/<name>/<name>.py as the lambda runtime would
+    os.environ.update(environment or {})
+    path = os.path.join(ROOT, 'lambdas', name)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+    return importlib.import_module(name)
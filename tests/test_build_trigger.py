@@ -0,0 +1,154 @@
+import pytest
+from botocore.stub import Stubber
+from conftest import load_handler
+
+build_trigger = load_handler('build_trigger', {'BUILD_PROJECT_NAME': 'site', 'REPOSITORY_NAME': 'site'})
+
+NEW = 'c0ffee0000000000000000000000000000000002'
+OLD = 'c0ffee0000000000000000000000000000000001'
+
+
+def push(*references):
+    # a CodeCommit trigger event, as recorded from a push
+    return {'Records': [{
+        'awsRegion': 'us-east-1',
+        'codecommit': {'references': list(references)},
+        'eventId': '5a824061-17ca-46a9-bbf9-114edeadbeef',
+        'eventName': 'TriggerEventTest',
+        'eventPartNumber': 1,
+        'eventSource': 'aws:codecommit',
+        'eventSourceARN': 'arn:aws:codecommit:us-east-1:123456789012:site',
+        'eventTime': '2024-01-15T10:00:00.000+0000',
+        'eventTotalParts': 1,
+        'eventTriggerName': 'site-build-trigger',
+        'eventVersion': '1.0',
+        'userIdentityARN': 'arn:aws:iam::123456789012:user/dev'
+    }]}
+
+
+def finished(build_id, status='SUCCEEDED', project='site'):
+    # an EventBridge CodeBuild state change event
+    return {'source': 'aws.codebuild', 'detail-type': 'CodeBuild Build State Change',
+            'detail': {'project-name': project, 'build-status': status, 'build-id': build_id}}
+
+
+def build(build_id, commit, phase='BUILD', status='IN_PROGRESS'):
+    return {'id': build_id, 'buildStatus': status, 'currentPhase': phase,
+            'sourceVersion': commit, 'resolvedSourceVersion': commit}
+
+
+@pytest.fixture
+def stubs():
+    codebuild, codecommit = Stubber(build_trigger.codebuild), Stubber(build_trigger.codecommit)
+    with codebuild, codecommit:
+        yield codebuild, codecommit
+        codebuild.assert_no_pending_responses()
+        codecommit.assert_no_pending_responses()
+
+
+def expect_running(codebuild, *builds):
+    codebuild.add_response('list_builds_for_project', {'ids': [b['id'] for b in builds] + ['site:done']},
+                           {'projectName': 'site', 'sortOrder': 'DESCENDING'})
+    codebuild.add_response('batch_get_builds',
+                           {'builds': list(builds) + [build('site:done', OLD, 'COMPLETED', 'SUCCEEDED')]},
+                           {'ids': [b['id'] for b in builds] + ['site:done']})
+
+
+def expect_start(codebuild, commit, build_id='site:new', pushed_at='2024-01-15T10:00:00.000+0000'):
+    params = {'projectName': 'site', 'sourceVersion': commit}
+    if pushed_at:
+        params['environmentVariablesOverride'] = [{'name': 'PUSHED_AT', 'value': pushed_at, 'type': 'PLAINTEXT'}]
+    codebuild.add_response('start_build', {'build': {'id': build_id}}, params)
+
+
+def test_pushes_off_the_branch_are_skipped(stubs):
+    event = push({'ref': 'refs/heads/feature', 'commit': NEW},
+                 {'ref': 'refs/tags/v1', 'commit': NEW},
+                 {'ref': 'refs/heads/master', 'commit': OLD, 'deleted': True})
+    assert build_trigger.lambda_handler(event, None)['action'] == 'skipped'
+
+
+def test_push_starts_a_build(stubs):
+    codebuild, _ = stubs
+    expect_running(codebuild)
+    expect_start(codebuild, NEW)
+    result = build_trigger.lambda_handler(push({'ref': 'refs/heads/master', 'commit': NEW}), None)
+    assert result == {'action': 'started', 'build': 'site:new', 'commit': NEW}
+
+
+def test_push_of_a_commit_already_building_is_skipped(stubs):
+    codebuild, _ = stubs
+    expect_running(codebuild, build('site:1', NEW))
+    result = build_trigger.lambda_handler(push({'ref': 'refs/heads/master', 'commit': NEW}), None)
+    assert result['action'] == 'skipped' and result['reason'] == 'already building'
+
+
+def test_cancel_stops_the_running_build(stubs, monkeypatch):
+    monkeypatch.setattr(build_trigger, 'MODE', 'cancel')
+    codebuild, _ = stubs
+    expect_running(codebuild, build('site:1', OLD))
+    codebuild.add_response('stop_build', {'build': {'id': 'site:1'}}, {'id': 'site:1'})
+    expect_start(codebuild, NEW)
+    result = build_trigger.lambda_handler(push({'ref': 'refs/heads/master', 'commit': NEW}), None)
+    assert result['action'] == 'started' and result['superseded'] == ['site:1']
+
+
+def test_queue_leaves_the_running_build(stubs, monkeypatch):
+    monkeypatch.setattr(build_trigger, 'MODE', 'queue')
+    codebuild, _ = stubs
+    expect_running(codebuild, build('site:1', OLD, phase='PROVISIONING'))
+    result = build_trigger.lambda_handler(push({'ref': 'refs/heads/master', 'commit': NEW}), None)
+    assert result == {'action': 'queued', 'commit': NEW}
+
+
+def test_coalesce_restarts_a_build_still_provisioning(stubs, monkeypatch):
+    monkeypatch.setattr(build_trigger, 'MODE', 'coalesce')
+    codebuild, _ = stubs
+    expect_running(codebuild, build('site:1', OLD, phase='DOWNLOAD_SOURCE'))
+    codebuild.add_response('stop_build', {'build': {'id': 'site:1'}}, {'id': 'site:1'})
+    expect_start(codebuild, NEW)
+    result = build_trigger.lambda_handler(push({'ref': 'refs/heads/master', 'commit': NEW}), None)
+    assert result['action'] == 'started' and result['superseded'] == ['site:1']
+
+
+def test_coalesce_queues_behind_a_build_already_rendering(stubs, monkeypatch):
+    monkeypatch.setattr(build_trigger, 'MODE', 'coalesce')
+    codebuild, _ = stubs
+    expect_running(codebuild, build('site:1', OLD, phase='BUILD'))
+    result = build_trigger.lambda_handler(push({'ref': 'refs/heads/master', 'commit': NEW}), None)
+    assert result == {'action': 'queued', 'commit': NEW}
+
+
+def test_finished_build_restarts_the_branch_head(stubs):
+    codebuild, codecommit = stubs
+    expect_running(codebuild)
+    codecommit.add_response('get_branch', {'branch': {'branchName': 'master', 'commitId': NEW}},
+                            {'repositoryName': 'site', 'branchName': 'master'})
+    codebuild.add_response('batch_get_builds', {'builds': [build('site:1', OLD, 'COMPLETED', 'SUCCEEDED')]},
+                           {'ids': ['site:1']})
+    expect_start(codebuild, NEW, pushed_at=None)
+    result = build_trigger.lambda_handler(finished('site:1'), None)
+    assert result == {'action': 'started', 'build': 'site:new', 'commit': NEW}
+
+
+def test_finished_build_of_the_head_starts_nothing(stubs):
+    codebuild, codecommit = stubs
+    expect_running(codebuild)
+    codecommit.add_response('get_branch', {'branch': {'branchName': 'master', 'commitId': NEW}},
+                            {'repositoryName': 'site', 'branchName': 'master'})
+    codebuild.add_response('batch_get_builds', {'builds': [build('site:1', NEW, 'COMPLETED', 'FAILED')]},
+                           {'ids': ['site:1']})
+    result = build_trigger.lambda_handler(finished('site:1', 'FAILED'), None)
+    assert result['action'] == 'skipped' and result['reason'] == 'head already built'
+
+
+def test_finished_build_waits_for_a_running_one(stubs):
+    codebuild, _ = stubs
+    expect_running(codebuild, build('site:2', NEW))
+    result = build_trigger.lambda_handler(finished('site:1'), None)
+    assert result['action'] == 'skipped' and result['reason'] == 'another build is running'
+
+
+def test_events_of_other_projects_are_ignored(stubs):
+    result = build_trigger.lambda_handler(finished('other:1', project='other'), None)
+    assert result['action'] == 'skipped'
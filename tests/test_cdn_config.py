@@ -0,0 +1,77 @@
+import types
+import itertools
+import pytest
+import cdn_config
+import settings
+from multisite import defaults_from
+
+CERT = 'arn:aws:acm:us-east-1:123456789012:certificate/example'
+FUNCTION = 'arn:aws:cloudfront::123456789012:function/example-redirects'
+
+
+def site(**overrides):
+    var = dict(defaults_from(settings), region='eu-west-1', proj_name='example', website_fqdn='www.example.com')
+    var.update(overrides)
+    return types.SimpleNamespace(**var)
+
+
+COMBINATIONS = list(itertools.product(
+    ['http2and3', 'http3', 'http2', 'http1.1'],
+    ['', 'auto', 'us-east-1'],
+    ['TLSv1.2_2021', 'TLSv1.2_2019', 'TLSv1'],
+    [('404.html', 300), ('/errors/missing.html', 0), ('', 60)],
+    [None, FUNCTION]
+))
+
+
+@pytest.mark.parametrize('http_version,origin_shield,min_tls_version,errors,function_arn', COMBINATIONS)
+def test_settings_make_a_valid_distribution_config(http_version, origin_shield, min_tls_version, errors,
+                                                   function_arn):
+    error_page, error_caching_ttl = errors
+    var = site(http_version=http_version, origin_shield=origin_shield, min_tls_version=min_tls_version,
+               error_page=error_page, error_caching_ttl=error_caching_ttl)
+    distribution_config = cdn_config.validate(cdn_config.config(var, CERT, 'ref', function_arn=function_arn))
+    # and a distribution made from it has not drifted from the settings
+    assert cdn_config.differences(var, distribution_config, function_arn) == []
+
+
+def test_origin_shield():
+    assert cdn_config.origin(site())['OriginShield'] == {'Enabled': False}
+    assert cdn_config.origin(site(origin_shield='auto'))['OriginShield'] == \
+        {'Enabled': True, 'OriginShieldRegion': 'eu-west-1'}
+    assert cdn_config.origin(site(origin_shield='ap-south-1'))['OriginShield'] == \
+        {'Enabled': True, 'OriginShieldRegion': 'ap-south-1'}
+
+
+def test_error_responses():
+    items = cdn_config.custom_error_responses(site(error_page='404.html', error_caching_ttl=300))['Items']
+    assert [(item['ErrorCode'], item.get('ResponsePagePath'), item['ErrorCachingMinTTL']) for item in items] == [
+        (403, '/404.html', 300), (404, '/404.html', 300),
+        (500, None, 5), (502, None, 5), (503, None, 5), (504, None, 5)]
+    bare = cdn_config.custom_error_responses(site(error_page=''))['Items']
+    assert not any('ResponsePagePath' in item for item in bare)
+
+
+@pytest.mark.parametrize('overrides', [
+    {'http_version': 'http4'},
+    {'min_tls_version': 'SSLv3'},
+    {'min_tls_version': 'TLSv1.4'},
+    {'origin_shield': 'eu-north-1'},
+    {'origin_shield': 'auto', 'region': 'eu-north-1'},
+    {'error_caching_ttl': -1},
+    {'error_caching_ttl': 1.5},
+    {'cache_policy': 'CachingEverything'}
+])
+def test_invalid_settings_are_refused(overrides):
+    with pytest.raises(ValueError):
+        cdn_config.config(site(**overrides), CERT, 'ref')
+
+
+def test_validate_catches_what_the_api_would_refuse():
+    distribution_config = cdn_config.config(site(), CERT, 'ref')
+    distribution_config['CustomErrorResponses']['Items'][0]['ErrorCode'] = '404'
+    del distribution_config['ViewerCertificate']['SSLSupportMethod']
+    distribution_config['DefaultCacheBehavior']['TargetOriginId'] = None
+    with pytest.raises(ValueError) as raised:
+        cdn_config.validate(distribution_config)
+    assert 'ErrorCode' in str(raised.value) and 'TargetOriginId' in str(raised.value)
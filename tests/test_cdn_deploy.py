@@ -0,0 +1,80 @@
+import types
+import datetime
+import pytest
+from botocore.stub import Stubber
+import aws
+import cdn_config
+import readiness
+import settings
+import setup
+from multisite import defaults_from
+from state import State
+
+DIST_ID = 'E2EXAMPLE'
+CERT = 'arn:aws:acm:us-east-1:123456789012:certificate/example'
+
+
+@pytest.fixture
+def cloudfront(monkeypatch):
+    client = aws.session().client('cloudfront', region_name='us-east-1')
+    monkeypatch.setitem(aws._clients, ('cloudfront', None), client)
+    # poll again straight away
+    monkeypatch.setattr(readiness, 'backoff', lambda attempt, base, cap: 0)
+    with Stubber(client) as stubber:
+        yield stubber
+        stubber.assert_no_pending_responses()
+
+
+def site(**overrides):
+    return types.SimpleNamespace(**dict(defaults_from(settings), proj_name='example',
+                                        website_fqdn='www.example.com', **overrides))
+
+
+def polled(stubber, status, changed_ago):
+    modified = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=changed_ago)
+    stubber.add_response('get_distribution', {'Distribution': {
+        'Id': DIST_ID, 'ARN': 'arn:aws:cloudfront::123456789012:distribution/'+DIST_ID, 'Status': status,
+        'LastModifiedTime': modified, 'InProgressInvalidationBatches': 0, 'DomainName': 'd111.cloudfront.net',
+        'DistributionConfig': cdn_config.config(site(), CERT, 'ref')
+    }}, {'Id': DIST_ID})
+
+
+def test_latency_is_taken_when_the_deploy_is_first_seen_done(cloudfront, capsys):
+    for status in ('InProgress', 'InProgress', 'Deployed'):
+        polled(cloudfront, status, 100)
+    out = setup.track_cdn_deploy(site(wait_for_cdn=True), {'cdn_dist_id': DIST_ID})
+    assert out['cdn_deployed']
+    assert 100 <= out['cdn_deploy_latency'] < 110
+    assert 'cdn deployed 10' in capsys.readouterr().out
+
+
+def test_a_deploy_already_done_has_no_latency(cloudfront, capsys):
+    polled(cloudfront, 'Deployed', 4 * 3600)
+    out = setup.track_cdn_deploy(site(wait_for_cdn=True), {'cdn_dist_id': DIST_ID})
+    assert out['cdn_deployed'] and out['cdn_deploy_latency'] is None
+    assert 'latency unknown (at most 1440' in capsys.readouterr().out
+
+
+def test_not_waiting_leaves_the_deploy_to_follow(cloudfront):
+    polled(cloudfront, 'InProgress', 5)
+    out = setup.track_cdn_deploy(site(wait_for_cdn=False), {'cdn_dist_id': DIST_ID})
+    assert not out['cdn_deployed'] and out['cdn_deploy_latency'] is None
+
+
+@pytest.mark.parametrize('statuses,changed_ago,measured', [
+    (['InProgress', 'Deployed'], 100, True),
+    # 'setup.py wait' run long after the deploy finished
+    (['Deployed'], 4 * 3600, False)
+])
+def test_wait_command(cloudfront, tmp_path, statuses, changed_ago, measured):
+    state = State(str(tmp_path / 'state.json'))
+    state.record('cdn', {'cdn_dist_id': DIST_ID})
+    for status in statuses:
+        polled(cloudfront, status, changed_ago)
+    assert setup.wait_command(state) == 0
+    recorded = state.outputs()
+    assert recorded['cdn_deployed']
+    if measured:
+        assert 100 <= recorded['cdn_deploy_latency'] < 110
+    else:
+        assert recorded['cdn_deploy_latency'] is None
@@ -0,0 +1,75 @@
+import json
+from conftest import load_handler
+
+invalidate_cdn = load_handler('invalidate_cdn', {'CDN_DIST_ID': 'ETEST'})
+
+
+def s3_record(key):
+    return {'eventSource': 'aws:s3', 'eventName': 'ObjectCreated:Put',
+            's3': {'bucket': {'name': 'www.example.com'}, 'object': {'key': key}}}
+
+
+def sqs_event(*batches):
+    # what the invalidation queue delivers: S3 notifications and sync.py
+    # messages in the bodies of a batch of messages
+    return {'Records': [{'eventSource': 'aws:sqs', 'body': json.dumps(body)} for body in batches]}
+
+
+def test_keys_from_direct_s3_notification():
+    event = {'Records': [s3_record('posts/a+b/index.html'), s3_record('caf%C3%A9.html')]}
+    assert invalidate_cdn.keys_from_event(event) == ['posts/a b/index.html', 'café.html']
+
+
+def test_keys_from_sqs_batch():
+    event = sqs_event({'Records': [s3_record('a.html'), s3_record('b/c.css')]},
+                      {'keys': ['d/index.html']},
+                      {'Records': [s3_record('e.js')]})
+    assert invalidate_cdn.keys_from_event(event) == ['a.html', 'b/c.css', 'd/index.html', 'e.js']
+
+
+def test_unserved_keys_are_not_invalidated():
+    keys = ['releases/20240101T000000Z/index.html', 'releases/20240101T000000Z/app.js', 'a.html']
+    assert invalidate_cdn.invalidation_paths(keys) == ['/a.html']
+
+
+def test_index_documents_invalidate_their_directory():
+    assert invalidate_cdn.invalidation_paths(['blog/index.html']) == ['/blog/', '/blog/index.html']
+
+
+def test_collapse_folds_a_crowded_directory():
+    paths = ['/blog/p%d.html' % n for n in range(11)] + ['/about.html']
+    assert invalidate_cdn.collapse(paths) == ['/about.html', '/blog/*']
+
+
+def test_collapse_keeps_a_directory_at_the_threshold():
+    paths = ['/blog/p%d.html' % n for n in range(10)]
+    assert invalidate_cdn.collapse(paths) == sorted(paths)
+
+
+def test_collapse_folds_upwards():
+    paths = ['/docs/v%d/p%d.html' % (v, n) for v in range(11) for n in range(11)]
+    assert invalidate_cdn.collapse(paths) == ['/docs/*']
+
+
+def test_root_is_never_folded():
+    paths = ['/p%d.html' % n for n in range(11)]
+    assert invalidate_cdn.collapse(paths) == sorted(paths)
+    assert invalidate_cdn.invalidation_paths(['p%d.html' % n for n in range(11)]) == sorted(paths)
+
+
+def test_too_many_wildcards_flush_everything():
+    keys = ['s%d/p%d.html' % (s, n) for s in range(invalidate_cdn.MAX_WILDCARDS + 1) for n in range(11)]
+    assert invalidate_cdn.invalidation_paths(keys) == ['/*']
+
+
+def test_wildcards_within_the_limit_are_kept():
+    keys = ['s%d/p%d.html' % (s, n) for s in range(invalidate_cdn.MAX_WILDCARDS) for n in range(11)]
+    paths = invalidate_cdn.invalidation_paths(keys)
+    assert paths == sorted('/s%d/*' % s for s in range(invalidate_cdn.MAX_WILDCARDS))
+
+
+def test_too_many_paths_flush_everything():
+    # spread so that no directory gets crowded
+    keys = ['d%d/p%d.html' % (d, n) for d in range(invalidate_cdn.MAX_PATHS // 10 + 1) for n in range(10)]
+    assert invalidate_cdn.invalidation_paths(keys) == ['/*']
+    assert invalidate_cdn.invalidation_paths(keys[:invalidate_cdn.MAX_PATHS]) != ['/*']
@@ -0,0 +1,67 @@
+import types
+import datetime
+import pytest
+from botocore.stub import Stubber
+from conftest import load_handler
+
+pipeline_metrics = load_handler('pipeline_metrics', {'BUILD_PROJECT_NAME': 'site', 'CDN_DIST_ID': 'E2EXAMPLE'})
+
+PUSHED = datetime.datetime(2024, 1, 15, 10, 0, 0, tzinfo=datetime.timezone.utc)
+CONTEXT = types.SimpleNamespace(get_remaining_time_in_millis=lambda: 300000)
+
+
+def at(seconds):
+    return PUSHED + datetime.timedelta(seconds=seconds)
+
+
+def build(pushed_at=None):
+    # submitted 5s after the push, synced from 60s to 90s
+    variables = [{'name': 'PUSHED_AT', 'value': pushed_at, 'type': 'PLAINTEXT'}] if pushed_at else []
+    return {
+        'id': 'site:1', 'startTime': at(5), 'endTime': at(95), 'resolvedSourceVersion': 'c0ffee',
+        'phases': [
+            {'phaseType': 'QUEUED', 'startTime': at(5), 'endTime': at(10)},
+            {'phaseType': 'INSTALL', 'startTime': at(10), 'endTime': at(60)},
+            {'phaseType': 'BUILD', 'startTime': at(60), 'endTime': at(90)}
+        ],
+        'environment': {'type': 'LINUX_CONTAINER', 'image': 'aws/codebuild/standard:7.0',
+                        'computeType': 'BUILD_GENERAL1_SMALL', 'environmentVariables': variables}
+    }
+
+
+@pytest.fixture
+def stubs():
+    codebuild, cloudfront = Stubber(pipeline_metrics.codebuild), Stubber(pipeline_metrics.cloudfront)
+    with codebuild, cloudfront:
+        yield codebuild, cloudfront
+        codebuild.assert_no_pending_responses()
+        cloudfront.assert_no_pending_responses()
+
+
+def record_of(stubs, found):
+    codebuild, cloudfront = stubs
+    codebuild.add_response('batch_get_builds', {'builds': [found]}, {'ids': ['site:1']})
+    cloudfront.add_response('list_invalidations', {'InvalidationList': {
+        'Marker': '', 'MaxItems': 100, 'IsTruncated': False, 'Quantity': 1,
+        'Items': [{'Id': 'I1', 'CreateTime': at(150), 'Status': 'Completed'}]
+    }}, {'DistributionId': 'E2EXAMPLE'})
+    event = {'detail': {'project-name': 'site', 'build-status': 'SUCCEEDED', 'build-id': 'site:1'}}
+    return pipeline_metrics.lambda_handler(event, CONTEXT)
+
+
+def declared(record):
+    return [metric['Name'] for metric in record['_aws']['CloudWatchMetrics'][0]['Metrics']]
+
+
+def test_a_pushed_build_is_timed_from_the_push(stubs):
+    record = record_of(stubs, build(pushed_at='2024-01-15T10:00:00.000+0000'))
+    assert record['Trigger'] == 5000 and record['Invalidation'] == 60000
+    assert 'PushToLive' in declared(record)
+    assert 'BuildToLive' not in record and 'BuildToLive' not in declared(record)
+
+
+def test_a_queued_push_build_is_timed_from_its_submission(stubs):
+    record = record_of(stubs, build())
+    assert 'BuildToLive' in declared(record)
+    assert record['BuildToLive'] >= 0
+    assert 'Trigger' not in record and 'PushToLive' not in record
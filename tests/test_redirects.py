@@ -0,0 +1,103 @@
+import shutil
+import pytest
+import profiles
+import redirects
+import setup
+import sync
+from standin import StandIn
+from scenarios import seed_account, site_settings, connect, provision, redirect_rules
+from redirect_matcher import node_run
+
+RULES = '''
+/about-us          /about
+/blog/*            /posts/:splat
+/blog/2019/*       /archive/2019/:splat   302
+/docs              https://docs.example.com/   302
+'''
+
+
+def entries(text):
+    return redirects.store_entries(redirects.Index(redirects.parse(text)))
+
+
+@pytest.fixture
+def site():
+    # a provisioned site with a redirects function and its store, and
+    # the calls made to them from then on
+    standin = StandIn(profiles.get('instant'))
+    seed_account(standin)
+    var = site_settings(redirects_file= '_redirects')
+    connect(standin)
+    _, out, _ = provision(var)
+    session = connect(standin)
+    calls = []
+
+    def record(model, **kwargs):
+        calls.append(model.name)
+    session.events.register('before-call.cloudfront', record)
+    session.events.register('before-call.cloudfront-keyvaluestore', record)
+    cloudfront, kvs = session.client('cloudfront'), session.client('cloudfront-keyvaluestore')
+
+    def publish(rules):
+        return sync.publish_redirects(cloudfront, out['cdn_dist_id'], rules, kvs)
+    store = standin.kv_stores[setup.redirects_store_name(var)]
+    function = standin.cdn_functions[setup.redirects_function_name(var)]
+    return publish, store, function, calls
+
+
+def test_rules_are_keyed_by_path():
+    assert entries(RULES) == {
+        '/about-us': '"/about"',
+        '/blog/*': '"/posts/:splat"',
+        '/blog/2019/*': '[302,"/archive/2019/:splat"]',
+        '/docs': '[302,"https://docs.example.com/"]'
+    }
+    # the code only holds the depths of the splat rules, longest first
+    assert b'var DEPTHS = [2,1];' in redirects.function_code(entries(RULES), 'store')
+    assert b'var STORE = null;' in redirects.function_code({}, 'store')
+
+
+def test_a_file_over_what_a_store_holds_is_refused(monkeypatch):
+    with pytest.raises(ValueError):
+        entries('/%s /about' % ('a' * redirects.MAX_KEY_SIZE))
+    monkeypatch.setattr(redirects, 'MAX_STORE_SIZE', 100)
+    with pytest.raises(ValueError):
+        entries(RULES)
+
+
+def test_publishing_updates_only_what_changed(site):
+    publish, store, function, calls = site
+    assert publish(entries(RULES))
+    assert store['items'] == entries(RULES)
+    assert b'cf.kvs("'+store['Id'].encode('utf-8')+b'")' in function['live']
+    # new and changed rules are in the store before the code changes,
+    # the rules that are gone are only deleted after
+    del calls[:]
+    assert publish(entries('/about-us /company\n/blog/* /posts/:splat'))
+    assert store['items'] == {'/about-us': '"/company"', '/blog/*': '"/posts/:splat"'}
+    updates = [n for n, name in enumerate(calls) if name == 'UpdateKeys']
+    assert updates[0] < calls.index('PublishFunction') < updates[-1]
+    del calls[:]
+    assert not publish(entries('/about-us /company\n/blog/* /posts/:splat'))
+    assert 'UpdateKeys' not in calls and 'UpdateFunction' not in calls
+    # a splat rule at a new depth needs new code
+    assert publish(entries('/about-us /company\n/blog/* /posts/:splat\n/blog/2019/* /archive/:splat'))
+    assert 'UpdateFunction' in calls
+
+
+def test_thousands_of_rules_fit(site):
+    publish, store, _, _ = site
+    rules = entries('\n'.join('%s %s %d' % (rule.source, rule.target, rule.status)
+                              for rule in redirect_rules(5000)))
+    assert publish(rules)
+    assert store['items'] == rules
+    assert publish({}) and store['items'] == {}
+
+
+@pytest.mark.skipif(shutil.which('node') is None, reason='needs node')
+def test_the_function_answers_as_the_index():
+    index = redirects.Index(redirects.parse(RULES + '\n/* /home/:splat 307'))
+    paths = ['/about-us', '/about-us/', '/blog/hello', '/blog/2019/a/b', '/blog', '/docs', '/', '/elsewhere/x']
+    code = redirects.function_code(redirects.store_entries(index), 'store')
+    answered = node_run(shutil.which('node'), redirects.store_entries(index), code, paths, rounds=1)
+    assert [tuple(found) if found else None for found in answered['sample']] == [index.match(path) for path in paths]
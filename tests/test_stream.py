@@ -0,0 +1,94 @@
+import os
+import types
+import subprocess
+import pytest
+import aws
+import buildspec
+import profiles
+import settings
+import sync
+from multisite import defaults_from
+from standin import StandIn
+from scenarios import seed_account, site_settings, connect, provision, generate_site, edit_site, render_command
+
+WRITES = ('PutObject', 'CreateMultipartUpload', 'UploadPart', 'CompleteMultipartUpload', 'CopyObject',
+          'DeleteObject', 'DeleteObjects')
+
+
+@pytest.fixture
+def site(tmp_path):
+    # a provisioned release site serving release-0, and the source of its
+    # next render with a few pages and assets edited
+    standin = StandIn(profiles.get('instant'))
+    seed_account(standin)
+    var = site_settings(deploy_mode= 'release')
+    connect(standin)
+    _, out, _ = provision(var)
+    connect(standin)
+    source = str(tmp_path / 'source')
+    generate_site(source, 300)
+    manifest = str(tmp_path / 'manifest.json')
+    deploy(var, out, source, manifest, 'release-0')
+    edit_site(source, changed=20, added=5, removed=5)
+    calls = []
+
+    def record(params, model, **kwargs):
+        calls.append((model.name, params.get('Key', ''), params))
+    aws.session().events.register('before-parameter-build.s3', record)
+    aws.session().events.register('before-parameter-build.cloudfront', record)
+    return types.SimpleNamespace(standin=standin, var=var, out=out, source=source, manifest=manifest,
+                                 calls=calls, tmp_path=tmp_path)
+
+
+def deploy(var, out, site_dir, manifest, release_id, command=None):
+    session = aws.session()
+    options = dict(scan_interval=0.05, settle=0.05) if command else {}
+    return sync.deploy_release(site_dir, var.website_fqdn, release_id, command=command, dist_id=out['cdn_dist_id'],
+                               switch=True, wait=False, s3=session.client('s3'),
+                               cloudfront=session.client('cloudfront'), manifest_path=manifest,
+                               log=lambda msg: None, **options)
+
+
+def live(site):
+    return sync.origin_release(site.standin.distributions[site.out['cdn_dist_id']]['config'])
+
+
+def test_nothing_served_changes_before_the_switch(site):
+    site_dir = str(site.tmp_path / 'public')
+    command = render_command(site.source, site_dir, 1.0)
+    _, changed, removed, switched = deploy(site.var, site.out, site_dir, site.manifest, 'release-1', command)
+    assert switched and live(site) == 'release-1'
+    assert changed and removed
+    switch = [n for n, (operation, _, _) in enumerate(site.calls) if operation == 'UpdateDistribution']
+    assert len(switch) == 1
+    before = [(operation, key) for operation, key, _ in site.calls[:switch[0]] if operation in WRITES]
+    # pages and assets all went into the new release, the unchanged ones
+    # copied from release-0, before the cdn was pointed at it
+    assert before and all(key.startswith(sync.release_prefix('release-1')) for _, key in before)
+    assert any(key.endswith('.html') for _, key in before)
+    assert any(operation == 'CopyObject' for operation, _ in before)
+    stored = site.standin.buckets[site.var.website_fqdn]['objects']
+    release = set(key for key in stored if key.startswith(sync.release_prefix('release-1')))
+    assert not any(operation in WRITES and key in release for operation, key, _ in site.calls[switch[0]:])
+
+
+def test_failed_render_leaves_the_site_as_it_was(site):
+    site_dir = str(site.tmp_path / 'public')
+    command = render_command(site.source, site_dir, 0.5)
+    command[2] += '\nsys.exit(3)'
+    with pytest.raises(subprocess.CalledProcessError):
+        deploy(site.var, site.out, site_dir, site.manifest, 'release-1', command)
+    assert live(site) == 'release-0'
+    assert not any(operation == 'UpdateDistribution' for operation, _, _ in site.calls)
+    stored = site.standin.buckets[site.var.website_fqdn]['objects']
+    assert not any(key.startswith(sync.release_prefix('release-1')) for key in stored)
+
+
+def test_streaming_in_place_is_refused():
+    var = types.SimpleNamespace(**dict(defaults_from(settings), sync_mode='stream', deploy_mode='inplace'))
+    with pytest.raises(ValueError):
+        buildspec.sync_mode(var)
+    var.deploy_mode = 'release'
+    assert buildspec.sync_mode(var) == 'stream'
+    with pytest.raises(SystemExit):
+        sync.main(['public', 'www.example.com', '--stream', '--', 'hugo'])
@@ -0,0 +1,123 @@
+import os
+import copy
+import gzip
+import shutil
+import boto3
+import pytest
+import profiles
+import sync
+from botocore.config import Config
+from standin import StandIn
+from upload_rules import Rules
+from scenarios import generate_site, edit_site
+
+# a tree the size of a real site, synced against the bench's in-process
+# stand-in for S3
+FILES = 10000
+BUCKET = 'www.example.com'
+
+
+def stand_in(buckets=None):
+    standin = StandIn(profiles.get('instant'))
+    session = boto3.session.Session(region_name='us-east-1', aws_access_key_id='test',
+                                    aws_secret_access_key='test')
+    standin.install(session)
+    s3 = session.client('s3', config=Config(max_pool_connections=20))
+    if buckets is None:
+        s3.create_bucket(Bucket= BUCKET)
+    else:
+        standin.buckets = copy.deepcopy(buckets)
+    return standin, s3
+
+
+def run(s3, site_dir, manifest_path, **kwargs):
+    return sync.sync(site_dir, BUCKET, manifest_path=manifest_path, s3=s3, log=lambda msg: None, **kwargs)
+
+
+def stored(standin):
+    return set(standin.buckets[BUCKET]['objects'])
+
+
+@pytest.fixture(scope='module')
+def site(tmp_path_factory):
+    site_dir = str(tmp_path_factory.mktemp('site'))
+    generate_site(site_dir, FILES)
+    return site_dir
+
+
+@pytest.fixture(scope='module')
+def first_sync(site, tmp_path_factory):
+    # the whole tree uploaded once, shared by the tests that only read it
+    standin, s3 = stand_in()
+    manifest = str(tmp_path_factory.mktemp('cache') / 'manifest.json')
+    result = run(s3, site, manifest)
+    return standin, s3, manifest, result, dict(standin.calls)
+
+
+@pytest.fixture
+def synced(first_sync):
+    standin, s3, manifest, _, _ = first_sync
+    standin.reset_counters()
+    return standin, s3, manifest
+
+
+def test_first_sync_uploads_the_whole_tree(site, first_sync):
+    standin, _, manifest, (changed, removed), calls = first_sync
+    assert len(changed) == FILES and removed == []
+    assert stored(standin) == set(sync.scan(site))
+    assert calls['s3.PutObject'] == FILES
+    assert os.path.exists(manifest)
+
+
+def test_unchanged_tree_uploads_nothing(site, synced):
+    standin, s3, manifest = synced
+    assert run(s3, site, manifest) == ([], [])
+    # answered from the manifest, the bucket is not even listed
+    assert dict(standin.calls) == {}
+
+
+def test_unchanged_tree_without_a_manifest_lists_the_bucket(site, synced):
+    standin, s3, _ = synced
+    assert run(s3, site, None) == ([], [])
+    assert set(standin.calls) == {'s3.ListObjectsV2'}
+
+
+def test_edits_upload_and_delete_only_what_changed(site, first_sync, tmp_path):
+    # on a copy of the synced tree and bucket, the others stay as they are
+    standin, s3 = stand_in(first_sync[0].buckets)
+    edited = str(tmp_path / 'site')
+    shutil.copytree(site, edited)
+    manifest = str(tmp_path / 'manifest.json')
+    shutil.copy(first_sync[2], manifest)
+    before = set(sync.scan(edited))
+    edit_site(edited, changed=25, added=5, removed=10)
+    after = set(sync.scan(edited))
+    changed, removed = run(s3, edited, manifest)
+    assert sorted(removed) == sorted(before - after)
+    assert after - before <= set(changed) and len(changed) == 30
+    assert standin.calls['s3.PutObject'] == 30
+    assert stored(standin) == after
+    assert run(s3, edited, manifest) == ([], [])
+
+
+def test_dry_run_changes_nothing(site, tmp_path):
+    standin, s3 = stand_in()
+    changed, removed = run(s3, site, str(tmp_path / 'manifest.json'), dry_run=True)
+    assert len(changed) == FILES and removed == []
+    assert stored(standin) == set()
+    assert not os.path.exists(str(tmp_path / 'manifest.json'))
+
+
+def test_text_is_stored_gzipped_for_every_viewer(site, synced):
+    standin, _, _ = synced
+    objects = standin.buckets[BUCKET]['objects']
+    pages = [obj for key, obj in objects.items() if key.endswith('.html')]
+    assert pages and all(obj['ContentEncoding'] == 'gzip' for obj in pages)
+    with open(os.path.join(site, pages[0]['Key']), 'rb') as page:
+        assert gzip.decompress(pages[0]['Body']) == page.read()
+    # the cdn serves the stored copy as is, so nothing only some viewers
+    # can decode is stored
+    with pytest.raises(ValueError):
+        Rules(encoding='br')
+    with pytest.raises(SystemExit):
+        sync.main([site, BUCKET, '--encoding', 'br'])